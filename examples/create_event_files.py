@@ -5,6 +5,7 @@ from os import path
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"  # see issue #152
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
 from factnn import ProtonPreprocessor, GammaPreprocessor, GammaDiffusePreprocessor
+from factnn.data.dataset.photon_stream_files import find_photon_stream_files
 import os
 
 from multiprocessing import Pool
@@ -26,12 +27,7 @@ shape = [30, 70]
 rebin_size = 5
 
 # Get paths from the directories
-gamma_paths = []
-for directory in gamma_dir:
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.endswith("phs.jsonl.gz"):
-                gamma_paths.append(os.path.join(root, file))
+gamma_paths = find_photon_stream_files(gamma_dir)
 print(len(gamma_paths))
 
 
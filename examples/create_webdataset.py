@@ -17,15 +17,13 @@ import torch
 from torch_geometric.data import Dataset
 from torch_geometric.data import Data
 
-from photon_stream.representations import (
-    list_of_lists_to_raw_phs,
-    raw_phs_to_point_cloud,
-)
-from photon_stream.geometry import GEOMETRY
 import photon_stream as ps
 import random
 
 from factnn.utils.augment import euclidean_distance, true_sign
+from factnn.data.preprocess import photons
+from factnn.data.dataset.event_store import load_event
+from factnn.data.dataset.event_record import RECORD_SUFFIX, load_cleaning_masks
 from multiprocessing import Manager, Queue, Pool
 
 
@@ -75,159 +73,125 @@ def get_single_example(p, num, proton_paths, gamma_paths):
     puncleaned = "/run/media/jacob/data/FACT_Torch/no_clean/raw/"
     pcore = f"/run/media/jacob/data/FACT_Torch/dumping/protonFeature/core{num}/"
     pclump = f"/run/media/jacob/data/FACT_Torch/dumping/protonFeature/clump{num}/"
-    if os.path.exists(os.path.join(core, p)) and p in gamma_paths:
+    if (os.path.exists(os.path.join(core, p)) or os.path.exists(os.path.join(uncleaned, p + RECORD_SUFFIX))) and p in gamma_paths:
         raw_path = os.path.join(core, p)
         clump_path = os.path.join(clump, p)
         uncleaned_path = os.path.join(uncleaned, p)
         is_gamma = True
-    elif os.path.exists(os.path.join(pcore, p)) and p in proton_paths:
+    elif (os.path.exists(os.path.join(pcore, p)) or os.path.exists(os.path.join(puncleaned, p + RECORD_SUFFIX))) and p in proton_paths:
         raw_path = os.path.join(pcore, p)
         clump_path = os.path.join(pclump, p)
         uncleaned_path = os.path.join(puncleaned, p)
         is_gamma = False
     try:
-        with open(raw_path, "rb") as pickled_event:
-            with open(uncleaned_path, "rb") as pickled_original:
+        record_path = uncleaned_path + RECORD_SUFFIX
+        if os.path.exists(record_path):
+            # One event record holds the uncleaned photons and which of them each cleaning keeps
+            event_data, data_format, features, _ = load_event(record_path, flat=True, cleaning=f"core{num}")
+            uncleaned_data, _, _, _ = load_event(record_path, flat=True)
+            masks = load_cleaning_masks(record_path)
+            # Convert to ints so that addition works, gives 0 for outside, 1 clump, 2 core
+            point_values = masks[f"core{num}"].astype(int) + masks[f"clump{num}"]
+        else:
+            event_data, data_format, features, _ = load_event(raw_path, flat=True)
+            uncleaned_data, _, _, _ = load_event(uncleaned_path, flat=True)
+            clump_data, _, _, _ = load_event(clump_path, flat=True)
+            uncleaned_photons = uncleaned_data[data_format["Image"]]
+            # Convert to ints so that addition works, gives 0 for outside, 1 clump, 2 core
+            point_values = photons.matching_photons(
+                *uncleaned_photons, *event_data[data_format["Image"]]
+            ).astype(int) + photons.matching_photons(
+                *uncleaned_photons, *clump_data[data_format["Image"]]
+            )
+        point_values = torch.from_numpy(point_values)
+        uncleaned_cloud = photons.point_cloud(*uncleaned_data[data_format["Image"]])
+        energy = torch.tensor(
+            [event_data[data_format["Energy"]]],
+            dtype=torch.long,
+        )
+        phi = torch.tensor(
+            [event_data[4]],
+            dtype=torch.long,  # Needed because most the proton events had the wrong data_format
+        )
+        theta = torch.tensor(
+            [event_data[5]],
+            dtype=torch.long,  # Needed because most the proton events had the wrong data_format
+        )
+        # Now add the features from the feature extraction
+        if (
+                features["extraction"] == 1
+        ):  # Failed extraction, so has no features to use
+            feature_list = []
+        else:
+            feature_list = []
+            feature_list.append(features["head_tail_ratio"])
+            feature_list.append(features["length"])
+            feature_list.append(features["width"])
+            feature_list.append(features["time_gradient"])
+            feature_list.append(features["number_photons"])
+            feature_list.append(
+                features["length"] * features["width"] * np.pi
+            )
+            feature_list.append(
                 (
-                    event_data,
-                    data_format,
-                    features,
-                    feature_cluster,
-                ) = pickle.load(pickled_event)
-                uncleaned_data, _, _, _ = pickle.load(pickled_original)
-                uncleaned_photons = uncleaned_data[data_format["Image"]]
-                uncleaned_photons = list_of_lists_to_raw_phs(uncleaned_photons)
-                uncleaned_cloud = np.asarray(
-                    raw_phs_to_point_cloud(
-                        uncleaned_photons,
-                        cx=GEOMETRY.x_angle,
-                        cy=GEOMETRY.y_angle,
-                    )
-                )
-                # Convert List of List to Point Cloud
-                event_photons = event_data[data_format["Image"]]
-                event_photons = list_of_lists_to_raw_phs(event_photons)
-                point_cloud = np.asarray(
-                    raw_phs_to_point_cloud(
-                        event_photons, cx=GEOMETRY.x_angle, cy=GEOMETRY.y_angle
-                    )
-                )
-                out = np.where(
-                    (uncleaned_cloud == point_cloud[:, None]).all(-1)
-                )[1]
-                point_values = np.zeros(uncleaned_cloud.shape)
-                point_values[out] = 1
-
-                with open(clump_path, "rb") as pickled_clump:
-                    clump_data, _, _, _ = pickle.load(pickled_clump)
-                    clump_photons = clump_data[data_format["Image"]]
-                    clump_photons = list_of_lists_to_raw_phs(clump_photons)
-                    clump_cloud = np.asarray(
-                        raw_phs_to_point_cloud(
-                            clump_photons,
-                            cx=GEOMETRY.x_angle,
-                            cy=GEOMETRY.y_angle,
-                        )
-                    )
-                    out = np.where(
-                        (uncleaned_cloud == clump_cloud[:, None]).all(-1)
-                    )[1]
-                    clump_values = np.zeros(uncleaned_cloud.shape)
-                    clump_values[out] = 1
-                    # clump_values = np.isclose(clump_cloud, point_cloud)
-                    # Convert to ints so that addition works, gives 0 for outside, 1 clump, 2 core
-                    point_values = point_values.astype(
-                        int
-                    ) + clump_values.astype(int)
-                    point_values = point_values[:, 0]
-                    point_values = torch.from_numpy(point_values)
-                energy = torch.tensor(
-                    [event_data[data_format["Energy"]]],
-                    dtype=torch.long,
+                        (features["length"] * features["width"] * np.pi)
+                        / np.log(features["number_photons"]) ** 2
                 )
-                phi = torch.tensor(
-                    [event_data[4]],
-                    dtype=torch.long,  # Needed because most the proton events had the wrong data_format
-                )
-                theta = torch.tensor(
-                    [event_data[5]],
-                    dtype=torch.long,  # Needed because most the proton events had the wrong data_format
+            )
+            feature_list.append(
+                (
+                        features["number_photons"]
+                        / (features["length"] * features["width"] * np.pi)
                 )
-                # Now add the features from the feature extraction
-                if (
-                        features["extraction"] == 1
-                ):  # Failed extraction, so has no features to use
-                    feature_list = []
-                else:
-                    feature_list = []
-                    feature_list.append(features["head_tail_ratio"])
-                    feature_list.append(features["length"])
-                    feature_list.append(features["width"])
-                    feature_list.append(features["time_gradient"])
-                    feature_list.append(features["number_photons"])
-                    feature_list.append(
-                        features["length"] * features["width"] * np.pi
-                    )
-                    feature_list.append(
-                        (
-                                (features["length"] * features["width"] * np.pi)
-                                / np.log(features["number_photons"]) ** 2
-                        )
-                    )
-                    feature_list.append(
-                        (
-                                features["number_photons"]
-                                / (features["length"] * features["width"] * np.pi)
+            )
+        is_diffuse = False
+        d_path = diffuse if is_gamma else pdiffuse
+        if os.path.exists(os.path.join(d_path, p)):
+            with open(os.path.join(d_path, p), "rb") as pickled_diffuse:
+                (
+                    diffuse_event_data,
+                    diffuse_data_format,
+                    features_d,
+                ) = pickle.load(pickled_diffuse)
+                try:
+                    # Try Diffuse
+                    disp = torch.tensor(
+                        [true_sign(
+                            diffuse_event_data[diffuse_data_format["Source_X"]],
+                            diffuse_event_data[diffuse_data_format["Source_Y"]],
+                            diffuse_event_data[diffuse_data_format["COG_X"]],
+                            diffuse_event_data[diffuse_data_format["COG_Y"]],
+                            diffuse_event_data[diffuse_data_format["Delta"]],
                         )
+                         * euclidean_distance(
+                            diffuse_event_data[diffuse_data_format["Source_X"]],
+                            diffuse_event_data[diffuse_data_format["Source_Y"]],
+                            diffuse_event_data[diffuse_data_format["COG_X"]],
+                            diffuse_event_data[diffuse_data_format["COG_Y"]],
+                        )],
+                        dtype=torch.float,
                     )
-                is_diffuse = False
-                d_path = diffuse if is_gamma else pdiffuse
-                if os.path.exists(os.path.join(d_path, p)):
-                    with open(os.path.join(d_path, p), "rb") as pickled_diffuse:
-                        (
-                            diffuse_event_data,
-                            diffuse_data_format,
-                            features_d,
-                        ) = pickle.load(pickled_diffuse)
-                        try:
-                            # Try Diffuse
-                            disp = torch.tensor(
-                                [true_sign(
-                                    diffuse_event_data[diffuse_data_format["Source_X"]],
-                                    diffuse_event_data[diffuse_data_format["Source_Y"]],
-                                    diffuse_event_data[diffuse_data_format["COG_X"]],
-                                    diffuse_event_data[diffuse_data_format["COG_Y"]],
-                                    diffuse_event_data[diffuse_data_format["Delta"]],
-                                )
-                                 * euclidean_distance(
-                                    diffuse_event_data[diffuse_data_format["Source_X"]],
-                                    diffuse_event_data[diffuse_data_format["Source_Y"]],
-                                    diffuse_event_data[diffuse_data_format["COG_X"]],
-                                    diffuse_event_data[diffuse_data_format["COG_Y"]],
-                                )],
-                                dtype=torch.float,
-                            )
-                            sign = torch.tensor(true_sign(
-                                diffuse_event_data[diffuse_data_format["Source_X"]],
-                                diffuse_event_data[diffuse_data_format["Source_Y"]],
-                                diffuse_event_data[diffuse_data_format["COG_X"]],
-                                diffuse_event_data[diffuse_data_format["COG_Y"]],
-                                diffuse_event_data[diffuse_data_format["Delta"]],
-                            ), dtype=torch.int)
-                            is_diffuse = True
-                        except Exception as e:
-                            print(f"Failed Diffuse Extraction With: {e}")
-                            disp = torch.zeros((1,))
-                            sign = torch.zeros((1,))
-                else:
+                    sign = torch.tensor(true_sign(
+                        diffuse_event_data[diffuse_data_format["Source_X"]],
+                        diffuse_event_data[diffuse_data_format["Source_Y"]],
+                        diffuse_event_data[diffuse_data_format["COG_X"]],
+                        diffuse_event_data[diffuse_data_format["COG_Y"]],
+                        diffuse_event_data[diffuse_data_format["Delta"]],
+                    ), dtype=torch.int)
+                    is_diffuse = True
+                except Exception as e:
+                    print(f"Failed Diffuse Extraction With: {e}")
                     disp = torch.zeros((1,))
                     sign = torch.zeros((1,))
-                points = torch.tensor(uncleaned_cloud, dtype=torch.float).squeeze()
-                print(f"Points: {points.shape}, Points Mask: {point_values.shape}, Values: {np.unique(point_values)} Gamma: {is_gamma}")
-                sample = {"__key__": p, "points.pth": points, "mask.pth": point_values,
-                          "features.pth": torch.tensor(feature_list, dtype=torch.float), "disp.pth": disp, "sign.pth": sign,
-                          "energy.pth": energy, "theta.pth": theta, "phi.pth": phi, "class.cls": int(is_gamma), "diffuse.cls": int(is_diffuse)}
-                return sample
+        else:
+            disp = torch.zeros((1,))
+            sign = torch.zeros((1,))
+        points = torch.tensor(uncleaned_cloud, dtype=torch.float).squeeze()
+        print(f"Points: {points.shape}, Points Mask: {point_values.shape}, Values: {np.unique(point_values)} Gamma: {is_gamma}")
+        sample = {"__key__": p, "points.pth": points, "mask.pth": point_values,
+                  "features.pth": torch.tensor(feature_list, dtype=torch.float), "disp.pth": disp, "sign.pth": sign,
+                  "energy.pth": energy, "theta.pth": theta, "phi.pth": phi, "class.cls": int(is_gamma), "diffuse.cls": int(is_diffuse)}
+        return sample
     except:
         print("Failed")
 
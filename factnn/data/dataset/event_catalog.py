@@ -0,0 +1,389 @@
+import os
+import sqlite3
+from multiprocessing import Pool
+from zlib import crc32
+
+import numpy as np
+
+from factnn.data.preprocess import photons
+from factnn.data.dataset.event_record import load_cleaning_masks
+from factnn.data.dataset.event_store import load_event
+
+VERSION = 1
+
+COLUMNS = (
+    ("path", "TEXT PRIMARY KEY"),
+    ("name", "TEXT NOT NULL"),
+    ("particle", "TEXT"),
+    # Comma separated, and starting and ending with a comma, so single cleanings can be found with instr
+    ("cleanings", "TEXT"),
+    ("mtime", "REAL"),
+    ("size", "INTEGER"),
+    # 'ok', 'empty' for empty Eventfiles or those without photons, 'error' for those that could not be read
+    ("status", "TEXT"),
+    ("energy", "REAL"),
+    ("zd", "REAL"),
+    ("az", "REAL"),
+    ("num_photons", "INTEGER"),
+    ("start_slice", "INTEGER"),
+    ("end_slice", "INTEGER"),
+    ("mean_slice", "REAL"),
+    ("std_slice", "REAL"),
+    ("extraction", "INTEGER"),
+    # Same value split_data uses to split by name, from 0 to 1
+    ("split_key", "REAL"),
+)
+_NAMES = [name for name, _ in COLUMNS]
+
+
+def split_key(name):
+    """
+    The value split_data in the pytorch datasets splits each event by, so the catalog gives the same splits
+
+    :param name: File name of the event
+    :return: Value from 0 to 1, the event is in the test set of a split with ratio r if it is below r
+    """
+    return (crc32(np.int64(crc32(str(name).encode()))) & 0xFFFFFFFF) / 2**32
+
+
+def catalog_row(path, particle=None, cleaning="no_clean"):
+    """
+    Reads one Eventfile or event record for the catalog
+
+    :param path: Path to the Eventfile or event record
+    :param particle: Particle type of the event, if None it is 'proton' or 'gamma' if that is in the path
+    :param cleaning: Which cleaning the Eventfile is, e.g. 'core20', event records list their own cleanings instead
+    :return: Dict of the value of each column
+    """
+    path = os.path.abspath(path)
+    if particle is None:
+        if "proton" in path:
+            particle = "proton"
+        elif "gamma" in path:
+            particle = "gamma"
+    stat = os.stat(path)
+    row = dict.fromkeys(_NAMES)
+    row.update(
+        path=path,
+        name=os.path.basename(path),
+        particle=particle,
+        cleanings="," + cleaning + ",",
+        mtime=stat.st_mtime,
+        size=stat.st_size,
+        status="ok",
+        split_key=split_key(os.path.basename(path)),
+    )
+    try:
+        event = load_event(path, flat=True)
+        if event is None:
+            row["status"] = "empty"
+            return row
+        data, data_format, features, _ = event
+        arrivals, offsets = data[data_format["Image"]]
+        start, end, mean, std = photons.arrival_window(arrivals, offsets)
+        masks = load_cleaning_masks(path)
+    except Exception as e:
+        print("Failed to catalog {}: {}".format(path, e))
+        row["status"] = "error"
+        return row
+    if masks is not None:
+        row["cleanings"] = ",".join(
+            [""]
+            + [cleaning]
+            + [name for name, mask in masks.items() if np.any(mask)]
+            + [""]
+        )
+    row.update(
+        energy=_value(data, data_format, "Energy"),
+        zd=_value(data, data_format, "Zd_Deg"),
+        az=_value(data, data_format, "Az_Deg"),
+        num_photons=int(offsets[-1] - offsets[0]),
+        start_slice=int(start[0]),
+        end_slice=int(end[0]),
+        mean_slice=float(mean[0]),
+        std_slice=float(std[0]),
+    )
+    if features is not None and "extraction" in features:
+        row["extraction"] = int(features["extraction"])
+    if start[0] < 0:
+        row["status"] = "empty"
+    return row
+
+
+def _catalog_row(arguments):
+    return catalog_row(*arguments)
+
+
+def _value(data, data_format, key):
+    if key not in data_format:
+        return None
+    return float(data[data_format[key]])
+
+
+class EventCatalog(object):
+    """
+    SQLite table with one row per Eventfile or event record, with its particle, energy, pointing, photon count, time
+    window, feature extraction status and cleanings, so events can be selected, split and balanced without opening
+    them
+
+    The catalog is filled in parallel and only reads the files that are new or changed since the last update
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the SQLite database, created if it does not exist
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, VERSION):
+            raise ValueError(
+                "{} is version {} of the event catalog, only version {} can be read".format(
+                    path, version, VERSION
+                )
+            )
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS events ({})".format(
+                    ", ".join(name + " " + kind for name, kind in COLUMNS)
+                )
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS events_name ON events (name)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS events_particle ON events (particle)"
+            )
+            self.connection.execute("PRAGMA user_version = {}".format(VERSION))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def __getstate__(self):
+        # The connection is opened again after unpickling
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def update(self, paths, particle=None, cleaning="no_clean", processes=None):
+        """
+        Adds the files that are not in the catalog, and reads again those changed since, by modification time and size
+
+        :param paths: Paths to the Eventfiles or event records
+        :param particle: Particle type of the events, if None it is 'proton' or 'gamma' if that is in each path
+        :param cleaning: Which cleaning the Eventfiles are, e.g. 'core20', event records list their own cleanings
+        :param processes: Number of processes to read the files with, defaults to the number of CPUs, 1 reads them
+        in this process
+        :return: Number of files read
+        """
+        known = dict(
+            (path, (mtime, size))
+            for path, mtime, size in self.connection.execute(
+                "SELECT path, mtime, size FROM events"
+            )
+        )
+        changed = []
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_mtime, stat.st_size):
+                changed.append((path, particle, cleaning))
+        if not changed:
+            return 0
+        if processes == 1:
+            rows = map(_catalog_row, changed)
+            self._insert(rows)
+        else:
+            with Pool(processes) as pool:
+                self._insert(pool.imap_unordered(_catalog_row, changed, chunksize=64))
+        return len(changed)
+
+    def update_directory(
+        self, directory, particle=None, cleaning="no_clean", processes=None
+    ):
+        """
+        Updates the catalog with every file under a directory, see update
+
+        :param directory: Directory with the Eventfiles or event records
+        :return: Number of files read
+        """
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            for file in files:
+                paths.append(os.path.join(root, file))
+        return self.update(paths, particle, cleaning, processes)
+
+    def remove_missing(self):
+        """
+        Removes the files that do not exist anymore
+        :return: Number of files removed
+        """
+        missing = [
+            (path,)
+            for (path,) in self.connection.execute("SELECT path FROM events")
+            if not os.path.exists(path)
+        ]
+        with self.connection:
+            self.connection.executemany("DELETE FROM events WHERE path = ?", missing)
+        return len(missing)
+
+    def _insert(self, rows):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO events ({}) VALUES ({})".format(
+                    ", ".join(_NAMES), ", ".join("?" * len(_NAMES))
+                ),
+                ([row[name] for name in _NAMES] for row in rows),
+            )
+
+    def rows(
+        self,
+        columns=("path",),
+        particle=None,
+        cleaning=None,
+        split=None,
+        val_split=0.2,
+        test_split=0.2,
+        directory=None,
+        extracted=None,
+        min_photons=None,
+        status="ok",
+        where=None,
+        parameters=(),
+        fraction=1.0,
+        seed=None,
+    ):
+        """
+        Selects events from the catalog, in path order
+
+        :param columns: Columns to return
+        :param particle: Only events of this particle type
+        :param cleaning: Only events with this cleaning, e.g. 'core20'
+        :param split: Only events of this split, one of 'train', 'val', 'test', 'trainval' or 'all', the same as
+        split_data on the file names with val_split and test_split
+        :param directory: Only events under this directory
+        :param extracted: If True only events with successful feature extraction, if False only those where it failed
+        :param min_photons: Only events with at least this many photons
+        :param status: Only events with this status, 'ok' by default, None for all
+        :param where: Extra SQL condition
+        :param parameters: Parameters of the extra SQL condition
+        :param fraction: If below 1.0, randomly takes this fraction of the events
+        :param seed: Seed for taking the fraction
+        :return: List of tuples of the columns
+        """
+        conditions = []
+        values = []
+        if particle is not None:
+            conditions.append("particle = ?")
+            values.append(particle)
+        if cleaning is not None:
+            # instr, not LIKE, so the _ and % in names are not wildcards
+            conditions.append("instr(cleanings, ?) > 0")
+            values.append("," + cleaning + ",")
+        if split is not None and split != "all":
+            bounds = {
+                "train": (val_split + test_split, 1.0),
+                "val": (val_split, val_split + test_split),
+                "test": (0.0, val_split),
+                "trainval": (val_split, 1.0),
+            }[split]
+            conditions.append("split_key >= ? AND split_key < ?")
+            values += bounds
+        if directory is not None:
+            prefix = os.path.join(os.path.abspath(directory), "")
+            conditions.append("substr(path, 1, length(?)) = ?")
+            values += [prefix, prefix]
+        if extracted is not None:
+            conditions.append("extraction IS NOT 1" if extracted else "extraction = 1")
+        if min_photons is not None:
+            conditions.append("num_photons >= ?")
+            values.append(min_photons)
+        if status is not None:
+            conditions.append("status = ?")
+            values.append(status)
+        if where is not None:
+            conditions.append("(" + where + ")")
+            values += list(parameters)
+        query = "SELECT {} FROM events".format(", ".join(columns))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        rows = self.connection.execute(query + " ORDER BY path", values).fetchall()
+        if 0.0 < fraction < 1.0:
+            rng = np.random.RandomState(seed)
+            keep = np.sort(
+                rng.choice(len(rows), size=int(fraction * len(rows)), replace=False)
+            )
+            rows = [rows[index] for index in keep]
+        return rows
+
+    def paths(self, **selection):
+        """
+        :param selection: Selection, see rows
+        :return: List of the paths of the selected events
+        """
+        return [path for (path,) in self.rows(("path",), **selection)]
+
+    def names(self, **selection):
+        """
+        :param selection: Selection, see rows
+        :return: List of the file names of the selected events
+        """
+        return [name for (name,) in self.rows(("name",), **selection)]
+
+    def balanced(
+        self, particles=("proton", "gamma"), column="name", seed=None, **selection
+    ):
+        """
+        Selects the same number of events of each particle type, randomly taken from the larger ones
+
+        :param particles: Particle types to balance
+        :param column: Column to return of each event
+        :param seed: Seed for taking the events
+        :param selection: Selection, see rows, fraction is applied after balancing
+        :return: Dict of the particle type to the list of the column of its events
+        """
+        fraction = selection.pop("fraction", 1.0)
+        selected = {
+            particle: [
+                value
+                for (value,) in self.rows((column,), particle=particle, **selection)
+            ]
+            for particle in particles
+        }
+        num_events = min(len(values) for values in selected.values())
+        if 0.0 < fraction < 1.0:
+            num_events = int(num_events * fraction)
+        rng = np.random.RandomState(seed)
+        return {
+            particle: [
+                values[index]
+                for index in np.sort(
+                    rng.choice(len(values), size=num_events, replace=False)
+                )
+            ]
+            for particle, values in selected.items()
+        }
+
+    def time_windows(self, paths):
+        """
+        The first and last arrival slice, and mean and standard deviation of the arrival slices of each event, as
+        dynamic_size gives them
+
+        :param paths: Paths of events in the catalog
+        :return: Dict of the path to (start, end, mean, std), -1 for all of them for events without photons
+        """
+        windows = {}
+        query = "SELECT path, start_slice, end_slice, mean_slice, std_slice FROM events WHERE path IN ({})"
+        paths = [os.path.abspath(path) for path in paths]
+        # SQLite limits the number of parameters of each query
+        for index in range(0, len(paths), 500):
+            chunk = paths[index : index + 500]
+            for path, start, end, mean, std in self.connection.execute(
+                query.format(", ".join("?" * len(chunk))), chunk
+            ):
+                if start is None:
+                    windows[path] = (-1, -1, -1, -1)
+                else:
+                    windows[path] = (start, end, mean, std)
+        return windows
@@ -5,6 +5,7 @@ sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"  # see issue #152
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
 from factnn import ProtonPreprocessor, GammaPreprocessor, GammaDiffusePreprocessor
+from factnn.data.dataset.photon_stream_files import find_photon_stream_files
 import os
 from multiprocessing import Pool
 from functools import partial
@@ -19,12 +20,7 @@ def process_diffuse_gamma_files(
     gamma_dl2="../gamma_simulations_diffuse_facttools_dl2.hdf5",
 ):
     # Get paths from the directories
-    paths = []
-    for directory in data_dir:
-        for root, dirs, files in os.walk(directory):
-            for file in files:
-                if file.endswith("phs.jsonl.gz"):
-                    paths.append(os.path.join(root, file))
+    paths = find_photon_stream_files(data_dir)
 
     def process_diffuse_gamma(clump_size, path):
         gamma_configuration = {
@@ -43,6 +39,11 @@ def process_diffuse_gamma_files(
             clump_size=clump_size,
         )
 
+    # Builds the DL2 index once, so the workers map the shared one instead of each reading the DL2 file
+    GammaDiffusePreprocessor(
+        config={"rebin_size": 5, "shape": [30, 70], "paths": [], "dl2_file": gamma_dl2}
+    )
+
     pool = Pool(num_workers)
     func = partial(process_diffuse_gamma, clump_size)
     jobs = pool.map_async(func, paths)
@@ -54,12 +55,7 @@ def process_gamma_files(
     data_dir="", output_dir="", clump_size=5, num_workers=12, hdf_file="../gamma.hdf5"
 ):
     # Get paths from the directories
-    paths = []
-    for directory in data_dir:
-        for root, dirs, files in os.walk(directory):
-            for file in files:
-                if file.endswith("phs.jsonl.gz"):
-                    paths.append(os.path.join(root, file))
+    paths = find_photon_stream_files(data_dir)
 
     def process_gamma(clump_size, path):
         print("Gamma")
@@ -87,12 +83,7 @@ def process_proton_files(
     data_dir="", output_dir="", clump_size=5, num_workers=12, hdf_file="../proton.hdf5"
 ):
     # Get paths from the directories
-    paths = []
-    for directory in data_dir:
-        for root, dirs, files in os.walk(directory):
-            for file in files:
-                if file.endswith("phs.jsonl.gz"):
-                    paths.append(os.path.join(root, file))
+    paths = find_photon_stream_files(data_dir)
 
     def process_proton(clump_size, path):
         proton_configuration = {
@@ -0,0 +1,453 @@
+import datetime
+import json
+import os
+import pickle
+import struct
+
+import numpy as np
+
+from factnn.data.preprocess import photons
+
+MAGIC = b"FEVT"
+# Version 1 stored every value of the data as float64, version 2 stores ints and datetimes as int64, and version 3
+# the cluster labels in the smallest type that holds them instead of always int8
+VERSION = 3
+RECORD_SUFFIX = ".evt"
+
+# magic, version, flags, length of the data, position of the image in it, number of features, bytes per cluster
+# label, number of photons, length of the names
+HEADER = struct.Struct("<4sHHHHHBxII")
+HAS_FEATURES = 1
+HAS_CLUSTER = 2
+HAS_CLEANING = 4
+
+# Smallest unsigned type for the per photon cleaning bitmask, by number of cleanings
+_MASK_TYPES = ((8, "<u1"), (16, "<u2"), (32, "<u4"), (64, "<u8"))
+# Smallest signed type for the cluster labels, by largest label
+_LABEL_TYPES = tuple(
+    (np.iinfo(label_type).max, label_type)
+    for label_type in ("<i1", "<i2", "<i4", "<i8")
+)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def is_event_record(buffer):
+    """
+    :param buffer: Start of the file contents
+    :return: Whether it is an event record, instead of a pickled Eventfile
+    """
+    return bytes(buffer[: len(MAGIC)]) == MAGIC
+
+
+def event_record_bytes(
+    data,
+    data_format,
+    features=None,
+    cluster=None,
+    cleaning=None,
+    cleaning_features=None,
+):
+    """
+    Packs one event into a binary record
+
+    The record is a fixed header, the names of the data and feature fields as JSON, the data as int64 for ints and
+    datetimes in microseconds and as float64 otherwise, the features as float32, the number of photons in each CHID
+    as uint16, the uint8 arrival slices, the cluster label of
+    each photon, and the cleaning bitmask of each photon, in that order, each part starting 8 byte aligned
+
+    :param data: Data of the event, as in the Eventfiles, with the image either as list of lists or as flat
+    (arrivals, offsets) photons, and every other value a number or datetime
+    :param data_format: Dict of the name to the position of each value in data
+    :param features: Optional dict of extracted features, stored as float32
+    :param cluster: Optional cluster labels of each photon in CHID order, or the DBSCAN or PhotonStreamCluster
+    object they come from
+    :param cleaning: Optional dict of the name of each cleaning, e.g. 'clump20' or 'core20', to a boolean array of
+    which photons it keeps, stored as one bit per cleaning for each photon
+    :param cleaning_features: Optional dict of the name of a cleaning to the features extracted from only its photons
+    :return: The record as bytes
+    """
+    image_index = data_format["Image"]
+    image = data[image_index]
+    if isinstance(image, tuple) and len(image) == 2:
+        arrivals, offsets = image
+    else:
+        arrivals, offsets = photons.flatten_photon_streams([image])
+    arrivals = np.ascontiguousarray(arrivals[offsets[0] : offsets[-1]], dtype=np.uint8)
+    counts = np.diff(offsets)
+    if np.any(counts > np.iinfo(np.uint16).max):
+        raise ValueError("More photons in a CHID than can be stored")
+
+    values = np.full(len(data), np.nan, dtype="<f8")
+    # Same bytes, so ints and datetimes are stored exactly instead of rounded to float64
+    int_values = values.view("<i8")
+    types = []
+    for position, value in enumerate(data):
+        if position == image_index:
+            types.append("image")
+        elif isinstance(value, datetime.datetime):
+            types.append("datetime")
+            int_values[position] = (value - _EPOCH) // datetime.timedelta(
+                microseconds=1
+            )
+        elif isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+            types.append("int")
+            int_values[position] = value
+        else:
+            types.append("float")
+            values[position] = value
+
+    flags = 0
+    feature_names = []
+    feature_values = np.zeros(0, dtype=np.float32)
+    if features is not None:
+        flags |= HAS_FEATURES
+        feature_names = list(features)
+        feature_values = np.array(
+            [features[name] for name in feature_names], dtype=np.float32
+        )
+    labels = np.zeros(0, dtype=np.int8)
+    label_size = 0
+    if cluster is not None:
+        flags |= HAS_CLUSTER
+        labels = _cluster_labels(cluster)
+        if len(labels) != len(arrivals):
+            raise ValueError(
+                "{} cluster labels for {} photons".format(len(labels), len(arrivals))
+            )
+        # Clusterings with min_samples=1 make a cluster of every lone photon, so more than int8 holds
+        labels = labels.astype(_label_type(np.max(labels) if len(labels) else 0))
+        label_size = labels.dtype.itemsize
+
+    cleaning_names = []
+    bitmask = np.zeros(0, dtype=np.uint8)
+    if cleaning is not None:
+        flags |= HAS_CLEANING
+        cleaning_names = list(cleaning)
+        bitmask = np.zeros(len(arrivals), dtype=_mask_type(len(cleaning_names)))
+        for bit, name in enumerate(cleaning_names):
+            mask = np.asarray(cleaning[name], dtype=bool)
+            if len(mask) != len(arrivals):
+                raise ValueError(
+                    "{} cleaning mask for {} photons".format(len(mask), len(arrivals))
+                )
+            bitmask[mask] |= bitmask.dtype.type(1 << bit)
+    if cleaning_features:
+        flags |= HAS_FEATURES
+        for name, cleaned_features in cleaning_features.items():
+            # Stored after the features of all photons, as 'cleaning/feature'
+            cleaned_names = [name + "/" + feature for feature in cleaned_features]
+            feature_names += cleaned_names
+            feature_values = np.concatenate(
+                [
+                    feature_values,
+                    np.array(list(cleaned_features.values()), dtype=np.float32),
+                ]
+            )
+
+    names = json.dumps(
+        {
+            "data_format": data_format,
+            "types": types,
+            "features": feature_names,
+            "cleaning": cleaning_names,
+        }
+    ).encode("utf-8")
+    parts = [
+        HEADER.pack(
+            MAGIC,
+            VERSION,
+            flags,
+            len(data),
+            image_index,
+            len(feature_names),
+            label_size,
+            len(arrivals),
+            len(names),
+        ),
+        names,
+        values.tobytes(),
+        feature_values.astype("<f4").tobytes(),
+        counts.astype("<u2").tobytes(),
+        arrivals.tobytes(),
+        labels.tobytes(),
+        bitmask.tobytes(),
+    ]
+    return b"".join(_pad(part) for part in parts)
+
+
+def write_event_record(
+    file,
+    data,
+    data_format,
+    features=None,
+    cluster=None,
+    cleaning=None,
+    cleaning_features=None,
+):
+    """
+    Writes one event as a binary record, see event_record_bytes
+
+    :param file: Path or file object opened for binary writing
+    :return:
+    """
+    record = event_record_bytes(
+        data, data_format, features, cluster, cleaning, cleaning_features
+    )
+    if hasattr(file, "write"):
+        file.write(record)
+    else:
+        with open(file, "wb") as record_file:
+            record_file.write(record)
+
+
+def read_event_record(buffer, flat=False, cleaning=None):
+    """
+    Reads one event from a binary record, the arrays are views into buffer, so nothing is copied unless a cleaning
+    is picked
+
+    :param buffer: The record, e.g. bytes read from the file or a memory map of it
+    :param flat: Whether the image is returned as flat (arrivals, offsets) photons instead of list of lists
+    :param cleaning: Name of a stored cleaning, e.g. 'core20', to only return the photons, cluster labels and features
+    of that cleaning, instead of those of all photons
+    :return: (data, data_format, features, cluster_labels) in the same form as the Eventfiles, with the cluster
+    label of each photon in place of the cluster object, features and cluster_labels are None if not stored
+    """
+    layout = _read_layout(buffer)
+    names = layout["names"]
+    arrivals = layout["arrivals"]
+    offsets = np.zeros(photons.NUMBER_OF_PIXELS + 1, dtype=np.int64)
+    np.cumsum(layout["counts"], out=offsets[1:])
+    labels = layout["labels"]
+    feature_names = names["features"]
+    prefix = ""
+    if cleaning is not None:
+        mask = _cleaning_mask(layout, cleaning)
+        arrivals, offsets = photons.select_photons(arrivals, offsets, mask)
+        if labels is not None:
+            labels = labels[mask]
+        prefix = cleaning + "/"
+
+    if flat:
+        image = (arrivals, offsets)
+    else:
+        image = photons.to_list_of_lists(arrivals, offsets)[0]
+    values = layout["values"]
+    int_values = values if layout["version"] == 1 else values.view("<i8")
+    data = []
+    for index, data_type in enumerate(names["types"]):
+        if data_type == "image":
+            data.append(image)
+        elif data_type == "datetime":
+            data.append(
+                _EPOCH + datetime.timedelta(microseconds=int(int_values[index]))
+            )
+        elif data_type == "int":
+            data.append(int(int_values[index]))
+        else:
+            data.append(float(values[index]))
+    features = None
+    if layout["flags"] & HAS_FEATURES:
+        features = {
+            name[len(prefix) :]: value
+            for name, value in zip(feature_names, layout["features"].tolist())
+            # Features of all photons have no '/' in their name
+            if name.startswith(prefix) and "/" not in name[len(prefix) :]
+        }
+        if cleaning is not None and not features:
+            features = None
+    return data, names["data_format"], features, labels
+
+
+def read_cleaning_masks(buffer):
+    """
+    Reads which photons each cleaning of a binary record keeps
+
+    :param buffer: The record, e.g. bytes read from the file or a memory map of it
+    :return: Dict of the name of each cleaning to a boolean array over the photons of the event in CHID order, or None
+    if the record has no cleaning
+    """
+    layout = _read_layout(buffer)
+    if layout["bitmask"] is None:
+        return None
+    return {name: _cleaning_mask(layout, name) for name in layout["names"]["cleaning"]}
+
+
+def _read_layout(buffer):
+    (
+        magic,
+        version,
+        flags,
+        data_length,
+        image_index,
+        num_features,
+        label_size,
+        num_photons,
+        names_length,
+    ) = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("Not an event record")
+    if not 1 <= version <= VERSION:
+        raise ValueError(
+            "Event record version {} can not be read, only versions 1 to {}".format(
+                version, VERSION
+            )
+        )
+    position = _padded(HEADER.size)
+    names = json.loads(bytes(buffer[position : position + names_length]))
+    position += _padded(names_length)
+    values = np.frombuffer(buffer, dtype="<f8", count=data_length, offset=position)
+    position += _padded(8 * data_length)
+    feature_values = np.frombuffer(
+        buffer, dtype="<f4", count=num_features, offset=position
+    )
+    position += _padded(4 * num_features)
+    counts = np.frombuffer(
+        buffer, dtype="<u2", count=photons.NUMBER_OF_PIXELS, offset=position
+    )
+    position += _padded(2 * photons.NUMBER_OF_PIXELS)
+    arrivals = np.frombuffer(buffer, dtype=np.uint8, count=num_photons, offset=position)
+    position += _padded(num_photons)
+
+    labels = None
+    if flags & HAS_CLUSTER:
+        # Records before version 3 have no label size, and always int8 labels
+        label_type = np.dtype("<i{}".format(label_size or 1))
+        labels = np.frombuffer(
+            buffer, dtype=label_type, count=num_photons, offset=position
+        )
+        position += _padded(label_type.itemsize * num_photons)
+    bitmask = None
+    if flags & HAS_CLEANING:
+        mask_type = np.dtype(_mask_type(len(names["cleaning"])))
+        bitmask = np.frombuffer(
+            buffer, dtype=mask_type, count=num_photons, offset=position
+        )
+    return {
+        "version": version,
+        "flags": flags,
+        "names": names,
+        "values": values,
+        "features": feature_values,
+        "counts": counts,
+        "arrivals": arrivals,
+        "labels": labels,
+        "bitmask": bitmask,
+    }
+
+
+def _cleaning_mask(layout, cleaning):
+    names = layout["names"].get("cleaning", [])
+    if cleaning not in names:
+        raise ValueError(
+            "Cleaning {} is not in the event record, only {}".format(cleaning, names)
+        )
+    bit = layout["bitmask"].dtype.type(1 << names.index(cleaning))
+    return (layout["bitmask"] & bit) != 0
+
+
+def _label_type(largest_label):
+    for largest, label_type in _LABEL_TYPES:
+        if largest_label <= largest:
+            return label_type
+    raise ValueError("More clusters than can be stored")
+
+
+def _mask_type(num_cleanings):
+    for bits, mask_type in _MASK_TYPES:
+        if num_cleanings <= bits:
+            return mask_type
+    raise ValueError("More cleanings than can be stored")
+
+
+def load_event_file(path, flat=False, cleaning=None):
+    """
+    Loads one event from a file, either a binary event record or a pickled Eventfile
+
+    :param path: Path to the file
+    :param flat: Whether the image is returned as flat (arrivals, offsets) photons instead of list of lists
+    :param cleaning: Name of a cleaning stored in the event record, e.g. 'core20', to only load its photons
+    :return: (data, data_format, features, cluster) as in the Eventfiles, features and cluster are None if not saved,
+    or None if the file is empty or the cleaning kept no photons
+    """
+    with open(path, "rb") as event_file:
+        buffer = event_file.read()
+    if not buffer:
+        return None
+    if is_event_record(buffer):
+        if cleaning is not None and not np.any(
+            _cleaning_mask(_read_layout(buffer), cleaning)
+        ):
+            # Same as there being no cleaned Eventfile for events without clumps
+            return None
+        return read_event_record(buffer, flat=flat, cleaning=cleaning)
+    if cleaning is not None:
+        raise ValueError("Only event records hold cleanings, not {}".format(path))
+    event = list(pickle.loads(buffer))
+    # Observation Eventfiles have no features or cluster, and diffuse ones no cluster
+    event += [None] * (4 - len(event))
+    if flat:
+        data, data_format = event[0], event[1]
+        data[data_format["Image"]] = photons.flatten_photon_streams(
+            [data[data_format["Image"]]]
+        )
+    return tuple(event)
+
+
+def load_cleaning_masks(path):
+    """
+    Loads which photons each cleaning in an event record keeps, see read_cleaning_masks
+
+    :param path: Path to the event record
+    :return: Dict of the name of each cleaning to a boolean array over the photons of the event, or None if the file
+    has no cleaning
+    """
+    with open(path, "rb") as event_file:
+        buffer = event_file.read()
+    if not is_event_record(buffer):
+        return None
+    return read_cleaning_masks(buffer)
+
+
+def convert_event_files(paths, output_directory=None, remove=False):
+    """
+    Converts pickled Eventfiles to binary event records, with the same name and RECORD_SUFFIX added
+
+    :param paths: Paths to the pickled Eventfiles
+    :param output_directory: Directory to write the records to, defaults to next to each Eventfile
+    :param remove: Whether to remove each Eventfile after it is converted
+    :return: List of the path of each record, None for empty Eventfiles
+    """
+    record_paths = []
+    for path in paths:
+        event = load_event_file(path, flat=True)
+        if event is None:
+            record_paths.append(None)
+            continue
+        directory = (
+            os.path.dirname(path) if output_directory is None else output_directory
+        )
+        record_path = os.path.join(directory, os.path.basename(path) + RECORD_SUFFIX)
+        write_event_record(record_path, *event)
+        record_paths.append(record_path)
+        if remove:
+            os.remove(path)
+    return record_paths
+
+
+def _cluster_labels(cluster):
+    if hasattr(cluster, "labels_"):
+        # sklearn DBSCAN
+        return np.asarray(cluster.labels_)
+    if hasattr(cluster, "labels"):
+        # photon_stream PhotonStreamCluster
+        return np.asarray(cluster.labels)
+    return np.asarray(cluster)
+
+
+def _padded(length):
+    return (length + 7) // 8 * 8
+
+
+def _pad(part):
+    return part + b"\0" * (_padded(len(part)) - len(part))
@@ -0,0 +1,490 @@
+import json
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+from factnn.data.preprocess import photons
+from factnn.data.dataset.event_record import load_event_file
+
+MANIFEST = "manifest.json"
+VERSION = 1
+
+# Reference to one event in an EventStore, which can be used anywhere a path to an Eventfile is taken
+StoredEvent = namedtuple("StoredEvent", ["directory", "event_id"])
+
+# Stores already opened in this process, keyed by directory, shared by every reader and inherited by forked workers
+_open_stores = {}
+
+
+def open_store(directory):
+    """
+    Opens an EventStore once per process
+
+    :param directory: Directory of the store
+    :return: EventStore
+    """
+    directory = os.path.abspath(directory)
+    if directory not in _open_stores:
+        _open_stores[directory] = EventStore(directory)
+    return _open_stores[directory]
+
+
+def load_event(path, flat=False, cleaning=None):
+    """
+    Loads one event, either from an Eventfile, a binary event record, or an EventStore
+
+    :param path: Path to the pickled Eventfile or event record, or StoredEvent
+    :param flat: Whether the image is returned as flat (arrivals, offsets) photons instead of list of lists
+    :param cleaning: Name of a cleaning stored in the event record, e.g. 'core20', to only load the photons it kept
+    :return: (data, data_format, features, cluster) as in the Eventfiles, features and cluster are None if not saved,
+    or None if the Eventfile is empty or the cleaning kept no photons, for event records cluster is the cluster label
+    of each photon
+    """
+    if isinstance(path, StoredEvent):
+        if cleaning is not None:
+            raise ValueError("EventStores do not hold cleanings")
+        return open_store(path.directory).event(path.event_id, flat=flat)
+    return load_event_file(path, flat=flat, cleaning=cleaning)
+
+
+def import_event_files(paths, directory, shard_size=10000):
+    """
+    Imports Eventfiles into an EventStore, appending to it if it already exists
+
+    :param paths: Paths to the pickled Eventfiles, all from the same preprocessor
+    :param directory: Directory of the store
+    :param shard_size: Number of events in each shard
+    :return: List of the StoredEvent of each imported Eventfile, None for empty ones
+    """
+    references = []
+    with EventStoreWriter(directory, shard_size=shard_size) as writer:
+        for path in paths:
+            event = load_event(path, flat=True)
+            if event is None:
+                references.append(None)
+                continue
+            data, data_format, features, _ = event
+            event_id = writer.add_event(
+                data, data_format, features, name=os.path.basename(path)
+            )
+            references.append(StoredEvent(writer.directory, event_id))
+    return references
+
+
+class EventStore(object):
+    """
+    Reads events from a sharded columnar store, with every shard memory mapped, so any event can be read without
+    opening a file per event
+
+    Each shard is a directory of .npy files, with the uint8 arrival slices of all its events, the uint16 number of
+    photons in each CHID of each event, the offset of each event into the arrivals, and one column per value in
+    the data of the Eventfiles and per extracted feature. The manifest lists the shards in order, so event ids are
+    consecutive over the shards
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: Directory of the store, as written by EventStoreWriter
+        """
+        self.directory = os.path.abspath(directory)
+        with open(os.path.join(self.directory, MANIFEST), "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest["version"] != VERSION:
+            raise ValueError(
+                "{} is version {} of the event store, only version {} can be read".format(
+                    directory, manifest["version"], VERSION
+                )
+            )
+        self.data_format = manifest["data_format"]
+        self.data_length = manifest["data_length"]
+        self.feature_columns = manifest["feature_columns"]
+        self.has_features = manifest["has_features"]
+        self.shard_names = [shard["name"] for shard in manifest["shards"]]
+        self.shard_starts = np.zeros(len(self.shard_names) + 1, dtype=np.int64)
+        np.cumsum(
+            [shard["num_events"] for shard in manifest["shards"]],
+            out=self.shard_starts[1:],
+        )
+        self._shards = [None] * len(self.shard_names)
+        self._names = None
+
+    def __len__(self):
+        return int(self.shard_starts[-1])
+
+    def __getstate__(self):
+        # The memory maps are opened again on first use after unpickling
+        state = self.__dict__.copy()
+        state["_shards"] = [None] * len(self.shard_names)
+        state["_names"] = None
+        return state
+
+    def shard(self, index):
+        """
+        Memory maps a shard on first use
+
+        :param index: Index of the shard
+        :return: Dict of array name to read-only memory mapped array, columns are named data/name and features/name
+        """
+        if self._shards[index] is None:
+            shard_directory = os.path.join(self.directory, self.shard_names[index])
+            arrays = {}
+            for root, _, files in os.walk(shard_directory):
+                for file in files:
+                    if file.endswith(".npy"):
+                        path = os.path.join(root, file)
+                        name = os.path.relpath(path, shard_directory)[: -len(".npy")]
+                        arrays[name.replace(os.sep, "/")] = np.load(path, mmap_mode="r")
+            self._shards[index] = arrays
+        return self._shards[index]
+
+    def locate(self, event_ids):
+        """
+        Finds the shard and the index within it of events
+
+        :param event_ids: Event id or array of them
+        :return: (shard, index) with the same shape as event_ids
+        """
+        event_ids = np.asarray(event_ids, dtype=np.int64)
+        if np.any((event_ids < 0) | (event_ids >= len(self))):
+            raise IndexError(
+                "Event ids have to be between 0 and {}".format(len(self) - 1)
+            )
+        shard = np.searchsorted(self.shard_starts, event_ids, side="right") - 1
+        return shard, event_ids - self.shard_starts[shard]
+
+    def event_photons(self, event_id):
+        """
+        Photons of one event, without copying the arrivals
+
+        :param event_id: Id of the event
+        :return: (arrivals, offsets) as from photons.flatten_photon_streams, where arrivals is the memory map of the
+        whole shard
+        """
+        shard, index = self.locate(event_id)
+        arrays = self.shard(int(shard))
+        offsets = np.empty(photons.NUMBER_OF_PIXELS + 1, dtype=np.int64)
+        offsets[0] = arrays["event_offsets"][index]
+        np.cumsum(arrays["counts"][index], out=offsets[1:])
+        offsets[1:] += offsets[0]
+        return arrays["arrivals"], offsets
+
+    def batch(self, event_ids):
+        """
+        Photons of many events, gathered shard by shard into one flattened batch
+
+        :param event_ids: Ids of the events, in the order they are wanted
+        :return: (arrivals, offsets) as from photons.flatten_photon_streams
+        """
+        shards, indices = self.locate(np.atleast_1d(event_ids))
+        counts = np.empty((len(shards), photons.NUMBER_OF_PIXELS), dtype=np.int64)
+        starts = np.empty(len(shards), dtype=np.int64)
+        for shard in np.unique(shards):
+            arrays = self.shard(int(shard))
+            selected = shards == shard
+            counts[selected] = arrays["counts"][indices[selected]]
+            starts[selected] = arrays["event_offsets"][indices[selected]]
+        lengths = counts.sum(axis=1)
+        offsets = np.zeros(counts.size + 1, dtype=np.int64)
+        np.cumsum(counts.ravel(), out=offsets[1:])
+        event_starts = offsets[: -1 : photons.NUMBER_OF_PIXELS]
+        arrivals = np.empty(offsets[-1], dtype=np.uint8)
+        for shard in np.unique(shards):
+            selected = shards == shard
+            # Position of each photon within its event, added to where the event starts in the shard and the batch
+            within = np.arange(lengths[selected].sum()) - np.repeat(
+                np.cumsum(lengths[selected]) - lengths[selected], lengths[selected]
+            )
+            arrivals[np.repeat(event_starts[selected], lengths[selected]) + within] = (
+                self.shard(int(shard))["arrivals"][
+                    np.repeat(starts[selected], lengths[selected]) + within
+                ]
+            )
+        return arrivals, offsets
+
+    def column(self, name, event_ids=None):
+        """
+        One data or feature column, e.g. "data/Energy", "data/1" or "features/length"
+
+        :param name: Name of the column, data columns either by their name in the data format or their position
+        :param event_ids: Ids of the events, defaults to all of them
+        :return: Array of the values, NaN where a shard does not have the column
+        """
+        if event_ids is None:
+            shards = np.repeat(
+                np.arange(len(self.shard_names)), np.diff(self.shard_starts)
+            )
+            indices = np.arange(len(self)) - self.shard_starts[shards]
+        else:
+            shards, indices = self.locate(np.atleast_1d(event_ids))
+        if name.startswith("data/") and name[len("data/") :] in self.data_format:
+            name = "data/{}".format(self.data_format[name[len("data/") :]])
+        values = None
+        for shard in np.unique(shards):
+            selected = shards == shard
+            arrays = self.shard(int(shard))
+            if name in arrays:
+                shard_values = arrays[name][indices[selected]]
+            else:
+                shard_values = np.full(np.count_nonzero(selected), np.nan)
+            if values is None:
+                values = np.empty(len(shards), dtype=shard_values.dtype)
+            elif values.dtype != np.result_type(values, shard_values):
+                values = values.astype(np.result_type(values, shard_values))
+            values[selected] = shard_values
+        if values is None:
+            values = np.empty(0)
+        return values
+
+    def event(self, event_id, flat=False):
+        """
+        One event in the same form as it is in the Eventfiles
+
+        :param event_id: Id of the event
+        :param flat: Whether the image is returned as flat (arrivals, offsets) photons instead of list of lists
+        :return: (data, data_format, features, None), features being None if the Eventfiles had none
+        """
+        shard, index = self.locate(event_id)
+        arrays = self.shard(int(shard))
+        data = [None] * self.data_length
+        for position in range(self.data_length):
+            if position != self.data_format["Image"]:
+                data[position] = _to_python(arrays["data/{}".format(position)][index])
+        image = self.event_photons(event_id)
+        if not flat:
+            image = photons.to_list_of_lists(*image)[0]
+        data[self.data_format["Image"]] = image
+        features = None
+        if self.has_features:
+            features = {}
+            for name in self.feature_columns:
+                if "features/" + name in arrays:
+                    features[name] = _to_python(arrays["features/" + name][index])
+        return data, dict(self.data_format), features, None
+
+    def names(self):
+        """
+        :return: Array of the name of each event, the Eventfile name for imported events
+        """
+        return self.column("names")
+
+    def event_id(self, name):
+        """
+        Looks up an event by name
+
+        :param name: Name of the event, e.g. the Eventfile name it was imported from
+        :return: Id of the event
+        """
+        return self._name_index()[name]
+
+    def event_ids(self, names):
+        """
+        Looks up events by name, leaving out the names that are not in the store
+
+        :param names: Names of the events
+        :return: Array of the ids of the events that are in the store
+        """
+        index = self._name_index()
+        return np.array(
+            [index[name] for name in names if name in index], dtype=np.int64
+        )
+
+    def _name_index(self):
+        if self._names is None:
+            self._names = {
+                event_name: event_id for event_id, event_name in enumerate(self.names())
+            }
+        return self._names
+
+    def references(self, event_ids=None):
+        """
+        :param event_ids: Ids of the events, defaults to all of them
+        :return: List of StoredEvent, to use in place of the paths to Eventfiles
+        """
+        if event_ids is None:
+            event_ids = range(len(self))
+        return [StoredEvent(self.directory, int(event_id)) for event_id in event_ids]
+
+
+class EventStoreWriter(object):
+    """
+    Writes events into an EventStore, one shard at a time, and appends to the store if it already exists
+    """
+
+    def __init__(self, directory, shard_size=10000):
+        """
+        :param directory: Directory of the store
+        :param shard_size: Number of events in each shard
+        """
+        self.directory = os.path.abspath(directory)
+        self.shard_size = shard_size
+        os.makedirs(self.directory, exist_ok=True)
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, "r") as manifest_file:
+                self.manifest = json.load(manifest_file)
+        else:
+            self.manifest = {
+                "version": VERSION,
+                "data_format": None,
+                "data_length": None,
+                "feature_columns": [],
+                "has_features": False,
+                "shards": [],
+            }
+        self.num_events = sum(shard["num_events"] for shard in self.manifest["shards"])
+        self._reset()
+
+    def _reset(self):
+        self._arrivals = []
+        self._counts = []
+        self._data = []
+        self._features = []
+        self._names = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_event(self, data, data_format, features=None, name=None):
+        """
+        Adds one event
+
+        :param data: Data of the event, as in the Eventfiles, with the image either as list of lists or as flat
+        (arrivals, offsets) photons
+        :param data_format: Dict of the name to the position of each value in data, the store keeps the one of the
+        first event, as some Eventfiles have the wrong data format, but the data has to have the same length and image
+        position for every event
+        :param features: Optional dict of extracted features
+        :param name: Optional name of the event, to look it up by
+        :return: Id of the event
+        """
+        if self.manifest["data_format"] is None:
+            self.manifest["data_format"] = dict(data_format)
+            self.manifest["data_length"] = len(data)
+        elif (
+            len(data) != self.manifest["data_length"]
+            or data_format["Image"] != self.manifest["data_format"]["Image"]
+        ):
+            raise ValueError(
+                "Data of length {} with the image at {} does not fit the store, with {} and {}".format(
+                    len(data),
+                    data_format["Image"],
+                    self.manifest["data_length"],
+                    self.manifest["data_format"]["Image"],
+                )
+            )
+        image = data[data_format["Image"]]
+        if isinstance(image, tuple) and len(image) == 2:
+            arrivals, offsets = image
+        else:
+            arrivals, offsets = photons.flatten_photon_streams([image])
+        counts = np.diff(offsets)
+        if np.any(counts > np.iinfo(np.uint16).max):
+            raise ValueError("More photons in a CHID than can be stored")
+        self._arrivals.append(
+            np.asarray(arrivals[offsets[0] : offsets[-1]], dtype=np.uint8)
+        )
+        self._counts.append(counts.astype(np.uint16))
+        self._data.append(list(data))
+        self._features.append(features)
+        self._names.append("" if name is None else str(name))
+        if features is not None:
+            self.manifest["has_features"] = True
+        self.num_events += 1
+        if len(self._counts) >= self.shard_size:
+            self.flush()
+        return self.num_events - 1
+
+    def flush(self):
+        """
+        Writes the events added so far as a new shard
+        :return:
+        """
+        if not self._counts:
+            return
+        name = "shard_{:05d}".format(len(self.manifest["shards"]))
+        # Written to a temporary directory then moved into place, so readers never see a half written shard
+        temp_directory = tempfile.mkdtemp(dir=self.directory, prefix=".tmp_")
+        try:
+            os.makedirs(os.path.join(temp_directory, "data"))
+            os.makedirs(os.path.join(temp_directory, "features"))
+            lengths = np.array([len(arrivals) for arrivals in self._arrivals])
+            event_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=event_offsets[1:])
+            np.save(
+                os.path.join(temp_directory, "arrivals.npy"),
+                np.concatenate(self._arrivals),
+            )
+            np.save(os.path.join(temp_directory, "counts.npy"), np.stack(self._counts))
+            np.save(os.path.join(temp_directory, "event_offsets.npy"), event_offsets)
+            np.save(
+                os.path.join(temp_directory, "names.npy"),
+                np.array(self._names, dtype=str),
+            )
+            for position in range(self.manifest["data_length"]):
+                if position == self.manifest["data_format"]["Image"]:
+                    continue
+                np.save(
+                    os.path.join(temp_directory, "data", "{}.npy".format(position)),
+                    _column([values[position] for values in self._data]),
+                )
+            feature_keys = []
+            for features in self._features:
+                if features is not None:
+                    feature_keys += [key for key in features if key not in feature_keys]
+            for key in feature_keys:
+                np.save(
+                    os.path.join(temp_directory, "features", key + ".npy"),
+                    _column(
+                        [
+                            np.nan if features is None else features.get(key, np.nan)
+                            for features in self._features
+                        ]
+                    ),
+                )
+                if key not in self.manifest["feature_columns"]:
+                    self.manifest["feature_columns"].append(key)
+            os.replace(temp_directory, os.path.join(self.directory, name))
+        except BaseException:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+            raise
+        self.manifest["shards"].append({"name": name, "num_events": len(lengths)})
+        self._write_manifest()
+        self._reset()
+
+    def close(self):
+        """
+        Writes the last shard
+        :return:
+        """
+        self.flush()
+        if not os.path.isfile(os.path.join(self.directory, MANIFEST)):
+            self._write_manifest()
+
+    def _write_manifest(self):
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.directory, suffix=".json", delete=False
+        ) as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2)
+        os.replace(manifest_file.name, os.path.join(self.directory, MANIFEST))
+        # The open store, if any, has to see the new shards
+        _open_stores.pop(self.directory, None)
+
+
+def _column(values):
+    column = np.asarray(values)
+    if column.dtype == object:
+        # e.g. the timestamps of observations, with microseconds so they are read back as datetime
+        column = np.array(values, dtype="datetime64[us]")
+    return column
+
+
+def _to_python(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
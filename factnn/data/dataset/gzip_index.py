@@ -0,0 +1,325 @@
+import gzip
+import json
+import os
+import tempfile
+import zlib
+
+import numpy as np
+
+INDEX_SUFFIX = ".idx.npz"
+
+# Size of the compressed chunks read while scanning or decompressing
+_CHUNK_SIZE = 1 << 20
+
+# Largest decompressed gzip member IndexedGzipReader reads, as it keeps the last members it decompressed in memory
+MAX_MEMBER_SIZE = 64 << 20
+
+
+class GzipIndex(object):
+    """
+    Index of the lines of a gzip file, e.g. the events of a phs.jsonl.gz file, with the offset of each gzip member as
+    decompression checkpoint, so a line can be read by only decompressing the members it is in
+
+    Plain gzip files are a single member, so reading a line still decompresses everything before it. Files written by
+    recompress_block_gzip are many small members, as in BGZF, so any line is read by decompressing one member. Both
+    are still ordinary gzip files for every other reader
+    """
+
+    def __init__(self, member_offsets, member_starts, line_starts, line_lengths):
+        """
+        :param member_offsets: Compressed offset of each gzip member, and the size of the file at the end
+        :param member_starts: Decompressed offset of each gzip member, and the decompressed size at the end
+        :param line_starts: Decompressed offset of each line
+        :param line_lengths: Length of each line, without the newline
+        """
+        self.member_offsets = member_offsets
+        self.member_starts = member_starts
+        self.line_starts = line_starts
+        self.line_lengths = line_lengths
+
+    def __len__(self):
+        return len(self.line_starts)
+
+    def members(self, line):
+        """
+        :param line: Index of the line
+        :return: (first, last) gzip member the line is in, last excluded
+        """
+        start = self.line_starts[line]
+        end = start + max(self.line_lengths[line], 1)
+        first = np.searchsorted(self.member_starts, start, side="right") - 1
+        last = np.searchsorted(self.member_starts, end, side="left")
+        return int(first), int(last)
+
+    def save(self, path, source):
+        """
+        Saves the index next to the file it indexes
+
+        :param path: Path of the .npz to write
+        :param source: Path of the gzip file, whose modification time and size are saved to check the index is current
+        :return:
+        """
+        stat = os.stat(source)
+        # Written under a unique name then moved into place, so no half written index is read
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(path)), suffix=".npz", delete=False
+        ) as index_file:
+            np.savez(
+                index_file,
+                member_offsets=self.member_offsets,
+                member_starts=self.member_starts,
+                line_starts=self.line_starts,
+                line_lengths=self.line_lengths,
+                source=np.array([stat.st_mtime, stat.st_size]),
+            )
+        os.replace(index_file.name, path)
+
+
+def build_gzip_index(path):
+    """
+    Scans a gzip file once for its members and lines
+
+    :param path: Path to the gzip file
+    :return: GzipIndex of the non-empty lines
+    """
+    member_offsets = [0]
+    member_starts = [0]
+    newlines = []
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    position = 0
+    decompressed = 0
+    with open(path, "rb") as gzip_file:
+        while True:
+            chunk = gzip_file.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            position += len(chunk)
+            while chunk:
+                data = decompressor.decompress(chunk)
+                newlines.append(
+                    np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+                    + decompressed
+                )
+                decompressed += len(data)
+                if not decompressor.eof:
+                    break
+                # End of a member, the rest of the chunk starts the next one
+                chunk = decompressor.unused_data
+                member_offsets.append(position - len(chunk))
+                member_starts.append(decompressed)
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                if not chunk:
+                    break
+    if member_offsets[-1] != position:
+        member_offsets.append(position)
+        member_starts.append(decompressed)
+    newlines = np.concatenate(newlines) if newlines else np.zeros(0, dtype=np.int64)
+    ends = newlines
+    if decompressed > 0 and (len(newlines) == 0 or newlines[-1] != decompressed - 1):
+        # Last line without a newline
+        ends = np.append(newlines, decompressed)
+    starts = np.concatenate([[0], newlines + 1])[: len(ends)]
+    lengths = ends - starts
+    kept = lengths > 0
+    return GzipIndex(
+        np.array(member_offsets, dtype=np.int64),
+        np.array(member_starts, dtype=np.int64),
+        starts[kept].astype(np.int64),
+        lengths[kept].astype(np.int64),
+    )
+
+
+def load_gzip_index(path, index_path=None):
+    """
+    Loads the index of a gzip file, building and saving it if there is none yet or the file changed since
+
+    :param path: Path to the gzip file
+    :param index_path: Path of the index, by default the file path with .idx.npz added
+    :return: GzipIndex
+    """
+    if index_path is None:
+        index_path = path + INDEX_SUFFIX
+    stat = os.stat(path)
+    if os.path.isfile(index_path):
+        with np.load(index_path) as arrays:
+            if tuple(arrays["source"]) == (stat.st_mtime, stat.st_size):
+                return GzipIndex(
+                    arrays["member_offsets"],
+                    arrays["member_starts"],
+                    arrays["line_starts"],
+                    arrays["line_lengths"],
+                )
+    index = build_gzip_index(path)
+    try:
+        index.save(index_path, path)
+    except OSError as e:
+        # e.g. a read only directory, the index is then rebuilt each time
+        print("Could not save index {}: {}".format(index_path, e))
+    return index
+
+
+def recompress_block_gzip(path, output_path, lines_per_member=16, compresslevel=6):
+    """
+    Recompresses a gzip file of lines into one gzip member per few lines, so each line can be read by decompressing
+    only its member, and saves its index
+
+    :param path: Path to the gzip file, e.g. a phs.jsonl.gz file
+    :param output_path: Path of the recompressed file
+    :param lines_per_member: Number of lines in each gzip member
+    :param compresslevel: Compression level of the members
+    :return: GzipIndex of the recompressed file
+    """
+    member_offsets = [0]
+    member_starts = [0]
+    line_starts = []
+    line_lengths = []
+    decompressed = 0
+    with gzip.open(path, "rb") as input_file, tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(os.path.abspath(output_path)), delete=False
+    ) as output_file:
+        lines = []
+        for line in input_file:
+            if line.strip():
+                lines.append(line if line.endswith(b"\n") else line + b"\n")
+            if len(lines) == lines_per_member:
+                decompressed = _write_member(
+                    output_file, lines, compresslevel, decompressed, line_starts
+                )
+                line_lengths += [len(line) - 1 for line in lines]
+                member_offsets.append(output_file.tell())
+                member_starts.append(decompressed)
+                lines = []
+        if lines:
+            decompressed = _write_member(
+                output_file, lines, compresslevel, decompressed, line_starts
+            )
+            line_lengths += [len(line) - 1 for line in lines]
+            member_offsets.append(output_file.tell())
+            member_starts.append(decompressed)
+    os.replace(output_file.name, output_path)
+    index = GzipIndex(
+        np.array(member_offsets, dtype=np.int64),
+        np.array(member_starts, dtype=np.int64),
+        np.array(line_starts, dtype=np.int64),
+        np.array(line_lengths, dtype=np.int64),
+    )
+    index.save(output_path + INDEX_SUFFIX, output_path)
+    return index
+
+
+def _write_member(output_file, lines, compresslevel, decompressed, line_starts):
+    for line in lines:
+        line_starts.append(decompressed)
+        decompressed += len(line)
+    output_file.write(gzip.compress(b"".join(lines), compresslevel=compresslevel))
+    return decompressed
+
+
+class IndexedGzipReader(object):
+    """
+    Reads any line of an indexed gzip file, decompressing only the gzip members it is in, and keeps the last
+    decompressed members so lines next to each other are only decompressed once
+
+    Only files whose members are all at most max_member_size decompressed are read, so what is kept stays small,
+    large plain gzip files are one member and have to be recompressed with recompress_block_gzip first
+    """
+
+    def __init__(self, path, index=None, max_member_size=MAX_MEMBER_SIZE):
+        """
+        :param path: Path to the gzip file
+        :param index: GzipIndex of it, by default loaded or built with load_gzip_index
+        :param max_member_size: Largest decompressed size of a gzip member to read
+        """
+        self.path = path
+        self.index = load_gzip_index(path) if index is None else index
+        largest = int(np.max(np.diff(self.index.member_starts), initial=0))
+        if largest > max_member_size:
+            raise ValueError(
+                "{} has a gzip member of {} bytes decompressed, more than max_member_size {}, recompress it with "
+                "recompress_block_gzip".format(path, largest, max_member_size)
+            )
+        self.max_member_size = max_member_size
+        self._file = None
+        self._members = None
+        self._data = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # The file is opened again after unpickling, e.g. in each worker
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_members"] = None
+        state["_data"] = None
+        return state
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def line(self, line):
+        """
+        :param line: Index of the line
+        :return: The line as bytes, without the newline
+        """
+        first, last = self.index.members(line)
+        if self._members is None or not (
+            self._members[0] <= first and last <= self._members[1]
+        ):
+            data = self._decompress(first, last)
+            start = self.index.line_starts[line] - self.index.member_starts[first]
+            if len(data) > self.max_member_size:
+                # A line over many members is not kept
+                self._data = None
+                self._members = None
+                return data[start : start + self.index.line_lengths[line]]
+            self._data = data
+            self._members = (first, last)
+        start = (
+            self.index.line_starts[line] - self.index.member_starts[self._members[0]]
+        )
+        return self._data[start : start + self.index.line_lengths[line]]
+
+    def lines(self, lines):
+        """
+        Reads many lines, member by member
+
+        :param lines: Indices of the lines
+        :return: List of the lines, in the order of lines
+        """
+        lines = np.asarray(lines, dtype=np.int64)
+        result = [None] * len(lines)
+        for position in np.argsort(lines, kind="stable"):
+            result[position] = self.line(lines[position])
+        return result
+
+    def event(self, line):
+        """
+        :param line: Index of the event
+        :return: The event, e.g. of a phs.jsonl.gz file, as a dict from its JSON
+        """
+        return json.loads(self.line(line))
+
+    def _decompress(self, first, last):
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        self._file.seek(self.index.member_offsets[first])
+        remaining = int(
+            self.index.member_offsets[last] - self.index.member_offsets[first]
+        )
+        parts = []
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        while remaining > 0:
+            chunk = self._file.read(min(remaining, _CHUNK_SIZE))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            while chunk:
+                parts.append(decompressor.decompress(chunk))
+                if not decompressor.eof:
+                    break
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        return b"".join(parts)
@@ -1,41 +1,453 @@
+import copy
+import os
+import queue
+from multiprocessing import Pool, Queue
+
 import h5py
+import numpy as np
+
+# Group holding which input files the datasets were made from, so an interrupted conversion can be resumed
+SOURCES = "sources"
+
+# Rows per chunk of the scalar columns, which are small enough that one event per chunk would only add overhead
+SCALAR_CHUNK_ROWS = 4096
+
+_queue = None
+
+
+def number_of_rows(hdf):
+    """
+    Number of complete rows in a file written by create_dataset, which can be less than the length of the datasets
+    while it is still being written, as they are grown ahead of the rows
+
+    :param hdf: Open h5py File
+    :return: Number of rows
+    """
+    if SOURCES in hdf:
+        rows = hdf[SOURCES]["rows"]
+        if hdf.swmr_mode:
+            rows.refresh()
+        return int(rows[0])
+    return len(hdf["Image"])
 
 
-def create_dataset(preprocessor, output_file="output.hdf5"):
+def create_dataset(
+    preprocessor,
+    output_file="output.hdf5",
+    chunk_size=256,
+    processes=None,
+    compression="lzf",
+    compression_opts=None,
+    queue_size=8,
+    **kwargs
+):
     """
     Create an HDF5 dataset from a preprocessor's output
-    :param preprocessor: The preprocessor to use, outputs data, data_format on each call of next
+
+    Each input file is rasterized in its own process, and the chunks from all of them are written by this process,
+    so events from different files end up interleaved. The datasets are chunked one event per chunk along the first
+    axis, so reading a random event only decompresses that event, and are grown by doubling them instead of on every
+    write
+
+    The file is written in SWMR mode, so it can be read while it is being written, using number_of_rows for the
+    number of events written so far. If the output file already exists, only the files not yet fully written to it
+    are converted and appended, dropping the events of any file that was only partly written
+
+    :param preprocessor: The preprocessor to use, with chunked batch_processor and data_format
     :param output_file: Name of the output file
-    :return:
-    """
-    gen = preprocessor.batch_processor()
-    batch, data_format = next(gen)
-    formatted_batch = preprocessor.format(batch)
-    row_count = formatted_batch[data_format["Image"]].shape[0]
-    print(row_count)
-
-    with h5py.File(output_file, "w") as hdf:
-        # Now go through each key in data_format, create the dataset
-        dset_sets = [None for i in formatted_batch]
-        for key, value in data_format:
-            maxshape = (None,) + formatted_batch[value].shape[1:]
-            dset = hdf.create_dataset(
-                key,
-                shape=formatted_batch[key].shape,
-                maxshape=maxshape,
-                chunks=formatted_batch[key].shape,
-                dtype=formatted_batch[key].dtype,
+    :param chunk_size: Number of events each process rasterizes at a time
+    :param processes: Number of processes to rasterize with, defaults to the number of CPUs, 1 rasterizes them in this
+    process
+    :param compression: Compression filter of the datasets, e.g. "lzf" or "gzip", None for no compression
+    :param compression_opts: Options of the compression filter, e.g. the level for gzip
+    :param queue_size: Number of chunks waiting to be written before the processes wait
+    :param kwargs: Passed on to batch_processor, e.g. clean_images
+    :return: Number of rows in the output file
+    """
+    data_format = preprocessor.data_format
+    with _open_output(output_file) as hdf:
+        sources = _add_sources(hdf, preprocessor.paths)
+        paths = list(sources["paths"].asstr()[:])
+        complete = sources["complete"][:]
+        tasks = [
+            (preprocessor, paths[index], index, chunk_size, kwargs)
+            for index in np.flatnonzero(~complete)
+        ]
+        rows = _resume(hdf, data_format)
+        if len(tasks) == 0:
+            return rows
+
+        datasets = None
+        if all(key in hdf for key in data_format):
+            datasets = [None] * len(data_format)
+            for key, value in data_format.items():
+                datasets[value] = hdf[key]
+            hdf.swmr_mode = True
+        for source, chunk in _produce_chunks(tasks, processes, queue_size):
+            if chunk is None:
+                sources["complete"][source] = True
+                hdf.flush()
+                continue
+            if datasets is None:
+                datasets = _create_datasets(
+                    hdf, data_format, chunk, compression, compression_opts
+                )
+                # No new objects can be added after starting SWMR
+                hdf.swmr_mode = True
+            rows = _append(datasets, sources, source, rows, chunk)
+        if datasets is not None:
+            for dset in datasets:
+                dset.resize(rows, axis=0)
+        hdf.flush()
+    return rows
+
+
+def _open_output(output_file):
+    if os.path.isfile(output_file):
+        return h5py.File(output_file, "a", libver="latest")
+    return h5py.File(output_file, "w", libver="latest")
+
+
+def _add_sources(hdf, paths):
+    """
+    Records the input files, adding any not recorded yet if the file is resumed
+    """
+    if SOURCES not in hdf:
+        sources = hdf.create_group(SOURCES)
+        sources.create_dataset(
+            "paths", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype()
+        )
+        sources.create_dataset("complete", shape=(0,), maxshape=(None,), dtype=bool)
+        # Start and end row of each chunk, and which file it came from
+        sources.create_dataset(
+            "chunks", shape=(0, 3), maxshape=(None, 3), dtype=np.int64
+        )
+        sources.create_dataset("rows", data=np.zeros(1, dtype=np.int64))
+    sources = hdf[SOURCES]
+    known = set(sources["paths"].asstr()[:])
+    new_paths = [path for path in paths if path not in known]
+    if new_paths:
+        start = len(sources["paths"])
+        sources["paths"].resize(start + len(new_paths), axis=0)
+        sources["paths"][start:] = new_paths
+        sources["complete"].resize(start + len(new_paths), axis=0)
+        sources["complete"][start:] = False
+    return sources
+
+
+def _resume(hdf, data_format):
+    """
+    Drops the rows of files that were only partly written, moving the rows after them down
+
+    :return: Number of rows kept
+    """
+    sources = hdf[SOURCES]
+    rows = int(sources["rows"][0])
+    chunks = sources["chunks"][:]
+    # Chunks recorded after the last row count was written were not fully written
+    written = chunks[:, 1] <= rows
+    complete = sources["complete"][:]
+    kept = complete[chunks[written, 2]]
+    if kept.all():
+        if not written.all():
+            sources["chunks"].resize(np.count_nonzero(written), axis=0)
+        return rows
+
+    chunks = chunks[written]
+    datasets = [hdf[key] for key in data_format]
+    position = 0
+    for start, end, source in chunks[kept]:
+        if start != position:
+            for dset in datasets:
+                dset[position : position + end - start] = dset[start:end]
+        position += end - start
+    chunks = chunks[kept]
+    lengths = chunks[:, 1] - chunks[:, 0]
+    chunks[:, 1] = np.cumsum(lengths)
+    chunks[:, 0] = chunks[:, 1] - lengths
+    sources["chunks"].resize(len(chunks), axis=0)
+    sources["chunks"][:] = chunks
+    sources["rows"][0] = position
+    for dset in datasets:
+        dset.resize(position, axis=0)
+    hdf.flush()
+    return position
+
+
+def _create_datasets(hdf, data_format, chunk, compression, compression_opts):
+    datasets = [None] * len(data_format)
+    for key, value in data_format.items():
+        column = chunk[value]
+        if column.ndim > 1:
+            chunks = (1,) + column.shape[1:]
+        else:
+            chunks = (SCALAR_CHUNK_ROWS,)
+        datasets[value] = hdf.create_dataset(
+            key,
+            shape=(0,) + column.shape[1:],
+            maxshape=(None,) + column.shape[1:],
+            chunks=chunks,
+            dtype=column.dtype,
+            compression=compression,
+            compression_opts=compression_opts,
+            shuffle=compression is not None,
+        )
+    return datasets
+
+
+def _append(datasets, sources, source, rows, chunk):
+    """
+    Writes a chunk after the last row, doubling the datasets if it does not fit
+
+    :return: Number of rows after the chunk
+    """
+    end = rows + len(chunk[0])
+    if end > datasets[0].shape[0]:
+        size = max(end, 2 * datasets[0].shape[0])
+        for dset in datasets:
+            dset.resize(size, axis=0)
+    for dset, column in zip(datasets, chunk):
+        dset[rows:end] = column
+    chunks = sources["chunks"]
+    chunks.resize(len(chunks) + 1, axis=0)
+    chunks[-1] = (rows, end, source)
+    # Written last, so readers and resuming only use rows that are completely written
+    sources["rows"][0] = end
+    sources.file.flush()
+    return end
+
+
+def _produce_chunks(tasks, processes, queue_size):
+    """
+    Rasterizes the files, in parallel unless processes is 1
+
+    :return: Generator over (source, chunk), with None as chunk once a file is done
+    """
+    if processes == 1:
+        for task in tasks:
+            for item in _file_chunks(*task):
+                yield item
+        return
+    chunk_queue = Queue(queue_size)
+    with Pool(processes, initializer=_set_queue, initargs=(chunk_queue,)) as pool:
+        result = pool.map_async(_put_file_chunks, tasks, chunksize=1)
+        remaining = len(tasks)
+        while remaining > 0:
+            try:
+                source, chunk = chunk_queue.get(timeout=1)
+            except queue.Empty:
+                if result.ready():
+                    # Raises the error if a process failed, else the last files are done
+                    result.get()
+                    if chunk_queue.empty():
+                        break
+                continue
+            if chunk is None:
+                remaining -= 1
+            yield source, chunk
+
+
+def _file_chunks(preprocessor, path, source, chunk_size, kwargs):
+    preprocessor = copy.copy(preprocessor)
+    preprocessor.paths = [path]
+    for chunk in preprocessor.batch_processor(chunk_size=chunk_size, **kwargs):
+        # The chunk arrays are reused for the next chunk, and queues only pickle them later
+        yield source, tuple(np.array(column) for column in chunk)
+    yield source, None
+
+
+def _set_queue(chunk_queue):
+    global _queue
+    _queue = chunk_queue
+
+
+def _put_file_chunks(task):
+    for item in _file_chunks(*task):
+        _queue.put(item)
+
+
+class HDF5BatchReader(object):
+    """
+    Reads shuffled batches of events from an HDF5 file, keeping the file open and reading whole blocks of rows at a
+    time instead of each event on its own
+
+    Each epoch goes through the blocks in a random order, reading a few of them at a time into a buffer and
+    shuffling the events within it, so the reads are nearly sequential while the batches are still well mixed.
+    Epochs only have whole batches, the last few events of each are left out
+
+    The file is opened once in each process, so a reader can be pickled or forked to workers
+    """
+
+    def __init__(
+        self,
+        path,
+        indices,
+        batch_size,
+        time_slice=0,
+        total_slices=None,
+        shuffle=True,
+        block_size=64,
+        buffer_blocks=16,
+        key="Image",
+    ):
+        """
+        :param path: Path to the HDF5 file
+        :param indices: Rows of the file to use, e.g. the training split
+        :param batch_size: Number of events in each batch
+        :param time_slice: First time slice to read
+        :param total_slices: Number of time slices to read, None for all after time_slice
+        :param shuffle: Whether to shuffle the blocks and the events in the buffer, or else go through the rows in
+        order, the same every epoch
+        :param block_size: Number of rows of the file in each block, best a multiple of the chunk size of the dataset
+        :param buffer_blocks: Number of blocks in the shuffle buffer
+        :param key: Dataset to read
+        """
+        self.path = path
+        self.indices = np.sort(np.asarray(indices, dtype=np.int64))
+        self.batch_size = batch_size
+        self.time_slice = time_slice
+        self.total_slices = total_slices
+        self.shuffle = shuffle
+        self.block_size = block_size
+        self.buffer_blocks = buffer_blocks
+        self.key = key
+
+        blocks = self.indices // block_size
+        self.block_starts = np.flatnonzero(
+            np.concatenate([[True], blocks[1:] != blocks[:-1]])
+        )
+        self.block_ends = np.append(self.block_starts[1:], len(self.indices))
+        self.steps = len(self.indices) // batch_size
+        if self.steps == 0:
+            raise ValueError(
+                "Fewer indices than the batch size: {} < {}".format(
+                    len(self.indices), batch_size
+                )
             )
-            dset_sets[value] = dset
-            dset_sets[value][:] = formatted_batch[key]
 
-        for batch in gen:
-            batch, data_format = batch
-            formatted_batch = preprocessor.format(batch)
+        self._file = None
+        self._pid = None
+        self._buffer = None
+        self._reset()
+
+    def __getstate__(self):
+        # The file and buffer are made again in each process
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_pid"] = None
+        state["_buffer"] = None
+        return state
+
+    def __len__(self):
+        return self.steps
 
-            shape = formatted_batch[1].shape[0]
-            for index, dset in enumerate(dset_sets):
-                dset.resize(row_count + shape, axis=0)
-                dset[row_count:] = formatted_batch[index]
+    def __iter__(self):
+        return self
 
-            row_count += shape
+    def __next__(self):
+        """
+        :return: (images, rows) of the next batch, images being a new array each time, and rows the row of each
+        event in the file, e.g. to select its labels
+        """
+        if self._step == self.steps:
+            self._reset()
+        dataset = self.dataset
+        images = np.empty(
+            (self.batch_size,) + self._buffer.shape[1:], dtype=dataset.dtype
+        )
+        rows = np.empty(self.batch_size, dtype=np.int64)
+        filled = 0
+        while filled < self.batch_size:
+            if self._next == len(self._available):
+                self._fill_buffer()
+            count = min(self.batch_size - filled, len(self._available) - self._next)
+            taken = slice(self._next, self._next + count)
+            np.take(
+                self._buffer,
+                self._available[taken],
+                axis=0,
+                out=images[filled : filled + count],
+            )
+            rows[filled : filled + count] = self._available_rows[taken]
+            filled += count
+            self._next += count
+        self._step += 1
+        return images, rows
+
+    @property
+    def dataset(self):
+        if self._file is None or self._pid != os.getpid():
+            # Handles inherited through fork are not safe to use, so each process opens its own
+            try:
+                self._file = h5py.File(self.path, "r", swmr=True)
+            except (OSError, ValueError):
+                self._file = h5py.File(self.path, "r")
+            self._pid = os.getpid()
+            self._buffer = None
+        dataset = self._file[self.key]
+        if self._buffer is None:
+            event_shape = dataset.shape[1:]
+            if self.total_slices is not None:
+                event_shape = (self.total_slices,) + event_shape[1:]
+            else:
+                event_shape = (event_shape[0] - self.time_slice,) + event_shape[1:]
+            self._buffer = np.empty(
+                (self.block_size * self.buffer_blocks,) + event_shape,
+                dtype=dataset.dtype,
+            )
+        return dataset
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _reset(self):
+        """
+        Starts a new epoch
+        """
+        self._block_order = np.arange(len(self.block_starts))
+        if self.shuffle:
+            np.random.shuffle(self._block_order)
+        self._group = 0
+        self._step = 0
+        self._available = np.zeros(0, dtype=np.int64)
+        self._available_rows = np.zeros(0, dtype=np.int64)
+        self._next = 0
+
+    def _fill_buffer(self):
+        """
+        Reads the next few blocks into the buffer with read_direct, each as one contiguous range of rows
+        """
+        dataset = self.dataset
+        end_slice = (
+            dataset.shape[1]
+            if self.total_slices is None
+            else self.time_slice + self.total_slices
+        )
+        group = self._block_order[
+            self._group * self.buffer_blocks : (self._group + 1) * self.buffer_blocks
+        ]
+        self._group += 1
+        available = []
+        available_rows = []
+        offset = 0
+        # Read in file order, so the blocks of a group are read front to back
+        for block in np.sort(group):
+            rows = self.indices[self.block_starts[block] : self.block_ends[block]]
+            start, stop = rows[0], rows[-1] + 1
+            dataset.read_direct(
+                self._buffer,
+                source_sel=np.s_[start:stop, self.time_slice : end_slice],
+                dest_sel=np.s_[offset : offset + stop - start],
+            )
+            available.append(rows - start + offset)
+            available_rows.append(rows)
+            offset += stop - start
+        self._available = np.concatenate(available)
+        self._available_rows = np.concatenate(available_rows)
+        if self.shuffle:
+            order = np.random.permutation(len(self._available))
+            self._available = self._available[order]
+            self._available_rows = self._available_rows[order]
+        self._next = 0
@@ -0,0 +1,122 @@
+import gzip
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool
+
+JSONL_SUFFIX = ".phs.jsonl.gz"
+BINARY_SUFFIX = ".phs.gz"
+
+
+def is_photon_stream_file(path):
+    """
+    :param path: Path to a file
+    :return: Whether it is a PhotonStream file, either JSONL or binary
+    """
+    return path.endswith(JSONL_SUFFIX) or path.endswith(BINARY_SUFFIX)
+
+
+def find_photon_stream_files(directories, binary=True):
+    """
+    Finds the PhotonStream files under directories, where a run is both a JSONL and binary file, only the binary one
+    is used
+
+    :param directories: List of directories to search
+    :param binary: Whether to use binary files, if False only JSONL files are found, as before
+    :return: List of the paths, in the order os.walk finds them
+    """
+    paths = []
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            for file in files:
+                if file.endswith(JSONL_SUFFIX):
+                    if binary and file[: -len(JSONL_SUFFIX)] + BINARY_SUFFIX in files:
+                        continue
+                    paths.append(os.path.join(root, file))
+                elif binary and file.endswith(BINARY_SUFFIX):
+                    paths.append(os.path.join(root, file))
+    return paths
+
+
+def binary_path(path, output_directory=None):
+    """
+    :param path: Path to a JSONL PhotonStream file
+    :param output_directory: Directory of the binary file, by default the same as the JSONL file
+    :return: Path of its binary PhotonStream file
+    """
+    if output_directory is None:
+        output_directory = os.path.dirname(path)
+    name = os.path.basename(path).split(".phs")[0]
+    return os.path.join(output_directory, name + BINARY_SUFFIX)
+
+
+def convert_to_binary(path, output_directory=None):
+    """
+    Converts a JSONL PhotonStream file to the binary PhotonStream format, which is smaller and read without decoding
+    JSON. The CORSIKA file of simulations is linked, or else copied, next to the binary file, so both are found the
+    same way as for the JSONL file
+
+    Files already converted since the JSONL file last changed are not converted again
+
+    :param path: Path to the phs.jsonl.gz file
+    :param output_directory: Directory of the binary file, by default the same as the JSONL file
+    :return: Path of the binary file
+    """
+    output_path = binary_path(path, output_directory)
+    if os.path.isfile(output_path) and os.path.getmtime(
+        output_path
+    ) >= os.path.getmtime(path):
+        return output_path
+    # Only needed for converting
+    import photon_stream as ps
+    from photon_stream.io.binary import append_event_to_file
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    # Written under a unique name then moved into place, so a stopped conversion leaves no half written file
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(os.path.abspath(output_path)), suffix=".tmp", delete=False
+    ) as temp_file:
+        try:
+            with gzip.open(temp_file, "wb") as binary_file:
+                for event in ps.EventListReader(path):
+                    append_event_to_file(event, binary_file)
+        except BaseException:
+            os.remove(temp_file.name)
+            raise
+    os.replace(temp_file.name, output_path)
+
+    mc_truth = path.split(".phs")[0] + ".ch.gz"
+    output_truth = output_path.split(".phs")[0] + ".ch.gz"
+    if os.path.isfile(mc_truth) and not os.path.exists(output_truth):
+        try:
+            os.link(mc_truth, output_truth)
+        except OSError:
+            shutil.copy2(mc_truth, output_truth)
+    return output_path
+
+
+def _convert_to_binary(arguments):
+    path, output_directory = arguments
+    try:
+        return convert_to_binary(path, output_directory)
+    except Exception as e:
+        print("Failed to convert {}: {}".format(path, e))
+        return None
+
+
+def convert_files_to_binary(paths, output_directory=None, processes=None):
+    """
+    Converts JSONL PhotonStream files to binary ones in parallel, see convert_to_binary
+
+    :param paths: Paths to the phs.jsonl.gz files
+    :param output_directory: Directory of the binary files, by default next to each JSONL file
+    :param processes: Number of processes to convert with, defaults to the number of CPUs, 1 converts them in this
+    process
+    :return: List of the path of each binary file, None for those that failed
+    """
+    arguments = [(path, output_directory) for path in paths]
+    if processes == 1:
+        return list(map(_convert_to_binary, arguments))
+    with Pool(processes) as pool:
+        # One file at a time per worker, as each file is large
+        return pool.map(_convert_to_binary, arguments, chunksize=1)
@@ -1,14 +1,35 @@
 import numpy as np
+from scipy.sparse import csr_matrix
 import fact
 from fact.instrument import get_pixel_coords
 from fact.instrument.constants import PIXEL_SPACING_MM
 from sklearn.cluster import DBSCAN
-import pickle
+import hashlib
 import os
-import pkg_resources as res
+from factnn.data.preprocess.rebinning import (
+    load_rebinning,
+    rebinning_to_arrays,
+    arrays_to_rebinning,
+    share_arrays,
+    attach_arrays,
+)
+from factnn.data.preprocess import photons
+from factnn.data.preprocess.clustering import PhotonNeighbours
+from factnn.data.preprocess.cleaning import threshold_cleaning
+from factnn.data.preprocess.event_cache import CachedPhotonStream
+from factnn.data.preprocess.normalization import normalize_batch
+from factnn.data.dataset.event_record import write_event_record, RECORD_SUFFIX
+from factnn.data.dataset.photon_stream_files import find_photon_stream_files
+
+# Rebinnings already set up in this process, keyed by (rebin_size, gaussian), shared by every preprocessor and
+# inherited by forked workers
+_rebinning_registry = {}
 
 
 class BasePreprocessor(object):
+    # Name and index of each column of the chunks from batch_processor, e.g. for create_dataset
+    data_format = None
+
     def __init__(self, config):
         if "directories" in config:
             self.directories = config["directories"]
@@ -16,39 +37,30 @@ class BasePreprocessor(object):
             self.paths = config["paths"]
         else:
             # Get paths from the directories
-            self.paths = []
-            for directory in self.directories:
-                for root, dirs, files in os.walk(directory):
-                    for file in files:
-                        if file.endswith("phs.jsonl.gz"):
-                            self.paths.append(os.path.join(root, file))
+            self.paths = find_photon_stream_files(self.directories)
 
         if "dl2_file" in config:
             self.dl2_file = config["dl2_file"]
         else:
             self.dl2_file = None
 
+        # Directory to cache the decoded simulation events in, so repeated passes do not decode them again
+        if "cache_directory" in config:
+            self.cache_directory = config["cache_directory"]
+        else:
+            self.cache_directory = None
+
         if "rebin_size" in config:
-            if config["rebin_size"] <= 300:
-                try:
-                    with open(
-                        res.resource_filename(
-                            "factnn.data.resources",
-                            "rebinning_" + str(config["rebin_size"]) + ".p",
-                        ),
-                        "rb",
-                    ) as rebinning_file:
-                        self.rebinning = pickle.load(rebinning_file)
-                except Exception as e:
-                    self.rebinning = self.generate_rebinning(config["rebin_size"])
-            else:
-                self.rebinning = self.generate_rebinning(config["rebin_size"])
+            self.rebin_size = config["rebin_size"]
         else:
-            self.rebinning = self.generate_rebinning(50)
+            self.rebin_size = 50
 
         if "gaussian" in config:
-            if config["gaussian"]:
-                self.rebinning = self.generate_rebin_fractions()
+            self.gaussian = config["gaussian"]
+        else:
+            self.gaussian = False
+
+        self.set_rebinning()
 
         if "shape" in config:
             self.start = config["shape"][0]
@@ -60,8 +72,8 @@ class BasePreprocessor(object):
 
         self.shape = [
             -1,
-            config["rebin_size"],
-            config["rebin_size"],
+            self.rebin_size,
+            self.rebin_size,
             self.end - self.start,
         ]
 
@@ -80,6 +92,79 @@ class BasePreprocessor(object):
 
         self.init()
 
+    @property
+    def rebinning(self):
+        """
+        The [chid_to_pixel, pixel_index_to_grid] rebinning, only built from self.rebinning_arrays when it is used
+        :return:
+        """
+        if self._rebinning is None:
+            self._rebinning = arrays_to_rebinning(
+                *self.rebinning_arrays, self.rebin_size
+            )
+            entry = _rebinning_registry.get((self.rebin_size, bool(self.gaussian)))
+            if entry is not None and entry[0] is self.rebinning_arrays:
+                entry[2] = self._rebinning
+        return self._rebinning
+
+    @rebinning.setter
+    def rebinning(self, rebinning):
+        self._rebinning = rebinning
+
+    def set_rebinning(self):
+        """
+        Sets the rebinning for self.rebin_size and self.gaussian from the process wide registry, so it is only
+        loaded or generated once per process, and generated ones only once per host
+        :return:
+        """
+        key = (self.rebin_size, bool(self.gaussian))
+        if key not in _rebinning_registry:
+            _rebinning_registry[key] = self.load_shared_rebinning(*key)
+        self.rebinning_arrays, self.rebinning_matrix, self._rebinning = (
+            _rebinning_registry[key]
+        )
+
+    def load_shared_rebinning(self, rebin_size, gaussian):
+        """
+        Loads the rebinning for the registry. Packaged sizes are memory mapped from the archive, so the OS already
+        shares them between processes, others are generated once and shared with share_arrays for the other
+        processes on the host
+        :param rebin_size: Number of grid squares along each side
+        :param gaussian: Whether it is the Gaussian rebinning
+        :return: [rebinning_arrays, rebinning_matrix, rebinning] where rebinning is None if it is only built
+        when used
+        """
+        rebinning = None
+        rebinning_arrays = load_rebinning(rebin_size)
+        if rebinning_arrays is None:
+            # The rebinning only depends on the pixel positions and the size
+            x, y = get_pixel_coords()
+            content = hashlib.sha1(np.ascontiguousarray([x, y], dtype=np.float64))
+            content.update(str(rebin_size).encode())
+            name = "factnn_rebinning_{}_{}".format(rebin_size, content.hexdigest())
+            rebinning_arrays = attach_arrays(name)
+            if rebinning_arrays is None:
+                rebinning = self.generate_rebinning(rebin_size)
+                rebinning_arrays = share_arrays(name, rebinning_to_arrays(rebinning))
+            rebinning_arrays = tuple(rebinning_arrays)
+
+        if gaussian:
+            return [rebinning_arrays, None, self.generate_rebin_fractions()]
+        rebinning_matrix = self.compile_rebinning(*rebinning_arrays, rebin_size)
+        return [rebinning_arrays, rebinning_matrix, rebinning]
+
+    def __getstate__(self):
+        # Only the (rebin_size, gaussian) key is pickled, workers get the tables from their own registry
+        state = self.__dict__.copy()
+        del state["rebinning_arrays"]
+        del state["rebinning_matrix"]
+        del state["_rebinning"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.set_rebinning()
+
     def init(self):
         """
         Recalcs the file paths if called based on self.directories
@@ -124,11 +209,20 @@ class BasePreprocessor(object):
         return pixel_fractions
 
     def generate_rebinning(self, size):
+        """
+        Generates the rebinning from the hexagonal camera pixels to a size x size square grid, from the overlap of
+        each grid square with each pixel hexagon
+
+        Only the few hexagons near each square are tested, using an STRtree over the 1440 hexagons, and all the
+        intersections are computed in one vectorized call, so large grids are cheap to generate
 
-        from shapely.geometry import Point, Polygon, MultiPoint
+        :param size: Number of grid squares along each side
+        :return: [chid_to_pixel, pixel_index_to_grid] where chid_to_pixel holds (pixel_index, fraction) for each CHID
+        """
+        import shapely
+        from shapely.geometry import Point, MultiPoint
         from shapely.affinity import translate
 
-        p = Point(0.0, 0.0)
         PIXEL_EDGE = 9.51 / np.sqrt(3)
         # Top one
         p1 = Point(0.0, PIXEL_EDGE)
@@ -153,7 +247,7 @@ class BasePreprocessor(object):
             square_start * 2 / steps
         )  # Now this is the size of the grid
 
-        square = Polygon(
+        square = np.array(
             [
                 (-square_start, square_start),
                 (-square_start + square_size, square_start),
@@ -163,55 +257,282 @@ class BasePreprocessor(object):
             ]
         )
 
-        list_of_squares = [square]
-
-        pixel_index_to_grid = {}
-        pix_index = 0
-        # Generate tessellation of grid
-        for x_step in range(steps):
-            for y_step in range(steps):
-                new_square = translate(
-                    square, xoff=x_step * square_size, yoff=-square_size * y_step
-                )
-                pixel_index_to_grid[pix_index] = [x_step, y_step]
-                pix_index += 1
-                list_of_squares.append(new_square)
+        # Generate tessellation of grid, the untranslated square is kept as the first one, so every later pixel_index
+        # is one past the x_step, y_step square it came from, which the stored rebinnings rely on
+        x_steps, y_steps = np.divmod(np.arange(steps * steps), steps)
+        offsets = np.zeros((steps * steps + 1, 1, 2))
+        offsets[1:, 0, 0] = x_steps * square_size
+        offsets[1:, 0, 1] = -square_size * y_steps
+        list_of_squares = shapely.polygons(square[np.newaxis] + offsets)
+        pixel_index_to_grid = {
+            pix_index: [x_step, y_step]
+            for pix_index, (x_step, y_step) in enumerate(
+                zip(x_steps.tolist(), y_steps.tolist())
+            )
+        }
 
         x, y = get_pixel_coords()
-        list_hexagons = []
-        for index, x_coor in enumerate(x):
-            list_hexagons.append(translate(hexagon, x_coor, y[index]))
-        list_pixels_and_fractions = {}
-        for i in range(len(list_of_squares)):
-            list_pixels_and_fractions[i] = []
+        list_hexagons = np.array(
+            [translate(hexagon, x_coor, y[index]) for index, x_coor in enumerate(x)]
+        )
+
+        pixel_indices, chids = shapely.STRtree(list_hexagons).query(
+            list_of_squares, predicate="intersects"
+        )
+        fractions = shapely.area(
+            shapely.intersection(list_of_squares[pixel_indices], list_hexagons[chids])
+        ) / shapely.area(list_hexagons[chids])
+        # Keep the pixels in order for each CHID, same as going through the squares one by one
+        order = np.lexsort((chids, pixel_indices))
+        order = order[~np.isclose(fractions[order], 0.0)]
 
         chid_to_pixel = {}
         for i in range(1440):
             chid_to_pixel[i] = []
-
-        for pixel_index, pixel in enumerate(list_of_squares):
-            for chid, hexagon in enumerate(list_hexagons):
-                # Do the dirty work, hexagons should be in CHID order because translate in that order and append
-                if pixel.intersects(hexagon):
-                    intersection = pixel.intersection(hexagon)
-                    fraction_whole = intersection.area / hexagon.area
-                    if not np.isclose(fraction_whole, 0.0):
-                        # so not close to zero overlap, add to list for that pixel
-                        list_pixels_and_fractions[np.abs(pixel_index)].append(
-                            (chid, fraction_whole)
-                        )
-                        chid_to_pixel[np.abs(1439 - chid)].append(
-                            (pixel_index, fraction_whole)
-                        )
+        for pixel_index, chid, fraction_whole in zip(
+            pixel_indices[order].tolist(),
+            chids[order].tolist(),
+            fractions[order].tolist(),
+        ):
+            chid_to_pixel[np.abs(1439 - chid)].append((pixel_index, fraction_whole))
 
         hex_to_grid = [chid_to_pixel, pixel_index_to_grid]
         return hex_to_grid
 
-    def batch_processor(self, clean_images=False):
+    def compile_rebinning(self, chid_offsets, pixel_indices, fractions, size):
+        """
+        Compiles the rebinning into a sparse operator that maps the 1440 CHIDs onto the flattened grid, so that
+        rasterizing is a single sparse matrix product instead of a Python loop
+
+        np.fliplr(np.rot90(image, 3)) is the same as swapping the two grid axes, so that is already built into the
+        target index of each row
+        :param chid_offsets: Offsets into pixel_indices and fractions for each CHID, as from rebinning_to_arrays
+        :param pixel_indices: Grid pixel index of each entry
+        :param fractions: Fraction of the CHID that goes into that pixel
+        :param size: Number of grid squares along each side
+        :return: CSR matrix of shape (size*size, 1440) holding the fraction of each CHID that goes into each grid cell
+        """
+        chids = np.repeat(np.arange(1440), np.diff(chid_offsets))
+        # Off the end of the grid, the old loops could not place these either
+        on_grid = pixel_indices < size * size
+        x_index, y_index = np.divmod(pixel_indices[on_grid], size)
+        # Duplicate entries are summed, same as the += in the old loops
+        return csr_matrix(
+            (
+                np.asarray(fractions[on_grid], dtype=np.float64),
+                (y_index * size + x_index, chids[on_grid]),
+            ),
+            shape=(size * size, 1440),
+        )
+
+    def flatten_photon_streams(self, photon_streams):
+        """
+        Packs a batch of list of lists photon streams into one flat arrival array with CHID offsets, see
+        photons.flatten_photon_streams
+
+        :param photon_streams: List of list of lists photon streams, one per event
+        :return: (arrivals, offsets) where the photons of CHID c in event b are
+        arrivals[offsets[b * 1440 + c] : offsets[b * 1440 + c + 1]]
+        """
+        return photons.flatten_photon_streams(photon_streams)
+
+    def batch_photon_histogram(
+        self, arrivals, offsets, start, num_slices, end=None, overflow=False
+    ):
+        """
+        Histograms the arrival slices of each CHID of every event in a flattened batch in one pass
+
+        :param arrivals: Flat array of arrival time slices, e.g. from flatten_photon_streams
+        :param offsets: Per event and CHID offsets into arrivals, of length number_of_events * 1440 + 1
+        :param start: First time slice to keep, either one value or one per event
+        :param num_slices: Number of time slices in the output
+        :param end: If given, photons arriving at or after end are dropped, either one value or one per event
+        :param overflow: Whether photons past the last slice are added to the last slice, instead of dropped
+        :return: (number_of_events, 1440, num_slices) array of photon counts
+        """
+        return photons.photon_histogram(
+            arrivals, offsets, start, num_slices, end=end, overflow=overflow
+        )
+
+    def photon_histogram(
+        self, photon_stream, start, num_slices, end=None, overflow=False
+    ):
+        """
+        Histograms the arrival slices of each CHID in a list of lists photon stream
+
+        :param photon_stream: List of lists of arrival time slices, one list per CHID
+        :param start: First time slice to keep
+        :param num_slices: Number of time slices in the output
+        :param end: If given, photons arriving at or after end are dropped
+        :param overflow: Whether photons past the last slice are added to the last slice, instead of dropped
+        :return: (1440, num_slices) array of photon counts
+        """
+        arrivals, offsets = self.flatten_photon_streams([photon_stream])
+        return self.batch_photon_histogram(
+            arrivals, offsets, start, num_slices, end=end, overflow=overflow
+        )[0]
+
+    def rasterize(self, photon_histogram, scale=1.0):
+        """
+        Rebins a per-CHID histogram onto the square grid with the precompiled rebinning operator
+        :param photon_histogram: (1440, time_slices) array, e.g. from photon_histogram
+        :param scale: Value each photon contributes to the image
+        :return: (size, size, time_slices) image, in the same orientation as np.fliplr(np.rot90(image, 3)) gave before
+        """
+        size = int(np.round(np.sqrt(self.rebinning_matrix.shape[0])))
+        image = self.rebinning_matrix @ photon_histogram
+        if scale != 1.0:
+            image *= scale
+        return image.reshape(size, size, photon_histogram.shape[1])
+
+    def rasterize_batch(
+        self,
+        arrivals,
+        offsets,
+        start,
+        num_slices,
+        end=None,
+        overflow=False,
+        scale=1.0,
+        out=None,
+    ):
+        """
+        Rasterizes a whole ragged batch of events into one contiguous (batch, size, size, time_slices) float32 array
+
+        All photons of the batch are histogrammed in a single pass, and each event is then rebinned straight into its
+        slot in the output, so no per-event cubes are allocated and stacked afterwards
+
+        :param arrivals: Flat array of arrival time slices, e.g. from flatten_photon_streams
+        :param offsets: Per event and CHID offsets into arrivals, of length number_of_events * 1440 + 1
+        :param start: First time slice to keep, either one value or one per event
+        :param num_slices: Number of time slices in the output
+        :param end: If given, photons arriving at or after end are dropped, either one value or one per event
+        :param overflow: Whether photons past the last slice are added to the last slice, instead of dropped
+        :param scale: Value each photon contributes to the image
+        :param out: Optional preallocated, C-contiguous (number_of_events, size, size, num_slices) float32 array to write into
+        :return: The (number_of_events, size, size, num_slices) float32 images
+        """
+        histogram = self.batch_photon_histogram(
+            arrivals, offsets, start, num_slices, end=end, overflow=overflow
+        )
+        return self.rasterize_histograms(histogram, scale=scale, out=out)
+
+    def rasterize_histograms(
+        self, histogram, scale=1.0, out=None, channels_last=True, dtype=np.float32
+    ):
+        """
+        Rebins a batch of per-CHID histograms, writing each event straight into its slot in the output
+
+        :param histogram: (number_of_events, 1440, time_slices) array, e.g. from batch_photon_histogram
+        :param scale: Value each photon contributes to the image
+        :param out: Optional preallocated, C-contiguous array of the output shape and dtype to write into
+        :param channels_last: Whether the output is (number_of_events, size, size, time_slices), or else
+        (number_of_events, time_slices, size, size)
+        :param dtype: Type of the output
+        :return: The images
+        """
+        size = int(np.round(np.sqrt(self.rebinning_matrix.shape[0])))
+        num_events, _, num_slices = histogram.shape
+        if channels_last:
+            shape = (num_events, size, size, num_slices)
+        else:
+            shape = (num_events, num_slices, size, size)
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif (
+            out.shape != shape
+            or out.dtype != np.dtype(dtype)
+            or not out.flags.c_contiguous
+        ):
+            # Else the reshapes below would write into a copy, leaving out untouched
+            raise ValueError(
+                "out must be a C-contiguous {} array of shape {}".format(
+                    np.dtype(dtype), shape
+                )
+            )
+        if channels_last:
+            # The per event products are already in (size, size, slices) order, so they can be written in place
+            flat_out = out.reshape(num_events, size * size, num_slices)
+            for index, event_histogram in enumerate(histogram):
+                flat_out[index] = self.rebinning_matrix @ event_histogram
+        else:
+            flat_out = out.reshape(num_events, num_slices, size * size)
+            for index, event_histogram in enumerate(histogram):
+                flat_out[index] = (self.rebinning_matrix @ event_histogram).T
+        if scale != 1.0:
+            out *= scale
+        return out
+
+    def batches(self, file_rows, chunk_size=None):
+        """
+        Rasterizes the events of every file in self.paths, either as one list per file, or as fixed size chunks
+
+        Chunks are written into the same preallocated float32 arrays each time, so memory is bounded by chunk_size
+        instead of the number of events in a file, but each chunk is only valid until the next one is requested,
+        copy it to keep it
+
+        :param file_rows: Function from the path of a file to an iterable of the rows of its events, with the photons
+        as list of lists first, then the other values
+        :param chunk_size: Number of events in each chunk, spanning files, the last one being smaller. None for one
+        list of rows per file, with the image of each event in place of its photons
+        :return: Generator over the lists, or over the chunks in the same order as format gives them, with the images
+        (chunk_size, time_slices, size, size) as reformat gives them
+        """
+        if chunk_size is None:
+            for file in self.paths:
+                data = []
+                for row in file_rows(file):
+                    input_matrix = self.rasterize(
+                        self.photon_histogram(row[0], self.start, self.shape[3])
+                    )
+                    data.append([input_matrix] + list(row[1:]))
+                yield data
+        else:
+            rows = (row for file in self.paths for row in file_rows(file))
+            yield from self.chunk_events(rows, chunk_size)
+
+    def chunk_events(self, rows, chunk_size):
+        """
+        Packs events into fixed size chunks, see batches
+
+        :param rows: Iterable of the rows of the events, with the photons as list of lists first
+        :param chunk_size: Number of events in each chunk
+        :return: Generator over tuples of the images and a float64 array of each other value
+        """
+        images = None
+        count = 0
+        for row in rows:
+            if images is None:
+                images = np.empty(
+                    (chunk_size, self.shape[3], self.shape[2], self.shape[1]),
+                    dtype=np.float32,
+                )
+                values = np.empty((len(row) - 1, chunk_size))
+            # Transposing the (size, size, time_slices) image gives the layout of reformat
+            images[count] = self.rasterize(
+                self.photon_histogram(row[0], self.start, self.shape[3])
+            ).T
+            values[:, count] = row[1:]
+            count += 1
+            if count == chunk_size:
+                yield (images,) + tuple(values)
+                count = 0
+        if count > 0:
+            yield (images[:count],) + tuple(values[:, :count])
+
+    def batch_processor(
+        self, clean_images=False, chunk_size=None, clean_type="dbscan", thresholds=None
+    ):
         return NotImplemented
 
     def single_processor(
-        self, normalize=False, collapse_time=False, final_slices=5, clean_images=False
+        self,
+        normalize=False,
+        collapse_time=False,
+        final_slices=5,
+        clean_images=False,
+        clean_type="dbscan",
+        thresholds=None,
     ):
         return NotImplemented
 
@@ -236,14 +557,81 @@ class BasePreprocessor(object):
         """
         return NotImplementedError
 
-    def event_processor(self, directory, clean_images=False):
+    def event_processor(
+        self, directory, clean_images=False, clean_type="dbscan", thresholds=None
+    ):
         """
         Goes through each event in all the files specified in self.paths and returns each event individually, including the
         default photon-stream representation, and auxiliary data and saves it to a new file based on the
+
+        With clean_images, each event is written once as an event record with all of its photons and which of them
+        each cleaning keeps, see event_record_masks, instead of one Eventfile per cleaning. clean_type and
+        thresholds choose the cleaning, as the method and thresholds of clean_image
         :return:
         """
         return NotImplementedError
 
+    def event_record_masks(
+        self,
+        directory,
+        name,
+        event,
+        clump_size=20,
+        eps=0.1,
+        clean_type="dbscan",
+        thresholds=None,
+    ):
+        """
+        Finds the event record path and the cleaning masks of an event for event_processor with clean_images
+
+        :param directory: Directory the event records are written to
+        :param name: Name of the event, e.g. its file name and number in the file
+        :param event: PhotonStream Event
+        :param clump_size: Min samples for DBSCAN, or list of them, all of which are found from one pass over the
+        event, see cleaning_masks
+        :param eps: maximal distance between two samples to be considered same neighborhood, or list of them
+        :param clean_type: Method to clean with, either 'dbscan' or 'facttools', see clean_image
+        :param thresholds: Thresholds of the facttools cleaning, see clean_image
+        :return: (record_path, masks), or None if the event record already exists or there are no clumps
+        """
+        record_path = os.path.join(directory, name + RECORD_SUFFIX)
+        if os.path.isfile(record_path):
+            print("True: " + name)
+            return None
+        masks = self.cleaning_masks(
+            event,
+            min_samples=clump_size,
+            eps=eps,
+            method=clean_type,
+            thresholds=thresholds,
+        )
+        if masks is None:
+            print("No Clumps, skip")
+            return None
+        return record_path, masks
+
+    def cleaned_event(
+        self, event, clean_type="dbscan", only_core=True, thresholds=None
+    ):
+        """
+        Cleans an event in place while reading it, e.g. for batch_processor or single_processor with clean_images
+
+        :param event: PhotonStream Event
+        :param clean_type: Method to clean with, either 'dbscan' or 'facttools', see clean_image
+        :param only_core: Whether to only keep the core photons, or all the photons in a clump
+        :param thresholds: Thresholds of the facttools cleaning, see clean_image
+        :return: The event with only the kept photons, or None if there are no clumps
+        """
+        _, clump_photons, core_photons, _ = self.clean_image(
+            event, method=clean_type, thresholds=thresholds
+        )
+        kept = core_photons if only_core else clump_photons
+        if kept is None:
+            print("No Clumps, skip")
+            return None
+        event.photon_stream.raw = kept
+        return event
+
     def count_events(self):
         """
         Ideally to count the number of events in the files for the streaming data
@@ -258,33 +646,15 @@ class BasePreprocessor(object):
         :param image:
         :return:
         """
-        # Now have the whole data image, go through an normalize each slice
-        temp_matrix = []
-        # Should be just one datacube per image
+        image = np.array(image, dtype=np.float64)
         if per_slice:
-            for data_cube in image:
-                print("Data Cube Shape: " + str(data_cube.shape))
-                if per_slice:
-                    for image_slice in data_cube:
-                        # Each time slice you normalize
-                        mean = np.mean(image_slice)
-                        stddev = np.std(image_slice)
-                        denom = np.max([stddev, 1.0 / np.sqrt(image_slice.size)])
-                        image_slice = (image_slice - mean) / denom
-                        temp_matrix.append(image_slice)
+            # Each time slice of each data cube is normalized on its own
+            temp_matrix = image.reshape((-1,) + image.shape[2:])
+            temp_matrix = normalize_batch(temp_matrix)
+            return temp_matrix.reshape((1,) + temp_matrix.shape)
         else:
             # Do it over the whole timeslice/channels
-            mean = np.mean(image)
-            stddev = np.std(image)
-            denom = np.max([stddev, 1.0 / np.sqrt(image.size)])
-            image = (image - mean) / denom
-            return image
-        # Should be normalized now
-        temp_matrix = np.array(temp_matrix)
-        temp_matrix = temp_matrix.reshape(
-            1, temp_matrix.shape[0], temp_matrix.shape[1], temp_matrix.shape[2]
-        )
-        return temp_matrix
+            return normalize_batch(image[np.newaxis])[0]
 
     def collapse_image_time(self, image, final_slices, as_channels=False):
         """
@@ -299,28 +669,14 @@ class BasePreprocessor(object):
         :param as_channels: Boolean, if the time dimension should be moved to the channels
         :return: Converted image cube with the proper dimensions
         """
-        temp_matrix = []
-        num_slices_per_final_slice = int(np.floor(image.shape[1] / final_slices))
-        for data_cube in image:
-            # Need to now sum up along each smaller section
-            for time_slice in range(final_slices):
-                if time_slice < (final_slices - 1):
-                    image_slice = data_cube[
-                        time_slice
-                        * num_slices_per_final_slice : (
-                            (time_slice + 1) * num_slices_per_final_slice
-                        ),
-                        ::,
-                    ]
-                else:
-                    # To use all the available slices
-                    image_slice = data_cube[
-                        time_slice * num_slices_per_final_slice :, ::
-                    ]
-                image_slice = np.sum(image_slice, axis=0)
-                temp_matrix.append(image_slice)
-        # Should be normalized now
-        temp_matrix = np.array(temp_matrix)
+        image = np.asarray(image)
+        lookup = photons.slice_lookup(
+            photons.collapse_edges(image.shape[1], final_slices),
+            length=image.shape[1],
+        )
+        temp_matrix = photons.bin_slices(image, lookup, final_slices, axis=1)
+        # Every data cube is stacked along the time axis, same as appending slice by slice
+        temp_matrix = temp_matrix.reshape((-1,) + temp_matrix.shape[2:])
         # Now to convert to chennel format if needed
         if as_channels:
             temp_matrix = np.swapaxes(temp_matrix, 0, 2)
@@ -378,9 +734,11 @@ class BasePreprocessor(object):
 
         return NotImplementedError
 
-    def select_clustered_photons(self, dbscan, point_cloud, debug=True, only_core=True):
+    def select_clustered_photons(
+        self, dbscan, point_cloud, debug=True, only_core=True, indices=None
+    ):
         """
-        Take DBSCAN output on the point cloud and translate it back to a list of lists of photons
+        Take DBSCAN output on the point cloud and translate it back to raw photons
 
         Useful for using the clustering to reduce the noise in the image stacks later, image cleaning
 
@@ -392,89 +750,37 @@ class BasePreprocessor(object):
         and we can test discarding them to clean the image further, so only dbscan.core_sample_indicies_ is
         needed really
 
-        Raw to point cloud is given below where cx and cy are the geometry of the image, but not needed here
-
-        def raw_phs_to_point_cloud(raw_phs, cx, cy):
-            number_photons = len(raw_phs) - NUMBER_OF_PIXELS
-            cloud = np.zeros(shape=(number_photons, 3))
-            pixel_chid = 0
-            p = 0
-            for s in raw_phs:
-                if s == io.binary.LINEBREAK:
-                    pixel_chid += 1
-                else:
-                    cloud[p, 0] = cx[pixel_chid]
-                    cloud[p, 1] = cy[pixel_chid]
-                    cloud[p, 2] = s*TIME_SLICE_DURATION_S
-                    p += 1
-            return cloud
-
-               # Now have each index into the point cloud, so start backwards, include all those not with -1
-                    current_photon = point_cloud[idx]
-                    for index in range(1440):
-                        if np.isclose(current_photon[0], x_angle[index]) and np.isclose(current_photon[1], y_angle[index]):
-                            time_slice = int(np.round(current_photon[2] / TIME_SLICE_DURATION_S))
-                            list_of_slices.append(time_slice)
-                            # Now add to new_raw
-                            new_list_of_list[index].append(time_slice)
-        # Convert back to raw
-
-        :param dbscan:
-        :param raw_photons:
+        :param dbscan: Fitted DBSCAN or PhotonClusters of the point cloud
+        :param point_cloud: Point cloud the clusters were found on
+        :param debug: Whether to print the arrival times and number of the kept photons
+        :param only_core: Whether to only keep the core photons, or all the photons in a clump
+        :param indices: (chids, slices) of each point of point_cloud, from photons.photon_indices, else they are
+        found from the angles and times of the points
         :return: New raw photon event, or None if no clumps are found
         """
-        TIME_SLICE_DURATION_S = 0.5e-9  # Taken from FACT magic constants
-
-        core_sample = dbscan.core_sample_indices_
         labels = dbscan.labels_
-        number = len(set(dbscan.labels_)) - (1 if -1 in dbscan.labels_ else 0)
-        # Now go backwards through the raw photons and gather those ones in a new raw photon format
-        # That format will be passed to raw_photons_to_list_of_lists to create a new list_of_lists repr
-
-        pixels = fact.instrument.get_pixel_dataframe()
-        pixels.sort_values("CHID", inplace=True)
-
-        x_angle = np.deg2rad(pixels.x_angle.values)
-        y_angle = np.deg2rad(pixels.y_angle.values)
-        new_list_of_list = [[] for _ in range(1440)]
-        list_of_slices = []
-        if only_core:
-            used_labels = core_sample
-        else:
-            used_labels = labels
-        for idx, element in enumerate(used_labels):
-            # Now have each index into the point cloud, so start backwards
-            if element >= 0:
-                if only_core:
-                    current_photon = point_cloud[element]
-                else:
-                    current_photon = point_cloud[idx]
-                for index in range(1440):
-                    if np.isclose(current_photon[0], x_angle[index]) and np.isclose(
-                        current_photon[1], y_angle[index]
-                    ):
-                        time_slice = int(
-                            np.round(current_photon[2] / TIME_SLICE_DURATION_S)
-                        )
-                        list_of_slices.append(time_slice)
-                        # Now add to new_raw
-                        new_list_of_list[index].append(time_slice)
-        # Convert back to raw
-        new_raw = []
-        for sublist in new_list_of_list:
-            # Go through each sublist in order, adding 255 for each one
-            if not sublist:
-                new_raw.append(255)
-                # List is empty
-            else:
-                # Go through sublist, adding its stuff to it
-                for item in sublist:
-                    new_raw.append(item)
-                # Done with sublist, so add end one
-                new_raw.append(255)
+        number = len(np.unique(labels[labels >= 0]))
         if number == 0:
             # No clumps, so returns None
             return None
+
+        if indices is None:
+            indices = photons.cloud_indices(point_cloud)
+        chids, slices = indices
+        if only_core:
+            kept = np.zeros(len(labels), dtype=bool)
+            kept[dbscan.core_sample_indices_] = True
+        else:
+            kept = labels >= 0
+        chids = chids[kept]
+        list_of_slices = slices[kept]
+        # Photons are grouped by CHID, keeping their order within each pixel
+        order = np.argsort(chids, kind="stable")
+        offsets = np.zeros(photons.NUMBER_OF_PIXELS + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(chids, minlength=photons.NUMBER_OF_PIXELS), out=offsets[1:]
+        )
+        new_raw = photons.to_raw(list_of_slices[order], offsets)
         if debug:
             print(
                 "Start: {}, End: {}, Mean: {}, Std: {} Clumps: {} Photons Before: {} Photons Saved: {}".format(
@@ -490,41 +796,190 @@ class BasePreprocessor(object):
         return new_raw
 
     def clean_image(
-        self, event, min_samples=20, eps=0.1, method="dbscan", only_core=True
+        self,
+        event,
+        min_samples=20,
+        eps=0.1,
+        method="dbscan",
+        only_core=True,
+        thresholds=None,
     ):
         """
-        Clean the image with various methods, currently only DBSCAN
+        Clean the image with DBSCAN or the two level cleaning of FACT-Tools
 
-        DBSCAN code is taken almost directly from pyfact
+        DBSCAN code is taken almost directly from pyfact, the facttools cleaning is threshold_cleaning, which works on
+        the photon counts and mean arrival times of each pixel and its neighbouring pixels instead of on every photon,
+        so is cheap enough to use while reading the events
 
 
         :param method: Method to use, either 'dbscan' or 'facttools', where facttools uses the method used by Fact Tools,
         and DBSCAN is used in pyfact
         :param event: PhotonStream Event
-        :param min_samples: Min samples for DBSCAN
-        :param eps: maximal distance between two samples to be considered same neighborhood
-        :return: The same Photon Stream Event with only photons in a cluster
+        :param min_samples: Min samples for DBSCAN, or list of them to clean with each
+        :param eps: maximal distance between two samples to be considered same neighborhood, or list of them
+        :param thresholds: Dict of the core_threshold, boundary_threshold, time_limit and min_neighbours of the
+        facttools cleaning, see threshold_cleaning, by default its defaults
+        :return: (all, clump, core, clusters) raw photons and the PhotonClusters, where if min_samples or eps is a list,
+        clump, core and clusters are dicts keyed by the names from cleaning_clusters, clusters is None for facttools
         """
 
-        point_cloud = event.photon_stream.point_cloud
-
         if method == "dbscan":
-            dbscan = self.find_clumps(point_cloud, min_samples, eps)
-            core_photons = self.select_clustered_photons(
-                dbscan, point_cloud, only_core=True
-            )
-            clump_photons = self.select_clustered_photons(
-                dbscan, point_cloud, only_core=False
+            arrivals, offsets = self.event_photons(event)
+            dbscan = self.cleaning_clusters(
+                event, min_samples, eps, flat_photons=(arrivals, offsets)
             )
+            point_cloud = photons.point_cloud(arrivals, offsets)
+            indices = photons.photon_indices(arrivals, offsets)
+            core_photons = {}
+            clump_photons = {}
+            for name, clusters in dbscan.items():
+                core_photons[name] = self.select_clustered_photons(
+                    clusters, point_cloud, only_core=True, indices=indices
+                )
+                clump_photons[name] = self.select_clustered_photons(
+                    clusters, point_cloud, only_core=False, indices=indices
+                )
+            if np.isscalar(min_samples) and np.isscalar(eps):
+                name = str(min_samples)
+                dbscan = dbscan[name]
+                core_photons = core_photons[name]
+                clump_photons = clump_photons[name]
         elif method == "facttools":
             dbscan = None
-            return NotImplementedError
+            arrivals, offsets = self.event_photons(event)
+            clump, core = threshold_cleaning(arrivals, offsets, **(thresholds or {}))
+            if np.any(core):
+                clump_photons = photons.to_raw(
+                    *photons.select_photons(arrivals, offsets, clump)
+                )
+                core_photons = photons.to_raw(
+                    *photons.select_photons(arrivals, offsets, core)
+                )
+            else:
+                # No core pixels, the same as no clumps
+                clump_photons = None
+                core_photons = None
         else:
             raise NotImplementedError("Only dbscan or facttools implemented for now")
         all_photons = event.photon_stream.raw
 
         return all_photons, clump_photons, core_photons, dbscan
 
+    def event_photons(self, event):
+        """
+        :param event: PhotonStream Event, or CachedEvent
+        :return: (arrivals, offsets) of the photons of the event, in CHID order
+        """
+        photon_stream = event.photon_stream
+        if isinstance(photon_stream, CachedPhotonStream):
+            return photon_stream.arrivals, photon_stream.offsets
+        return photons.flatten_photon_streams([photon_stream.list_of_lists])
+
+    def cleaning_clusters(self, event, min_samples=20, eps=0.1, flat_photons=None):
+        """
+        Clusters the photons of an event with every min_samples and eps, decoding the event once and finding the
+        neighbours once per eps, as min_samples only changes which photons are core
+
+        :param event: PhotonStream Event
+        :param min_samples: Min samples for DBSCAN, or list of them
+        :param eps: maximal distance between two samples to be considered same neighborhood, or list of them
+        :param flat_photons: (arrivals, offsets) of the event if already decoded, see event_photons
+        :return: Dict of the name of each cleaning, str(min_samples), with '_eps{eps}' added if eps is a list, to its
+        PhotonClusters, which has the same labels_ and core_sample_indices_ as find_clumps
+        """
+        if flat_photons is None:
+            flat_photons = self.event_photons(event)
+        arrivals, offsets = flat_photons
+        clusters = {}
+        for value in [eps] if np.isscalar(eps) else eps:
+            neighbours = PhotonNeighbours(arrivals, offsets, value)
+            for samples in [min_samples] if np.isscalar(min_samples) else min_samples:
+                name = str(samples)
+                if not np.isscalar(eps):
+                    name += "_eps" + str(value)
+                clusters[name] = neighbours.clusters(samples)
+        return clusters
+
+    def cleaning_masks(
+        self, event, min_samples=20, eps=0.1, method="dbscan", thresholds=None
+    ):
+        """
+        Cleans the image, the same as clean_image, but only finds which photons each cleaning keeps, so
+        the event can be stored once with all of its cleanings, all from one pass over the event, see
+        cleaning_clusters
+
+        :param event: PhotonStream Event
+        :param min_samples: Min samples for DBSCAN, or list of them to clean with each
+        :param eps: maximal distance between two samples to be considered same neighborhood, or list of them
+        :param method: Method to use, either 'dbscan' or 'facttools', as in clean_image
+        :param thresholds: Thresholds of the facttools cleaning, as in clean_image
+        :return: Dict of 'clump{name}' and 'core{name}' to boolean arrays over the photons of the event in CHID order,
+        with the names from cleaning_clusters, e.g. 'clump5', or 'facttools' for facttools, or None if there are no
+        clumps for any of them
+        """
+        masks = {}
+        if method == "facttools":
+            clump, core = threshold_cleaning(
+                *self.event_photons(event), **(thresholds or {})
+            )
+            masks["clumpfacttools"] = clump
+            masks["corefacttools"] = core
+        elif method == "dbscan":
+            for name, dbscan in self.cleaning_clusters(event, min_samples, eps).items():
+                core = np.zeros(len(dbscan.labels_), dtype=bool)
+                core[dbscan.core_sample_indices_] = True
+                masks["clump" + name] = dbscan.labels_ >= 0
+                masks["core" + name] = core
+        else:
+            raise NotImplementedError("Only dbscan or facttools implemented for now")
+        if not any(np.any(mask) for mask in masks.values()):
+            return None
+        return masks
+
+    def write_cleaned_event(
+        self,
+        path,
+        event,
+        masks,
+        data,
+        data_format,
+        features=None,
+        cluster=None,
+        extract_features=None,
+    ):
+        """
+        Writes the uncleaned event with its cleaning masks as one event record, instead of one Eventfile per cleaning
+
+        :param path: Path of the event record
+        :param event: PhotonStream Event the data comes from
+        :param masks: Cleaning masks from cleaning_masks
+        :param data: Data of the event, with the uncleaned image
+        :param data_format: Dict of the name to the position of each value in data
+        :param features: Features extracted from all photons
+        :param cluster: Cluster of all photons
+        :param extract_features: Optional function taking the event and returning (features, cluster), to also store
+        the features of only the photons of each cleaning
+        :return:
+        """
+        cleaning_features = None
+        if extract_features is not None:
+            cleaning_features = {}
+            raw = event.photon_stream.raw
+            arrivals, offsets = photons.flatten_photon_streams(
+                [data[data_format["Image"]]]
+            )
+            for name, mask in masks.items():
+                if not np.any(mask):
+                    continue
+                event.photon_stream.raw = photons.to_raw(
+                    *photons.select_photons(arrivals, offsets, mask)
+                )
+                cleaning_features[name] = extract_features(event)[0]
+            event.photon_stream.raw = raw
+        write_event_record(
+            path, data, data_format, features, cluster, masks, cleaning_features
+        )
+
     def find_clumps(self, point_cloud, min_samples=20, eps=0.1):
         deg_over_s = 0.35e9
         xyt = point_cloud.copy()
@@ -546,23 +1001,47 @@ class BasePreprocessor(object):
         :return: (start,end)
         """
 
-        length = len(sorted(photon_stream, key=len, reverse=True)[0])
-        arr = np.array([xi + [np.nan] * (length - len(xi)) for xi in photon_stream])
-        try:
-            start = int(np.nanmin(arr))
-            end = int(np.nanmax(arr))
-            mean = np.nanmean(arr)
-            std = np.nanstd(arr)
-        except Exception as e:
-            # Should only fail if no photons are present
-            # print("Failed")
-            # print(photon_stream)
-            # print(len(photon_stream))
-            start = self.start
-            end = self.end
+        start, end, mean, std = photons.arrival_window(
+            *photons.flatten_photon_streams([photon_stream])
+        )
+        if start[0] < 0:
+            # No photons are present
             return -1, -1, -1, -1
 
-        return (start, end, mean, std)
+        return (int(start[0]), int(end[0]), mean[0], std[0])
+
+    def time_window(
+        self,
+        arrivals,
+        offsets,
+        dynamic_resize=False,
+        truncate=False,
+        densest_window=False,
+    ):
+        """
+        Finds the time window of each event in a flattened batch at once, without changing self.start and self.end
+
+        :param arrivals: Flat array of arrival time slices
+        :param offsets: Per event and CHID offsets into arrivals
+        :param dynamic_resize: Whether to start and end at the first and last photon of each event
+        :param truncate: Whether to end self.shape[3] slices after the start
+        :param densest_window: Whether to use the self.shape[3] slices with the most photons of each event, this
+        overrides dynamic_resize and always ends self.shape[3] slices after the start
+        :return: (start, end) arrays with one entry per event, both -1 for events without photons if the window
+        depends on the photons
+        """
+        num_events = (len(offsets) - 1) // photons.NUMBER_OF_PIXELS
+        if densest_window:
+            start, end, _ = photons.densest_window(arrivals, offsets, self.shape[3])
+            return start, end
+        if dynamic_resize:
+            start, end, _, _ = photons.arrival_window(arrivals, offsets)
+        else:
+            start = np.full(num_events, self.start, dtype=np.int64)
+            end = np.full(num_events, self.end, dtype=np.int64)
+        if truncate:
+            end = start + self.shape[3]
+        return start, end
 
     def format(self, batch):
         return NotImplemented
@@ -0,0 +1,90 @@
+import numpy as np
+from fact.instrument.camera import get_neighbor_matrix
+
+from factnn.data.preprocess import photons
+
+# Defaults of the two level cleaning, in photons per pixel and arrival time slices
+CORE_THRESHOLD = 5
+BOUNDARY_THRESHOLD = 2
+TIME_LIMIT = 10
+
+_pixel_edges = None
+
+
+def pixel_edges():
+    """
+    Every pair of neighbouring pixels of the camera, from pyfact's neighbour matrix, only made once per process
+
+    :return: (starts, neighbours) where the neighbours of CHID c are neighbours[starts[c] : starts[c + 1]], every
+    pixel having at least one
+    """
+    global _pixel_edges
+    if _pixel_edges is None:
+        matrix = get_neighbor_matrix().tocsr(copy=True)
+        matrix.eliminate_zeros()
+        matrix.sort_indices()
+        _pixel_edges = (matrix.indptr[:-1].astype(np.int64), matrix.indices)
+    return _pixel_edges
+
+
+def count_neighbours(pixels, starts):
+    """
+    :param pixels: (number_of_events, 1440) boolean array over the neighbours of each pixel, one column per row of
+    pixel_edges
+    :param starts: Starts from pixel_edges
+    :return: (number_of_events, 1440) array of how many of the neighbours of each pixel are True
+    """
+    return np.add.reduceat(pixels.astype(np.int32), starts, axis=1)
+
+
+def threshold_cleaning(
+    arrivals,
+    offsets,
+    core_threshold=CORE_THRESHOLD,
+    boundary_threshold=BOUNDARY_THRESHOLD,
+    time_limit=TIME_LIMIT,
+    min_neighbours=1,
+):
+    """
+    Two level cleaning like FACT-Tools' TwoLevelTimeNeighbor, on the number of photons and the mean arrival slice of
+    each pixel instead of the extracted charge and arrival time, for a whole batch at once
+
+    Core pixels have at least core_threshold photons and min_neighbours core neighbours, boundary pixels at least
+    boundary_threshold photons and a core neighbour, and both only stay if at least min_neighbours of the kept
+    pixels next to them have a mean arrival within time_limit slices of theirs
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: Per event and CHID offsets into arrivals
+    :param core_threshold: Photons needed in a core pixel
+    :param boundary_threshold: Photons needed in a boundary pixel
+    :param time_limit: Largest difference in mean arrival slice to a neighbour
+    :param min_neighbours: Neighbours needed by each kept pixel
+    :return: (clump, core) boolean arrays over the photons in arrivals[offsets[0] : offsets[-1]], clump being the
+    photons of the core and boundary pixels
+    """
+    starts, neighbours = pixel_edges()
+    counts = photons.photon_counts(offsets)
+    rows = np.repeat(np.arange(counts.size), counts.ravel())
+    times = np.bincount(
+        rows, weights=arrivals[offsets[0] : offsets[-1]], minlength=counts.size
+    ).reshape(counts.shape)
+    np.divide(times, counts, out=times, where=counts > 0)
+
+    core = counts >= core_threshold
+    core &= count_neighbours(core[:, neighbours], starts) >= min_neighbours
+    boundary = (
+        ~core
+        & (counts >= boundary_threshold)
+        & (count_neighbours(core[:, neighbours], starts) > 0)
+    )
+    clump = core | boundary
+    # Repeats each pixel once per neighbour, to compare it with every neighbour at once
+    own_times = np.repeat(times, np.diff(np.append(starts, len(neighbours))), axis=1)
+    in_time = clump[:, neighbours] & (
+        np.abs(own_times - times[:, neighbours]) <= time_limit
+    )
+    clump &= count_neighbours(in_time, starts) >= min_neighbours
+    core &= clump
+    return np.repeat(clump.ravel(), counts.ravel()), np.repeat(
+        core.ravel(), counts.ravel()
+    )
@@ -0,0 +1,198 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+import fact
+
+from factnn.data.preprocess import photons
+
+# Scaling of the arrival times to angles, the same as find_clumps and pyfact use
+DEG_OVER_S = 0.35e9
+TIME_SCALE = photons.TIME_SLICE_DURATION_S * np.deg2rad(DEG_OVER_S)
+
+# Pixel neighbour tables already made in this process, keyed by eps
+_neighbour_tables = {}
+
+
+def absolute_eps(eps):
+    """
+    :param eps: Neighbourhood size as a fraction of the camera diameter, as find_clumps takes it
+    :return: Neighbourhood size in radians
+    """
+    fov_radius = np.deg2rad(fact.instrument.camera.FOV_RADIUS)
+    return eps * (2.0 * fov_radius)
+
+
+def pixel_neighbours(eps):
+    """
+    Table of which pixels are within eps of each pixel, and how many time slices apart photons in them can be while
+    still being within eps, only made once per eps in each process
+
+    :param eps: Neighbourhood size as a fraction of the camera diameter
+    :return: (starts, pixels, slices) where the neighbours of CHID c are pixels[starts[c] : starts[c + 1]], including
+    c itself, and slices the largest difference in arrival slice for each of them
+    """
+    if eps not in _neighbour_tables:
+        abs_eps = absolute_eps(eps)
+        x_angle, y_angle = photons.pixel_angles()
+        distances = (x_angle[:, np.newaxis] - x_angle[np.newaxis, :]) ** 2 + (
+            y_angle[:, np.newaxis] - y_angle[np.newaxis, :]
+        ) ** 2
+        chids, neighbours = np.nonzero(distances <= abs_eps**2)
+        distances = distances[chids, neighbours]
+        max_slices = int(abs_eps / TIME_SCALE)
+        # Tested with the same sums as the distance between the points, so the border is the same
+        slices = np.full(len(chids), -1, dtype=np.int32)
+        for difference in range(max_slices + 1):
+            within = distances + (difference * TIME_SCALE) ** 2 <= abs_eps**2
+            slices[within] = difference
+        starts = np.zeros(photons.NUMBER_OF_PIXELS + 1, dtype=np.int32)
+        np.cumsum(
+            np.bincount(chids, minlength=photons.NUMBER_OF_PIXELS), out=starts[1:]
+        )
+        _neighbour_tables[eps] = (starts, neighbours.astype(np.int32), slices)
+    return _neighbour_tables[eps]
+
+
+class PhotonClusters(object):
+    """
+    Result of clustering the photons of an event, with the same labels_ and core_sample_indices_ as a fitted sklearn
+    DBSCAN on the point cloud of the event
+    """
+
+    def __init__(self, labels, core_sample_indices):
+        """
+        :param labels: Cluster of each photon, -1 for noise
+        :param core_sample_indices: Indices of the core photons
+        """
+        self.labels_ = labels
+        self.core_sample_indices_ = core_sample_indices
+
+
+class PhotonNeighbours(object):
+    """
+    Neighbours of each photon of one event, within eps in the scaled (x, y, t) space find_clumps clusters in
+
+    Photons can only be at the 1440 pixel centres and whole time slices, so the neighbours are found from the pixel
+    neighbour table and the photons sorted by pixel and arrival slice, without a general neighbour search
+    """
+
+    def __init__(self, arrivals, offsets, eps=0.1):
+        """
+        :param arrivals: Flat array of arrival time slices
+        :param offsets: CHID offsets into arrivals for one event
+        :param eps: Neighbourhood size as a fraction of the camera diameter
+        """
+        starts, pixels, slices = pixel_neighbours(eps)
+        offsets = np.asarray(offsets)
+        self.number_photons = int(offsets[-1] - offsets[0])
+        chids = np.repeat(
+            np.arange(photons.NUMBER_OF_PIXELS, dtype=np.int32), np.diff(offsets)
+        )
+        arrival_slices = arrivals[offsets[0] : offsets[-1]].astype(np.int32)
+
+        # Each pixel gets padding slices on both sides, so the time windows never reach into the next pixel
+        padding = int(slices.max())
+        width = 256 + 2 * padding
+        keys = chids * width + arrival_slices + padding
+        order = np.argsort(keys, kind="stable")
+        # Number of photons before each (pixel, slice), which is where they start when sorted by pixel and slice
+        before = np.zeros(photons.NUMBER_OF_PIXELS * width + 1, dtype=np.int32)
+        np.cumsum(
+            np.bincount(keys, minlength=photons.NUMBER_OF_PIXELS * width),
+            out=before[1:],
+        )
+
+        # One row per photon and neighbouring pixel
+        number_neighbours = starts[chids + 1] - starts[chids]
+        ends = np.cumsum(number_neighbours)
+        photon = np.repeat(
+            np.arange(self.number_photons, dtype=np.int32), number_neighbours
+        )
+        neighbour = np.repeat(
+            starts[chids] - ends + number_neighbours, number_neighbours
+        ) + np.arange(len(photon), dtype=np.int32)
+        neighbour_key = pixels[neighbour] * width + padding + arrival_slices[photon]
+        low = before[neighbour_key - slices[neighbour]]
+        found = before[neighbour_key + slices[neighbour] + 1] - low
+        # Each photon is its own neighbour, as in sklearn
+        self.counts = np.zeros(self.number_photons, dtype=np.int64)
+        if self.number_photons > 0:
+            self.counts[:] = np.add.reduceat(found, ends - number_neighbours)
+
+        self._order = order
+        self._photon = photon
+        self._low = low
+        self._found = found
+
+    def neighbour_pairs(self, photons_mask):
+        """
+        :param photons_mask: Boolean array of the photons to find the neighbours of
+        :return: (first, second) where each photon second is a neighbour of photon first, for every photon first in
+        photons_mask
+        """
+        rows = photons_mask[self._photon] & (self._found > 0)
+        found = self._found[rows]
+        ends = np.cumsum(found)
+        first = np.repeat(self._photon[rows], found)
+        second = self._order[
+            np.repeat(self._low[rows] - ends + found, found)
+            + np.arange(len(first), dtype=np.int32)
+        ]
+        return first, second
+
+    def clusters(self, min_samples=20):
+        """
+        Clusters the photons the same as DBSCAN, core photons having at least min_samples neighbours, and clusters
+        numbered in the order of their first core photon, as sklearn does
+
+        :param min_samples: Min samples for DBSCAN
+        :return: PhotonClusters
+        """
+        core = self.counts >= min_samples
+        labels = np.full(self.number_photons, -1, dtype=np.int64)
+        core_indices = np.flatnonzero(core)
+        if len(core_indices) == 0:
+            return PhotonClusters(labels, core_indices)
+
+        first, second = self.neighbour_pairs(core)
+        core_edges = core[second]
+        # Neighbours are mutual, so one direction of each edge is enough, and the pairs are already in row order
+        edges = core_edges & (first < second)
+        indptr = np.zeros(self.number_photons + 1, dtype=np.int32)
+        np.cumsum(
+            np.bincount(first[edges], minlength=self.number_photons), out=indptr[1:]
+        )
+        graph = csr_matrix(
+            (np.ones(indptr[-1], dtype=np.int8), second[edges], indptr),
+            shape=(self.number_photons, self.number_photons),
+        )
+        _, components = connected_components(graph, directed=False)
+        components = components[core_indices]
+        unique_components, first_core = np.unique(components, return_index=True)
+        cluster = np.empty(components.max() + 1, dtype=np.int64)
+        cluster[unique_components[np.argsort(first_core)]] = np.arange(
+            len(unique_components)
+        )
+        labels[core_indices] = cluster[components]
+
+        # Border photons join the first cluster that reaches them
+        border_edges = ~core_edges
+        border_labels = np.full(self.number_photons, self.number_photons)
+        np.minimum.at(border_labels, second[border_edges], labels[first[border_edges]])
+        border = border_labels < self.number_photons
+        labels[border] = border_labels[border]
+        return PhotonClusters(labels, core_indices)
+
+
+def photon_dbscan(arrivals, offsets, min_samples=20, eps=0.1):
+    """
+    Clusters the photons of one event, giving the same labels and core photons as find_clumps gives with sklearn's
+    DBSCAN on the point cloud
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: CHID offsets into arrivals for one event
+    :param min_samples: Min samples for DBSCAN
+    :param eps: Neighbourhood size as a fraction of the camera diameter
+    :return: PhotonClusters
+    """
+    return PhotonNeighbours(arrivals, offsets, eps).clusters(min_samples)
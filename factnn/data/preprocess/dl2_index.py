@@ -0,0 +1,179 @@
+import hashlib
+import os
+
+import numpy as np
+
+from factnn.data.preprocess.rebinning import share_arrays, attach_arrays
+
+# DL2 indices already loaded in this process, keyed by the file, its modification time and size and the columns and
+# keys, shared by every preprocessor and inherited by forked workers
+_dl2_registry = {}
+
+
+class DL2Index(object):
+    """
+    Sorted key index over the column pruned arrays of a DL2 table, to join PhotonStream events to their DL2 row in
+    O(log rows) instead of scanning the whole table for each event
+
+    Rows are matched on exact keys, e.g. (night, run_id, event_num), and optionally one close key matched with the
+    same tolerance as np.isclose, e.g. the simulated energy. If several rows match, the first one in the table is
+    used, the same as taking .values[0] of the matching rows of the DataFrame
+    """
+
+    def __init__(self, keys, rows, columns, close=None, rtol=1e-05, atol=1e-08):
+        """
+        :param keys: Structured array of the exact keys, then the close key, sorted
+        :param rows: Row of each entry in the original table
+        :param columns: Dict of column name to the values of that column in the same order as keys
+        :param close: Name of the close key, or None if all keys are matched exactly
+        :param rtol: Relative tolerance of the close key, as in np.isclose
+        :param atol: Absolute tolerance of the close key, as in np.isclose
+        """
+        self.keys = keys
+        self.rows = rows
+        self.columns = columns
+        self.close = close
+        self.rtol = rtol
+        self.atol = atol
+
+    @classmethod
+    def from_table(cls, table, columns, keys, close=None, rtol=1e-05, atol=1e-08):
+        """
+        Builds the index from a DL2 table
+
+        :param table: DataFrame or dict of column name to array
+        :param columns: Columns to keep for the joined events
+        :param keys: Names of the columns matched exactly
+        :param close: Name of the column matched with np.isclose, or None
+        :return: DL2Index
+        """
+        key_names = list(keys) + ([close] if close is not None else [])
+        key_values = [np.asarray(table[name]) for name in key_names]
+        num_rows = len(key_values[0])
+        # Sorted by the keys, then by row so the first matching row comes first among equal keys
+        order = np.lexsort([np.arange(num_rows)] + key_values[::-1])
+        sorted_keys = np.empty(
+            num_rows,
+            dtype=[(name, value.dtype) for name, value in zip(key_names, key_values)],
+        )
+        for name, value in zip(key_names, key_values):
+            sorted_keys[name] = value[order]
+        return cls(
+            sorted_keys,
+            order.astype(np.int64),
+            dict((name, np.asarray(table[name])[order]) for name in columns),
+            close=close,
+            rtol=rtol,
+            atol=atol,
+        )
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, column):
+        """
+        :param column: Column name
+        :return: Values of that column, indexed by the positions lookup gives
+        """
+        return self.columns[column]
+
+    def lookup(self, *keys):
+        """
+        Finds the matching row for a batch of events
+
+        :param keys: Values of each exact key, then of the close key, each a scalar or an array with one value per event
+        :return: Array of the position of the matching row of each event, -1 if there is none
+        """
+        keys = np.broadcast_arrays(*[np.atleast_1d(key) for key in keys])
+        names = self.keys.dtype.names
+        lower = np.empty(len(keys[0]), dtype=self.keys.dtype)
+        for name, value in zip(names, keys):
+            lower[name] = value
+        upper = lower.copy()
+        if self.close is not None:
+            value = keys[-1].astype(np.float64)
+            tolerance = self.atol + self.rtol * np.abs(value)
+            lower[self.close] = value - tolerance
+            upper[self.close] = value + tolerance
+        start = np.searchsorted(self.keys, lower, side="left")
+        end = np.searchsorted(self.keys, upper, side="right")
+        positions = np.where(end > start, start, -1)
+        if self.close is not None:
+            # Several rows within the tolerance are sorted by the close key, not by row, so take the first row
+            for event in np.flatnonzero(end - start > 1):
+                positions[event] = start[event] + np.argmin(
+                    self.rows[start[event] : end[event]]
+                )
+        return positions
+
+    def find(self, *keys):
+        """
+        Finds the matching row of a single event
+
+        :param keys: Value of each exact key, then of the close key
+        :return: Dict of column name to value of the matching row, or None if there is none
+        """
+        position = self.lookup(*keys)[0]
+        if position < 0:
+            return None
+        return self.row(position)
+
+    def row(self, position):
+        """
+        :param position: Position lookup gave
+        :return: Dict of column name to value of that row
+        """
+        return dict((name, values[position]) for name, values in self.columns.items())
+
+
+def load_dl2_index(dl2_file, columns, keys, close=None, key="events"):
+    """
+    Loads the DL2 index of a file from the process wide registry. The first process on the host to use it reads the
+    columns from the file and shares the sorted arrays with share_arrays, so every other process, including each pool
+    worker, memory maps the same pages instead of reading the DL2 file again
+
+    :param dl2_file: Path to the DL2 HDF5 file
+    :param columns: Columns to keep for the joined events
+    :param keys: Names of the columns matched exactly
+    :param close: Name of the column matched with np.isclose, or None
+    :param key: Group of the DL2 file the events are in
+    :return: DL2Index
+    """
+    stat = os.stat(dl2_file)
+    registry_key = (
+        os.path.abspath(dl2_file),
+        stat.st_mtime,
+        stat.st_size,
+        key,
+        tuple(columns),
+        tuple(keys),
+        close,
+    )
+    if registry_key in _dl2_registry:
+        return _dl2_registry[registry_key]
+    name = "factnn_dl2_" + hashlib.sha1(repr(registry_key).encode()).hexdigest()
+    arrays = attach_arrays(name)
+    if arrays is None:
+        # Only needed, with PyTables, by the process building the index
+        from fact.io import read_h5py
+
+        key_names = list(keys) + ([close] if close is not None else [])
+        table = read_h5py(
+            dl2_file,
+            key=key,
+            columns=list(columns)
+            + [column for column in key_names if column not in columns],
+        )
+        index = DL2Index.from_table(table, columns, keys, close=close)
+        arrays = share_arrays(
+            name,
+            [index.keys, index.rows] + [index.columns[column] for column in columns],
+        )
+    index = DL2Index(
+        arrays[0],
+        arrays[1],
+        dict(zip(columns, arrays[2:])),
+        close=close,
+    )
+    _dl2_registry[registry_key] = index
+    return index
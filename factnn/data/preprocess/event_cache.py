@@ -0,0 +1,211 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+from factnn.data.preprocess import photons
+from factnn.data.dataset.event_store import EventStoreWriter, open_store, MANIFEST
+
+# Simulation truth of the cached events, with only the values the preprocessors use
+AirShowerTruth = namedtuple("AirShowerTruth", ["energy", "phi", "theta"])
+SimulationTruth = namedtuple("SimulationTruth", ["run", "event", "reuse", "air_shower"])
+
+DATA_FORMAT = {
+    "Image": 0,
+    "Zd_Deg": 1,
+    "Az_Deg": 2,
+    "Run": 3,
+    "Event": 4,
+    "Reuse": 5,
+    "Energy": 6,
+    "Phi": 7,
+    "Theta": 8,
+}
+
+
+class CachedPhotonStream(object):
+    """
+    Photons of one cached event, with the same raw, list_of_lists and point_cloud as photon_stream's PhotonStream,
+    each only built when it is used
+    """
+
+    def __init__(self, arrivals, offsets):
+        """
+        :param arrivals: Flat array of arrival time slices, e.g. the memory map of a whole shard
+        :param offsets: CHID offsets into arrivals for the event
+        """
+        self.arrivals = arrivals
+        self.offsets = offsets
+
+    @property
+    def raw(self):
+        return photons.to_raw(self.arrivals, self.offsets)
+
+    @raw.setter
+    def raw(self, raw):
+        # e.g. to only keep the photons of a cleaning, as on photon_stream's PhotonStream
+        self.arrivals, self.offsets = photons.from_raw(raw)
+
+    @property
+    def list_of_lists(self):
+        return photons.to_list_of_lists(self.arrivals, self.offsets)[0]
+
+    @property
+    def point_cloud(self):
+        return photons.point_cloud(self.arrivals, self.offsets)
+
+    @property
+    def number_photons(self):
+        return int(self.offsets[-1] - self.offsets[0])
+
+
+class CachedEvent(object):
+    """
+    Simulated event read from the cache, in place of a photon_stream Event from SimulationReader
+    """
+
+    def __init__(self, photon_stream, zd, az, simulation_truth):
+        self.photon_stream = photon_stream
+        self.zd = zd
+        self.az = az
+        self.simulation_truth = simulation_truth
+
+
+def simulation_cache_path(path, mc_truth, cache_directory):
+    """
+    Where the decoded events of a simulation file are cached, which changes whenever the PhotonStream or CORSIKA
+    file does
+
+    :param path: Path to the phs.jsonl.gz file
+    :param mc_truth: Path to its CORSIKA .ch.gz file
+    :param cache_directory: Directory of the caches
+    :return: Directory of the EventStore holding the cache of the file
+    """
+    key = []
+    for source in (path, mc_truth):
+        stat = os.stat(source)
+        key += [os.path.abspath(source), stat.st_mtime, stat.st_size]
+    name = os.path.basename(path).split(".phs")[0]
+    return os.path.join(
+        cache_directory,
+        name + "_" + hashlib.sha1(repr(key).encode()).hexdigest()[:16],
+    )
+
+
+def simulation_events(path, mc_truth=None, cache_directory=None):
+    """
+    Reads the events of a simulation file, the same as photon_stream's SimulationReader, but the first pass over
+    the file caches the decoded photons and simulation truth as an EventStore, and later passes read the cache
+    instead of decoding the gzipped JSON and CORSIKA file again
+
+    The cache is only kept once the whole file has been read
+
+    :param path: Path to the phs.jsonl.gz file
+    :param mc_truth: Path to its CORSIKA .ch.gz file, by default next to it
+    :param cache_directory: Directory of the caches, None to not cache
+    :return: Iterator over the events, photon_stream Events or CachedEvents
+    """
+    if mc_truth is None:
+        mc_truth = path.split(".phs")[0] + ".ch.gz"
+    if cache_directory is not None:
+        cache = simulation_cache_path(path, mc_truth, cache_directory)
+        if os.path.isfile(os.path.join(cache, MANIFEST)):
+            return _read_cache(cache)
+    # Only needed when the file is not cached yet
+    import photon_stream as ps
+
+    events = ps.SimulationReader(photon_stream_path=path, mmcs_corsika_path=mc_truth)
+    if cache_directory is None:
+        return iter(events)
+    return cache_events(events, cache)
+
+
+def count_simulation_events(path, mc_truth=None, cache_directory=None):
+    """
+    Number of events in a simulation file, from the cache without reading the events if it is cached, otherwise
+    reading it once fills the cache
+
+    :param path: Path to the phs.jsonl.gz file
+    :param mc_truth: Path to its CORSIKA .ch.gz file, by default next to it
+    :param cache_directory: Directory of the caches, None to not cache
+    :return: Number of events
+    """
+    if mc_truth is None:
+        mc_truth = path.split(".phs")[0] + ".ch.gz"
+    if cache_directory is not None:
+        cache = simulation_cache_path(path, mc_truth, cache_directory)
+        if os.path.isfile(os.path.join(cache, MANIFEST)):
+            return len(open_store(cache))
+    return sum(1 for _ in simulation_events(path, mc_truth, cache_directory))
+
+
+def cache_events(events, cache):
+    """
+    Passes on simulated events while writing them to a cache, which is only kept once all of them have been read
+
+    :param events: Iterable of photon_stream Events or CachedEvents
+    :param cache: Directory of the EventStore to cache them in, e.g. from simulation_cache_path
+    :return: Iterator over the same events
+    """
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    # Written to a temporary directory then moved into place, so a pass that stops early leaves no partial cache
+    temp_directory = tempfile.mkdtemp(dir=os.path.dirname(cache), prefix=".tmp_")
+    complete = False
+    try:
+        writer = EventStoreWriter(temp_directory)
+        for event in events:
+            truth = event.simulation_truth
+            writer.add_event(
+                [
+                    photons.flatten_photon_streams([event.photon_stream.list_of_lists]),
+                    event.zd,
+                    event.az,
+                    truth.run,
+                    truth.event,
+                    truth.reuse,
+                    truth.air_shower.energy,
+                    truth.air_shower.phi,
+                    truth.air_shower.theta,
+                ],
+                DATA_FORMAT,
+            )
+            yield event
+        writer.close()
+        complete = True
+    finally:
+        if complete:
+            try:
+                os.replace(temp_directory, cache)
+            except OSError as e:
+                # Another process finished caching the same file first, its cache is used instead
+                if not os.path.isfile(os.path.join(cache, MANIFEST)):
+                    print("Could not cache {}: {}".format(cache, e))
+        shutil.rmtree(temp_directory, ignore_errors=True)
+
+
+def _read_cache(cache):
+    store = open_store(cache)
+    if len(store) == 0:
+        return
+    columns = dict(
+        (name, store.column("data/" + name).tolist())
+        for name in DATA_FORMAT
+        if name != "Image"
+    )
+    for event_id in range(len(store)):
+        yield CachedEvent(
+            CachedPhotonStream(*store.event_photons(event_id)),
+            columns["Zd_Deg"][event_id],
+            columns["Az_Deg"][event_id],
+            SimulationTruth(
+                columns["Run"][event_id],
+                columns["Event"][event_id],
+                columns["Reuse"][event_id],
+                AirShowerTruth(
+                    columns["Energy"][event_id],
+                    columns["Phi"][event_id],
+                    columns["Theta"][event_id],
+                ),
+            ),
+        )
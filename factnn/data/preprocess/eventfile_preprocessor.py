@@ -1,17 +1,24 @@
 import numpy as np
 from factnn.data.preprocess.base_preprocessor import BasePreprocessor
-import pickle
+from factnn.data.preprocess import photons
+from factnn.data.preprocess.normalization import normalize_batch, ImageStatistics
+from factnn.data.dataset.event_store import load_event, StoredEvent
 import os
 
 
 class EventFilePreprocessor(BasePreprocessor):
+    # Number of the features feature_list gives
+    num_features = 8
+
     def init(self):
         pass
 
-    def check_files(self, paths, title):
+    def check_files(self, paths, title, catalog=None):
         """
         Check various things on the given paths, like non-null photons, and overall distribution of starting and end points
         :param paths:
+        :param catalog: Optional EventCatalog, if given it is updated with the paths and the time windows are read from
+        it, so only new or changed Eventfiles are opened
         :return:
         """
         starts = []
@@ -21,28 +28,39 @@ class EventFilePreprocessor(BasePreprocessor):
         failed_paths = []
         import matplotlib.pyplot as plt
 
+        windows = {}
+        if catalog is not None:
+            file_paths = [path for path in paths if not isinstance(path, StoredEvent)]
+            catalog.update(file_paths)
+            windows = catalog.time_windows(file_paths)
         for index, file in enumerate(paths):
             try:
-                with open(file, "rb") as pickled_event:
-                    data, data_format = pickle.load(pickled_event)
+                if (
+                    not isinstance(file, StoredEvent)
+                    and os.path.abspath(file) in windows
+                ):
+                    self.start, self.end, mean, std = windows[os.path.abspath(file)]
+                else:
+                    data, data_format, _, _ = load_event(file)
                     self.start, self.end, mean, std = self.dynamic_size(
                         data[data_format["Image"]]
                     )
-                    if self.start < 0:
-                        failed_paths.append(file)
-                    else:
-                        # Real paths
-                        starts.append(self.start)
-                        ends.append(self.end)
-                        means.append(mean)
-                        stds.append(std)
+                if self.start < 0:
+                    failed_paths.append(file)
+                else:
+                    # Real paths
+                    starts.append(self.start)
+                    ends.append(self.end)
+                    means.append(mean)
+                    stds.append(std)
             except Exception as e:
                 print(e)
                 print(file)
                 print(paths)
                 failed_paths.append(file)
         for path in failed_paths:
-            os.remove(path)
+            if not isinstance(path, StoredEvent):
+                os.remove(path)
         #    print("Removed: ", path)
         # print("Number of failed paths: ", len(failed_paths))
         # plt.hist(starts)
@@ -72,124 +90,94 @@ class EventFilePreprocessor(BasePreprocessor):
         return_features=False,
         return_collapsed=False,
         norm_per_slice=False,
+        statistics=None,
+        densest_window=False,
     ):
+        """
+        Takes Eventfile format file paths, and returns the images with optional preprocessing
+
+        :param paths: Paths to the Eventfiles
+        :param collapse_time: Whether to collapse the time slices to final_slices
+        :param final_slices: Number of time slices after collapsing
+        :param normalize: Whether to normalize each image on its own
+        :param dynamic_resize: Whether to start and end at the first and last photon of each event
+        :param truncate: Whether to drop photons after the last slice, instead of adding them to it
+        :param equal_slices: Whether each slice holds an equal number of time slices between start and end
+        :param return_features: Whether to return the Hillas features extracted beforehand
+        :param return_collapsed: Whether to also return the image collapsed to a single slice
+        :param norm_per_slice: Whether normalize is done per time slice
+        :param statistics: ImageStatistics over the final images, e.g. from dataset_statistics, if given the images are
+        normalized with those global statistics instead of each on its own
+        :param densest_window: Whether to use the self.shape[3] slices with the most photons of each event, instead of
+        the fixed or dynamic start and end
+        """
         all_data = []
         for index, file in enumerate(paths):
-            # load the pickled file from the disk
-            if os.path.getsize(file) > 0:
+            # load the pickled file from the disk, or the event from an EventStore
+            event = load_event(file, flat=True)
+            if event is not None:
                 # Checks that file is not 0
-                with open(file, "rb") as pickled_event:
-                    data, data_format, features, feature_cluster = pickle.load(
-                        pickled_event
+                data, data_format, features, feature_cluster = event
+                if return_features:
+                    if features["extraction"] == 1:
+                        # Failed feature extraction, so ignore event
+                        continue
+                    else:
+                        feature_list = self.feature_list(features)
+                # Flattened once, every view of the photons below is made from these
+                arrivals, offsets = data[data_format["Image"]]
+                # Do dynamic resizing if wanted, so start and end are only within the bounds, potentially saving memory
+                start, end = self.time_window(
+                    arrivals, offsets, dynamic_resize, truncate, densest_window
+                )
+                start, end = int(start[0]), int(end[0])
+
+                if equal_slices:
+                    # Each slice is an equal number of timeslices summed up, to fit within the orignal constraints
+                    lookup = photons.slice_lookup(
+                        photons.equal_width_edges(start, end, self.shape[3])
                     )
-                    if return_features:
-                        if features["extraction"] == 1:
-                            # Failed feature extraction, so ignore event
-                            continue
-                        else:
-                            # Based off a subset the Open Crab Sample Analysis
-                            feature_list = []
-                            feature_list.append(features["head_tail_ratio"])
-                            feature_list.append(features["length"])
-                            feature_list.append(features["width"])
-                            feature_list.append(features["time_gradient"])
-                            feature_list.append(features["number_photons"])
-                            feature_list.append(
-                                features["length"] * features["width"] * np.pi
-                            )
-                            feature_list.append(
-                                (
-                                    (features["length"] * features["width"] * np.pi)
-                                    / np.log(features["number_photons"]) ** 2
-                                )
-                            )
-                            feature_list.append(
-                                (
-                                    features["number_photons"]
-                                    / (features["length"] * features["width"] * np.pi)
-                                )
-                            )
-                    input_matrix = np.zeros(
-                        [self.shape[1], self.shape[2], self.shape[3]]
+                else:
+                    # If not truncating, the last frame has all the rest of the frames
+                    lookup = photons.slice_lookup(
+                        start + np.arange(self.shape[3] + 1),
+                        overflow=not truncate,
+                        end=end,
                     )
-                    chid_to_pixel = self.rebinning[0]
-                    pixel_index_to_grid = self.rebinning[1]
-                    # Do dynamic resizing if wanted, so start and end are only within the bounds, potentially saving memory
-                    if dynamic_resize:
-                        self.start, self.end, _, _ = self.dynamic_size(
-                            data[data_format["Image"]]
-                        )
-
-                    if truncate:
-                        # Truncates the images at x timesteps in, each slice is one temporal slice
-                        self.end = self.start + self.shape[3]
-
-                    if equal_slices:
-                        # Creates a slice size that then assignes all values in those set of slices to a single slice to fit
-                        # within the orignal constraints, each slice is an equal number of timeslices summed up
-                        slice_size = int(
-                            np.ceil((self.end - self.start) / self.shape[3])
-                        )
-                        slice_sizes = []
-                        for i in range(self.shape[3]):
-                            # Organized smallest to largest
-                            slice_sizes.append(((i) * slice_size) + self.start)
-
-                    for index in range(1440):
-                        for element in chid_to_pixel[index]:
-                            coords = pixel_index_to_grid[element[0]]
-                            for value in data[data_format["Image"]][index]:
-                                if self.end > value >= self.start:
-                                    # Now add more logic for the other cases
-                                    # Nothing for truncate, end is already specified
-                                    # Equal slices is only real one
-                                    if equal_slices:
-                                        for idx, number in enumerate(slice_sizes):
-                                            if (idx * slice_size) < value <= number:
-                                                # In the range of the slice, add to it
-                                                input_matrix[coords[0]][coords[1]][
-                                                    idx
-                                                ] += (element[1] * 1)
-                                                break
-                                    elif not truncate:
-                                        # Now sum up last one, as equal already used, so last frame has all the rest of the frames
-                                        if value - self.start >= self.shape[3]:
-                                            input_matrix[coords[0]][coords[1]][
-                                                self.shape[3] - 1
-                                            ] += (element[1] * 1)
-                                        else:
-                                            input_matrix[coords[0]][coords[1]][
-                                                value - self.start
-                                            ] += (element[1] * 1)
-                                    else:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 1)
+                photon_histogram = self.binned_photon_histogram(
+                    arrivals,
+                    offsets,
+                    lookup,
+                    final_slices if collapse_time and not normalize else None,
+                )
+                input_matrix = self.rasterize(photon_histogram)
 
-                    # Now have image in resized format, all other data is set
-                    data[data_format["Image"]] = np.fliplr(np.rot90(input_matrix, 3))
-                    # need to do the format thing here, and add auxiliary structure
-                    data = self.format([data, data_format])
+                # Now have image in resized format, all other data is set
+                data[data_format["Image"]] = input_matrix
+                # need to do the format thing here, and add auxiliary structure
+                data = self.format([data, data_format])
+                if return_collapsed:
+                    collapsed_data = self.collapse_image_time(
+                        data[0], 1, self.as_channels
+                    )
+                if normalize:
+                    data = list(data)
+                    data[0] = self.normalize_image(data[0], per_slice=norm_per_slice)
+                    data = tuple(data)
                     if return_collapsed:
-                        collapsed_data = self.collapse_image_time(
-                            data[0], 1, self.as_channels
-                        )
-                    if normalize:
-                        data = list(data)
-                        data[0] = self.normalize_image(
-                            data[0], per_slice=norm_per_slice
-                        )
-                        data = tuple(data)
-                        if return_collapsed:
-                            collapsed_data = self.normalize_image(
-                                collapsed_data, per_slice=False
-                            )
-                    if collapse_time:
-                        data = list(data)
-                        data[0] = self.collapse_image_time(
-                            data[0], final_slices, self.as_channels
+                        collapsed_data = self.normalize_image(
+                            collapsed_data, per_slice=False
                         )
-                        data = tuple(data)
+                if collapse_time:
+                    data = list(data)
+                    data[0] = self.collapse_image_time(
+                        data[0], final_slices, self.as_channels
+                    )
+                    data = tuple(data)
+                if statistics is not None:
+                    data = list(data)
+                    data[0] = normalize_batch(data[0], statistics=statistics)
+                    data = tuple(data)
                 temp_data = [data, data_format]
                 if return_features:
                     temp_data.append(feature_list)
@@ -199,6 +187,52 @@ class EventFilePreprocessor(BasePreprocessor):
         # Now have all the data transformed as necessary, return as list of list of images, data_formats
         return all_data
 
+    def feature_list(self, features):
+        """
+        Gathers the Hillas features used for training from those extracted beforehand, based off a subset of the Open
+        Crab Sample Analysis
+        :param features: Dict of features, as stored in the Eventfile
+        :return: List of the features
+        """
+        area = features["length"] * features["width"] * np.pi
+        return [
+            features["head_tail_ratio"],
+            features["length"],
+            features["width"],
+            features["time_gradient"],
+            features["number_photons"],
+            area,
+            area / np.log(features["number_photons"]) ** 2,
+            features["number_photons"] / area,
+        ]
+
+    def dataset_statistics(
+        self, paths, axis=(0,), chunk_size=128, output_file=None, **kwargs
+    ):
+        """
+        Streams once over the Eventfiles and accumulates the global mean and standard deviation of the final images,
+        so on_files_processor can normalize every batch the same way with statistics
+
+        :param paths: Paths to the Eventfiles, usually the training set
+        :param axis: Axes the statistics are taken over, 0 being the event axis, e.g. (0,) for per pixel
+        :param chunk_size: Number of Eventfiles processed at a time
+        :param output_file: If given, where to save the statistics, e.g. next to the dataset
+        :param kwargs: Arguments for on_files_processor, the same as used for training, without normalize
+        :return: ImageStatistics
+        """
+        statistics = ImageStatistics(axis=axis)
+        for start in range(0, len(paths), chunk_size):
+            images = self.on_files_processor(
+                paths[start : start + chunk_size], normalize=False, **kwargs
+            )
+            if images:
+                statistics.update(
+                    np.concatenate([image[0][0] for image in images], axis=0)
+                )
+        if output_file is not None:
+            statistics.save(output_file)
+        return statistics
+
     def single_processor(
         self, normalize=False, collapse_time=False, final_slices=5, clean_images=False
     ):
@@ -216,35 +250,57 @@ class EventFilePreprocessor(BasePreprocessor):
         :param final_slices:
         :return:
         """
-        with open(filepath, "rb") as data_file:
-            data, data_format = pickle.load(data_file)
-            input_matrix = np.zeros([self.shape[1], self.shape[2], self.shape[3]])
-            chid_to_pixel = self.rebinning[0]
-            pixel_index_to_grid = self.rebinning[1]
-            for index in range(1440):
-                for element in chid_to_pixel[index]:
-                    coords = pixel_index_to_grid[element[0]]
-                    for value in data[data_format["Image"]][index]:
-                        if self.end > value >= self.start:
-                            input_matrix[coords[0]][coords[1]][value - self.start] += (
-                                element[1] * 1
-                            )
+        data, data_format, _, _ = load_event(filepath, flat=True)
+        arrivals, offsets = data[data_format["Image"]]
+        lookup = photons.slice_lookup(
+            self.start + np.arange(self.shape[3] + 1), end=self.end
+        )
+        input_matrix = self.rasterize(
+            self.binned_photon_histogram(
+                arrivals,
+                offsets,
+                lookup,
+                final_slices if collapse_time and not normalize else None,
+            )
+        )
 
-            # Now have image in resized format, all other data is set
-            data[data_format["Image"]] = np.fliplr(np.rot90(input_matrix, 3))
-            # need to do the format thing here, and add auxiliary structure
-            data = self.format([data, data_format])
-            if normalize:
-                data = list(data)
-                data[0] = self.normalize_image(data[0])
-                data = tuple(data)
-            if collapse_time:
-                data = list(data)
-                data[0] = self.collapse_image_time(
-                    data[0], final_slices, self.as_channels
-                )
-                data = tuple(data)
-            yield data, data_format
+        # Now have image in resized format, all other data is set
+        data[data_format["Image"]] = input_matrix
+        # need to do the format thing here, and add auxiliary structure
+        data = self.format([data, data_format])
+        if normalize:
+            data = list(data)
+            data[0] = self.normalize_image(data[0])
+            data = tuple(data)
+        if collapse_time:
+            data = list(data)
+            data[0] = self.collapse_image_time(data[0], final_slices, self.as_channels)
+            data = tuple(data)
+        yield data, data_format
+
+    def binned_photon_histogram(self, arrivals, offsets, lookup, final_slices=None):
+        """
+        Histograms one flattened event into the self.shape[3] time bins of lookup, optionally collapsing those
+        straight to final_slices, so the full image cube is never made for collapsed images
+
+        Collapsing an image made from the collapsed histogram with collapse_image_time gives the same image as
+        collapsing the full one, as the time bins are already summed up
+
+        :param arrivals: Flat array of arrival time slices
+        :param offsets: CHID offsets into arrivals
+        :param lookup: Bin of each arrival slice, from photons.slice_lookup
+        :param final_slices: If given, the number of slices to collapse the self.shape[3] bins to
+        :return: (1440, time_bins) array of photon counts
+        """
+        num_bins = self.shape[3]
+        if final_slices is not None:
+            collapse = photons.slice_lookup(
+                photons.collapse_edges(self.shape[3], final_slices),
+                length=self.shape[3],
+            )
+            lookup = np.where(lookup >= 0, collapse[lookup], -1)
+            num_bins = final_slices
+        return photons.binned_photon_histogram(arrivals, offsets, lookup, num_bins)[0]
 
     def format(self, batch):
         data = batch[0]
@@ -270,26 +326,13 @@ class EventFilePreprocessor(BasePreprocessor):
 
         # TODO: Look into more even distribution of information, like each slce having multiple timesteps vs the last one
         # having them all
-        temp_matrix = []
-        num_slices_per_final_slice = int(np.floor(image.shape[2] / final_slices))
-        # Need to now sum up along each smaller section
-        for time_slice in range(final_slices):
-            if time_slice < (final_slices - 1):
-                image_slice = image[
-                    ::,
-                    ::,
-                    time_slice
-                    * num_slices_per_final_slice : (
-                        (time_slice + 1) * num_slices_per_final_slice
-                    ),
-                ]
-            else:
-                # To use all the available slices
-                image_slice = image[::, ::, time_slice * num_slices_per_final_slice :]
-            image_slice = np.sum(image_slice, axis=2)
-            temp_matrix.append(image_slice)
-        # Should be normalized now
-        temp_matrix = np.array(temp_matrix)
+        lookup = photons.slice_lookup(
+            photons.collapse_edges(image.shape[2], final_slices),
+            length=image.shape[2],
+        )
+        temp_matrix = np.moveaxis(
+            photons.bin_slices(image, lookup, final_slices, axis=2), 2, 0
+        )
         # Now to convert to chennel format if needed
         if as_channels:
             temp_matrix = np.swapaxes(temp_matrix, 0, 2)
@@ -0,0 +1,116 @@
+import numpy as np
+
+
+def normalize_batch(images, axis=None, statistics=None):
+    """
+    Normalizes a whole batch of images at once to zero mean and unit standard deviation, in place if the images are
+    already a float array
+
+    Without statistics, each image is normalized with its own mean and standard deviation along axis, e.g. for
+    (batch, time_slices, width, height) images axis=(2, 3) is per slice, and axis=(1, 2, 3) is per data cube. As
+    before, the standard deviation is at least 1 / sqrt(number of values it is taken over)
+
+    :param images: Array of images, with the events along the first axis
+    :param axis: Axes to take the mean and standard deviation along, defaults to all but the first one
+    :param statistics: ImageStatistics, if given that global mean and standard deviation is used instead, so the
+    normalization does not depend on what else is in the batch
+    :return: The normalized images
+    """
+    if not (isinstance(images, np.ndarray) and images.dtype.kind == "f"):
+        images = np.asarray(images, dtype=np.float32)
+    if statistics is not None:
+        mean = statistics.mean
+        denom = np.maximum(statistics.std, 1.0 / np.sqrt(statistics.count))
+    else:
+        if axis is None:
+            axis = tuple(range(1, images.ndim))
+        mean = np.mean(images, axis=axis, keepdims=True)
+        denom = np.maximum(
+            np.std(images, axis=axis, keepdims=True),
+            1.0 / np.sqrt(images.size / mean.size),
+        )
+    images -= mean.astype(images.dtype, copy=False)
+    images /= denom.astype(images.dtype, copy=False)
+    return images
+
+
+class ImageStatistics(object):
+    """
+    Global mean and standard deviation of images, accumulated batch by batch with Welford's algorithm, so it can be
+    streamed over a whole training set once, saved next to the dataset, and then used to normalize every batch the
+    same way
+    """
+
+    def __init__(self, axis=(0,)):
+        """
+        :param axis: Axes of each batch the statistics are taken over, has to include the event axis 0, e.g. for
+        (batch, time_slices, width, height) images (0, 2, 3) is per slice, and (0,) per pixel
+        """
+        self.axis = tuple(axis)
+        if 0 not in self.axis:
+            raise ValueError("The statistics have to be taken over the event axis 0")
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, images):
+        """
+        Adds a batch of images to the statistics
+        :param images: Array of images, with the events along the first axis
+        :return:
+        """
+        images = np.asarray(images, dtype=np.float64)
+        if images.shape[0] == 0:
+            return
+        batch_count = images.size // np.prod(
+            [
+                images.shape[index]
+                for index in range(images.ndim)
+                if index not in self.axis
+            ]
+        )
+        batch_mean = np.mean(images, axis=self.axis, keepdims=True)
+        batch_m2 = np.sum((images - batch_mean) ** 2, axis=self.axis, keepdims=True)
+        if self.mean is None:
+            self.count = batch_count
+            self.mean = batch_mean
+            self.m2 = batch_m2
+            return
+        # Combine the two sets of statistics, the batch form of Welford's update
+        count = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * (batch_count / count)
+        self.m2 = self.m2 + batch_m2 + delta**2 * (self.count * batch_count / count)
+        self.count = count
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+    def save(self, output_file):
+        """
+        Saves the statistics, e.g. next to the dataset they were taken over
+        :param output_file: Path to save to, should end in .npz
+        :return:
+        """
+        np.savez(
+            output_file,
+            axis=np.array(self.axis),
+            count=self.count,
+            mean=self.mean,
+            m2=self.m2,
+        )
+
+    @classmethod
+    def load(cls, input_file):
+        """
+        Loads statistics saved with save
+        :param input_file: Path to the saved statistics
+        :return: ImageStatistics
+        """
+        with np.load(input_file) as saved:
+            statistics = cls(axis=saved["axis"].tolist())
+            statistics.count = int(saved["count"])
+            statistics.mean = saved["mean"]
+            statistics.m2 = saved["m2"]
+        return statistics
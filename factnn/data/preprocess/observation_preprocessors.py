@@ -1,7 +1,7 @@
 import numpy as np
 import h5py
 import photon_stream as ps
-from fact.io import read_h5py
+from factnn.data.preprocess.dl2_index import load_dl2_index
 import datetime
 import os
 import pickle
@@ -11,9 +11,9 @@ from factnn.data.preprocess.base_preprocessor import BasePreprocessor
 
 class ObservationPreprocessor(BasePreprocessor):
     def init(self):
-        self.dl2_file = read_h5py(
+        # Joins each event to its DL2 row by night, run and event number
+        self.dl2_index = load_dl2_index(
             self.dl2_file,
-            key="events",
             columns=[
                 "event_num",
                 "run_id",
@@ -28,10 +28,18 @@ class ObservationPreprocessor(BasePreprocessor):
                 "pointing_position_az",
                 "pointing_position_zd",
             ],
+            keys=["night", "run_id", "event_num"],
         )
 
     def event_processor(
-        self, directory, clean_images=False, only_core=True, clump_size=20
+        self,
+        directory,
+        clean_images=False,
+        only_core=True,
+        clump_size=20,
+        eps=0.1,
+        clean_type="dbscan",
+        thresholds=None,
     ):
         for index, file in enumerate(self.paths):
             file_name = file.split("/")[-1].split(".phs")[0]
@@ -39,157 +47,99 @@ class ObservationPreprocessor(BasePreprocessor):
                 sim_reader = ps.EventListReader(file)
                 counter = 0
                 for event in sim_reader:
-                    df_event = self.dl2_file.loc[
-                        (self.dl2_file["event_num"] == event.observation_info.event)
-                        & (self.dl2_file["night"] == event.observation_info.night)
-                        & (self.dl2_file["run_id"] == event.observation_info.run)
-                    ]
-                    if not df_event.empty:
+                    df_event = self.dl2_index.find(
+                        event.observation_info.night,
+                        event.observation_info.run,
+                        event.observation_info.event,
+                    )
+                    if df_event is not None:
                         counter += 1
 
-                        if os.path.isfile(
-                            os.path.join(
-                                directory,
-                                "clump" + str(clump_size),
-                                str(file_name) + "_" + str(counter),
-                            )
-                        ) and os.path.isfile(
-                            os.path.join(
+                        if clean_images:
+                            cleaned = self.event_record_masks(
                                 directory,
-                                "core" + str(clump_size),
                                 str(file_name) + "_" + str(counter),
+                                event,
+                                clump_size,
+                                eps,
+                                clean_type,
+                                thresholds,
                             )
-                        ):
-                            print("True: " + str(file_name) + "_" + str(counter))
-                            continue
-
-                        if clean_images:
-                            # Do it for no clumps, all clump, and only core into different subfolders
-                            all_photons, clump_photons, core_photons = self.clean_image(
-                                event, only_core=only_core, min_samples=clump_size
-                            )
-                            if core_photons is None:
-                                print("No Clumps, skip")
+                            if cleaned is None:
                                 continue
-                            else:
-                                for key, photon_set in {
-                                    "no_clean": all_photons,
-                                    "clump": clump_photons,
-                                    "core": core_photons,
-                                }.items():
-                                    event.photon_stream.raw = photon_set
-                                    # In the event chosen from the file
-                                    # Each event is the same as each line below
-                                    source_pos_x = df_event["source_position_x"].values[
-                                        0
-                                    ]
-                                    source_pos_y = df_event["source_position_y"].values[
-                                        0
-                                    ]
-                                    timestamp = (
-                                        df_event["timestamp"]
-                                        .values[0]
-                                        .astype(datetime.datetime)
-                                    )
-                                    event_photons = event.photon_stream.list_of_lists
-                                    zd_deg = event.zd
-                                    az_deg = event.az
-                                    cog_x = df_event["cog_x"].values[0]
-                                    cog_y = df_event["cog_y"].values[0]
-                                    sky_source_az = df_event[
-                                        "source_position_az"
-                                    ].values[0]
-                                    sky_source_zd = df_event[
-                                        "source_position_zd"
-                                    ].values[0]
-                                    zd_deg1 = df_event["pointing_position_zd"].values[0]
-                                    az_deg1 = df_event["pointing_position_az"].values[0]
-                                    event_num = event.observation_info.event
-                                    night = event.observation_info.night
-                                    run = event.observation_info.run
-                                    data_dict = [
-                                        [
-                                            event_photons,
-                                            timestamp,
-                                            zd_deg,
-                                            az_deg,
-                                            cog_x,
-                                            cog_y,
-                                            sky_source_az,
-                                            sky_source_zd,
-                                            zd_deg1,
-                                            az_deg1,
-                                            source_pos_x,
-                                            source_pos_y,
-                                            event_num,
-                                            night,
-                                            run,
-                                        ],
-                                        {
-                                            "Image": 0,
-                                            "Timestamp": 1,
-                                            "Zd_Deg": 2,
-                                            "Az_Deg": 3,
-                                            "COG_X": 4,
-                                            "COG_Y": 5,
-                                            "Source_Position_Az": 6,
-                                            "Source_Position_Zd": 7,
-                                            "Pointing_Position_Zd": 8,
-                                            "Pointing_Position_Az": 9,
-                                            "Source_Position_X": 10,
-                                            "Source_Position_Y": 11,
-                                            "Event_Number": 12,
-                                            "Night": 13,
-                                            "Run": 14,
-                                        },
-                                    ]
-                                    if key != "no_clean":
-                                        with open(
-                                            os.path.join(
-                                                directory,
-                                                key + str(clump_size),
-                                                str(file_name) + "_" + str(counter),
-                                            ),
-                                            "wb",
-                                        ) as event_file:
-                                            pickle.dump(data_dict, event_file)
-                                    else:
-                                        if not os.path.isfile(
-                                            os.path.join(
-                                                directory,
-                                                key,
-                                                str(file_name) + "_" + str(counter),
-                                            )
-                                        ):
-                                            with open(
-                                                os.path.join(
-                                                    directory,
-                                                    key,
-                                                    str(file_name) + "_" + str(counter),
-                                                ),
-                                                "wb",
-                                            ) as event_file:
-                                                pickle.dump(data_dict, event_file)
+                            record_path, masks = cleaned
+                            # In the event chosen from the file
+                            # Each event is the same as each line below
+                            source_pos_x = df_event["source_position_x"]
+                            source_pos_y = df_event["source_position_y"]
+                            timestamp = df_event["timestamp"].astype(datetime.datetime)
+                            event_photons = event.photon_stream.list_of_lists
+                            zd_deg = event.zd
+                            az_deg = event.az
+                            cog_x = df_event["cog_x"]
+                            cog_y = df_event["cog_y"]
+                            sky_source_az = df_event["source_position_az"]
+                            sky_source_zd = df_event["source_position_zd"]
+                            zd_deg1 = df_event["pointing_position_zd"]
+                            az_deg1 = df_event["pointing_position_az"]
+                            event_num = event.observation_info.event
+                            night = event.observation_info.night
+                            run = event.observation_info.run
+                            data_dict = [
+                                [
+                                    event_photons,
+                                    timestamp,
+                                    zd_deg,
+                                    az_deg,
+                                    cog_x,
+                                    cog_y,
+                                    sky_source_az,
+                                    sky_source_zd,
+                                    zd_deg1,
+                                    az_deg1,
+                                    source_pos_x,
+                                    source_pos_y,
+                                    event_num,
+                                    night,
+                                    run,
+                                ],
+                                {
+                                    "Image": 0,
+                                    "Timestamp": 1,
+                                    "Zd_Deg": 2,
+                                    "Az_Deg": 3,
+                                    "COG_X": 4,
+                                    "COG_Y": 5,
+                                    "Source_Position_Az": 6,
+                                    "Source_Position_Zd": 7,
+                                    "Pointing_Position_Zd": 8,
+                                    "Pointing_Position_Az": 9,
+                                    "Source_Position_X": 10,
+                                    "Source_Position_Y": 11,
+                                    "Event_Number": 12,
+                                    "Night": 13,
+                                    "Run": 14,
+                                },
+                            ]
+                            self.write_cleaned_event(
+                                record_path, event, masks, *data_dict
+                            )
                         else:
                             # In the event chosen from the file
                             # Each event is the same as each line below
                             # Each event is the same as each line below
-                            source_pos_x = df_event["source_position_x"].values[0]
-                            source_pos_y = df_event["source_position_y"].values[0]
-                            timestamp = (
-                                df_event["timestamp"]
-                                .values[0]
-                                .astype(datetime.datetime)
-                            )
+                            source_pos_x = df_event["source_position_x"]
+                            source_pos_y = df_event["source_position_y"]
+                            timestamp = df_event["timestamp"].astype(datetime.datetime)
                             event_photons = event.photon_stream.list_of_lists
                             zd_deg = event.zd
                             az_deg = event.az
-                            cog_x = df_event["cog_x"].values[0]
-                            cog_y = df_event["cog_y"].values[0]
-                            sky_source_az = df_event["source_position_az"].values[0]
-                            sky_source_zd = df_event["source_position_zd"].values[0]
-                            zd_deg1 = df_event["pointing_position_zd"].values[0]
-                            az_deg1 = df_event["pointing_position_az"].values[0]
+                            cog_x = df_event["cog_x"]
+                            cog_y = df_event["cog_y"]
+                            sky_source_az = df_event["source_position_az"]
+                            sky_source_zd = df_event["source_position_zd"]
+                            zd_deg1 = df_event["pointing_position_zd"]
+                            az_deg1 = df_event["pointing_position_az"]
                             event_num = event.observation_info.event
                             night = event.observation_info.night
                             run = event.observation_info.run
@@ -240,7 +190,7 @@ class ObservationPreprocessor(BasePreprocessor):
                 print(str(e))
                 pass
 
-    def batch_processor(self, clean_images=False):
+    def batch_processor(self, clean_images=False, clean_type="dbscan", thresholds=None):
         self.init()
         for index, file in enumerate(self.paths):
             print(file)
@@ -248,50 +198,44 @@ class ObservationPreprocessor(BasePreprocessor):
                 sim_reader = ps.EventListReader(file)
                 data = []
                 for event in sim_reader:
-                    df_event = self.dl2_file.loc[
-                        (self.dl2_file["event_num"] == event.observation_info.event)
-                        & (self.dl2_file["night"] == event.observation_info.night)
-                        & (self.dl2_file["run_id"] == event.observation_info.run)
-                    ]
-                    if not df_event.empty:
+                    df_event = self.dl2_index.find(
+                        event.observation_info.night,
+                        event.observation_info.run,
+                        event.observation_info.event,
+                    )
+                    if df_event is not None:
                         if clean_images:
-                            event = self.clean_image(event)
+                            event = self.cleaned_event(
+                                event, clean_type=clean_type, thresholds=thresholds
+                            )
+                            if event is None:
+                                continue
                         # In the event chosen from the file
                         # Each event is the same as each line below
-                        source_pos_x = df_event["source_position_x"].values[0]
-                        source_pos_y = df_event["source_position_y"].values[0]
-                        energy = (
-                            df_event["timestamp"].values[0].astype(datetime.datetime)
-                        )
+                        source_pos_x = df_event["source_position_x"]
+                        source_pos_y = df_event["source_position_y"]
+                        energy = df_event["timestamp"].astype(datetime.datetime)
                         event_photons = event.photon_stream.list_of_lists
                         zd_deg = event.zd
                         az_deg = event.az
-                        cog_x = df_event["cog_x"].values[0]
-                        cog_y = df_event["cog_y"].values[0]
-                        sky_source_az = df_event["source_position_az"].values[0]
-                        sky_source_zd = df_event["source_position_zd"].values[0]
-                        zd_deg1 = df_event["pointing_position_zd"].values[0]
-                        az_deg1 = df_event["pointing_position_az"].values[0]
+                        cog_x = df_event["cog_x"]
+                        cog_y = df_event["cog_y"]
+                        sky_source_az = df_event["source_position_az"]
+                        sky_source_zd = df_event["source_position_zd"]
+                        zd_deg1 = df_event["pointing_position_zd"]
+                        az_deg1 = df_event["pointing_position_az"]
                         event_num = event.observation_info.event
                         night = event.observation_info.night
                         run = event.observation_info.run
-                        input_matrix = np.zeros(
-                            [self.shape[1], self.shape[2], self.shape[3]]
+                        input_matrix = self.rasterize(
+                            self.photon_histogram(
+                                event_photons, self.start, self.shape[3]
+                            )
                         )
-                        chid_to_pixel = self.rebinning[0]
-                        pixel_index_to_grid = self.rebinning[1]
-                        for index in range(1440):
-                            for element in chid_to_pixel[index]:
-                                coords = pixel_index_to_grid[element[0]]
-                                for value in event_photons[index]:
-                                    if self.end >= value >= self.start:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 1)
 
                         data.append(
                             [
-                                np.fliplr(np.rot90(input_matrix, 3)),
+                                input_matrix,
                                 energy,
                                 zd_deg,
                                 az_deg,
@@ -320,6 +264,8 @@ class ObservationPreprocessor(BasePreprocessor):
         final_slices=5,
         as_channels=False,
         clean_images=False,
+        clean_type="dbscan",
+        thresholds=None,
     ):
         while True:
             print("New Crab")
@@ -328,52 +274,44 @@ class ObservationPreprocessor(BasePreprocessor):
                     sim_reader = ps.EventListReader(file)
                     for event in sim_reader:
                         data = []
-                        df_event = self.dl2_file.loc[
-                            (self.dl2_file["event_num"] == event.observation_info.event)
-                            & (self.dl2_file["night"] == event.observation_info.night)
-                            & (self.dl2_file["run_id"] == event.observation_info.run)
-                        ]
-                        if not df_event.empty:
+                        df_event = self.dl2_index.find(
+                            event.observation_info.night,
+                            event.observation_info.run,
+                            event.observation_info.event,
+                        )
+                        if df_event is not None:
                             if clean_images:
-                                event = self.clean_image(event)
+                                event = self.cleaned_event(
+                                    event, clean_type=clean_type, thresholds=thresholds
+                                )
+                                if event is None:
+                                    continue
                             # In the event chosen from the file
                             # Each event is the same as each line below
-                            source_pos_x = df_event["source_position_x"].values[0]
-                            source_pos_y = df_event["source_position_y"].values[0]
-                            energy = (
-                                df_event["timestamp"]
-                                .values[0]
-                                .astype(datetime.datetime)
-                            )
+                            source_pos_x = df_event["source_position_x"]
+                            source_pos_y = df_event["source_position_y"]
+                            energy = df_event["timestamp"].astype(datetime.datetime)
                             event_photons = event.photon_stream.list_of_lists
                             zd_deg = event.zd
                             az_deg = event.az
-                            cog_x = df_event["cog_x"].values[0]
-                            cog_y = df_event["cog_y"].values[0]
-                            sky_source_az = df_event["source_position_az"].values[0]
-                            sky_source_zd = df_event["source_position_zd"].values[0]
-                            zd_deg1 = df_event["pointing_position_zd"].values[0]
-                            az_deg1 = df_event["pointing_position_az"].values[0]
+                            cog_x = df_event["cog_x"]
+                            cog_y = df_event["cog_y"]
+                            sky_source_az = df_event["source_position_az"]
+                            sky_source_zd = df_event["source_position_zd"]
+                            zd_deg1 = df_event["pointing_position_zd"]
+                            az_deg1 = df_event["pointing_position_az"]
                             event_num = event.observation_info.event
                             night = event.observation_info.night
                             run = event.observation_info.run
-                            input_matrix = np.zeros(
-                                [self.shape[1], self.shape[2], self.shape[3]]
+                            input_matrix = self.rasterize(
+                                self.photon_histogram(
+                                    event_photons, self.start, self.shape[3]
+                                )
                             )
-                            chid_to_pixel = self.rebinning[0]
-                            pixel_index_to_grid = self.rebinning[1]
-                            for index in range(1440):
-                                for element in chid_to_pixel[index]:
-                                    coords = pixel_index_to_grid[element[0]]
-                                    for value in event_photons[index]:
-                                        if self.end >= value >= self.start:
-                                            input_matrix[coords[0]][coords[1]][
-                                                value - self.start
-                                            ] += (element[1] * 1)
 
                             data.append(
                                 [
-                                    np.fliplr(np.rot90(input_matrix, 3)),
+                                    input_matrix,
                                     energy,
                                     zd_deg,
                                     az_deg,
@@ -423,14 +361,18 @@ class ObservationPreprocessor(BasePreprocessor):
                 try:
                     print("Trying...")
                     crab_reader = ps.EventListReader(file)
-                    for event in crab_reader:
-                        df_event = self.dl2_file.loc[
-                            (self.dl2_file["event_num"] == event.observation_info.event)
-                            & (self.dl2_file["night"] == event.observation_info.night)
-                            & (self.dl2_file["run_id"] == event.observation_info.run)
+                    # Only the keys are needed, so the whole file is looked up at once
+                    keys = np.array(
+                        [
+                            (
+                                event.observation_info.night,
+                                event.observation_info.run,
+                                event.observation_info.event,
+                            )
+                            for event in crab_reader
                         ]
-                        if not df_event.empty:
-                            count += 1
+                    ).reshape(-1, 3)
+                    count += np.count_nonzero(self.dl2_index.lookup(*keys.T) >= 0)
                     print(count)
                 except Exception as e:
                     print(str(e))
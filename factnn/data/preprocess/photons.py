@@ -0,0 +1,423 @@
+import numpy as np
+from itertools import chain
+from scipy.spatial import cKDTree
+from fact.instrument import get_pixel_dataframe
+
+NUMBER_OF_PIXELS = 1440
+TIME_SLICE_DURATION_S = 0.5e-9  # Taken from FACT magic constants
+LINEBREAK = 255  # Ends each CHID in photon_stream's raw format
+
+_pixel_angles = None
+_pixel_tree = None
+
+
+def pixel_angles():
+    """
+    The x and y angle in radians of each CHID, the same as photon_stream's GEOMETRY.x_angle and GEOMETRY.y_angle,
+    only read once per process
+
+    :return: (x_angle, y_angle) arrays of length 1440 in CHID order
+    """
+    global _pixel_angles
+    if _pixel_angles is None:
+        pixels = get_pixel_dataframe()
+        pixels = pixels.sort_values("CHID")
+        _pixel_angles = (
+            np.deg2rad(pixels.x_angle.values),
+            np.deg2rad(pixels.y_angle.values),
+        )
+    return _pixel_angles
+
+
+def flatten_photon_streams(photon_streams):
+    """
+    Packs a batch of list of lists photon streams into the flat arrival representation that the other functions here
+    take, so the Python lists are only gone through once per event
+
+    :param photon_streams: List of list of lists photon streams, one per event
+    :return: (arrivals, offsets) where arrivals is uint8 and the photons of CHID c in event b are
+    arrivals[offsets[b * 1440 + c] : offsets[b * 1440 + c + 1]]
+    """
+    lengths = np.fromiter(
+        (len(pixel) for photon_stream in photon_streams for pixel in photon_stream),
+        dtype=np.int64,
+        count=NUMBER_OF_PIXELS * len(photon_streams),
+    )
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    # Arrival slices are stored as uint8 in the PhotonStream raw format, with 255 as the pixel separator
+    arrivals = np.fromiter(
+        chain.from_iterable(chain.from_iterable(photon_streams)),
+        dtype=np.uint8,
+        count=offsets[-1],
+    )
+    return arrivals, offsets
+
+
+def concatenate_events(flat_events):
+    """
+    Joins flattened events or batches into one batch
+
+    :param flat_events: List of (arrivals, offsets), e.g. from flatten_photon_streams
+    :return: (arrivals, offsets) of all the events, in order
+    """
+    if not flat_events:
+        return np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64)
+    arrivals = np.concatenate(
+        [arrivals[offsets[0] : offsets[-1]] for arrivals, offsets in flat_events]
+    )
+    lengths = np.concatenate([np.diff(offsets) for _, offsets in flat_events])
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return arrivals, offsets
+
+
+def to_list_of_lists(arrivals, offsets):
+    """
+    Converts the flat arrivals back to list of lists photon streams
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: Per event and CHID offsets into arrivals
+    :return: List of list of lists photon streams, one per event
+    """
+    pixels = np.split(
+        np.asarray(arrivals[offsets[0] : offsets[-1]]), offsets[1:-1] - offsets[0]
+    )
+    return [
+        [pixel.tolist() for pixel in pixels[start : start + NUMBER_OF_PIXELS]]
+        for start in range(0, len(pixels), NUMBER_OF_PIXELS)
+    ]
+
+
+def photon_histogram(arrivals, offsets, start, num_slices, end=None, overflow=False):
+    """
+    Histograms the arrival slices of each CHID of every event in one pass
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: Per event and CHID offsets into arrivals, of length number_of_events * 1440 + 1
+    :param start: First time slice to keep, either one value or one per event
+    :param num_slices: Number of time slices in the output
+    :param end: If given, photons arriving at or after end are dropped, either one value or one per event
+    :param overflow: Whether photons past the last slice are added to the last slice, instead of dropped
+    :return: (number_of_events, 1440, num_slices) array of photon counts
+    """
+    edges = np.add.outer(np.asarray(start), np.arange(num_slices + 1))
+    if end is not None and np.ndim(end) > 0 and edges.ndim == 1:
+        edges = np.broadcast_to(edges, (len(end), num_slices + 1))
+    lookup = slice_lookup(
+        edges,
+        overflow=overflow,
+        end=end,
+        length=_lookup_length(arrivals, offsets),
+    )
+    return binned_photon_histogram(arrivals, offsets, lookup, num_slices)
+
+
+def binned_photon_histogram(arrivals, offsets, lookup, num_bins):
+    """
+    Histograms the arrivals of each CHID of every event into time bins in one pass, so any binning of the time
+    axis is done while the photons are counted, instead of on the full image cube afterwards
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: Per event and CHID offsets into arrivals, of length number_of_events * 1440 + 1
+    :param lookup: Bin of each arrival slice, with -1 for dropped slices, either one lookup or one per event,
+    e.g. from slice_lookup
+    :param num_bins: Number of time bins in the output
+    :return: (number_of_events, 1440, num_bins) array of photon counts
+    """
+    num_events = (len(offsets) - 1) // NUMBER_OF_PIXELS
+    rows = np.repeat(np.arange(num_events * NUMBER_OF_PIXELS), np.diff(offsets))
+    arrivals = arrivals[offsets[0] : offsets[-1]]
+    if np.ndim(lookup) == 2:
+        bins = lookup[rows // NUMBER_OF_PIXELS, arrivals]
+    else:
+        bins = lookup[arrivals]
+    mask = bins >= 0
+    return np.bincount(
+        rows[mask] * num_bins + bins[mask],
+        minlength=num_events * NUMBER_OF_PIXELS * num_bins,
+    ).reshape(num_events, NUMBER_OF_PIXELS, num_bins)
+
+
+def slice_lookup(edges, overflow=False, end=None, length=256):
+    """
+    Builds the lookup from arrival slice to time bin, so binning the photons is a single indexing operation
+
+    :param edges: Increasing bin edges in time slices, bin i holds the slices edges[i] <= slice < edges[i + 1],
+    either one set of edges or one row per event
+    :param overflow: Whether slices at or past the last edge go into the last bin, instead of being dropped
+    :param end: If given, slices at or after end are dropped, either one value or one per event
+    :param length: Number of slices in the lookup, 256 covers every uint8 arrival slice
+    :return: int64 array of length length, or (number_of_events, length), with the bin of each slice or -1
+    """
+    edges = np.asarray(edges)
+    slices = np.arange(length)
+    # Number of inner edges at or before each slice is its bin
+    bins = np.sum(slices[:, np.newaxis] >= edges[..., np.newaxis, 1:-1], axis=-1)
+    dropped = slices < edges[..., :1]
+    if not overflow:
+        dropped = dropped | (slices >= edges[..., -1:])
+    if end is not None:
+        dropped = dropped | (slices >= np.reshape(end, np.shape(end) + (1,)))
+    return np.where(dropped, -1, bins)
+
+
+def equal_width_edges(start, end, num_bins):
+    """
+    Edges splitting start <= slice < end into num_bins bins of an equal number of slices, the last one being cut
+    short at end if they do not divide evenly
+
+    :param start: First time slice
+    :param end: Slice after the last one
+    :param num_bins: Number of bins
+    :return: num_bins + 1 edges
+    """
+    bin_width = int(np.ceil((end - start) / num_bins))
+    return np.minimum(start + np.arange(num_bins + 1) * bin_width, end)
+
+
+def collapse_edges(num_slices, final_slices):
+    """
+    Edges that collapse num_slices slices to final_slices, each with the same number of slices except for the last,
+    which has all the rest, the same as BasePreprocessor.collapse_image_time
+
+    :param num_slices: Number of slices before collapsing
+    :param final_slices: Number of slices after collapsing
+    :return: final_slices + 1 edges
+    """
+    num_slices_per_final_slice = num_slices // final_slices
+    edges = np.arange(final_slices + 1) * num_slices_per_final_slice
+    edges[-1] = num_slices
+    return edges
+
+
+def bin_slices(image, lookup, num_bins, axis):
+    """
+    Sums the time slices of an image into time bins
+
+    :param image: Image with the time slices along axis
+    :param lookup: Bin of each time slice, with -1 for dropped slices, e.g. from slice_lookup
+    :param num_bins: Number of time bins in the output
+    :param axis: Time axis of image
+    :return: Image with num_bins bins along axis
+    """
+    lookup = lookup[: image.shape[axis]]
+    binning = (lookup[:, np.newaxis] == np.arange(num_bins)).astype(image.dtype)
+    return np.moveaxis(np.tensordot(image, binning, axes=([axis], [0])), -1, axis)
+
+
+def _lookup_length(arrivals, offsets):
+    if offsets[-1] == offsets[0]:
+        return 256
+    return max(256, int(np.max(arrivals[offsets[0] : offsets[-1]])) + 1)
+
+
+def photon_counts(offsets):
+    """
+    Number of photons in each CHID
+
+    :param offsets: Per event and CHID offsets into arrivals
+    :return: (number_of_events, 1440) array of photon counts
+    """
+    return np.diff(offsets).reshape(-1, NUMBER_OF_PIXELS)
+
+
+def point_cloud(arrivals, offsets):
+    """
+    Converts the flat arrivals to point clouds, the same as photon_stream's raw_phs_to_point_cloud with
+    cx=GEOMETRY.x_angle and cy=GEOMETRY.y_angle
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: Per event and CHID offsets into arrivals
+    :return: (number_of_photons, 3) array of x angle, y angle and arrival time in seconds, where the points of
+    event b are rows offsets[b * 1440] - offsets[0] to offsets[(b + 1) * 1440] - offsets[0]
+    """
+    x_angle, y_angle = pixel_angles()
+    chids, slices = photon_indices(arrivals, offsets)
+    cloud = np.empty((len(chids), 3))
+    cloud[:, 0] = x_angle[chids]
+    cloud[:, 1] = y_angle[chids]
+    cloud[:, 2] = slices
+    cloud[:, 2] *= TIME_SLICE_DURATION_S
+    return cloud
+
+
+def photon_indices(arrivals, offsets):
+    """
+    CHID and arrival slice of each photon, in the same order as the rows of point_cloud, so anything found on the
+    point cloud can be mapped back to the photons without matching the angles
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: Per event and CHID offsets into arrivals
+    :return: (chids, slices) arrays with one entry per photon
+    """
+    chids = np.repeat(
+        np.tile(np.arange(NUMBER_OF_PIXELS), (len(offsets) - 1) // NUMBER_OF_PIXELS),
+        np.diff(offsets),
+    )
+    return chids, arrivals[offsets[0] : offsets[-1]]
+
+
+def cloud_indices(cloud):
+    """
+    CHID and arrival slice of each point of a point cloud made by point_cloud or photon_stream, for when the photons
+    it was made from are not at hand
+
+    :param cloud: (number_of_photons, 3) array of x angle, y angle and arrival time in seconds
+    :return: (chids, slices) arrays with one entry per point
+    """
+    global _pixel_tree
+    if _pixel_tree is None:
+        _pixel_tree = cKDTree(np.column_stack(pixel_angles()))
+    cloud = np.asarray(cloud)
+    _, chids = _pixel_tree.query(cloud[:, :2])
+    slices = np.round(cloud[:, 2] / TIME_SLICE_DURATION_S).astype(np.uint8)
+    return chids, slices
+
+
+def arrival_window(arrivals, offsets):
+    """
+    First and last arrival slice, and mean and standard deviation of the arrival slices of each event
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: Per event and CHID offsets into arrivals
+    :return: (start, end, mean, std) arrays with one entry per event, all -1 for events without photons
+    """
+    event_offsets = offsets[::NUMBER_OF_PIXELS] - offsets[0]
+    counts = np.diff(event_offsets)
+    arrivals = np.asarray(arrivals[offsets[0] : offsets[-1]], dtype=np.int64)
+    start = np.full(len(counts), -1, dtype=np.int64)
+    end = np.full(len(counts), -1, dtype=np.int64)
+    mean = np.full(len(counts), -1.0)
+    std = np.full(len(counts), -1.0)
+    has_photons = counts > 0
+    if np.any(has_photons):
+        # Events without photons add nothing in between, so reducing from the start of each event with photons works
+        event_starts = event_offsets[:-1][has_photons]
+        start[has_photons] = np.minimum.reduceat(arrivals, event_starts)
+        end[has_photons] = np.maximum.reduceat(arrivals, event_starts)
+        mean[has_photons] = (
+            np.add.reduceat(arrivals, event_starts) / counts[has_photons]
+        )
+        squares = (
+            np.add.reduceat(arrivals * arrivals, event_starts) / counts[has_photons]
+        )
+        std[has_photons] = np.sqrt(np.maximum(squares - mean[has_photons] ** 2, 0.0))
+    return start, end, mean, std
+
+
+def densest_window(arrivals, offsets, width):
+    """
+    Finds the width slice long window with the most photons in each event, with a sliding window sum over the
+    per event arrival histogram, so the time axis can be cut down to where the shower is
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: Per event and CHID offsets into arrivals
+    :param width: Number of time slices in the window
+    :return: (start, end, count) arrays with one entry per event, where the window is start <= slice < end and
+    count is the number of photons in it, start and end are -1 for events without photons
+    """
+    event_offsets = offsets[::NUMBER_OF_PIXELS] - offsets[0]
+    counts = np.diff(event_offsets)
+    length = _lookup_length(arrivals, offsets)
+    events = np.repeat(np.arange(len(counts)), counts)
+    histogram = np.bincount(
+        events * length + arrivals[offsets[0] : offsets[-1]],
+        minlength=len(counts) * length,
+    ).reshape(len(counts), length)
+    cumulative = np.zeros((len(counts), length + 1), dtype=np.int64)
+    np.cumsum(histogram, axis=1, out=cumulative[:, 1:])
+    window = min(width, length)
+    # Number of photons in the window starting at each slice, the first densest one is taken
+    window_counts = cumulative[:, window:] - cumulative[:, : length - window + 1]
+    start = np.argmax(window_counts, axis=1)
+    count = window_counts[np.arange(len(counts)), start]
+    end = start + width
+    start[counts == 0] = -1
+    end[counts == 0] = -1
+    return start, end, count
+
+
+def window_mask(arrivals, offsets, start, end):
+    """
+    Which photons are within the time window of their event
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: Per event and CHID offsets into arrivals
+    :param start: First time slice of the window, either one value or one per event
+    :param end: Slice after the last one of the window, either one value or one per event
+    :return: Boolean array with one entry per photon in arrivals[offsets[0] : offsets[-1]]
+    """
+    counts = np.diff(offsets[::NUMBER_OF_PIXELS])
+    arrivals = arrivals[offsets[0] : offsets[-1]]
+    start = np.repeat(np.broadcast_to(start, counts.shape), counts)
+    end = np.repeat(np.broadcast_to(end, counts.shape), counts)
+    return (arrivals >= start) & (arrivals < end)
+
+
+def select_photons(arrivals, offsets, mask):
+    """
+    Keeps only some of the photons, e.g. those in a time window
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: Per event and CHID offsets into arrivals
+    :param mask: Boolean array with one entry per photon in arrivals[offsets[0] : offsets[-1]]
+    :return: (arrivals, offsets) of the kept photons
+    """
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    kept = np.zeros(len(offsets), dtype=np.int64)
+    np.cumsum(np.bincount(rows[mask], minlength=len(offsets) - 1), out=kept[1:])
+    return arrivals[offsets[0] : offsets[-1]][mask], kept
+
+
+def to_raw(arrivals, offsets):
+    """
+    Converts the flat arrivals of one event back to photon_stream's raw format, the arrival slices of each CHID in
+    order, each CHID ended by a 255
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: CHID offsets into arrivals for one event
+    :return: uint8 array of the raw photon stream
+    """
+    counts = np.diff(offsets)
+    raw = np.full(offsets[-1] - offsets[0] + len(counts), LINEBREAK, dtype=np.uint8)
+    # Each photon is moved along by the line breaks of the CHIDs before it
+    rows = np.repeat(np.arange(len(counts)), counts)
+    raw[np.arange(len(rows)) + rows] = arrivals[offsets[0] : offsets[-1]]
+    return raw
+
+
+def from_raw(raw):
+    """
+    Converts one event in photon_stream's raw format to the flat arrivals, the inverse of to_raw
+
+    :param raw: Arrival slices of each CHID in order, each CHID ended by a 255
+    :return: (arrivals, offsets) of the event
+    """
+    raw = np.asarray(raw, dtype=np.uint8)
+    linebreaks = np.flatnonzero(raw == LINEBREAK)
+    offsets = np.zeros(len(linebreaks) + 1, dtype=np.int64)
+    offsets[1:] = linebreaks - np.arange(len(linebreaks))
+    return raw[raw != LINEBREAK], offsets
+
+
+def matching_photons(arrivals, offsets, other_arrivals, other_offsets):
+    """
+    Which photons have a photon in the same CHID and time slice in the other events, e.g. which photons of the
+    uncleaned events were kept by a cleaning
+
+    :param arrivals: Flat array of arrival time slices
+    :param offsets: Per event and CHID offsets into arrivals
+    :param other_arrivals: Flat array of arrival time slices of the other events
+    :param other_offsets: Per event and CHID offsets into other_arrivals, for the same number of events
+    :return: Boolean array with one entry per photon in arrivals[offsets[0] : offsets[-1]]
+    """
+    return np.isin(
+        _photon_keys(arrivals, offsets), _photon_keys(other_arrivals, other_offsets)
+    )
+
+
+def _photon_keys(arrivals, offsets):
+    # Arrival slices are uint8, so each (event, CHID, slice) has its own key
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return rows * 256 + arrivals[offsets[0] : offsets[-1]]
@@ -0,0 +1,250 @@
+import numpy as np
+from factnn.data.preprocess import photons
+from factnn.data.dataset.event_store import load_event
+
+
+class EventFilePipeline(object):
+    """
+    Fused version of EventFilePreprocessor.on_files_processor for a fixed set of options, which writes every event
+    straight into its final slot of one batch array
+
+    The photons of the whole batch are flattened once, binned into the final slices with one lookup per event, and
+    each event is then rebinned directly into the output, so no per-event image cubes are made, reformatted, collapsed
+    and stacked afterwards. The images are the same as on_files_processor with collapse_time gives, stacked along the
+    first axis
+    """
+
+    def __init__(
+        self,
+        preprocessor,
+        final_slices=5,
+        normalize=False,
+        dynamic_resize=False,
+        truncate=False,
+        equal_slices=False,
+        as_channels=False,
+        return_features=False,
+        return_collapsed=False,
+        statistics=None,
+        densest_window=False,
+        cleaning=None,
+        dtype=np.float32,
+    ):
+        """
+        :param preprocessor: EventFilePreprocessor with the rebinning, start, end and number of time slices to use
+        :param final_slices: Number of time slices after collapsing
+        :param normalize: Whether to normalize each image on its own, over the whole image before collapsing
+        :param dynamic_resize: Whether to start and end at the first and last photon of each event
+        :param truncate: Whether to drop photons after the last slice, instead of adding them to it
+        :param equal_slices: Whether each slice holds an equal number of time slices between start and end
+        :param as_channels: Whether the images are (batch, size, size, final_slices), or else
+        (batch, final_slices, size, size)
+        :param return_features: Whether to also return the Hillas features extracted beforehand
+        :param return_collapsed: Whether to also return the (batch, size, size, 1) images collapsed to a single slice
+        :param statistics: ImageStatistics, if given the images are normalized with those global statistics
+        :param densest_window: Whether to use the time slices with the most photons of each event, instead of the
+        fixed or dynamic start and end
+        :param cleaning: Name of a cleaning stored in event records, e.g. 'core20', to only use the photons it keeps
+        :param dtype: Type of the output images
+        """
+        self.preprocessor = preprocessor
+        self.final_slices = final_slices
+        self.normalize = normalize
+        self.dynamic_resize = dynamic_resize
+        self.truncate = truncate
+        self.equal_slices = equal_slices
+        self.as_channels = as_channels
+        self.return_features = return_features
+        self.return_collapsed = return_collapsed
+        self.statistics = statistics
+        self.densest_window = densest_window
+        self.cleaning = cleaning
+        self.dtype = dtype
+
+        self.size = preprocessor.rebin_size
+        self.num_slices = preprocessor.shape[3]
+        self.collapse_lookup = photons.slice_lookup(
+            photons.collapse_edges(self.num_slices, final_slices),
+            length=self.num_slices,
+        )
+        # Number of the time slices in each of the final slices
+        self.slices_per_bin = np.bincount(self.collapse_lookup, minlength=final_slices)
+        if normalize:
+            # The sum of squares of an image is h.T @ (M.T @ M) @ h over the per CHID histogram h, so the per image
+            # normalization can be done without making the full image
+            self.gram_matrix = (
+                preprocessor.rebinning_matrix.T @ preprocessor.rebinning_matrix
+            ).tocsr()
+
+    def image_shape(self, num_events):
+        """
+        Shape of the images for num_events events
+        :param num_events: Number of events
+        :return: Shape tuple
+        """
+        if self.as_channels:
+            return num_events, self.size, self.size, self.final_slices
+        return num_events, self.final_slices, self.size, self.size
+
+    def process(self, paths, out=None, collapsed_out=None):
+        """
+        Loads and preprocesses the Eventfiles
+
+        :param paths: Paths to the Eventfiles, or StoredEvent references into an EventStore
+        :param out: Optional C-contiguous array of shape image_shape(len(paths)) to write the images into
+        :param collapsed_out: Optional C-contiguous (len(paths), size, size, 1) array to write the collapsed images into
+        :return: (images, collapsed_images, features, data, data_format) for the events that were kept, where data is
+        the list of the rest of the data of each event, and collapsed_images and features are None if not returned
+        """
+        flat_events = []
+        data = []
+        features = []
+        data_format = None
+        for file in paths:
+            event = load_event(file, flat=True, cleaning=self.cleaning)
+            if event is None:
+                continue
+            event_data, data_format, event_features, _ = event
+            if self.return_features:
+                if event_features["extraction"] == 1:
+                    # Failed feature extraction, so ignore event
+                    continue
+                features.append(self.preprocessor.feature_list(event_features))
+            # Flattened straight away, so the lists of photons are not all kept around
+            flat_events.append(event_data[data_format["Image"]])
+            event_data[data_format["Image"]] = None
+            data.append(event_data)
+
+        num_events = len(flat_events)
+        if out is None:
+            out = np.empty(self.image_shape(num_events), dtype=self.dtype)
+        else:
+            out = out[:num_events]
+        if self.return_collapsed:
+            if collapsed_out is None:
+                collapsed_out = np.empty(
+                    (num_events, self.size, self.size, 1), dtype=self.dtype
+                )
+            else:
+                collapsed_out = collapsed_out[:num_events]
+        else:
+            collapsed_out = None
+        if num_events == 0:
+            if self.return_features:
+                # Same type as for a non-empty batch, so it can be concatenated with one
+                features = np.empty((0, self.preprocessor.num_features))
+            else:
+                features = None
+            return out, collapsed_out, features, data, data_format
+
+        arrivals, offsets = photons.concatenate_events(flat_events)
+        lookup = self.lookup(arrivals, offsets)
+        if self.normalize:
+            # The full histogram is needed for the sum of squares, and is small compared to the images
+            histogram = photons.binned_photon_histogram(
+                arrivals, offsets, lookup, self.num_slices
+            )
+            final_histogram = photons.bin_slices(
+                histogram, self.collapse_lookup, self.final_slices, axis=2
+            )
+        else:
+            final_histogram = photons.binned_photon_histogram(
+                arrivals,
+                offsets,
+                np.where(lookup >= 0, self.collapse_lookup[lookup], -1),
+                self.final_slices,
+            )
+        self.preprocessor.rasterize_histograms(
+            final_histogram, out=out, channels_last=self.as_channels, dtype=self.dtype
+        )
+
+        if self.return_collapsed:
+            collapsed_out[...] = np.sum(
+                out, axis=3 if self.as_channels else 1, keepdims=True
+            ).reshape(collapsed_out.shape)
+
+        if self.normalize:
+            self.normalize_images(out, histogram)
+            if self.return_collapsed:
+                # Normalized over the collapsed image itself, same as before
+                flat_collapsed = collapsed_out.reshape(num_events, -1)
+                mean = np.mean(flat_collapsed, axis=1, keepdims=True)
+                denom = np.maximum(
+                    np.std(flat_collapsed, axis=1, keepdims=True),
+                    1.0 / np.sqrt(flat_collapsed.shape[1]),
+                )
+                flat_collapsed -= mean
+                flat_collapsed /= denom
+        if self.statistics is not None:
+            out -= self.statistics.mean.astype(out.dtype)
+            out /= np.maximum(
+                self.statistics.std, 1.0 / np.sqrt(self.statistics.count)
+            ).astype(out.dtype)
+
+        if self.return_features:
+            features = np.array(features)
+        else:
+            features = None
+        return out, collapsed_out, features, data, data_format
+
+    def lookup(self, arrivals, offsets):
+        """
+        Builds the per event lookup from arrival slice to time slice, the same as on_files_processor
+
+        :param arrivals: Flat array of arrival time slices of the batch
+        :param offsets: Per event and CHID offsets into arrivals
+        :return: (number_of_events, 256) lookup
+        """
+        start, end = self.preprocessor.time_window(
+            arrivals, offsets, self.dynamic_resize, self.truncate, self.densest_window
+        )
+        if self.equal_slices:
+            bin_width = np.ceil((end - start) / self.num_slices).astype(np.int64)
+            edges = np.minimum(
+                start[:, np.newaxis]
+                + np.arange(self.num_slices + 1) * bin_width[:, np.newaxis],
+                end[:, np.newaxis],
+            )
+            return photons.slice_lookup(edges)
+        edges = start[:, np.newaxis] + np.arange(self.num_slices + 1)
+        return photons.slice_lookup(edges, overflow=not self.truncate, end=end)
+
+    def normalize_images(self, images, histogram):
+        """
+        Normalizes each collapsed image with the mean and standard deviation of its full image, which is the same as
+        normalizing the full image and then collapsing it
+
+        :param images: The collapsed images
+        :param histogram: (number_of_events, 1440, time_slices) full histograms of the images
+        :return:
+        """
+        num_events = histogram.shape[0]
+        num_values = self.size * self.size * self.num_slices
+        # Every photon is spread over the grid by the rebinning, so the total of the full image is the same as
+        # the total of the collapsed one
+        totals = images.reshape(num_events, -1).sum(axis=1, dtype=np.float64)
+        flat_histogram = np.ascontiguousarray(histogram.transpose(1, 0, 2)).reshape(
+            photons.NUMBER_OF_PIXELS, -1
+        )
+        squares = np.sum(
+            (self.gram_matrix @ flat_histogram).reshape(
+                photons.NUMBER_OF_PIXELS, num_events, -1
+            )
+            * histogram.transpose(1, 0, 2),
+            axis=(0, 2),
+        )
+        mean = totals / num_values
+        denom = np.maximum(
+            np.sqrt(np.maximum(squares / num_values - mean**2, 0.0)),
+            1.0 / np.sqrt(num_values),
+        )
+        # Each final slice is the sum of slices_per_bin normalized slices
+        if self.as_channels:
+            bin_shape = (1, 1, 1, self.final_slices)
+        else:
+            bin_shape = (1, self.final_slices, 1, 1)
+        event_shape = (num_events, 1, 1, 1)
+        images -= (
+            mean.reshape(event_shape) * self.slices_per_bin.reshape(bin_shape)
+        ).astype(images.dtype)
+        images /= denom.reshape(event_shape).astype(images.dtype)
@@ -1,13 +1,7 @@
 from factnn.data.preprocess.eventfile_preprocessor import EventFilePreprocessor
-import pickle
-import os
 import numpy as np
-from photon_stream.representations import (
-    list_of_lists_to_raw_phs,
-    raw_phs_to_point_cloud,
-)
-from photon_stream.geometry import GEOMETRY
-from photon_stream.io.magic_constants import TIME_SLICE_DURATION_S
+from factnn.data.preprocess import photons
+from factnn.data.dataset.event_store import load_event
 
 
 class PointCloudPreprocessor(EventFilePreprocessor):
@@ -22,6 +16,7 @@ class PointCloudPreprocessor(EventFilePreprocessor):
         replacement=False,
         truncate=False,
         return_features=False,
+        densest_window=False,
         **kwargs
     ):
         """
@@ -35,91 +30,53 @@ class PointCloudPreprocessor(EventFilePreprocessor):
         :param normalize:
         :param truncate: Whether to truncate the photons before converting to a point cloud or not
         :param return_features: Whether to return the Hillas features extracted beforehand
+        :param densest_window: Whether to only keep the photons in the self.shape[3] slices with the most photons,
+        instead of the ones from the start to the end
         :param kwargs:
         :return:
         """
         all_data = []
         for index, file in enumerate(paths):
-            # load the pickled file from the disk
-            if os.path.getsize(file) > 0:
+            # load the pickled file from the disk, or the event from an EventStore
+            event = load_event(file, flat=True)
+            if event is not None:
                 # Checks that file is not 0
-                with open(file, "rb") as pickled_event:
-                    data, data_format, features, feature_cluster = pickle.load(
-                        pickled_event
+                data, data_format, features, feature_cluster = event
+                if return_features:
+                    if features["extraction"] == 1:
+                        # Failed feature extraction, so ignore event
+                        continue
+                    else:
+                        feature_list = self.feature_list(features)
+
+                # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
+                point_cloud = photons.point_cloud(
+                    *self.photon_window(
+                        *data[data_format["Image"]],
+                        truncate=truncate,
+                        densest_window=densest_window,
+                        move=True,
+                    )
+                )
+                if point_cloud.shape[0] == 0:
+                    # No photons to sample points from
+                    continue
+
+                # Now have to subsample (or resample) points
+                # Replacement has to be used if there are less points than final_points photons available
+                if replacement or point_cloud.shape[0] < final_points:
+                    point_indicies = np.random.choice(
+                        point_cloud.shape[0], final_points, replace=True
                     )
-                    if return_features:
-                        if features["extraction"] == 1:
-                            # Failed feature extraction, so ignore event
-                            continue
-                        else:
-                            # Based off a subset the Open Crab Sample Analysis
-                            feature_list = []
-                            feature_list.append(features["head_tail_ratio"])
-                            feature_list.append(features["length"])
-                            feature_list.append(features["width"])
-                            feature_list.append(features["time_gradient"])
-                            feature_list.append(features["number_photons"])
-                            feature_list.append(
-                                features["length"] * features["width"] * np.pi
-                            )
-                            feature_list.append(
-                                (
-                                    (features["length"] * features["width"] * np.pi)
-                                    / np.log(features["number_photons"]) ** 2
-                                )
-                            )
-                            feature_list.append(
-                                (
-                                    features["number_photons"]
-                                    / (features["length"] * features["width"] * np.pi)
-                                )
-                            )
-
-                    # Convert from timeslice to time
-                    self.end *= TIME_SLICE_DURATION_S
-                    self.start *= TIME_SLICE_DURATION_S
-
-                    if truncate:
-                        self.end = self.start + (self.shape[3] * TIME_SLICE_DURATION_S)
-
-                    # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
-                    event_photons = data[data_format["Image"]]
-                    event_photons = list_of_lists_to_raw_phs(event_photons)
-                    point_cloud = np.asarray(
-                        raw_phs_to_point_cloud(
-                            event_photons, cx=GEOMETRY.x_angle, cy=GEOMETRY.y_angle
-                        )
+                else:
+                    point_indicies = np.random.choice(
+                        point_cloud.shape[0], final_points, replace=False
                     )
-                    start_one = min(point_cloud[:, 2])
-                    if start_one > self.start:
-                        diff = start_one - self.start
-                        self.start += diff
-                        self.end += diff
-                    # print("Min: {} Max: {}".format(min(point_cloud[:,2]), max(point_cloud[:,2])))
-                    # print("Min: {} Max: {}".format(self.start, self.end))
-                    # Now in point cloud format, truncation is just cutting off in z now
-                    # print("Num Points Before Mask: {}".format(len(point_cloud)))
-                    # mask = (point_cloud[:, 2] <= self.end) & (point_cloud[:, 2] >= self.start)
-                    # TODO Move around if no pixels contained
-                    # TODO mask seems to be off slightly
-                    # point_cloud = point_cloud[mask]
-                    # print("Num Points: {}".format(len(point_cloud)))
-
-                    # Now have to subsample (or resample) points
-                    # Replacement has to be used if there are less points than final_points photons available
-                    if replacement or point_cloud.shape[0] < final_points:
-                        point_indicies = np.random.choice(
-                            point_cloud.shape[0], final_points, replace=True
-                        )
-                    else:
-                        point_indicies = np.random.choice(
-                            point_cloud.shape[0], final_points, replace=False
-                        )
 
-                    point_cloud = point_cloud[point_indicies]
+                point_cloud = point_cloud[point_indicies]
 
-                    data[data_format["Image"]] = point_cloud
-                    data = self.format([data, data_format])
+                data[data_format["Image"]] = point_cloud
+                data = self.format([data, data_format])
 
                 temp_data = [data, data_format]
                 if return_features:
@@ -134,68 +91,97 @@ class PointCloudPreprocessor(EventFilePreprocessor):
         replacement=False,
         truncate=False,
         return_features=False,
+        densest_window=False,
     ):
 
-        with open(filepath, "rb") as pickled_event:
-            data, data_format, features, feature_cluster = pickle.load(pickled_event)
-            if return_features:
-                if features["extraction"] == 1:
-                    # Failed feature extraction, so ignore event
-                    pass
-                else:
-                    # Based off a subset the Open Crab Sample Analysis
-                    feature_list = []
-                    feature_list.append(features["head_tail_ratio"])
-                    feature_list.append(features["length"])
-                    feature_list.append(features["width"])
-                    feature_list.append(features["time_gradient"])
-                    feature_list.append(features["number_photons"])
-                    feature_list.append(features["length"] * features["width"] * np.pi)
-                    feature_list.append(
-                        (
-                            (features["length"] * features["width"] * np.pi)
-                            / np.log(features["number_photons"]) ** 2
-                        )
+        data, data_format, features, feature_cluster = load_event(filepath, flat=True)
+        if return_features:
+            if features["extraction"] == 1:
+                # Failed feature extraction, so ignore event
+                pass
+            else:
+                # Based off a subset the Open Crab Sample Analysis
+                feature_list = []
+                feature_list.append(features["head_tail_ratio"])
+                feature_list.append(features["length"])
+                feature_list.append(features["width"])
+                feature_list.append(features["time_gradient"])
+                feature_list.append(features["number_photons"])
+                feature_list.append(features["length"] * features["width"] * np.pi)
+                feature_list.append(
+                    (
+                        (features["length"] * features["width"] * np.pi)
+                        / np.log(features["number_photons"]) ** 2
                     )
-                    feature_list.append(
-                        (
-                            features["number_photons"]
-                            / (features["length"] * features["width"] * np.pi)
-                        )
+                )
+                feature_list.append(
+                    (
+                        features["number_photons"]
+                        / (features["length"] * features["width"] * np.pi)
                     )
-
-            # Convert from timeslice to time
-            self.end *= TIME_SLICE_DURATION_S
-            self.start *= TIME_SLICE_DURATION_S
-            if truncate:
-                self.end = self.start + (self.shape[3] * TIME_SLICE_DURATION_S)
-
-            # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
-            event_photons = data[data_format["Image"]]
-            event_photons = list_of_lists_to_raw_phs(event_photons)
-            point_cloud = np.asarray(
-                raw_phs_to_point_cloud(
-                    event_photons, cx=GEOMETRY.x_angle, cy=GEOMETRY.y_angle
                 )
-            )
-
-            # Now in point cloud format, truncation is just cutting off in z now
-            mask = (point_cloud[:, 2] <= self.end) & (point_cloud[:, 2] >= self.start)
-            point_cloud = point_cloud[mask]
 
-            # Now have to subsample (or resample) points
-            # Replacement has to be used if there are less points than final_points
-            if replacement or point_cloud.shape[0] < final_points:
-                point_indicies = np.random.choice(
-                    point_cloud.shape[0], final_points, replace=True
-                )
-            else:
-                point_indicies = np.random.choice(
-                    point_cloud.shape[0], final_points, replace=False
-                )
+        # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
+        point_cloud = photons.point_cloud(
+            *self.photon_window(
+                *data[data_format["Image"]],
+                truncate=truncate,
+                densest_window=densest_window,
+                move=True,
+            )
+        )
+        if point_cloud.shape[0] == 0:
+            # No photons to sample points from
+            return
+
+        # Now have to subsample (or resample) points
+        # Replacement has to be used if there are less points than final_points
+        if replacement or point_cloud.shape[0] < final_points:
+            point_indicies = np.random.choice(
+                point_cloud.shape[0], final_points, replace=True
+            )
+        else:
+            point_indicies = np.random.choice(
+                point_cloud.shape[0], final_points, replace=False
+            )
 
-            point_cloud = point_cloud[point_indicies]
+        point_cloud = point_cloud[point_indicies]
 
-            data[data_format["Image"]] = point_cloud
-            data = self.format([data, data_format])
+        data[data_format["Image"]] = point_cloud
+        data = self.format([data, data_format])
         yield data, data_format
+
+    def photon_window(
+        self, arrivals, offsets, truncate=False, densest_window=False, move=False
+    ):
+        """
+        Cuts a flattened event down to the photons in its time window, done on the arrival slices so the cut is
+        exactly the same as for the images
+
+        :param arrivals: Flat array of arrival time slices
+        :param offsets: CHID offsets into arrivals
+        :param truncate: Whether to end self.shape[3] slices after the start, instead of at self.end
+        :param densest_window: Whether to use the self.shape[3] slices with the most photons instead
+        :param move: Whether to move the window to start at the first photon, if that is after the start or none of
+        the photons are in the window
+        :return: (arrivals, offsets) of the photons in the window
+        """
+        start, end = self.time_window(
+            arrivals, offsets, truncate=truncate, densest_window=densest_window
+        )
+        window = photons.select_photons(
+            arrivals, offsets, photons.window_mask(arrivals, offsets, start, end)
+        )
+        if move and not densest_window:
+            first, _, _, _ = photons.arrival_window(arrivals, offsets)
+            inside = np.diff(window[1][:: photons.NUMBER_OF_PIXELS])
+            moved = (first >= 0) & ((first > start) | (inside == 0))
+            if np.any(moved):
+                end = np.where(moved, end + first - start, end)
+                start = np.where(moved, first, start)
+                window = photons.select_photons(
+                    arrivals,
+                    offsets,
+                    photons.window_mask(arrivals, offsets, start, end),
+                )
+        return window
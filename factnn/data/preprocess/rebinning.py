@@ -0,0 +1,211 @@
+import getpass
+import numpy as np
+import os
+import struct
+import tempfile
+import zipfile
+import pkg_resources as res
+
+REBINNING_ARCHIVE = "rebinning.npz"
+# Part of the name of every shared file, so a new version of the code never maps arrays an older one shared
+SHARED_ARRAYS_VERSION = 1
+
+_rebinning_archive = None
+
+
+def memmap_npz(path):
+    """
+    Memory maps every array in an uncompressed .npz file, instead of reading them in like np.load does
+
+    :param path: Path to a .npz written with np.savez
+    :return: Dict of array name to read-only np.memmap
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as raw_file:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(
+                    "{} in {} is compressed, so can not be memory mapped".format(
+                        info.filename, path
+                    )
+                )
+            # The local header can have a different extra field than the central directory, so read its lengths
+            raw_file.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", raw_file.read(4))
+            raw_file.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(raw_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(
+                    raw_file
+                )
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(
+                    raw_file
+                )
+            arrays[info.filename[: -len(".npy")]] = np.memmap(
+                path,
+                dtype=dtype,
+                mode="r",
+                offset=raw_file.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+
+def load_rebinning(size):
+    """
+    Loads a precomputed rebinning from the packaged archive, which is memory mapped on first use
+
+    :param size: Number of grid squares along each side
+    :return: (chid_offsets, pixel_indices, fractions) arrays as from rebinning_to_arrays, or None if that size
+    is not in the archive
+    """
+    global _rebinning_archive
+    if _rebinning_archive is None:
+        try:
+            _rebinning_archive = memmap_npz(
+                res.resource_filename("factnn.data.resources", REBINNING_ARCHIVE)
+            )
+        except (IOError, ValueError):
+            _rebinning_archive = {}
+    if not _rebinning_archive:
+        return None
+    position = np.searchsorted(_rebinning_archive["sizes"], size)
+    if (
+        position == len(_rebinning_archive["sizes"])
+        or _rebinning_archive["sizes"][position] != size
+    ):
+        return None
+    chid_offsets = _rebinning_archive["chid_offsets"][position]
+    return (
+        np.asarray(chid_offsets - chid_offsets[0]),
+        _rebinning_archive["pixel_indices"][chid_offsets[0] : chid_offsets[-1]],
+        _rebinning_archive["fractions"][chid_offsets[0] : chid_offsets[-1]],
+    )
+
+
+def rebinning_to_arrays(rebinning):
+    """
+    Converts a [chid_to_pixel, pixel_index_to_grid] rebinning to flat arrays
+
+    :param rebinning: The rebinning, as from BasePreprocessor.generate_rebinning
+    :return: (chid_offsets, pixel_indices, fractions) where the entries for CHID c are
+    pixel_indices[chid_offsets[c] : chid_offsets[c + 1]], and the same for fractions
+    """
+    chid_to_pixel = rebinning[0]
+    chid_offsets = np.zeros(1441, dtype=np.int64)
+    chid_offsets[1:] = np.cumsum([len(chid_to_pixel[chid]) for chid in range(1440)])
+    pixel_indices = np.array(
+        [pixel for chid in range(1440) for pixel, _ in chid_to_pixel[chid]],
+        dtype=np.int32,
+    )
+    fractions = np.array(
+        [fraction for chid in range(1440) for _, fraction in chid_to_pixel[chid]],
+        dtype=np.float32,
+    )
+    return chid_offsets, pixel_indices, fractions
+
+
+def arrays_to_rebinning(chid_offsets, pixel_indices, fractions, size):
+    """
+    Converts the flat arrays back to the [chid_to_pixel, pixel_index_to_grid] rebinning
+
+    :param size: Number of grid squares along each side
+    :return: [chid_to_pixel, pixel_index_to_grid]
+    """
+    chid_to_pixel = {}
+    for chid in range(1440):
+        chid_to_pixel[chid] = list(
+            zip(
+                pixel_indices[chid_offsets[chid] : chid_offsets[chid + 1]].tolist(),
+                fractions[chid_offsets[chid] : chid_offsets[chid + 1]].tolist(),
+            )
+        )
+    pixel_index_to_grid = {}
+    for pix_index in range(size * size):
+        pixel_index_to_grid[pix_index] = [pix_index // size, pix_index % size]
+    return [chid_to_pixel, pixel_index_to_grid]
+
+
+def write_rebinning_archive(output_file, rebinnings):
+    """
+    Writes rebinnings to a single uncompressed archive that load_rebinning can memory map
+
+    :param output_file: Path to write, e.g. factnn/data/resources/rebinning.npz
+    :param rebinnings: Dict of size to [chid_to_pixel, pixel_index_to_grid] rebinning
+    :return:
+    """
+    sizes = np.array(sorted(rebinnings), dtype=np.int32)
+    chid_offsets = np.zeros((len(sizes), 1441), dtype=np.int64)
+    pixel_indices = []
+    fractions = []
+    start = 0
+    for index, size in enumerate(sizes):
+        offsets, size_pixel_indices, size_fractions = rebinning_to_arrays(
+            rebinnings[size]
+        )
+        chid_offsets[index] = offsets + start
+        start += offsets[-1]
+        pixel_indices.append(size_pixel_indices)
+        fractions.append(size_fractions)
+    np.savez(
+        output_file,
+        sizes=sizes,
+        chid_offsets=chid_offsets,
+        pixel_indices=np.concatenate(pixel_indices),
+        fractions=np.concatenate(fractions),
+    )
+
+
+def share_arrays(name, arrays):
+    """
+    Writes arrays to an uncompressed .npz in a per user directory under the temporary directory and memory maps them,
+    so every other process of the user on the host can map the same pages with attach_arrays instead of building
+    their own copy
+
+    :param name: Name to share the arrays under, which should include a hash of whatever the arrays are built from
+    :param arrays: List of arrays to share
+    :return: List of read-only memory mapped arrays
+    """
+    path = _shared_path(name)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    # Written under a unique name then moved into place, so attach_arrays never maps a half written file
+    temp_file = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path), suffix=".npz", delete=False
+    )
+    try:
+        with temp_file:
+            np.savez(temp_file, *arrays)
+        os.replace(temp_file.name, path)
+    except BaseException:
+        if os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+        raise
+    return attach_arrays(name)
+
+
+def attach_arrays(name):
+    """
+    Memory maps arrays shared with share_arrays
+
+    :param name: Name the arrays were shared under
+    :return: List of read-only memory mapped arrays, or None if nothing was shared under that name
+    """
+    try:
+        arrays = memmap_npz(_shared_path(name))
+    except (IOError, ValueError, zipfile.BadZipFile):
+        return None
+    return [arrays["arr_{}".format(index)] for index in range(len(arrays))]
+
+
+def _shared_path(name):
+    if hasattr(os, "getuid"):
+        user = str(os.getuid())
+    else:
+        user = getpass.getuser()
+    return os.path.join(
+        tempfile.gettempdir(),
+        "factnn-" + user,
+        "{}_v{}.npz".format(name, SHARED_ARRAYS_VERSION),
+    )
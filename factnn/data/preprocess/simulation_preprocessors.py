@@ -2,15 +2,30 @@ import numpy as np
 import h5py
 import fact
 import photon_stream as ps
-from fact.io import read_h5py
+from factnn.data.preprocess.dl2_index import load_dl2_index
+from factnn.data.preprocess.event_cache import (
+    simulation_events,
+    count_simulation_events,
+)
 from factnn.data.preprocess.base_preprocessor import BasePreprocessor
 from sklearn.utils import shuffle
+from functools import partial
 import pickle
 import os
 from factnn.utils.hillas import extract_single_simulation_features
 
 
 class SimulationPreprocessor(BasePreprocessor):
+    # Columns of the chunks from batch_processor
+    data_format = {
+        "Image": 0,
+        "Energy": 1,
+        "Zd_Deg": 2,
+        "Az_Deg": 3,
+        "Phi": 4,
+        "Theta": 5,
+    }
+
     def event_processor(
         self,
         directory,
@@ -18,6 +33,8 @@ class SimulationPreprocessor(BasePreprocessor):
         clean_images=False,
         only_core=True,
         clump_size=20,
+        eps=0.1,
+        thresholds=None,
     ):
         for index, file in enumerate(self.paths):
             mc_truth = file.split(".phs")[0] + ".ch.gz"
@@ -30,101 +47,60 @@ class SimulationPreprocessor(BasePreprocessor):
                 for event in sim_reader:
                     counter += 1
 
-                    if os.path.isfile(
-                        os.path.join(
+                    if clean_images:
+                        cleaned = self.event_record_masks(
                             directory,
-                            "clump" + str(clump_size),
                             str(file_name) + "_" + str(counter),
+                            event,
+                            clump_size,
+                            eps,
+                            clean_type,
+                            thresholds,
                         )
-                    ) and os.path.isfile(
-                        os.path.join(
-                            directory,
-                            "core" + str(clump_size),
-                            str(file_name) + "_" + str(counter),
+                        if cleaned is None:
+                            continue
+                        record_path, masks = cleaned
+                        # TODO Get features from FeatureStream without DBSCAN
+                        features, cluster = extract_single_simulation_features(
+                            event, min_samples=1
                         )
-                    ):
-                        print("True: " + str(file_name) + "_" + str(counter))
-                        continue
-
-                    if clean_images:
-                        # Do it for no clumps, all clump, and only core into different subfolders
-                        (
-                            all_photons,
-                            clump_photons,
-                            core_photons,
-                            dbscan,
-                        ) = self.clean_image(
-                            event, only_core=only_core, min_samples=clump_size
+                        # In the event chosen from the file
+                        # Each event is the same as each line below
+                        energy = event.simulation_truth.air_shower.energy
+                        event_photons = event.photon_stream.list_of_lists
+                        zd_deg = event.zd
+                        az_deg = event.az
+                        act_phi = event.simulation_truth.air_shower.phi
+                        act_theta = event.simulation_truth.air_shower.theta
+                        data_dict = [
+                            [
+                                event_photons,
+                                energy,
+                                zd_deg,
+                                az_deg,
+                                act_phi,
+                                act_theta,
+                            ],
+                            {
+                                "Image": 0,
+                                "Energy": 1,
+                                "Zd_Deg": 2,
+                                "Az_Deg": 3,
+                                "Phi": 4,
+                                "Theta": 5,
+                            },
+                            features,
+                            cluster,
+                        ]
+                        self.write_cleaned_event(
+                            record_path,
+                            event,
+                            masks,
+                            *data_dict,
+                            extract_features=lambda cleaned: extract_single_simulation_features(
+                                cleaned, min_samples=1
+                            ),
                         )
-                        if core_photons is None:
-                            print("No Clumps, skip")
-                            continue
-                        for key, photon_set in {
-                            "no_clean": all_photons,
-                            "clump": clump_photons,
-                            "core": core_photons,
-                        }.items():
-                            event.photon_stream.raw = photon_set
-                            # Extract parameters from the file, if cleaning type is 'facttools', then this still calls DBSCAN currently
-                            # TODO Get features from FeatureStream without DBSCAN
-                            features, cluster = extract_single_simulation_features(
-                                event, cluster=dbscan, min_samples=clump_size
-                            )
-                            # In the event chosen from the file
-                            # Each event is the same as each line below
-                            energy = event.simulation_truth.air_shower.energy
-                            event_photons = event.photon_stream.list_of_lists
-                            zd_deg = event.zd
-                            az_deg = event.az
-                            act_phi = event.simulation_truth.air_shower.phi
-                            act_theta = event.simulation_truth.air_shower.theta
-                            data_dict = [
-                                [
-                                    event_photons,
-                                    energy,
-                                    zd_deg,
-                                    az_deg,
-                                    act_phi,
-                                    act_theta,
-                                ],
-                                {
-                                    "Image": 0,
-                                    "Energy": 1,
-                                    "Zd_Deg": 2,
-                                    "Az_Deg": 3,
-                                    "Phi": 4,
-                                    "Theta": 5,
-                                },
-                                features,
-                                cluster,
-                            ]
-                            if key != "no_clean":
-                                with open(
-                                    os.path.join(
-                                        directory,
-                                        key + str(clump_size),
-                                        str(file_name) + "_" + str(counter),
-                                    ),
-                                    "wb",
-                                ) as event_file:
-                                    pickle.dump(data_dict, event_file)
-                            else:
-                                if not os.path.isfile(
-                                    os.path.join(
-                                        directory,
-                                        key,
-                                        str(file_name) + "_" + str(counter),
-                                    )
-                                ):
-                                    with open(
-                                        os.path.join(
-                                            directory,
-                                            key,
-                                            str(file_name) + "_" + str(counter),
-                                        ),
-                                        "wb",
-                                    ) as event_file:
-                                        pickle.dump(data_dict, event_file)
                     else:
                         # In the event chosen from the file
                         # Each event is the same as each line below
@@ -159,55 +135,67 @@ class SimulationPreprocessor(BasePreprocessor):
                 print(str(e))
                 pass
 
-    def batch_processor(self, clean_images=False):
-        for index, file in enumerate(self.paths):
-            mc_truth = file.split(".phs")[0] + ".ch.gz"
-            try:
-                sim_reader = ps.SimulationReader(
-                    photon_stream_path=file, mmcs_corsika_path=mc_truth
-                )
-                data = []
-                for event in sim_reader:
-                    if clean_images:
-                        event = self.clean_image(event)
-                        if event.photon_stream.raw is None:
-                            print("No Clumps, skip")
-                            continue
-                    # In the event chosen from the file
-                    # Each event is the same as each line below
-                    energy = event.simulation_truth.air_shower.energy
-                    event_photons = event.photon_stream.list_of_lists
-                    zd_deg = event.zd
-                    az_deg = event.az
-                    act_phi = event.simulation_truth.air_shower.phi
-                    act_theta = event.simulation_truth.air_shower.theta
-                    input_matrix = np.zeros(
-                        [self.shape[1], self.shape[2], self.shape[3]]
-                    )
-                    chid_to_pixel = self.rebinning[0]
-                    pixel_index_to_grid = self.rebinning[1]
-                    for index in range(1440):
-                        for element in chid_to_pixel[index]:
-                            coords = pixel_index_to_grid[element[0]]
-                            for value in event_photons[index]:
-                                if self.end >= value >= self.start:
-                                    input_matrix[coords[0]][coords[1]][
-                                        value - self.start
-                                    ] += (element[1] * 1)
-                    data.append(
-                        [
-                            np.fliplr(np.rot90(input_matrix, 3)),
-                            energy,
-                            zd_deg,
-                            az_deg,
-                            act_phi,
-                            act_theta,
-                        ]
-                    )
-                yield data
+    def batch_processor(
+        self,
+        clean_images=False,
+        chunk_size=None,
+        clean_type="dbscan",
+        thresholds=None,
+    ):
+        """
+        Rasterizes the events of all files, see BasePreprocessor.batches
 
-            except Exception as e:
-                print(str(e))
+        :param clean_images: Whether to only keep the photons of the clumps found by clean_image
+        :param chunk_size: Number of events in each chunk, None for one list per file
+        :param clean_type: Method to clean with, either 'dbscan' or 'facttools', see clean_image
+        :param thresholds: Thresholds of the facttools cleaning, see clean_image
+        :return: Generator over the batches
+        """
+        return self.batches(
+            partial(
+                self.file_rows,
+                clean_images=clean_images,
+                clean_type=clean_type,
+                thresholds=thresholds,
+            ),
+            chunk_size,
+        )
+
+    def file_rows(self, file, clean_images=False, clean_type="dbscan", thresholds=None):
+        """
+        :param file: Path to the phs.jsonl.gz file
+        :return: Generator over the rows of its events, with the photons as list of lists in place of the image
+        """
+        mc_truth = file.split(".phs")[0] + ".ch.gz"
+        try:
+            sim_reader = ps.SimulationReader(
+                photon_stream_path=file, mmcs_corsika_path=mc_truth
+            )
+            for event in sim_reader:
+                if clean_images:
+                    event = self.cleaned_event(
+                        event, clean_type=clean_type, thresholds=thresholds
+                    )
+                    if event is None:
+                        continue
+                # In the event chosen from the file
+                # Each event is the same as each line below
+                energy = event.simulation_truth.air_shower.energy
+                event_photons = event.photon_stream.list_of_lists
+                zd_deg = event.zd
+                az_deg = event.az
+                act_phi = event.simulation_truth.air_shower.phi
+                act_theta = event.simulation_truth.air_shower.theta
+                yield [
+                    event_photons,
+                    energy,
+                    zd_deg,
+                    az_deg,
+                    act_phi,
+                    act_theta,
+                ]
+        except Exception as e:
+            print(str(e))
 
     def single_processor(
         self,
@@ -216,21 +204,22 @@ class SimulationPreprocessor(BasePreprocessor):
         final_slices=5,
         as_channels=False,
         clean_images=False,
+        clean_type="dbscan",
+        thresholds=None,
     ):
         while True:
             self.paths = shuffle(self.paths)
             for index, file in enumerate(self.paths):
                 mc_truth = file.split(".phs")[0] + ".ch.gz"
                 try:
-                    sim_reader = ps.SimulationReader(
-                        photon_stream_path=file, mmcs_corsika_path=mc_truth
-                    )
+                    sim_reader = simulation_events(file, mc_truth, self.cache_directory)
                     for event in sim_reader:
                         data = []
                         if clean_images:
-                            event = self.clean_image(event)
-                            if event.photon_stream.raw is None:
-                                print("No Clumps, skip")
+                            event = self.cleaned_event(
+                                event, clean_type=clean_type, thresholds=thresholds
+                            )
+                            if event is None:
                                 continue
                         # In the event chosen from the file
                         # Each event is the same as each line below
@@ -240,22 +229,15 @@ class SimulationPreprocessor(BasePreprocessor):
                         az_deg = event.az
                         act_phi = event.simulation_truth.air_shower.phi
                         act_theta = event.simulation_truth.air_shower.theta
-                        input_matrix = np.zeros(
-                            [self.shape[1], self.shape[2], self.shape[3]]
+                        input_matrix = self.rasterize(
+                            self.photon_histogram(
+                                event_photons, self.start, self.shape[3]
+                            ),
+                            scale=100,
                         )
-                        chid_to_pixel = self.rebinning[0]
-                        pixel_index_to_grid = self.rebinning[1]
-                        for index in range(1440):
-                            for element in chid_to_pixel[index]:
-                                coords = pixel_index_to_grid[element[0]]
-                                for value in event_photons[index]:
-                                    if self.end >= value >= self.start:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 100)
                         data.append(
                             [
-                                np.fliplr(np.rot90(input_matrix, 3)),
+                                input_matrix,
                                 energy,
                                 zd_deg,
                                 az_deg,
@@ -293,10 +275,9 @@ class SimulationPreprocessor(BasePreprocessor):
             for index, file in enumerate(self.paths):
                 mc_truth = file.split(".phs")[0] + ".ch.gz"
                 try:
-                    sim_reader = ps.SimulationReader(
-                        photon_stream_path=file, mmcs_corsika_path=mc_truth
+                    count += count_simulation_events(
+                        file, mc_truth, self.cache_directory
                     )
-                    count += sum(1 for _ in sim_reader)
                 except Exception as e:
                     print(str(e))
             print(count)
@@ -318,8 +299,25 @@ class SimulationPreprocessor(BasePreprocessor):
 
 
 class ProtonPreprocessor(BasePreprocessor):
+    # Columns of the chunks from batch_processor
+    data_format = {
+        "Image": 0,
+        "Energy": 1,
+        "Zd_Deg": 2,
+        "Az_Deg": 3,
+        "Phi": 4,
+        "Theta": 5,
+    }
+
     def event_processor(
-        self, directory, clean_images=False, only_core=True, clump_size=20
+        self,
+        directory,
+        clean_images=False,
+        only_core=True,
+        clump_size=20,
+        eps=0.1,
+        clean_type="dbscan",
+        thresholds=None,
     ):
         for index, file in enumerate(self.paths):
             mc_truth = file.split(".phs")[0] + ".ch.gz"
@@ -332,100 +330,60 @@ class ProtonPreprocessor(BasePreprocessor):
                 for event in sim_reader:
                     counter += 1
 
-                    if os.path.isfile(
-                        os.path.join(
+                    if clean_images:
+                        cleaned = self.event_record_masks(
                             directory,
-                            "clump" + str(clump_size),
                             str(file_name) + "_" + str(counter),
+                            event,
+                            clump_size,
+                            eps,
+                            clean_type,
+                            thresholds,
                         )
-                    ) and os.path.isfile(
-                        os.path.join(
-                            directory,
-                            "core" + str(clump_size),
-                            str(file_name) + "_" + str(counter),
+                        if cleaned is None:
+                            continue
+                        record_path, masks = cleaned
+                        # Extract parameters from the file
+                        features, cluster = extract_single_simulation_features(
+                            event, min_samples=1
                         )
-                    ):
-                        print("True: " + str(file_name) + "_" + str(counter))
-                        continue
-
-                    if clean_images:
-                        # Do it for no clumps, all clump, and only core into different subfolders
-                        (
-                            all_photons,
-                            clump_photons,
-                            core_photons,
-                            dbscan,
-                        ) = self.clean_image(
-                            event, only_core=only_core, min_samples=clump_size
+                        # In the event chosen from the file
+                        # Each event is the same as each line below
+                        energy = event.simulation_truth.air_shower.energy
+                        event_photons = event.photon_stream.list_of_lists
+                        zd_deg = event.zd
+                        az_deg = event.az
+                        act_phi = event.simulation_truth.air_shower.phi
+                        act_theta = event.simulation_truth.air_shower.theta
+                        data_dict = [
+                            [
+                                event_photons,
+                                energy,
+                                zd_deg,
+                                az_deg,
+                                act_phi,
+                                act_theta,
+                            ],
+                            {
+                                "Image": 0,
+                                "Energy": 1,
+                                "Zd_Deg": 2,
+                                "Az_Deg": 3,
+                                "Phi": 4,
+                                "Theta": 5,
+                            },
+                            features,
+                            cluster,
+                        ]
+                        self.write_cleaned_event(
+                            record_path,
+                            event,
+                            masks,
+                            *data_dict,
+                            extract_features=lambda cleaned: extract_single_simulation_features(
+                                cleaned, min_samples=1
+                            ),
                         )
-                        if core_photons is None:
-                            print("No Clumps, skip")
-                            continue
-                        for key, photon_set in {
-                            "no_clean": all_photons,
-                            "clump": clump_photons,
-                            "core": core_photons,
-                        }.items():
-                            event.photon_stream.raw = photon_set
-                            # Extract parameters from the file
-                            features, cluster = extract_single_simulation_features(
-                                event, min_samples=1
-                            )
-                            # In the event chosen from the file
-                            # Each event is the same as each line below
-                            energy = event.simulation_truth.air_shower.energy
-                            event_photons = event.photon_stream.list_of_lists
-                            zd_deg = event.zd
-                            az_deg = event.az
-                            act_phi = event.simulation_truth.air_shower.phi
-                            act_theta = event.simulation_truth.air_shower.theta
-                            data_dict = [
-                                [
-                                    event_photons,
-                                    energy,
-                                    zd_deg,
-                                    az_deg,
-                                    act_phi,
-                                    act_theta,
-                                ],
-                                {
-                                    "Image": 0,
-                                    "Energy": 1,
-                                    "Zd_Deg": 2,
-                                    "Az_Deg": 3,
-                                    "Phi": 4,
-                                    "Theta": 5,
-                                },
-                                features,
-                                cluster,
-                            ]
-                            if key != "no_clean":
-                                with open(
-                                    os.path.join(
-                                        directory,
-                                        key + str(clump_size),
-                                        str(file_name) + "_" + str(counter),
-                                    ),
-                                    "wb",
-                                ) as event_file:
-                                    pickle.dump(data_dict, event_file)
-                            else:
-                                if not os.path.isfile(
-                                    os.path.join(
-                                        directory,
-                                        key,
-                                        str(file_name) + "_" + str(counter),
-                                    )
-                                ):
-                                    with open(
-                                        os.path.join(
-                                            directory,
-                                            key,
-                                            str(file_name) + "_" + str(counter),
-                                        ),
-                                        "wb",
-                                    ) as event_file:
-                                        pickle.dump(data_dict, event_file)
                     else:
                         # In the event chosen from the file
                         # Each event is the same as each line below
@@ -461,56 +419,81 @@ class ProtonPreprocessor(BasePreprocessor):
                 print(str(e))
                 pass
 
-    def batch_processor(self, clean_images=False, only_core=True):
-        for index, file in enumerate(self.paths):
-            mc_truth = file.split(".phs")[0] + ".ch.gz"
-            try:
-                sim_reader = ps.SimulationReader(
-                    photon_stream_path=file, mmcs_corsika_path=mc_truth
-                )
-                data = []
-                for event in sim_reader:
-                    if clean_images:
-                        event = self.clean_image(event, only_core=only_core)
-                        if event.photon_stream.raw is None:
-                            print("No Clumps, skip")
-                            continue
-                    # In the event chosen from the file
-                    # Each event is the same as each line below
-                    # TODO Update this to reflect new outputs
-                    energy = event.simulation_truth.air_shower.energy
-                    event_photons = event.photon_stream.list_of_lists
-                    zd_deg = event.zd
-                    az_deg = event.az
-                    act_phi = event.simulation_truth.air_shower.phi
-                    act_theta = event.simulation_truth.air_shower.theta
-                    input_matrix = np.zeros(
-                        [self.shape[1], self.shape[2], self.shape[3]]
-                    )
-                    chid_to_pixel = self.rebinning[0]
-                    pixel_index_to_grid = self.rebinning[1]
-                    for index in range(1440):
-                        for element in chid_to_pixel[index]:
-                            coords = pixel_index_to_grid[element[0]]
-                            for value in event_photons[index]:
-                                if self.end >= value >= self.start:
-                                    input_matrix[coords[0]][coords[1]][
-                                        value - self.start
-                                    ] += (element[1] * 1)
-                    data.append(
-                        [
-                            np.fliplr(np.rot90(input_matrix, 3)),
-                            energy,
-                            zd_deg,
-                            az_deg,
-                            act_phi,
-                            act_theta,
-                        ]
-                    )
-                yield data
+    def batch_processor(
+        self,
+        clean_images=False,
+        only_core=True,
+        chunk_size=None,
+        clean_type="dbscan",
+        thresholds=None,
+    ):
+        """
+        Rasterizes the events of all files, see BasePreprocessor.batches
 
-            except Exception as e:
-                print(str(e))
+        :param clean_images: Whether to only keep the photons of the clumps found by clean_image
+        :param only_core: Whether clean_image only keeps the core photons of the clumps
+        :param chunk_size: Number of events in each chunk, None for one list per file
+        :param clean_type: Method to clean with, either 'dbscan' or 'facttools', see clean_image
+        :param thresholds: Thresholds of the facttools cleaning, see clean_image
+        :return: Generator over the batches
+        """
+        return self.batches(
+            partial(
+                self.file_rows,
+                clean_images=clean_images,
+                only_core=only_core,
+                clean_type=clean_type,
+                thresholds=thresholds,
+            ),
+            chunk_size,
+        )
+
+    def file_rows(
+        self,
+        file,
+        clean_images=False,
+        only_core=True,
+        clean_type="dbscan",
+        thresholds=None,
+    ):
+        """
+        :param file: Path to the phs.jsonl.gz file
+        :return: Generator over the rows of its events, with the photons as list of lists in place of the image
+        """
+        mc_truth = file.split(".phs")[0] + ".ch.gz"
+        try:
+            sim_reader = ps.SimulationReader(
+                photon_stream_path=file, mmcs_corsika_path=mc_truth
+            )
+            for event in sim_reader:
+                if clean_images:
+                    event = self.cleaned_event(
+                        event,
+                        clean_type=clean_type,
+                        only_core=only_core,
+                        thresholds=thresholds,
+                    )
+                    if event is None:
+                        continue
+                # In the event chosen from the file
+                # Each event is the same as each line below
+                # TODO Update this to reflect new outputs
+                energy = event.simulation_truth.air_shower.energy
+                event_photons = event.photon_stream.list_of_lists
+                zd_deg = event.zd
+                az_deg = event.az
+                act_phi = event.simulation_truth.air_shower.phi
+                act_theta = event.simulation_truth.air_shower.theta
+                yield [
+                    event_photons,
+                    energy,
+                    zd_deg,
+                    az_deg,
+                    act_phi,
+                    act_theta,
+                ]
+        except Exception as e:
+            print(str(e))
 
     def single_processor(
         self,
@@ -520,6 +503,8 @@ class ProtonPreprocessor(BasePreprocessor):
         as_channels=False,
         clean_images=False,
         only_core=True,
+        clean_type="dbscan",
+        thresholds=None,
     ):
         while True:
             self.paths = shuffle(self.paths)
@@ -527,15 +512,17 @@ class ProtonPreprocessor(BasePreprocessor):
             for index, file in enumerate(self.paths):
                 mc_truth = file.split(".phs")[0] + ".ch.gz"
                 try:
-                    sim_reader = ps.SimulationReader(
-                        photon_stream_path=file, mmcs_corsika_path=mc_truth
-                    )
+                    sim_reader = simulation_events(file, mc_truth, self.cache_directory)
                     for event in sim_reader:
                         data = []
                         if clean_images:
-                            event = self.clean_image(event, only_core=only_core)
-                            if event.photon_stream.raw is None:
-                                print("No Clumps, skip")
+                            event = self.cleaned_event(
+                                event,
+                                clean_type=clean_type,
+                                only_core=only_core,
+                                thresholds=thresholds,
+                            )
+                            if event is None:
                                 continue
                         # In the event chosen from the file
                         # Each event is the same as each line below
@@ -546,22 +533,14 @@ class ProtonPreprocessor(BasePreprocessor):
                         az_deg = event.az
                         act_phi = event.simulation_truth.air_shower.phi
                         act_theta = event.simulation_truth.air_shower.theta
-                        input_matrix = np.zeros(
-                            [self.shape[1], self.shape[2], self.shape[3]]
+                        input_matrix = self.rasterize(
+                            self.photon_histogram(
+                                event_photons, self.start, self.shape[3]
+                            )
                         )
-                        chid_to_pixel = self.rebinning[0]
-                        pixel_index_to_grid = self.rebinning[1]
-                        for index in range(1440):
-                            for element in chid_to_pixel[index]:
-                                coords = pixel_index_to_grid[element[0]]
-                                for value in event_photons[index]:
-                                    if self.end >= value >= self.start:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 1)
                         data.append(
                             [
-                                np.fliplr(np.rot90(input_matrix, 3)),
+                                input_matrix,
                                 energy,
                                 zd_deg,
                                 az_deg,
@@ -600,10 +579,9 @@ class ProtonPreprocessor(BasePreprocessor):
             for index, file in enumerate(self.paths):
                 mc_truth = file.split(".phs")[0] + ".ch.gz"
                 try:
-                    sim_reader = ps.SimulationReader(
-                        photon_stream_path=file, mmcs_corsika_path=mc_truth
+                    count += count_simulation_events(
+                        file, mc_truth, self.cache_directory
                     )
-                    count += sum(1 for _ in sim_reader)
                 except Exception as e:
                     print(str(e))
             print(count)
@@ -625,8 +603,25 @@ class ProtonPreprocessor(BasePreprocessor):
 
 
 class GammaPreprocessor(BasePreprocessor):
+    # Columns of the chunks from batch_processor
+    data_format = {
+        "Image": 0,
+        "Energy": 1,
+        "Zd_Deg": 2,
+        "Az_Deg": 3,
+        "Phi": 4,
+        "Theta": 5,
+    }
+
     def event_processor(
-        self, directory, clean_images=False, only_core=True, clump_size=20
+        self,
+        directory,
+        clean_images=False,
+        only_core=True,
+        clump_size=20,
+        eps=0.1,
+        clean_type="dbscan",
+        thresholds=None,
     ):
         for index, file in enumerate(self.paths):
             mc_truth = file.split(".phs")[0] + ".ch.gz"
@@ -639,100 +634,59 @@ class GammaPreprocessor(BasePreprocessor):
                 for event in sim_reader:
                     counter += 1
 
-                    if os.path.isfile(
-                        os.path.join(
+                    if clean_images:
+                        cleaned = self.event_record_masks(
                             directory,
-                            "clump" + str(clump_size),
                             str(file_name) + "_" + str(counter),
+                            event,
+                            clump_size,
+                            eps,
+                            clean_type,
+                            thresholds,
                         )
-                    ) and os.path.isfile(
-                        os.path.join(
-                            directory,
-                            "core" + str(clump_size),
-                            str(file_name) + "_" + str(counter),
+                        if cleaned is None:
+                            continue
+                        record_path, masks = cleaned
+                        features, cluster = extract_single_simulation_features(
+                            event, min_samples=1
                         )
-                    ):
-                        print("True: " + str(file_name) + "_" + str(counter))
-                        continue
-
-                    if clean_images:
-                        # Do it for no clumps, all clump, and only core into different subfolders
-                        (
-                            all_photons,
-                            clump_photons,
-                            core_photons,
-                            dbscan,
-                        ) = self.clean_image(
-                            event, only_core=only_core, min_samples=clump_size
+                        # In the event chosen from the file
+                        # Each event is the same as each line below
+                        energy = event.simulation_truth.air_shower.energy
+                        event_photons = event.photon_stream.list_of_lists
+                        zd_deg = event.zd
+                        az_deg = event.az
+                        act_phi = event.simulation_truth.air_shower.phi
+                        act_theta = event.simulation_truth.air_shower.theta
+                        data_dict = [
+                            [
+                                event_photons,
+                                energy,
+                                zd_deg,
+                                az_deg,
+                                act_phi,
+                                act_theta,
+                            ],
+                            {
+                                "Image": 0,
+                                "Energy": 1,
+                                "Zd_Deg": 2,
+                                "Az_Deg": 3,
+                                "Phi": 4,
+                                "Theta": 5,
+                            },
+                            features,
+                            cluster,
+                        ]
+                        self.write_cleaned_event(
+                            record_path,
+                            event,
+                            masks,
+                            *data_dict,
+                            extract_features=lambda cleaned: extract_single_simulation_features(
+                                cleaned, min_samples=1
+                            ),
                         )
-                        if core_photons is None:
-                            print("No Clumps, skip")
-                            continue
-                        else:
-                            for key, photon_set in {
-                                "no_clean": all_photons,
-                                "clump": clump_photons,
-                                "core": core_photons,
-                            }.items():
-                                event.photon_stream.raw = photon_set
-                                features, cluster = extract_single_simulation_features(
-                                    event, min_samples=1
-                                )
-                                # In the event chosen from the file
-                                # Each event is the same as each line below
-                                energy = event.simulation_truth.air_shower.energy
-                                event_photons = event.photon_stream.list_of_lists
-                                zd_deg = event.zd
-                                az_deg = event.az
-                                act_phi = event.simulation_truth.air_shower.phi
-                                act_theta = event.simulation_truth.air_shower.theta
-                                data_dict = [
-                                    [
-                                        event_photons,
-                                        energy,
-                                        zd_deg,
-                                        az_deg,
-                                        act_phi,
-                                        act_theta,
-                                    ],
-                                    {
-                                        "Image": 0,
-                                        "Energy": 1,
-                                        "Zd_Deg": 2,
-                                        "Az_Deg": 3,
-                                        "Phi": 4,
-                                        "Theta": 5,
-                                    },
-                                    features,
-                                    cluster,
-                                ]
-                                if key != "no_clean":
-                                    with open(
-                                        os.path.join(
-                                            directory,
-                                            key + str(clump_size),
-                                            str(file_name) + "_" + str(counter),
-                                        ),
-                                        "wb",
-                                    ) as event_file:
-                                        pickle.dump(data_dict, event_file)
-                                else:
-                                    if not os.path.isfile(
-                                        os.path.join(
-                                            directory,
-                                            key,
-                                            str(file_name) + "_" + str(counter),
-                                        )
-                                    ):
-                                        with open(
-                                            os.path.join(
-                                                directory,
-                                                key,
-                                                str(file_name) + "_" + str(counter),
-                                            ),
-                                            "wb",
-                                        ) as event_file:
-                                            pickle.dump(data_dict, event_file)
                     else:
                         # In the event chosen from the file
                         # Each event is the same as each line below
@@ -767,55 +721,67 @@ class GammaPreprocessor(BasePreprocessor):
                 print(str(e))
                 pass
 
-    def batch_processor(self, clean_images=False):
-        for index, file in enumerate(self.paths):
-            mc_truth = file.split(".phs")[0] + ".ch.gz"
-            try:
-                sim_reader = ps.SimulationReader(
-                    photon_stream_path=file, mmcs_corsika_path=mc_truth
-                )
-                data = []
-                for event in sim_reader:
-                    if clean_images:
-                        event = self.clean_image(event)
-                        if event.photon_stream.raw is None:
-                            print("No Clumps, skip")
-                            continue
-                    # In the event chosen from the file
-                    # Each event is the same as each line below
-                    energy = event.simulation_truth.air_shower.energy
-                    event_photons = event.photon_stream.list_of_lists
-                    zd_deg = event.zd
-                    az_deg = event.az
-                    act_phi = event.simulation_truth.air_shower.phi
-                    act_theta = event.simulation_truth.air_shower.theta
-                    input_matrix = np.zeros(
-                        [self.shape[1], self.shape[2], self.shape[3]]
-                    )
-                    chid_to_pixel = self.rebinning[0]
-                    pixel_index_to_grid = self.rebinning[1]
-                    for index in range(1440):
-                        for element in chid_to_pixel[index]:
-                            coords = pixel_index_to_grid[element[0]]
-                            for value in event_photons[index]:
-                                if self.end >= value >= self.start:
-                                    input_matrix[coords[0]][coords[1]][
-                                        value - self.start
-                                    ] += (element[1] * 1)
-                    data.append(
-                        [
-                            np.fliplr(np.rot90(input_matrix, 3)),
-                            energy,
-                            zd_deg,
-                            az_deg,
-                            act_phi,
-                            act_theta,
-                        ]
-                    )
-                yield data
+    def batch_processor(
+        self,
+        clean_images=False,
+        chunk_size=None,
+        clean_type="dbscan",
+        thresholds=None,
+    ):
+        """
+        Rasterizes the events of all files, see BasePreprocessor.batches
 
-            except Exception as e:
-                print(str(e))
+        :param clean_images: Whether to only keep the photons of the clumps found by clean_image
+        :param chunk_size: Number of events in each chunk, None for one list per file
+        :param clean_type: Method to clean with, either 'dbscan' or 'facttools', see clean_image
+        :param thresholds: Thresholds of the facttools cleaning, see clean_image
+        :return: Generator over the batches
+        """
+        return self.batches(
+            partial(
+                self.file_rows,
+                clean_images=clean_images,
+                clean_type=clean_type,
+                thresholds=thresholds,
+            ),
+            chunk_size,
+        )
+
+    def file_rows(self, file, clean_images=False, clean_type="dbscan", thresholds=None):
+        """
+        :param file: Path to the phs.jsonl.gz file
+        :return: Generator over the rows of its events, with the photons as list of lists in place of the image
+        """
+        mc_truth = file.split(".phs")[0] + ".ch.gz"
+        try:
+            sim_reader = ps.SimulationReader(
+                photon_stream_path=file, mmcs_corsika_path=mc_truth
+            )
+            for event in sim_reader:
+                if clean_images:
+                    event = self.cleaned_event(
+                        event, clean_type=clean_type, thresholds=thresholds
+                    )
+                    if event is None:
+                        continue
+                # In the event chosen from the file
+                # Each event is the same as each line below
+                energy = event.simulation_truth.air_shower.energy
+                event_photons = event.photon_stream.list_of_lists
+                zd_deg = event.zd
+                az_deg = event.az
+                act_phi = event.simulation_truth.air_shower.phi
+                act_theta = event.simulation_truth.air_shower.theta
+                yield [
+                    event_photons,
+                    energy,
+                    zd_deg,
+                    az_deg,
+                    act_phi,
+                    act_theta,
+                ]
+        except Exception as e:
+            print(str(e))
 
     def single_processor(
         self,
@@ -824,6 +790,8 @@ class GammaPreprocessor(BasePreprocessor):
         final_slices=5,
         as_channels=False,
         clean_images=False,
+        clean_type="dbscan",
+        thresholds=None,
     ):
         while True:
             self.paths = shuffle(self.paths)
@@ -831,15 +799,14 @@ class GammaPreprocessor(BasePreprocessor):
             for index, file in enumerate(self.paths):
                 mc_truth = file.split(".phs")[0] + ".ch.gz"
                 try:
-                    sim_reader = ps.SimulationReader(
-                        photon_stream_path=file, mmcs_corsika_path=mc_truth
-                    )
+                    sim_reader = simulation_events(file, mc_truth, self.cache_directory)
                     for event in sim_reader:
                         data = []
                         if clean_images:
-                            event = self.clean_image(event)
-                            if event.photon_stream.raw is None:
-                                print("No Clumps, skip")
+                            event = self.cleaned_event(
+                                event, clean_type=clean_type, thresholds=thresholds
+                            )
+                            if event is None:
                                 continue
                         # In the event chosen from the file
                         # Each event is the same as each line below
@@ -849,22 +816,15 @@ class GammaPreprocessor(BasePreprocessor):
                         az_deg = event.az
                         act_phi = event.simulation_truth.air_shower.phi
                         act_theta = event.simulation_truth.air_shower.theta
-                        input_matrix = np.zeros(
-                            [self.shape[1], self.shape[2], self.shape[3]]
+                        input_matrix = self.rasterize(
+                            self.photon_histogram(
+                                event_photons, self.start, self.shape[3]
+                            ),
+                            scale=100,
                         )
-                        chid_to_pixel = self.rebinning[0]
-                        pixel_index_to_grid = self.rebinning[1]
-                        for index in range(1440):
-                            for element in chid_to_pixel[index]:
-                                coords = pixel_index_to_grid[element[0]]
-                                for value in event_photons[index]:
-                                    if self.end >= value >= self.start:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 100)
                         data.append(
                             [
-                                np.fliplr(np.rot90(input_matrix, 3)),
+                                input_matrix,
                                 energy,
                                 zd_deg,
                                 az_deg,
@@ -903,10 +863,9 @@ class GammaPreprocessor(BasePreprocessor):
             for index, file in enumerate(self.paths):
                 mc_truth = file.split(".phs")[0] + ".ch.gz"
                 try:
-                    sim_reader = ps.SimulationReader(
-                        photon_stream_path=file, mmcs_corsika_path=mc_truth
+                    count += count_simulation_events(
+                        file, mc_truth, self.cache_directory
                     )
-                    count += sum(1 for _ in sim_reader)
                 except Exception as e:
                     print(str(e))
             print(count)
@@ -928,10 +887,27 @@ class GammaPreprocessor(BasePreprocessor):
 
 
 class GammaDiffusePreprocessor(BasePreprocessor):
+    # Columns of the chunks from batch_processor
+    data_format = {
+        "Image": 0,
+        "Source_X": 1,
+        "Source_Y": 2,
+        "COG_X": 3,
+        "COG_Y": 4,
+        "Zd_Deg": 5,
+        "Az_Deg": 6,
+        "Source_Zd": 7,
+        "Source_Az": 8,
+        "Delta": 9,
+        "Energy": 10,
+        "Pointing_Zd": 11,
+        "Pointing_Az": 12,
+    }
+
     def init(self):
-        self.dl2_file = read_h5py(
+        # Joins each event to its DL2 row by run and simulated energy
+        self.dl2_index = load_dl2_index(
             self.dl2_file,
-            key="events",
             columns=[
                 "event_num",
                 "source_position_x",
@@ -947,10 +923,19 @@ class GammaDiffusePreprocessor(BasePreprocessor):
                 "corsika_event_header_az",
                 "run_id",
             ],
+            keys=["run_id"],
+            close="corsika_event_header_total_energy",
         )
 
     def event_processor(
-        self, directory, clean_images=False, only_core=True, clump_size=20
+        self,
+        directory,
+        clean_images=False,
+        only_core=True,
+        clump_size=20,
+        eps=0.1,
+        clean_type="dbscan",
+        thresholds=None,
     ):
         for index, file in enumerate(self.paths):
             mc_truth = file.split(".phs")[0] + ".ch.gz"
@@ -962,162 +947,103 @@ class GammaDiffusePreprocessor(BasePreprocessor):
                 counter = 0
                 for event in sim_reader:
                     print(f"Event Count: {counter}")
-                    df_event = self.dl2_file.loc[
-                        (
-                            np.isclose(
-                                self.dl2_file["corsika_event_header_total_energy"],
-                                event.simulation_truth.air_shower.energy,
-                            )
-                        )
-                        & (self.dl2_file["run_id"] == event.simulation_truth.run)
-                    ]
+                    df_event = self.dl2_index.find(
+                        event.simulation_truth.run,
+                        event.simulation_truth.air_shower.energy,
+                    )
                     counter += 1
-                    if not df_event.empty:
-                        if os.path.isfile(
-                            os.path.join(
+                    if df_event is not None:
+                        if clean_images:
+                            cleaned = self.event_record_masks(
                                 directory,
-                                "clump" + str(clump_size),
                                 str(file_name) + "_" + str(counter),
+                                event,
+                                clump_size,
+                                eps,
+                                clean_type,
+                                thresholds,
                             )
-                        ) and os.path.isfile(
-                            os.path.join(
-                                directory,
-                                "core" + str(clump_size),
-                                str(file_name) + "_" + str(counter),
+                            if cleaned is None:
+                                continue
+                            record_path, masks = cleaned
+                            # Now extract parameters from the available photons and save them to a file
+                            features, _ = extract_single_simulation_features(
+                                event, min_samples=1
                             )
-                        ):
-                            print("True: " + str(file_name) + "_" + str(counter))
-                            continue
-
-                        if clean_images:
-                            (
-                                all_photons,
-                                clump_photons,
-                                core_photons,
-                                dbscan,
-                            ) = self.clean_image(
-                                event, only_core=only_core, min_samples=clump_size
+                            # In the event chosen from the file
+                            # Each event is the same as each line below
+                            cog_x = df_event["cog_x"]
+                            cog_y = df_event["cog_y"]
+                            act_sky_source_zero = df_event["source_position_x"]
+                            act_sky_source_one = df_event["source_position_y"]
+                            event_photons = event.photon_stream.list_of_lists
+                            zd_deg = event.zd
+                            az_deg = event.az
+                            delta = df_event["delta"]
+                            energy = event.simulation_truth.air_shower.energy
+                            sky_source_zd = df_event["source_position_zd"]
+                            sky_source_az = df_event["source_position_az"]
+                            zd_deg1 = df_event["aux_pointing_position_az"]
+                            az_deg1 = df_event["aux_pointing_position_zd"]
+                            data_dict = [
+                                [
+                                    event_photons,
+                                    act_sky_source_zero,
+                                    act_sky_source_one,
+                                    cog_x,
+                                    cog_y,
+                                    zd_deg,
+                                    az_deg,
+                                    sky_source_zd,
+                                    sky_source_az,
+                                    delta,
+                                    energy,
+                                    zd_deg1,
+                                    az_deg1,
+                                ],
+                                {
+                                    "Image": 0,
+                                    "Source_X": 1,
+                                    "Source_Y": 2,
+                                    "COG_X": 3,
+                                    "COG_Y": 4,
+                                    "Zd_Deg": 5,
+                                    "Az_Deg": 6,
+                                    "Source_Zd": 7,
+                                    "Source_Az": 8,
+                                    "Delta": 9,
+                                    "Energy": 10,
+                                    "Pointing_Zd": 11,
+                                    "Pointing_Az": 12,
+                                },
+                                features,
+                            ]
+                            self.write_cleaned_event(
+                                record_path,
+                                event,
+                                masks,
+                                *data_dict,
+                                extract_features=lambda cleaned: extract_single_simulation_features(
+                                    cleaned, min_samples=1
+                                ),
                             )
-                            if core_photons is None:
-                                print("No Clumps, skip")
-                                continue
-                            else:
-                                for key, photon_set in {
-                                    "no_clean": all_photons,
-                                    "clump": clump_photons,
-                                    "core": core_photons,
-                                }.items():
-                                    event.photon_stream.raw = photon_set
-                                    # Now extract parameters from the available photons and save them to a file
-                                    features = extract_single_simulation_features(
-                                        event, min_samples=1
-                                    )
-                                    # In the event chosen from the file
-                                    # Each event is the same as each line below
-                                    cog_x = df_event["cog_x"].values[0]
-                                    cog_y = df_event["cog_y"].values[0]
-                                    act_sky_source_zero = df_event[
-                                        "source_position_x"
-                                    ].values[0]
-                                    act_sky_source_one = df_event[
-                                        "source_position_y"
-                                    ].values[0]
-                                    event_photons = event.photon_stream.list_of_lists
-                                    zd_deg = event.zd
-                                    az_deg = event.az
-                                    delta = df_event["delta"].values[0]
-                                    energy = event.simulation_truth.air_shower.energy
-                                    sky_source_zd = df_event[
-                                        "source_position_zd"
-                                    ].values[0]
-                                    sky_source_az = df_event[
-                                        "source_position_az"
-                                    ].values[0]
-                                    zd_deg1 = df_event[
-                                        "aux_pointing_position_az"
-                                    ].values[0]
-                                    az_deg1 = df_event[
-                                        "aux_pointing_position_zd"
-                                    ].values[0]
-                                    data_dict = [
-                                        [
-                                            event_photons,
-                                            act_sky_source_zero,
-                                            act_sky_source_one,
-                                            cog_x,
-                                            cog_y,
-                                            zd_deg,
-                                            az_deg,
-                                            sky_source_zd,
-                                            sky_source_az,
-                                            delta,
-                                            energy,
-                                            zd_deg1,
-                                            az_deg1,
-                                        ],
-                                        {
-                                            "Image": 0,
-                                            "Source_X": 1,
-                                            "Source_Y": 2,
-                                            "COG_X": 3,
-                                            "COG_Y": 4,
-                                            "Zd_Deg": 5,
-                                            "Az_Deg": 6,
-                                            "Source_Zd": 7,
-                                            "Source_Az": 8,
-                                            "Delta": 9,
-                                            "Energy": 10,
-                                            "Pointing_Zd": 11,
-                                            "Pointing_Az": 12,
-                                        },
-                                        features,
-                                    ]
-                                    if key != "no_clean":
-                                        with open(
-                                            os.path.join(
-                                                directory,
-                                                key + str(clump_size),
-                                                str(file_name) + "_" + str(counter),
-                                            ),
-                                            "wb",
-                                        ) as event_file:
-                                            pickle.dump(data_dict, event_file)
-                                    else:
-                                        if not os.path.isfile(
-                                            os.path.join(
-                                                directory,
-                                                key,
-                                                str(file_name) + "_" + str(counter),
-                                            )
-                                        ):
-                                            with open(
-                                                os.path.join(
-                                                    directory,
-                                                    key,
-                                                    str(file_name) + "_" + str(counter),
-                                                ),
-                                                "wb",
-                                            ) as event_file:
-                                                pickle.dump(data_dict, event_file)
                         else:
                             # In the event chosen from the file
                             # Each event is the same as each line below
                             features = extract_single_simulation_features(event)
-                            cog_x = df_event["cog_x"].values[0]
-                            cog_y = df_event["cog_y"].values[0]
-                            act_sky_source_zero = df_event["source_position_x"].values[
-                                0
-                            ]
-                            act_sky_source_one = df_event["source_position_y"].values[0]
+                            cog_x = df_event["cog_x"]
+                            cog_y = df_event["cog_y"]
+                            act_sky_source_zero = df_event["source_position_x"]
+                            act_sky_source_one = df_event["source_position_y"]
                             event_photons = event.photon_stream.list_of_lists
                             zd_deg = event.zd
                             az_deg = event.az
-                            delta = df_event["delta"].values[0]
+                            delta = df_event["delta"]
                             energy = event.simulation_truth.air_shower.energy
-                            sky_source_zd = df_event["source_position_zd"].values[0]
-                            sky_source_az = df_event["source_position_az"].values[0]
-                            zd_deg1 = df_event["aux_pointing_position_az"].values[0]
-                            az_deg1 = df_event["aux_pointing_position_zd"].values[0]
+                            sky_source_zd = df_event["source_position_zd"]
+                            sky_source_az = df_event["source_position_az"]
+                            zd_deg1 = df_event["aux_pointing_position_az"]
+                            az_deg1 = df_event["aux_pointing_position_zd"]
                             data_dict = [
                                 [
                                     event_photons,
@@ -1162,76 +1088,86 @@ class GammaDiffusePreprocessor(BasePreprocessor):
                 print(str(e))
                 pass
 
-    def batch_processor(self, clean_images=False):
-        for index, file in enumerate(self.paths):
-            mc_truth = file.split(".phs")[0] + ".ch.gz"
-            try:
-                sim_reader = ps.SimulationReader(
-                    photon_stream_path=file, mmcs_corsika_path=mc_truth
+    def batch_processor(
+        self,
+        clean_images=False,
+        chunk_size=None,
+        clean_type="dbscan",
+        thresholds=None,
+    ):
+        """
+        Rasterizes the events of all files, see BasePreprocessor.batches
+
+        :param clean_images: Whether to only keep the photons of the clumps found by clean_image
+        :param chunk_size: Number of events in each chunk, None for one list per file
+        :param clean_type: Method to clean with, either 'dbscan' or 'facttools', see clean_image
+        :param thresholds: Thresholds of the facttools cleaning, see clean_image
+        :return: Generator over the batches
+        """
+        return self.batches(
+            partial(
+                self.file_rows,
+                clean_images=clean_images,
+                clean_type=clean_type,
+                thresholds=thresholds,
+            ),
+            chunk_size,
+        )
+
+    def file_rows(self, file, clean_images=False, clean_type="dbscan", thresholds=None):
+        """
+        :param file: Path to the phs.jsonl.gz file
+        :return: Generator over the rows of its events, with the photons as list of lists in place of the image
+        """
+        mc_truth = file.split(".phs")[0] + ".ch.gz"
+        try:
+            sim_reader = ps.SimulationReader(
+                photon_stream_path=file, mmcs_corsika_path=mc_truth
+            )
+            for event in sim_reader:
+                df_event = self.dl2_index.find(
+                    event.simulation_truth.run,
+                    event.simulation_truth.air_shower.energy,
                 )
-                data = []
-                for event in sim_reader:
-                    df_event = self.dl2_file.loc[
-                        (
-                            np.isclose(
-                                self.dl2_file["corsika_event_header_total_energy"],
-                                event.simulation_truth.air_shower.energy,
-                            )
+                if df_event is not None:
+                    if clean_images:
+                        event = self.cleaned_event(
+                            event, clean_type=clean_type, thresholds=thresholds
                         )
-                        & (self.dl2_file["run_id"] == event.simulation_truth.run)
+                        if event is None:
+                            continue
+                    # In the event chosen from the file
+                    # Each event is the same as each line below
+                    cog_x = df_event["cog_x"]
+                    cog_y = df_event["cog_y"]
+                    act_sky_source_zero = df_event["source_position_x"]
+                    act_sky_source_one = df_event["source_position_y"]
+                    event_photons = event.photon_stream.list_of_lists
+                    zd_deg = event.zd
+                    az_deg = event.az
+                    delta = df_event["delta"]
+                    energy = event.simulation_truth.air_shower.energy
+                    sky_source_zd = df_event["source_position_zd"]
+                    sky_source_az = df_event["source_position_az"]
+                    zd_deg1 = df_event["aux_pointing_position_az"]
+                    az_deg1 = df_event["aux_pointing_position_zd"]
+                    yield [
+                        event_photons,
+                        act_sky_source_zero,
+                        act_sky_source_one,
+                        cog_x,
+                        cog_y,
+                        zd_deg,
+                        az_deg,
+                        sky_source_zd,
+                        sky_source_az,
+                        delta,
+                        energy,
+                        zd_deg1,
+                        az_deg1,
                     ]
-                    if not df_event.empty:
-                        # In the event chosen from the file
-                        # Each event is the same as each line below
-                        cog_x = df_event["cog_x"].values[0]
-                        cog_y = df_event["cog_y"].values[0]
-                        act_sky_source_zero = df_event["source_position_x"].values[0]
-                        act_sky_source_one = df_event["source_position_y"].values[0]
-                        event_photons = event.photon_stream.list_of_lists
-                        zd_deg = event.zd
-                        az_deg = event.az
-                        delta = df_event["delta"].values[0]
-                        energy = event.simulation_truth.air_shower.energy
-                        sky_source_zd = df_event["source_position_zd"].values[0]
-                        sky_source_az = df_event["source_position_az"].values[0]
-                        zd_deg1 = df_event["aux_pointing_position_az"].values[0]
-                        az_deg1 = df_event["aux_pointing_position_zd"].values[0]
-                        input_matrix = np.zeros(
-                            [self.shape[1], self.shape[2], self.shape[3]]
-                        )
-                        chid_to_pixel = self.rebinning[0]
-                        pixel_index_to_grid = self.rebinning[1]
-                        for index in range(1440):
-                            for element in chid_to_pixel[index]:
-                                # Now get the first 60 event photons
-                                coords = pixel_index_to_grid[element[0]]
-                                for value in event_photons[index]:
-                                    if self.end >= value >= self.start:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 1)
-
-                        data.append(
-                            [
-                                np.fliplr(np.rot90(input_matrix, 3)),
-                                act_sky_source_zero,
-                                act_sky_source_one,
-                                cog_x,
-                                cog_y,
-                                zd_deg,
-                                az_deg,
-                                sky_source_zd,
-                                sky_source_az,
-                                delta,
-                                energy,
-                                zd_deg1,
-                                az_deg1,
-                            ]
-                        )
-                yield data
-
-            except Exception as e:
-                print(str(e))
+        except Exception as e:
+            print(str(e))
 
     def single_processor(
         self,
@@ -1240,66 +1176,51 @@ class GammaDiffusePreprocessor(BasePreprocessor):
         final_slices=5,
         as_channels=False,
         clean_images=False,
+        clean_type="dbscan",
+        thresholds=None,
     ):
         while True:
             self.paths = shuffle(self.paths)
             for index, file in enumerate(self.paths):
                 mc_truth = file.split(".phs")[0] + ".ch.gz"
                 try:
-                    sim_reader = ps.SimulationReader(
-                        photon_stream_path=file, mmcs_corsika_path=mc_truth
-                    )
+                    sim_reader = simulation_events(file, mc_truth, self.cache_directory)
                     for event in sim_reader:
                         data = []
-                        df_event = self.dl2_file.loc[
-                            (
-                                np.isclose(
-                                    self.dl2_file["corsika_event_header_total_energy"],
-                                    event.simulation_truth.air_shower.energy,
-                                )
-                            )
-                            & (self.dl2_file["run_id"] == event.simulation_truth.run)
-                        ]
-                        if not df_event.empty:
+                        df_event = self.dl2_index.find(
+                            event.simulation_truth.run,
+                            event.simulation_truth.air_shower.energy,
+                        )
+                        if df_event is not None:
                             if clean_images:
-                                event = self.clean_image(event)
-                                if event.photon_stream.raw is None:
-                                    print("No Clumps, skip")
+                                event = self.cleaned_event(
+                                    event, clean_type=clean_type, thresholds=thresholds
+                                )
+                                if event is None:
                                     continue
                             # In the event chosen from the file
                             # Each event is the same as each line below
-                            cog_x = df_event["cog_x"].values[0]
-                            cog_y = df_event["cog_y"].values[0]
-                            act_sky_source_zero = df_event["source_position_x"].values[
-                                0
-                            ]
-                            act_sky_source_one = df_event["source_position_y"].values[0]
+                            cog_x = df_event["cog_x"]
+                            cog_y = df_event["cog_y"]
+                            act_sky_source_zero = df_event["source_position_x"]
+                            act_sky_source_one = df_event["source_position_y"]
                             event_photons = event.photon_stream.list_of_lists
                             zd_deg = event.zd
                             az_deg = event.az
-                            delta = df_event["delta"].values[0]
+                            delta = df_event["delta"]
                             energy = event.simulation_truth.air_shower.energy
-                            sky_source_zd = df_event["source_position_zd"].values[0]
-                            sky_source_az = df_event["source_position_zd"].values[0]
-                            zd_deg1 = df_event["aux_pointing_position_az"].values[0]
-                            az_deg1 = df_event["aux_pointing_position_zd"].values[0]
-                            input_matrix = np.zeros(
-                                [self.shape[1], self.shape[2], self.shape[3]]
+                            sky_source_zd = df_event["source_position_zd"]
+                            sky_source_az = df_event["source_position_zd"]
+                            zd_deg1 = df_event["aux_pointing_position_az"]
+                            az_deg1 = df_event["aux_pointing_position_zd"]
+                            input_matrix = self.rasterize(
+                                self.photon_histogram(
+                                    event_photons, self.start, self.shape[3]
+                                )
                             )
-                            chid_to_pixel = self.rebinning[0]
-                            pixel_index_to_grid = self.rebinning[1]
-                            for index in range(1440):
-                                for element in chid_to_pixel[index]:
-                                    # Now get the first 60 event photons
-                                    coords = pixel_index_to_grid[element[0]]
-                                    for value in event_photons[index]:
-                                        if self.end >= value >= self.start:
-                                            input_matrix[coords[0]][coords[1]][
-                                                value - self.start
-                                            ] += (element[1] * 1)
                             data.append(
                                 [
-                                    np.fliplr(np.rot90(input_matrix, 3)),
+                                    input_matrix,
                                     act_sky_source_zero,
                                     act_sky_source_one,
                                     cog_x,
@@ -1354,21 +1275,18 @@ class GammaDiffusePreprocessor(BasePreprocessor):
             for index, file in enumerate(self.paths):
                 mc_truth = file.split(".phs")[0] + ".ch.gz"
                 try:
-                    sim_reader = ps.SimulationReader(
-                        photon_stream_path=file, mmcs_corsika_path=mc_truth
-                    )
-                    for event in sim_reader:
-                        df_event = self.dl2_file.loc[
+                    sim_reader = simulation_events(file, mc_truth, self.cache_directory)
+                    # Only the keys are needed, so the whole file is looked up at once
+                    keys = np.array(
+                        [
                             (
-                                np.isclose(
-                                    self.dl2_file["corsika_event_header_total_energy"],
-                                    event.simulation_truth.air_shower.energy,
-                                )
+                                event.simulation_truth.run,
+                                event.simulation_truth.air_shower.energy,
                             )
-                            & (self.dl2_file["run_id"] == event.simulation_truth.run)
+                            for event in sim_reader
                         ]
-                        if not df_event.empty:
-                            count += 1
+                    ).reshape(-1, 2)
+                    count += np.count_nonzero(self.dl2_index.lookup(*keys.T) >= 0)
                 except Exception as e:
                     print(str(e))
             self.num_events = count
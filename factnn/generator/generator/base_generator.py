@@ -1,9 +1,8 @@
 from factnn.utils.augment import (
-    get_random_from_list,
-    get_chunk_from_list,
+    get_batch_from_readers,
     get_random_from_paths,
 )
-import numpy as np
+from factnn.data.dataset.hdf5 import HDF5BatchReader
 
 # TODO Add k-fold cross-validation generation
 
@@ -48,6 +47,11 @@ class BaseGenerator(object):
         self.test_steps = None
         self.test_current_step = 0
 
+        # Readers of the HDF5 files for each mode, only made when first used
+        self.train_readers = None
+        self.validate_readers = None
+        self.test_readers = None
+
         # Now the preprocessor stuff, only used for streaming from files
         self.train_preprocessor = None
         self.validate_preprocessor = None
@@ -111,6 +115,33 @@ class BaseGenerator(object):
     def __iter__(self):
         return self
 
+    def batch_readers(self, indices, shuffle):
+        """
+        Makes the readers of the HDF5 files, which keep the files open and read them a block of rows at a time
+        :param indices: Rows of the files to use
+        :param shuffle: Whether to shuffle the events, or else go through them in order every epoch
+        :return: (reader, proton_reader), proton_reader being None if there is no second input
+        """
+        reader = HDF5BatchReader(
+            self.input,
+            indices,
+            self.batch_size,
+            time_slice=self.start_slice,
+            total_slices=self.number_slices,
+            shuffle=shuffle,
+        )
+        proton_reader = None
+        if self.second_input is not None:
+            proton_reader = HDF5BatchReader(
+                self.second_input,
+                indices,
+                self.batch_size,
+                time_slice=self.start_slice,
+                total_slices=self.number_slices,
+                shuffle=shuffle,
+            )
+        return reader, proton_reader
+
     def __next__(self):
         """
         Get the next batch of values here, should loop forever
@@ -119,57 +150,48 @@ class BaseGenerator(object):
         if not self.from_directory:
             while True:
                 if self.mode == "train":
-                    batch_images, batch_image_label = get_random_from_list(
-                        self.train_data,
-                        size=self.batch_size,
-                        time_slice=self.start_slice,
-                        total_slices=self.number_slices,
+                    if self.train_readers is None:
+                        self.train_readers = self.batch_readers(
+                            self.train_data, shuffle=True
+                        )
+                    batch_images, batch_image_label = get_batch_from_readers(
+                        *self.train_readers,
                         labels=self.labels,
                         augment=self.augment,
-                        gamma=self.input,
-                        proton_input=self.second_input,
                         shape=self.input_shape,
                     )
                     return batch_images, batch_image_label
                 elif self.mode == "validate":
-                    self.validate_steps = int(
-                        np.floor(len(self.validate_data) / self.batch_size)
-                    )
                     # Shouldn't be doing random for this one, should be same everytime
-                    batch_images, batch_image_label = get_chunk_from_list(
-                        self.validate_data,
-                        size=self.batch_size,
-                        time_slice=self.start_slice,
-                        total_slices=self.number_slices,
+                    if self.validate_readers is None:
+                        self.validate_readers = self.batch_readers(
+                            self.validate_data, shuffle=False
+                        )
+                    self.validate_steps = len(self.validate_readers[0])
+                    batch_images, batch_image_label = get_batch_from_readers(
+                        *self.validate_readers,
                         labels=self.labels,
                         augment=False,
-                        gamma=self.input,
-                        proton_input=self.second_input,
-                        shape=self.input_shape,
                         swap=False,
-                        current_step=self.validate_current_step,
+                        shape=self.input_shape,
                     )
                     self.validate_current_step += 1
                     self.validate_current_step %= self.validate_steps
                     return batch_images, batch_image_label
 
                 elif self.mode == "test":
-                    self.test_steps = int(
-                        np.floor(len(self.test_data) / self.batch_size)
-                    )
                     # Shouldn't be random or augmenting this one, should be same everytime
-                    batch_images, batch_image_label = get_chunk_from_list(
-                        self.test_data,
-                        size=self.batch_size,
-                        time_slice=self.start_slice,
-                        total_slices=self.number_slices,
+                    if self.test_readers is None:
+                        self.test_readers = self.batch_readers(
+                            self.test_data, shuffle=False
+                        )
+                    self.test_steps = len(self.test_readers[0])
+                    batch_images, batch_image_label = get_batch_from_readers(
+                        *self.test_readers,
                         labels=self.labels,
                         augment=False,
-                        gamma=self.input,
-                        proton_input=self.second_input,
-                        shape=self.input_shape,
                         swap=False,
-                        current_step=self.test_current_step,
+                        shape=self.input_shape,
                     )
                     self.test_current_step += 1
                     self.test_current_step %= self.test_steps
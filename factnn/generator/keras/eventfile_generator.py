@@ -2,7 +2,12 @@ import numpy as np
 from sklearn.utils import shuffle
 from tensorflow.keras.utils import Sequence
 
-from factnn.utils.augment import augment_image_batch
+from factnn.data.preprocess.pipeline import EventFilePipeline
+from factnn.utils.augment import (
+    image_augmenter,
+    dual_image_augmenter,
+    get_training_labels,
+)
 
 
 class EventFileGenerator(Sequence):
@@ -24,6 +29,8 @@ class EventFileGenerator(Sequence):
         equal_slices=False,
         return_collapsed=False,
         return_features=False,
+        statistics=None,
+        densest_window=False,
     ):
         self.paths = paths
         self.batch_size = batch_size
@@ -39,6 +46,10 @@ class EventFileGenerator(Sequence):
         self.truncate = truncate
         self.dynamic_resize = dynamic_resize
         self.equal_slices = equal_slices
+        # Global ImageStatistics to normalize with, instead of per event
+        self.statistics = statistics
+        # Whether each event uses its own densest window of time slices
+        self.densest_window = densest_window
 
         # These three are for if multiple inputs need to be returned,
         self.features = return_features
@@ -47,6 +58,27 @@ class EventFileGenerator(Sequence):
             self.multiple = True
         else:
             self.multiple = False
+        # Each batch is written straight into one array by the pipelines, configured once here
+        pipeline_options = dict(
+            final_slices=final_slices,
+            normalize=normalize,
+            dynamic_resize=dynamic_resize,
+            truncate=truncate,
+            equal_slices=equal_slices,
+            as_channels=as_channels,
+            return_features=return_features,
+            return_collapsed=return_collapsed,
+            statistics=statistics,
+            densest_window=densest_window,
+        )
+        self.pipeline = None
+        self.proton_pipeline = None
+        if preprocessor is not None:
+            self.pipeline = EventFilePipeline(preprocessor, **pipeline_options)
+        if proton_preprocessor is not None:
+            self.proton_pipeline = EventFilePipeline(
+                proton_preprocessor, **pipeline_options
+            )
         # failed_paths = self.proton_preprocessor.check_files(self.paths, "Gamma")
         # self.paths = [x for x in self.paths if x not in failed_paths]
         # sfailed_paths = self.proton_preprocessor.check_files(self.proton_paths, "Proton")
@@ -65,47 +97,74 @@ class EventFileGenerator(Sequence):
             proton_batch_files = self.proton_paths[
                 index * self.batch_size : (index + 1) * self.batch_size
             ]
-            proton_images = self.proton_preprocessor.on_files_processor(
-                paths=proton_batch_files,
-                final_slices=self.final_slices,
-                normalize=self.normalize,
-                dynamic_resize=self.dynamic_resize,
-                truncate=self.truncate,
-                equal_slices=self.equal_slices,
-                return_collapsed=self.collapsed,
-                return_features=self.features,
-            )
         else:
-            proton_images = None
-        images = self.preprocessor.on_files_processor(
-            paths=batch_files,
-            final_slices=self.final_slices,
-            normalize=self.normalize,
-            dynamic_resize=self.dynamic_resize,
-            truncate=self.truncate,
-            equal_slices=self.equal_slices,
-            return_collapsed=self.collapsed,
-            return_features=self.features,
-        )
-        images, labels = augment_image_batch(
-            images,
-            proton_images=proton_images,
-            type_training=self.training_type,
-            augment=self.augment,
-            swap=self.augment,
-            shape=[
-                -1,
-                self.final_slices,
-                self.preprocessor.shape[1],
-                self.preprocessor.shape[2],
-                1,
-            ],
-            as_channels=self.as_channels,
-            return_collapsed=self.collapsed,
-            return_features=self.features,
+            proton_batch_files = []
+        num_files = len(batch_files) + len(proton_batch_files)
+        images = np.empty(self.pipeline.image_shape(num_files), dtype=np.float32)
+        collapsed_images = None
+        if self.collapsed:
+            collapsed_images = np.empty(
+                (num_files, self.pipeline.size, self.pipeline.size, 1),
+                dtype=np.float32,
+            )
+
+        gamma_images, _, features, data, data_format = self.pipeline.process(
+            batch_files, out=images, collapsed_out=collapsed_images
         )
+        num_events = len(gamma_images)
+        if self.proton_paths is not None:
+            # Protons go in the same arrays after the gammas
+            proton_images, _, proton_features, _, _ = self.proton_pipeline.process(
+                proton_batch_files,
+                out=images[num_events:],
+                collapsed_out=(
+                    None if collapsed_images is None else collapsed_images[num_events:]
+                ),
+            )
+            labels = np.zeros((num_events + len(proton_images), 2), dtype=np.float32)
+            labels[:num_events, 1] = 1.0
+            labels[num_events:, 0] = 1.0
+            num_events += len(proton_images)
+            if self.features:
+                features = np.concatenate([features, proton_features], axis=0)
+        else:
+            labels = get_training_labels(data, data_format, self.training_type)
+        images = images[:num_events]
+        if self.collapsed:
+            collapsed_images = collapsed_images[:num_events]
+
+        if self.augment:
+            if self.collapsed:
+                images, collapsed_images = dual_image_augmenter(
+                    images, collapsed_images, self.as_channels
+                )
+            else:
+                images = image_augmenter(images, self.as_channels)
+        if not self.as_channels:
+            images = images.reshape(
+                [
+                    -1,
+                    self.final_slices,
+                    self.preprocessor.shape[1],
+                    self.preprocessor.shape[2],
+                    1,
+                ]
+            )
+        outputs = [images]
+        if self.features:
+            outputs.append(features)
+        if self.collapsed:
+            outputs.append(collapsed_images)
+        if self.augment:
+            # Shuffle the events, mostly to mix the gammas and protons
+            order = np.random.permutation(num_events)
+            outputs = [output[order] for output in outputs]
+            if labels is not None:
+                labels = labels[order]
 
-        return images, labels
+        if self.multiple:
+            return outputs, [labels] * len(outputs)
+        return outputs[0], labels
 
     def __len__(self):
         """
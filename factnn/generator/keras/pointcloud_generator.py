@@ -26,6 +26,7 @@ class PointCloudGenerator(Sequence):
         return_features=False,
         rotate=True,
         jitter=None,
+        densest_window=False,
     ):
         self.paths = paths
         self.batch_size = batch_size
@@ -40,6 +41,7 @@ class PointCloudGenerator(Sequence):
         self.final_points = final_points
         self.rotate = rotate
         self.jitter = jitter
+        self.densest_window = densest_window
 
         # These three are for if multiple inputs need to be returned,
         self.features = return_features
@@ -62,6 +64,7 @@ class PointCloudGenerator(Sequence):
                 replacement=self.replacement,
                 truncate=self.truncate,
                 return_features=self.features,
+                densest_window=self.densest_window,
             )
         else:
             proton_images = None
@@ -71,6 +74,7 @@ class PointCloudGenerator(Sequence):
             replacement=self.replacement,
             truncate=self.truncate,
             return_features=self.features,
+            densest_window=self.densest_window,
         )
         images, labels = augment_pointcloud_batch(
             images,
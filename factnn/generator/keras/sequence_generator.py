@@ -1,7 +1,15 @@
+import json
+
 import numpy as np
-from sklearn.utils import shuffle
 from tensorflow.keras.utils import Sequence
 
+from factnn.data.preprocess import photons
+from factnn.data.dataset.gzip_index import IndexedGzipReader
+from factnn.utils.augment import image_augmenter
+
+# Key of the photons of each event in the phs.jsonl.gz files
+PHOTON_ARRIVALS = "PhotonArrivals_500ps"
+
 
 class BaseSequence(Sequence):
     def __init__(
@@ -11,145 +19,140 @@ class BaseSequence(Sequence):
         batch_size,
         preprocessor=None,
         proton_preprocessor=None,
+        proton_paths=None,
         as_channels=False,
         final_slices=5,
         slices=(30, 70),
         augment=False,
     ):
         """
-        Idea for this is to be simpler than the base_generator, less options and less have everything and the kitchen sink
-        Instead, each BaseSequence will do one thing, given the paths assigned to it, take a uniform sample of the images in each file,
-        get their labels/ augment the images, and return them for use
-
-        For prediction purposes, the use of the original generator is perferred, as it will go through all the events in
-        all the files given to it, unlike this one where that is not currently guaranteed
-
-        Same for validation purposes, but that has to be fixed to really work, for now just use the resoivoir sampling
-
-        Could have the on_batch_preprocess return both the data, data_format, and whether the file was exhausted or not,
-        if not, on the next call, that file is continued until it is exhausted....
-
-        Downside is having to work through the whole file to get to the part that hasn't been done
-        Same with the iterators going through the entire file each time
-
-        Downside to tracking how far into the file you are is that there is no guarantee that that worker will get the
-        same file as before, most likely it will not and so the same events will be read, so the reservoir sampling makes
-        more sense to do, although not great for testing. Also means validation data is not the same everytime.
-
-        Best solution would be to change each event file into the one image per file structure and using that
-
-        Could do that the index is ignored as long as there are more events in a file.
-
-        Have second SequenceGenerator that is based off each event is its own file, with preprocessors that write out the
-        image and necessary aux data to individual files for use in this later. Need to open many more files, but then
-        gets the benefit of real randomness, better shuffling, and no need to resevoir sample.
-
-        Resevooir sampling will be done for this one, makes it slower but better distributed, each pass through opens each
-        file once, samples it, and then moves on. Meaning different data each time for validation and training, but overall
-        should be comsistent over time
-
-        Second sequence generator takes the paths to files in individual directories, assumes one image per file, and
-        goes from there
-
-        So options would then be the current generators, this SquenceGenerator for less duplication in training and validation
-
-        Validation data might be better served by using the other generator class to iterate completely through the dataset
-
-        Otherwise, the validation data could be set to use the first few elements from each file instead, the batch size,
-        but this makes the validation set much smaller than otherwise usually used
-
-
-        Final setup then would be:
-
-        BaseGenerator for HDF5 files, streaming in files with infinite loops if no need for multiprocesssing
-        SequenceGenerator for streaming in files, with each file used once per iteration, regardless of how much of it is used
-        EventGenerator for streaming in files where there is one event per file, still a form of Sequence Generator,
-        but designed for a single event per file setup
-
-        Other things needed:
-        Preprocessor on_batch_preprocess for SequenceGenerator
-        Way to generate the one event per file setup
-        New class of DataFormatter?
-
-        Dataset class that holds the parts for creating the HDF5 dataset, one file per event conversion, and
-
-        New Design:
-            models -> holds most useful models
-            docs -> docs
-            resources -> resources
-            tests -> tests
-            utils -> augment, plotting parts
-            data -> data.preprocess holds preprocessors
-            data -> data.dataset holds creating HDF5 converthing to different storage formats
-            generator -> generator.keras holds Sequence-based generators
-            generator -> generator.generator holds BaseGenerator-based generators
-
-
-        :param paths:
-        :param num_elements:
-        :param batch_size: Maximum size of batch, might be smaller depending on how many events are left in each file
-        :param preprocessor:
-        :param proton_preprocessor:
-        :param as_channels:
-        :param final_slices:
-        :param slices:
-        :param augment:
+        Sequence of random events read straight from the phs.jsonl.gz files, without converting them to one file per
+        event first. Each file is read through its gzip index, see gzip_index, so any event can be read without going
+        through the file, and every epoch goes through the events in a new random order
+
+        Files recompressed with recompress_block_gzip only decompress the few events around each event read, plain
+        gzip files are only read if they are small, see IndexedGzipReader, so should be recompressed for training
+
+        :param paths: Paths to the phs.jsonl.gz files
+        :param num_elements: Number of events to use each epoch, None for all of them
+        :param batch_size: Number of events in each batch, of each of gammas and protons if proton_paths are given
+        :param preprocessor: Preprocessor with the rebinning to make the images with
+        :param proton_preprocessor: Preprocessor for the proton files, defaults to preprocessor
+        :param proton_paths: Paths to proton phs.jsonl.gz files, the labels are [proton, gamma] one hot, so are all
+        gamma if there are none
+        :param as_channels: Whether the images are (batch, size, size, final_slices), or else
+        (batch, final_slices, size, size, 1)
+        :param final_slices: Number of time slices after collapsing
+        :param slices: First and last time slice to use
+        :param augment: Whether to randomly flip and rotate the images
         """
         self.paths = paths
         self.num_elements = num_elements
         self.batch_size = batch_size
         self.preprocessor = preprocessor
-        self.proton_preprocessor = proton_preprocessor
+        self.proton_preprocessor = (
+            preprocessor if proton_preprocessor is None else proton_preprocessor
+        )
+        self.proton_paths = proton_paths
         self.as_channels = as_channels
         self.final_slices = final_slices
         self.slices = slices
         self.augment = augment
+        self.collapse_lookup = photons.slice_lookup(
+            photons.collapse_edges(slices[1] - slices[0], final_slices),
+            length=slices[1] - slices[0],
+        )
+
+        self.readers = [IndexedGzipReader(path) for path in paths]
+        self.starts = np.cumsum([0] + [len(reader) for reader in self.readers])
+        self.proton_readers = None
+        if proton_paths is not None:
+            self.proton_readers = [IndexedGzipReader(path) for path in proton_paths]
+            self.proton_starts = np.cumsum(
+                [0] + [len(reader) for reader in self.proton_readers]
+            )
+        self.on_epoch_end()
 
     def __getitem__(self, index):
         """
-        Use index to get the file to use, then use ressivoir sampling on each file to get the random files to get
-        Involves adding to the preprocessors a on_batch_preprocessor that returns a batch number of images and aux data
-        Those are then sent to the augment ones to get the actually augmented results, if needed
-        :param index:
-        :return:
+        Reads and rasterizes the events of one batch
+        :param index: Index of the batch
+        :return: (images, labels), labels being [proton, gamma] one hot
         """
-        if self.augment:
-            # Augmenting, so do a resoivor sample batch_size large of the whole file, the run it through the augment
-            # Much slower, but with multiprocessing hopefully fine enough
-            images, data_format = self.preprocessor.on_batch_preprocess(
-                datafile=self.paths[index], size=self.batch_size, augment=self.augment
+        batch = slice(index * self.batch_size, (index + 1) * self.batch_size)
+        images = self.event_images(
+            self.preprocessor, self.readers, self.starts, self.order[batch]
+        )
+        labels = np.zeros((len(images), 2), dtype=np.float32)
+        labels[:, 1] = 1.0
+        if self.proton_readers is not None:
+            proton_images = self.event_images(
+                self.proton_preprocessor,
+                self.proton_readers,
+                self.proton_starts,
+                self.proton_order[batch],
             )
-            pass
-        else:
-            # Not augment, so take the first batch_size elements in the file
-            self.preprocessor.on_batch_preprocess(
-                datafile=self.paths[index], size=self.batch_size, augment=self.augment
+            labels = np.zeros((len(images) + len(proton_images), 2), dtype=np.float32)
+            labels[: len(images), 1] = 1.0
+            labels[len(images) :, 0] = 1.0
+            images = np.concatenate([images, proton_images], axis=0)
+
+        if self.augment:
+            images = image_augmenter(images, self.as_channels)
+            if self.proton_readers is not None:
+                # Shuffle the events, mostly to mix the gammas and protons
+                order = np.random.permutation(len(images))
+                images = images[order]
+                labels = labels[order]
+        if not self.as_channels:
+            images = images.reshape(
+                [-1, self.final_slices, images.shape[2], images.shape[3], 1]
             )
-            pass
+        return images, labels
 
     def __len__(self):
         """
-        Returns the length of the list of paths, as the number of events is not known
+        Number of batches in an epoch, only up to the number of proton events are used if there are protons, keeping a
+        1 to 1 ratio
         :return:
         """
-        return len(self.paths)
+        return int(np.ceil(len(self.order) / float(self.batch_size)))
 
     def on_epoch_end(self):
-        if self.augment:
-            self.paths = shuffle(self.paths)
-
-    def iter_sample_fast(self, iterable, samplesize):
-        results = []
-        iterator = iter(iterable)
-        # Fill in the first samplesize elements:
-        for _ in range(samplesize):
-            results.append(next(iterator))
-        np.random.shuffle(results)  # Randomize their positions
-        for i, v in enumerate(iterator, samplesize):
-            r = np.random.randint(0, i)
-            if r < samplesize:
-                results[r] = v  # at a decreasing rate, replace random items
-
-        if len(results) < samplesize:
-            raise ValueError("Sample larger than population.")
-        return results
+        num_events = self.starts[-1]
+        if self.proton_readers is not None:
+            num_events = min(num_events, self.proton_starts[-1])
+        if self.num_elements is not None:
+            num_events = min(num_events, self.num_elements)
+        self.order = np.random.permutation(self.starts[-1])[:num_events]
+        if self.proton_readers is not None:
+            self.proton_order = np.random.permutation(self.proton_starts[-1])[
+                :num_events
+            ]
+
+    def event_images(self, preprocessor, readers, starts, event_ids):
+        """
+        Reads events from the files and rasterizes them
+
+        :param preprocessor: Preprocessor with the rebinning to use
+        :param readers: IndexedGzipReader of each file
+        :param starts: Id of the first event of each file, and the number of events at the end
+        :param event_ids: Ids of the events over all files
+        :return: Images of the events, (batch, size, size, final_slices) if as_channels else
+        (batch, final_slices, size, size)
+        """
+        files = np.searchsorted(starts, event_ids, side="right") - 1
+        photon_streams = [None] * len(event_ids)
+        for file in np.unique(files):
+            positions = np.flatnonzero(files == file)
+            lines = readers[file].lines(event_ids[positions] - starts[file])
+            for position, line in zip(positions, lines):
+                photon_streams[position] = json.loads(line)[PHOTON_ARRIVALS]
+        arrivals, offsets = photons.flatten_photon_streams(photon_streams)
+        histogram = preprocessor.batch_photon_histogram(
+            arrivals, offsets, self.slices[0], self.slices[1] - self.slices[0]
+        )
+        return preprocessor.rasterize_histograms(
+            photons.bin_slices(histogram, self.collapse_lookup, self.final_slices, 2),
+            channels_last=self.as_channels,
+        )
@@ -13,15 +13,14 @@ import torch
 from torch_geometric.data import Dataset
 from torch_geometric.data import Data
 
-from photon_stream.representations import (
-    list_of_lists_to_raw_phs,
-    raw_phs_to_point_cloud,
-)
-from photon_stream.geometry import GEOMETRY
 import photon_stream as ps
 
 
 from factnn.utils.augment import euclidean_distance, true_sign
+from factnn.data.preprocess import photons
+from factnn.data.dataset.event_store import load_event, open_store
+from factnn.data.dataset.event_record import RECORD_SUFFIX, load_cleaning_masks
+from factnn.data.dataset.event_catalog import EventCatalog
 
 
 def to_list(x):
@@ -160,6 +159,8 @@ class EventDataset(Dataset):
         fraction=1.0,
         transform=None,
         pre_transform=None,
+        event_store=None,
+        catalog=None,
     ):
         """
         :param task: Either 'separation', 'energy', 'phi', or 'theta'
@@ -170,6 +171,11 @@ class EventDataset(Dataset):
         :param fraction: Fraction of dataset to use, if not 1.0, then takes randomly the fraction of the dataset to use
         :param cleanliness: str, which version of the DBSCAN cleaned files to use, and which raw filenames to load, one of 'no_clean', 'clump5',
         'clump10', 'clump15', 'clump20', 'core5', 'core10', 'core15', 'core20'
+        :param event_store: Directory of an EventStore the raw files were imported into, if given the events are read
+        from it by file name and made into Data when used, instead of being saved one .pt file per event, pre_filter is
+        not used then
+        :param catalog: Path of an EventCatalog of the raw files, if given the events are selected, split and balanced
+        with it, instead of with the lists of raw file names, and those with failed feature extraction are left out
         """
         self.task = task.lower()
         self.split = split.lower()
@@ -177,32 +183,67 @@ class EventDataset(Dataset):
         self.balanced_classes = balanced_classes
         self.cleanliness = cleanliness.strip().lower()
         self.fraction = fraction
+        self.catalog = None if catalog is None else EventCatalog(catalog)
 
-        try:
-            self.event_dict = pickle.load(
-                open(
-                    res.resource_filename(
-                        "factnn.data.resources", f"{self.cleanliness}_raw_names.p"
-                    ),
-                    "rb",
+        if self.catalog is None:
+            try:
+                self.event_dict = pickle.load(
+                    open(
+                        res.resource_filename(
+                            "factnn.data.resources", f"{self.cleanliness}_raw_names.p"
+                        ),
+                        "rb",
+                    )
+                )
+            except:
+                raise ValueError(
+                    "cleanliness value is not one of: 'no_clean', 'clump5','clump10', 'clump15', 'clump20', 'core5', 'core10', 'core15', 'core20'"
                 )
-            )
-        except:
-            raise ValueError(
-                "cleanliness value is not one of: 'no_clean', 'clump5','clump10', 'clump15', 'clump20', 'core5', 'core10', 'core15', 'core20'"
-            )
         self.processed_filenames = (
             []
         )  # Because of multithreading, its faster than using file_exists in base class on actual list
+        self.event_store = None if event_store is None else open_store(event_store)
+        # (event id, is proton) of each event used from the event store
+        self.stored_events = []
         super(EventDataset, self).__init__(root, transform, pre_transform)
 
     @property
     def raw_file_names(self):
+        if self.catalog is not None:
+            return self.catalog.names(
+                particle=None if self.include_proton else "gamma",
+                cleaning=self.cleanliness,
+                directory=self.raw_dir,
+            )
         if self.include_proton:
             return list(self.event_dict["proton"]) + list(self.event_dict["gamma"])
         else:
             return list(self.event_dict["gamma"])
 
+    def catalog_events(self):
+        """
+        Selects the proton and gamma events to use from the catalog
+        :return: (protons, gammas) lists of raw filenames
+        """
+        selection = dict(
+            split=self.split,
+            cleaning=self.cleanliness,
+            directory=self.raw_dir,
+            extracted=True,
+        )
+        if self.balanced_classes and self.task == "separation":
+            events = self.catalog.balanced(fraction=self.fraction, **selection)
+        else:
+            events = {
+                particle: self.catalog.names(
+                    particle=particle, fraction=self.fraction, **selection
+                )
+                for particle in ("proton", "gamma")
+            }
+        if not self.include_proton:
+            events["proton"] = []
+        return events["proton"], events["gamma"]
+
     @property
     def processed_file_names(self):
         return self.processed_filenames
@@ -224,105 +265,126 @@ class EventDataset(Dataset):
         if osp.exists(osp.join(self.processed_dir, f"{raw_path}.pt")):
             processed_list.append(f"{raw_path}.pt")
         else:
-            with open(osp.join(self.raw_dir, raw_path), "rb") as pickled_event:
-                event_data, data_format, features, feature_cluster = pickle.load(
-                    pickled_event
-                )
-                # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
-                event_photons = event_data[data_format["Image"]]
-                event_photons = list_of_lists_to_raw_phs(event_photons)
-                point_cloud = np.asarray(
-                    raw_phs_to_point_cloud(
-                        event_photons, cx=GEOMETRY.x_angle, cy=GEOMETRY.y_angle
-                    )
-                )
-                # Read data from `raw_path`.
-                data = Data(
-                    pos=torch.tensor(point_cloud, dtype=torch.float).squeeze(),
-                )  # Just need x,y,z ignore derived features
-                if is_proton:
-                    data.event_type = torch.tensor([0], dtype=torch.long
-                    )
-                else:
-                    data.event_type = torch.tensor([1], dtype=torch.long
-                    )
-                data.energy = torch.tensor(
-                    [event_data[data_format["Energy"]]],
-                    dtype=torch.long,
-                )
-                data.phi = torch.tensor(
-                    [event_data[4]],
-                    dtype=torch.long,  # Needed because most the proton events had the wrong data_format
-                )
-                data.theta = torch.tensor(
-                    [event_data[5]],
-                    dtype=torch.long,  # Needed because most the proton events had the wrong data_format
-                )
+            data = self.event_to_data(
+                is_proton, load_event(osp.join(self.raw_dir, raw_path), flat=True)
+            )
+            if data is None:
+                return
+            if self.pre_filter is not None and not self.pre_filter(data):
+                return
 
-                # Now add the features from the feature extraction
-                if (
-                    features["extraction"] == 1
-                ):  # Failed extraction, so has no features to use
-                    return
-                else:
-                    feature_list = []
-                    feature_list.append(features["head_tail_ratio"])
-                    feature_list.append(features["length"])
-                    feature_list.append(features["width"])
-                    feature_list.append(features["time_gradient"])
-                    feature_list.append(features["number_photons"])
-                    feature_list.append(
-                        features["length"] * features["width"] * np.pi
-                    )
-                    feature_list.append(
-                        (
-                            (features["length"] * features["width"] * np.pi)
-                            / np.log(features["number_photons"]) ** 2
-                        )
-                    )
-                    feature_list.append(
-                        (
-                            features["number_photons"]
-                            / (features["length"] * features["width"] * np.pi)
-                        )
-                    )
-                # Now make it the node features
-                data.features = torch.tensor(
-                    np.asarray(feature_list),
-                    dtype=torch.float,
-                )
+            if self.pre_transform is not None:
+                data = self.pre_transform(data)
+            torch.save(
+                data, osp.join(self.processed_dir, "{}.pt".format(raw_path)),
+            )
+            processed_list.append("{}.pt".format(raw_path))
 
-                if self.pre_filter is not None and not self.pre_filter(data):
-                    return
+    def event_to_data(self, is_proton, event):
+        """
+        Makes the Data of a single event
+        :param is_proton: Whether the event is a proton event or not
+        :param event: The event, as from load_event with flat=True
+        :return: Data, or None if the feature extraction failed
+        """
+        event_data, data_format, features, feature_cluster = event
+        # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
+        point_cloud = photons.point_cloud(*event_data[data_format["Image"]])
+        # Read data from `raw_path`.
+        data = Data(
+            pos=torch.tensor(point_cloud, dtype=torch.float).squeeze(),
+        )  # Just need x,y,z ignore derived features
+        if is_proton:
+            data.event_type = torch.tensor([0], dtype=torch.long
+            )
+        else:
+            data.event_type = torch.tensor([1], dtype=torch.long
+            )
+        data.energy = torch.tensor(
+            [event_data[data_format["Energy"]]],
+            dtype=torch.long,
+        )
+        data.phi = torch.tensor(
+            [event_data[4]],
+            dtype=torch.long,  # Needed because most the proton events had the wrong data_format
+        )
+        data.theta = torch.tensor(
+            [event_data[5]],
+            dtype=torch.long,  # Needed because most the proton events had the wrong data_format
+        )
 
-                if self.pre_transform is not None:
-                    data = self.pre_transform(data)
-                torch.save(
-                    data, osp.join(self.processed_dir, "{}.pt".format(raw_path)),
+        # Now add the features from the feature extraction
+        if (
+            features["extraction"] == 1
+        ):  # Failed extraction, so has no features to use
+            return None
+        else:
+            feature_list = []
+            feature_list.append(features["head_tail_ratio"])
+            feature_list.append(features["length"])
+            feature_list.append(features["width"])
+            feature_list.append(features["time_gradient"])
+            feature_list.append(features["number_photons"])
+            feature_list.append(
+                features["length"] * features["width"] * np.pi
+            )
+            feature_list.append(
+                (
+                    (features["length"] * features["width"] * np.pi)
+                    / np.log(features["number_photons"]) ** 2
+                )
+            )
+            feature_list.append(
+                (
+                    features["number_photons"]
+                    / (features["length"] * features["width"] * np.pi)
                 )
-                processed_list.append("{}.pt".format(raw_path))
+            )
+        # Now make it the node features
+        data.features = torch.tensor(
+            np.asarray(feature_list),
+            dtype=torch.float,
+        )
+        return data
 
     def process(self):
-        used_paths = split_data(self.raw_file_names)[self.split]
-        protons = np.intersect1d(
-            used_paths, self.event_dict["proton"], assume_unique=True
-        )
-        gammas = np.intersect1d(
-            used_paths, self.event_dict["gamma"], assume_unique=True
-        )
-        if self.balanced_classes and self.task == 'separation': # Only matters for separation task, all others only need gamma
-            num_events = len(protons) if len(protons) < len(gammas) else len(gammas)
-            if 0.0 < self.fraction < 1.0:
-                num_events *= self.fraction
-            protons = np.random.choice(protons, size=int(num_events), replace=False)
-            gammas = np.random.choice(gammas, size=int(num_events), replace=False)
-        elif 0.0 < self.fraction < 1.0:
-            protons = np.random.choice(
-                protons, size=int(self.fraction * len(protons)), replace=False
+        if self.catalog is not None:
+            # Split, balanced and sampled by the catalog
+            protons, gammas = self.catalog_events()
+        else:
+            used_paths = split_data(self.raw_file_names)[self.split]
+            protons = np.intersect1d(
+                used_paths, self.event_dict["proton"], assume_unique=True
             )
-            gammas = np.random.choice(
-                gammas, size=int(self.fraction * len(gammas)), replace=False
+            gammas = np.intersect1d(
+                used_paths, self.event_dict["gamma"], assume_unique=True
             )
+            if self.balanced_classes and self.task == 'separation': # Only matters for separation task, all others only need gamma
+                num_events = len(protons) if len(protons) < len(gammas) else len(gammas)
+                if 0.0 < self.fraction < 1.0:
+                    num_events *= self.fraction
+                protons = np.random.choice(protons, size=int(num_events), replace=False)
+                gammas = np.random.choice(gammas, size=int(num_events), replace=False)
+            elif 0.0 < self.fraction < 1.0:
+                protons = np.random.choice(
+                    protons, size=int(self.fraction * len(protons)), replace=False
+                )
+                gammas = np.random.choice(
+                    gammas, size=int(self.fraction * len(gammas)), replace=False
+                )
+        if self.event_store is not None:
+            # Nothing to save, only which events to use, without those with failed feature extraction
+            self.stored_events = []
+            for is_proton, names in ((True, protons), (False, gammas)):
+                if is_proton and self.task != "separation":
+                    continue
+                event_ids = self.event_store.event_ids(names)
+                if "extraction" in self.event_store.feature_columns:
+                    event_ids = event_ids[
+                        self.event_store.column("features/extraction", event_ids) != 1
+                    ]
+                self.stored_events += [(event_id, is_proton) for event_id in event_ids]
+            return
         manager = Manager()
         pool = Pool()
         threaded_filenames = manager.list()
@@ -337,10 +399,22 @@ class EventDataset(Dataset):
             self.processed_filenames.append(element)
 
     def len(self):
+        if self.event_store is not None:
+            return len(self.stored_events)
         return len(self.processed_filenames)
 
     def get(self, idx):
-        data = torch.load(osp.join(self.processed_dir, self.processed_file_names[idx]))
+        if self.event_store is not None:
+            event_id, is_proton = self.stored_events[idx]
+            data = self.event_to_data(
+                is_proton, self.event_store.event(event_id, flat=True)
+            )
+            if self.pre_transform is not None:
+                data = self.pre_transform(data)
+        else:
+            data = torch.load(
+                osp.join(self.processed_dir, self.processed_file_names[idx])
+            )
         if self.task == "energy":
             del data.phi
             del data.theta
@@ -382,6 +456,8 @@ class DiffuseDataset(Dataset):
         transform=None,
         pre_transform=None,
             fraction=1.0,
+        event_store=None,
+        catalog=None,
     ):
         """
         EventFile Dataloader for specifically Disp calculations,
@@ -390,28 +466,40 @@ class DiffuseDataset(Dataset):
         Use EventFileDataset for Energy and Separation tasks
 
         :param num_points: The number of points to have, either using points multiple times, or subselecting from the total points
+        :param event_store: Directory of an EventStore the raw files were imported into, if given the events are read
+        from it by file name and made into Data when used, instead of being saved one .pt file per event, pre_filter is
+        not used then
+        :param catalog: Path of an EventCatalog of the raw files, if given the events are selected and split with it,
+        instead of with the list of raw file names
         """
         self.processed_filenames = []
+        self.event_store = None if event_store is None else open_store(event_store)
+        # Ids of the events used from the event store
+        self.stored_events = []
         self.split = split.lower()
         self.cleanliness = cleanliness.strip().lower()
         self.fraction = fraction
-        try:
-            self.event_list = pickle.load(
-                open(
-                    res.resource_filename(
-                        "factnn.data.resources", f"{self.cleanliness}_diffuse_raw_names.p"
-                    ),
-                    "rb",
+        self.catalog = None if catalog is None else EventCatalog(catalog)
+        if self.catalog is None:
+            try:
+                self.event_list = pickle.load(
+                    open(
+                        res.resource_filename(
+                            "factnn.data.resources", f"{self.cleanliness}_diffuse_raw_names.p"
+                        ),
+                        "rb",
+                    )
+                )
+            except:
+                raise ValueError(
+                    "cleanliness value is not one of: 'no_clean', 'clump20', 'core20'"
                 )
-            )
-        except:
-            raise ValueError(
-                "cleanliness value is not one of: 'no_clean', 'clump20', 'core20'"
-            )
         super(DiffuseDataset, self).__init__(root, transform, pre_transform)
 
     @property
     def raw_file_names(self):
+        if self.catalog is not None:
+            return self.catalog.names(cleaning=self.cleanliness, directory=self.raw_dir)
         return self.event_list
 
     @property
@@ -436,53 +524,67 @@ class DiffuseDataset(Dataset):
             processed_list.append(f"diffuse_{raw_path}.pt")
         else:
             # Checks that file is not 0
-            with open(osp.join(self.raw_dir, raw_path), "rb") as pickled_event:
-                event_data, data_format, features = pickle.load(
-                    pickled_event
-                )
-                # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
-                event_photons = event_data[data_format["Image"]]
-                event_photons = list_of_lists_to_raw_phs(event_photons)
-                point_cloud = np.asarray(
-                    raw_phs_to_point_cloud(
-                        event_photons, cx=GEOMETRY.x_angle, cy=GEOMETRY.y_angle
-                    )
-                )
-                # Read data from `raw_path`.
-                data = Data(
-                    pos=torch.tensor(point_cloud, dtype=torch.float).squeeze(),
-                )  # Just need x,y,z ignore derived features
-                data.y = torch.tensor(
-                    [true_sign(
-                        event_data[data_format["Source_X"]],
-                        event_data[data_format["Source_Y"]],
-                        event_data[data_format["COG_X"]],
-                        event_data[data_format["COG_Y"]],
-                        event_data[data_format["Delta"]],
-                    )
-                    * euclidean_distance(
-                        event_data[data_format["Source_X"]],
-                        event_data[data_format["Source_Y"]],
-                        event_data[data_format["COG_X"]],
-                        event_data[data_format["COG_Y"]],
-                    )],
-                    dtype=torch.float,
-                )
-                if self.pre_filter is not None and not self.pre_filter(data):
-                    return
+            data = self.event_to_data(
+                load_event(osp.join(self.raw_dir, raw_path), flat=True)
+            )
+            if self.pre_filter is not None and not self.pre_filter(data):
+                return
 
-                if self.pre_transform is not None:
-                    data = self.pre_transform(data)
-                torch.save(
-                    data,
-                    osp.join(self.processed_dir, "diffuse_{}.pt".format(raw_path)),
-                )
-                processed_list.append("diffuse_{}.pt".format(raw_path))
+            if self.pre_transform is not None:
+                data = self.pre_transform(data)
+            torch.save(
+                data,
+                osp.join(self.processed_dir, "diffuse_{}.pt".format(raw_path)),
+            )
+            processed_list.append("diffuse_{}.pt".format(raw_path))
+
+    def event_to_data(self, event):
+        """
+        Makes the Data of a single event
+        :param event: The event, as from load_event with flat=True
+        :return: Data
+        """
+        event_data, data_format, features, _ = event
+        # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
+        point_cloud = photons.point_cloud(*event_data[data_format["Image"]])
+        # Read data from `raw_path`.
+        data = Data(
+            pos=torch.tensor(point_cloud, dtype=torch.float).squeeze(),
+        )  # Just need x,y,z ignore derived features
+        data.y = torch.tensor(
+            [true_sign(
+                event_data[data_format["Source_X"]],
+                event_data[data_format["Source_Y"]],
+                event_data[data_format["COG_X"]],
+                event_data[data_format["COG_Y"]],
+                event_data[data_format["Delta"]],
+            )
+            * euclidean_distance(
+                event_data[data_format["Source_X"]],
+                event_data[data_format["Source_Y"]],
+                event_data[data_format["COG_X"]],
+                event_data[data_format["COG_Y"]],
+            )],
+            dtype=torch.float,
+        )
+        return data
 
     def process(self):
-        used_paths = split_data(self.raw_file_names)[self.split]
-        if 0.0 < self.fraction < 1.0:
-            used_paths = np.random.choice(used_paths, size=int(self.fraction*len(used_paths)), replace=False)
+        if self.catalog is not None:
+            used_paths = self.catalog.names(
+                split=self.split,
+                cleaning=self.cleanliness,
+                directory=self.raw_dir,
+                fraction=self.fraction,
+            )
+        else:
+            used_paths = split_data(self.raw_file_names)[self.split]
+            if 0.0 < self.fraction < 1.0:
+                used_paths = np.random.choice(used_paths, size=int(self.fraction*len(used_paths)), replace=False)
+        if self.event_store is not None:
+            # Nothing to save, only which events to use
+            self.stored_events = self.event_store.event_ids(used_paths)
+            return
         manager = Manager()
         threaded_filenames = manager.list()
         pool = Pool()
@@ -493,9 +595,18 @@ class DiffuseDataset(Dataset):
             self.processed_filenames.append(element)
 
     def len(self):
+        if self.event_store is not None:
+            return len(self.stored_events)
         return len(self.processed_file_names)
 
     def get(self, idx):
+        if self.event_store is not None:
+            data = self.event_to_data(
+                self.event_store.event(self.stored_events[idx], flat=True)
+            )
+            if self.pre_transform is not None:
+                data = self.pre_transform(data)
+            return data
         data = torch.load(
             osp.join(self.processed_dir, self.processed_file_names[idx])
         )
@@ -519,7 +630,8 @@ class ClusterDataset(Dataset):
         :param uncleaned_root: Root of files, with same names, that do not have the DBSCAN cleaned output
         :param split: Splits to include, either 'train', 'val', 'test', or 'trainval' for training, validation, test, or training and validation sets
         :param root: Root directory for the dataset, holding the files with the "cleaned" files
-        :param clump_root: Root for files that hold the non-core clump outputs from DBSCAN, optional
+        :param clump_root: Root for files that hold the non-core clump outputs from DBSCAN, optional, for event records
+        with cleaning masks any value adds the clump labels from the record
         :param cleanliness: name of DBSCAN output eventfiles for the files in root, one of 'no_clean', 'clump5','clump10', 'clump15', 'clump20', 'core5', 'core10', 'core15', 'core20'
         """
         self.split = split.lower()
@@ -565,14 +677,15 @@ class ClusterDataset(Dataset):
 
     def process_file(self, base_path):
         """
-        Process single cluster file
+        Process single cluster file, either from an event record with cleaning masks in uncleaned_root, named
+        base_path with RECORD_SUFFIX, or from the cleaned Eventfiles matched to the uncleaned one
         :param base_path:
         :return:
         """
         raw_path = osp.join(self.raw_dir, base_path)
         # Assumes that the folder structure follows the default convention of 'raw'
         uncleaned_path = osp.join(self.uncleaned_root, "raw", base_path)
-        clump_path = osp.join(self.clump_root, "raw", base_path)
+        record_path = uncleaned_path + RECORD_SUFFIX
         # load the pickled file from the disk
         if osp.exists(
             osp.join(self.processed_dir, f"cluster_{base_path}.pt")
@@ -580,81 +693,61 @@ class ClusterDataset(Dataset):
             self.processed_filenames.append(f"cluster_{base_path}.pt")
         else:
             try:
-                with open(raw_path, "rb") as pickled_event:
-                    with open(uncleaned_path, "rb") as pickled_original:
-                        (
-                            event_data,
-                            data_format,
-                            features,
-                            feature_cluster,
-                        ) = pickle.load(pickled_event)
-                        uncleaned_data, _, _, _ = pickle.load(pickled_original)
-                        uncleaned_photons = uncleaned_data[data_format["Image"]]
-                        uncleaned_photons = list_of_lists_to_raw_phs(uncleaned_photons)
-                        uncleaned_cloud = np.asarray(
-                            raw_phs_to_point_cloud(
-                                uncleaned_photons,
-                                cx=GEOMETRY.x_angle,
-                                cy=GEOMETRY.y_angle,
-                            )
-                        )
-                        # Convert List of List to Point Cloud
-                        event_photons = event_data[data_format["Image"]]
-                        event_photons = list_of_lists_to_raw_phs(event_photons)
-                        point_cloud = np.asarray(
-                            raw_phs_to_point_cloud(
-                                event_photons, cx=GEOMETRY.x_angle, cy=GEOMETRY.y_angle
-                            )
-                        )
-                        out = np.where(
-                            (uncleaned_cloud == point_cloud[:, None]).all(-1)
-                        )[1]
-                        point_values = np.zeros(uncleaned_cloud.shape)
-                        point_values[out] = 1
-                        if self.clumps:
-                            with open(clump_path, "rb") as pickled_clump:
-                                clump_data, _, _, _ = pickle.load(pickled_clump)
-                                clump_photons = clump_data[data_format["Image"]]
-                                clump_photons = list_of_lists_to_raw_phs(clump_photons)
-                                clump_cloud = np.asarray(
-                                    raw_phs_to_point_cloud(
-                                        clump_photons,
-                                        cx=GEOMETRY.x_angle,
-                                        cy=GEOMETRY.y_angle,
-                                    )
-                                )
-                                out = np.where(
-                                    (uncleaned_cloud == clump_cloud[:, None]).all(-1)
-                                )[1]
-                                clump_values = np.zeros(uncleaned_cloud.shape)
-                                clump_values[out] = 1
-                                # clump_values = np.isclose(clump_cloud, point_cloud)
-                                # Convert to ints so that addition works, gives 0 for outside, 1 clump, 2 core
-                                point_values = point_values.astype(
-                                    int
-                                ) + clump_values.astype(int)
-                                point_values = point_values[:, 0]
-                        else:
-                            point_values = point_values.astype(int)
-                            point_values = point_values[:, 0]
-                        data = Data(
-                            pos=torch.tensor(uncleaned_cloud, dtype=torch.float).squeeze(), y=point_values
-                        )  # Just need x,y,z ignore derived features
-                        if self.pre_filter is not None and not self.pre_filter(data):
-                            return
-
-                        if self.pre_transform is not None:
-                            data = self.pre_transform(data)
-                        torch.save(
-                            data,
-                            osp.join(
-                                self.processed_dir,
-                                "cluster_{}.pt".format(base_path),
-                            ),
-                        )
-                        self.processed_filenames.append(
-                            "cluster_{}.pt".format(base_path)
+                if osp.exists(record_path):
+                    # Every cleaning is a mask over the uncleaned photons, so no matching is needed
+                    uncleaned_data, data_format, _, _ = load_event(record_path, flat=True)
+                    masks = load_cleaning_masks(record_path)
+                    clump_name = self.cleanliness.replace("core", "clump")
+                    if self.cleanliness == "no_clean":
+                        # Every photon is kept
+                        _, offsets = uncleaned_data[data_format["Image"]]
+                        kept = np.ones(offsets[-1] - offsets[0], dtype=bool)
+                        masks = {self.cleanliness: kept, clump_name: kept}
+                    elif masks is None or self.cleanliness not in masks or (
+                        self.clumps and clump_name not in masks
+                    ):
+                        # Same as there being no cleaned Eventfile, as load_event does for a missing cleaning
+                        print(f"No {self.cleanliness} cleaning in {record_path}, skip")
+                        return
+                    point_values = masks[self.cleanliness].astype(int)
+                    if self.clumps:
+                        # Gives 0 for outside, 1 clump, 2 core
+                        point_values += masks[clump_name]
+                else:
+                    uncleaned_data, data_format, _, _ = load_event(uncleaned_path, flat=True)
+                    event_data, _, _, _ = load_event(raw_path, flat=True)
+                    uncleaned_photons = uncleaned_data[data_format["Image"]]
+                    point_values = photons.matching_photons(
+                        *uncleaned_photons, *event_data[data_format["Image"]]
+                    ).astype(int)
+                    if self.clumps:
+                        clump_path = osp.join(self.clump_root, "raw", base_path)
+                        clump_data, _, _, _ = load_event(clump_path, flat=True)
+                        # Gives 0 for outside, 1 clump, 2 core
+                        point_values += photons.matching_photons(
+                            *uncleaned_photons, *clump_data[data_format["Image"]]
                         )
+                uncleaned_cloud = photons.point_cloud(
+                    *uncleaned_data[data_format["Image"]]
+                )
+                data = Data(
+                    pos=torch.tensor(uncleaned_cloud, dtype=torch.float).squeeze(), y=point_values
+                )  # Just need x,y,z ignore derived features
+                if self.pre_filter is not None and not self.pre_filter(data):
+                    return
+
+                if self.pre_transform is not None:
+                    data = self.pre_transform(data)
+                torch.save(
+                    data,
+                    osp.join(
+                        self.processed_dir,
+                        "cluster_{}.pt".format(base_path),
+                    ),
+                )
+                self.processed_filenames.append(
+                    "cluster_{}.pt".format(base_path)
+                )
             except Exception as e:
                 print(f"Failed: {e}")
                 return
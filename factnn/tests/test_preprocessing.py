@@ -1,6 +1,1114 @@
 import unittest
+import datetime
+import gzip
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from functools import partial
+import h5py
+import numpy as np
 
+from factnn.data.preprocess.base_preprocessor import BasePreprocessor
+from factnn.data.preprocess import photons, rebinning
+from factnn.data.preprocess.rebinning import attach_arrays, share_arrays
+from factnn.data.preprocess.clustering import PhotonNeighbours
+from factnn.data.preprocess.cleaning import pixel_edges, threshold_cleaning
+from factnn.data.preprocess.normalization import normalize_batch, ImageStatistics
 from factnn.data.preprocess.simulation_preprocessors import GammaPreprocessor
+from factnn.data.preprocess.eventfile_preprocessor import EventFilePreprocessor
+from factnn.data.preprocess.pipeline import EventFilePipeline
+from factnn.data.preprocess.pointcloud_preprocessor import PointCloudPreprocessor
+from factnn.data.dataset.event_store import (
+    EventStoreWriter,
+    import_event_files,
+    load_event,
+    open_store,
+)
+from factnn.data.dataset.event_catalog import EventCatalog
+from factnn.data.preprocess.dl2_index import DL2Index
+from factnn.data.dataset.photon_stream_files import (
+    binary_path,
+    find_photon_stream_files,
+)
+from factnn.data.dataset.gzip_index import (
+    IndexedGzipReader,
+    build_gzip_index,
+    load_gzip_index,
+    recompress_block_gzip,
+)
+from factnn.data.preprocess.event_cache import (
+    AirShowerTruth,
+    CachedEvent,
+    CachedPhotonStream,
+    SimulationTruth,
+    cache_events,
+    count_simulation_events,
+    simulation_cache_path,
+    simulation_events,
+)
+from factnn.data.dataset.hdf5 import (
+    HDF5BatchReader,
+    create_dataset,
+    number_of_rows,
+)
+from factnn.data.dataset.event_record import (
+    HEADER,
+    RECORD_SUFFIX,
+    convert_event_files,
+    event_record_bytes,
+    load_cleaning_masks,
+    read_event_record,
+    write_event_record,
+)
+
+
+class TestPhotons(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1337)
+        self.photon_streams = [
+            [list(rng.randint(0, 100, size=rng.randint(0, 4))) for _ in range(1440)]
+            for _ in range(3)
+        ]
+        # No photons at all
+        self.photon_streams.append([[] for _ in range(1440)])
+        self.arrivals, self.offsets = photons.flatten_photon_streams(
+            self.photon_streams
+        )
+
+    def test_to_list_of_lists(self):
+        self.assertEqual(
+            photons.to_list_of_lists(self.arrivals, self.offsets), self.photon_streams
+        )
+
+    def test_point_cloud(self):
+        x_angle, y_angle = photons.pixel_angles()
+        cloud = photons.point_cloud(self.arrivals, self.offsets)
+        expected = [
+            (x_angle[chid], y_angle[chid], value * photons.TIME_SLICE_DURATION_S)
+            for photon_stream in self.photon_streams
+            for chid, pixel in enumerate(photon_stream)
+            for value in pixel
+        ]
+        np.testing.assert_allclose(cloud, expected)
+
+    def test_matching_photons(self):
+        arrivals, offsets = self.arrivals, self.offsets[: photons.NUMBER_OF_PIXELS + 1]
+        mask = np.arange(offsets[-1]) % 3 == 0
+        kept = photons.select_photons(arrivals, offsets, mask)
+        kept_photons = {
+            (chid, value)
+            for chid, pixel in enumerate(photons.to_list_of_lists(*kept)[0])
+            for value in pixel
+        }
+        expected = [
+            (chid, value) in kept_photons
+            for chid, pixel in enumerate(self.photon_streams[0])
+            for value in pixel
+        ]
+        np.testing.assert_array_equal(
+            photons.matching_photons(arrivals, offsets, *kept), expected
+        )
+
+        raw = photons.to_raw(arrivals, offsets)
+        self.assertEqual(np.sum(raw == photons.LINEBREAK), photons.NUMBER_OF_PIXELS)
+        np.testing.assert_array_equal(
+            raw[raw != photons.LINEBREAK], arrivals[: offsets[-1]]
+        )
+
+    def test_arrival_window(self):
+        start, end, mean, std = photons.arrival_window(self.arrivals, self.offsets)
+        for index, photon_stream in enumerate(self.photon_streams[:3]):
+            values = np.concatenate(photon_stream)
+            self.assertEqual(start[index], np.min(values))
+            self.assertEqual(end[index], np.max(values))
+            self.assertAlmostEqual(mean[index], np.mean(values))
+            self.assertAlmostEqual(std[index], np.std(values))
+        self.assertEqual((start[3], end[3], mean[3], std[3]), (-1, -1, -1, -1))
+
+    def test_slice_lookup(self):
+        lookup = photons.slice_lookup(photons.equal_width_edges(10, 19, 4))
+        np.testing.assert_array_equal(
+            lookup[8:21], [-1, -1, 0, 0, 0, 1, 1, 1, 2, 2, 2, -1, -1]
+        )
+        lookup = photons.slice_lookup([10, 12, 15], overflow=True, end=18)
+        np.testing.assert_array_equal(
+            lookup[8:20], [-1, -1, 0, 0, 1, 1, 1, 1, 1, 1, -1, -1]
+        )
+
+    def test_binned_photon_histogram(self):
+        lookup = photons.slice_lookup(photons.collapse_edges(60, 4))
+        histogram = photons.binned_photon_histogram(
+            self.arrivals, self.offsets, lookup, 4
+        )
+        full_histogram = photons.photon_histogram(self.arrivals, self.offsets, 0, 60)
+        np.testing.assert_array_equal(
+            histogram[..., :3],
+            full_histogram[..., :45].reshape(4, 1440, 3, 15).sum(axis=-1),
+        )
+        np.testing.assert_array_equal(
+            histogram[..., 3], full_histogram[..., 45:].sum(axis=-1)
+        )
+
+    def test_densest_window(self):
+        start, end, count = photons.densest_window(self.arrivals, self.offsets, 20)
+        self.assertEqual((start[-1], end[-1], count[-1]), (-1, -1, 0))
+        for index, photon_stream in enumerate(self.photon_streams[:-1]):
+            values = np.concatenate([np.asarray(pixel) for pixel in photon_stream])
+            counts = [
+                np.sum((values >= slice) & (values < slice + 20))
+                for slice in range(256)
+            ]
+            self.assertEqual(start[index], np.argmax(counts))
+            self.assertEqual(end[index], start[index] + 20)
+            self.assertEqual(count[index], np.max(counts))
+
+    def test_select_photons(self):
+        mask = photons.window_mask(
+            self.arrivals, self.offsets, np.array([10, 20, 0, 0]), 50
+        )
+        arrivals, offsets = photons.select_photons(self.arrivals, self.offsets, mask)
+        starts = [10, 20, 0, 0]
+        expected = [
+            [
+                [value for value in pixel if starts[index] <= value < 50]
+                for pixel in event
+            ]
+            for index, event in enumerate(self.photon_streams)
+        ]
+        self.assertEqual(photons.to_list_of_lists(arrivals, offsets), expected)
+
+    def test_photon_counts(self):
+        counts = photons.photon_counts(self.offsets)
+        self.assertEqual(counts.shape, (4, 1440))
+        self.assertEqual(counts[1, 7], len(self.photon_streams[1][7]))
+        self.assertEqual(counts.sum(), len(self.arrivals))
+
+
+class TestClustering(unittest.TestCase):
+    def test_same_as_dbscan(self):
+        preprocessor = BasePreprocessor(
+            config={"paths": [], "rebin_size": 5, "shape": [10, 40]}
+        )
+        rng = np.random.RandomState(1337)
+        x_angle, y_angle = photons.pixel_angles()
+        # Noise everywhere, with a shower at one spot
+        photon_stream = [
+            list(rng.randint(0, 100, size=rng.poisson(1))) for _ in range(1440)
+        ]
+        shower = np.hypot(x_angle - x_angle[700], y_angle - y_angle[700]) < 0.01
+        for chid in np.flatnonzero(shower):
+            photon_stream[chid] += list(rng.randint(40, 46, size=rng.poisson(6)))
+        arrivals, offsets = photons.flatten_photon_streams([photon_stream])
+        neighbours = PhotonNeighbours(arrivals, offsets)
+        for min_samples in [3, 10, 20]:
+            dbscan = preprocessor.find_clumps(
+                photons.point_cloud(arrivals, offsets), min_samples
+            )
+            clusters = neighbours.clusters(min_samples)
+            np.testing.assert_array_equal(clusters.labels_, dbscan.labels_)
+            np.testing.assert_array_equal(
+                clusters.core_sample_indices_, dbscan.core_sample_indices_
+            )
+        self.assertGreater(clusters.labels_.max(), -1)
+
+        event = CachedEvent(CachedPhotonStream(arrivals, offsets), 0.0, 0.0, None)
+        masks = preprocessor.cleaning_masks(event, min_samples=[3, 10, 20])
+        self.assertEqual(
+            sorted(masks), ["clump10", "clump20", "clump3", "core10", "core20", "core3"]
+        )
+        np.testing.assert_array_equal(masks["clump20"], clusters.labels_ >= 0)
+        masks = preprocessor.cleaning_masks(event, min_samples=[10], eps=[0.05, 0.1])
+        np.testing.assert_array_equal(
+            masks["core10_eps0.1"],
+            preprocessor.cleaning_masks(event, min_samples=10)["core10"],
+        )
+
+        _, clump, core, clusters = preprocessor.clean_image(event, min_samples=20)
+        np.testing.assert_array_equal(
+            clump,
+            photons.to_raw(
+                *photons.select_photons(arrivals, offsets, clusters.labels_ >= 0)
+            ),
+        )
+        # Without the photons, the CHIDs are found from the angles of the point cloud
+        np.testing.assert_array_equal(
+            preprocessor.select_clustered_photons(
+                clusters, photons.point_cloud(arrivals, offsets), debug=False
+            ),
+            core,
+        )
+
+    def test_threshold_cleaning(self):
+        preprocessor = BasePreprocessor(
+            config={"paths": [], "rebin_size": 5, "shape": [10, 40]}
+        )
+        rng = np.random.RandomState(1337)
+        x_angle, y_angle = photons.pixel_angles()
+        photon_streams = []
+        for center in [700, 100, 1300]:
+            photon_stream = [
+                list(rng.randint(0, 100, size=rng.poisson(1))) for _ in range(1440)
+            ]
+            distance = np.hypot(x_angle - x_angle[center], y_angle - y_angle[center])
+            for chid in np.flatnonzero(distance < 0.01):
+                photon_stream[chid] += list(rng.randint(40, 46, size=rng.poisson(6)))
+            photon_streams.append(photon_stream)
+        arrivals, offsets = photons.flatten_photon_streams(photon_streams)
+        clump, core = threshold_cleaning(arrivals, offsets)
+
+        starts, neighbours = pixel_edges()
+        ends = np.append(starts[1:], len(neighbours))
+        counts = photons.photon_counts(offsets)
+        for index, photon_stream in enumerate(photon_streams):
+            times = [np.mean(pixel) if pixel else 0.0 for pixel in photon_stream]
+            core_pixels = {
+                chid
+                for chid in range(1440)
+                if counts[index, chid] >= 5
+                and any(
+                    counts[index, n] >= 5 for n in neighbours[starts[chid] : ends[chid]]
+                )
+            }
+            clump_pixels = core_pixels | {
+                chid
+                for chid in range(1440)
+                if counts[index, chid] >= 2
+                and core_pixels & set(neighbours[starts[chid] : ends[chid]])
+            }
+            kept = {
+                chid
+                for chid in clump_pixels
+                if any(
+                    n in clump_pixels and abs(times[chid] - times[n]) <= 10
+                    for n in neighbours[starts[chid] : ends[chid]]
+                )
+            }
+            event_photons = slice(
+                offsets[index * 1440] - offsets[0], offsets[(index + 1) * 1440]
+            )
+            chids = np.repeat(np.arange(1440), counts[index])
+            np.testing.assert_array_equal(
+                clump[event_photons], [chid in kept for chid in chids]
+            )
+            np.testing.assert_array_equal(
+                core[event_photons], [chid in kept & core_pixels for chid in chids]
+            )
+            self.assertTrue(np.any(core[event_photons]))
+
+        event = CachedEvent(
+            CachedPhotonStream(arrivals, offsets[: 1440 + 1]), 0.0, 0.0, None
+        )
+        _, clump_raw, core_raw, _ = preprocessor.clean_image(event, method="facttools")
+        masks = preprocessor.cleaning_masks(event, method="facttools")
+        self.assertEqual(sorted(masks), ["clumpfacttools", "corefacttools"])
+        np.testing.assert_array_equal(
+            core_raw,
+            photons.to_raw(
+                *photons.select_photons(
+                    arrivals, offsets[: 1440 + 1], masks["corefacttools"]
+                )
+            ),
+        )
+        self.assertLessEqual(len(core_raw), len(clump_raw))
+
+        thresholds = {"core_threshold": 1000, "boundary_threshold": 1000}
+        self.assertIsNone(
+            preprocessor.cleaning_masks(
+                event, method="facttools", thresholds=thresholds
+            )
+        )
+        self.assertIsNone(
+            preprocessor.cleaned_event(
+                event, clean_type="facttools", thresholds=thresholds
+            )
+        )
+        cleaned = preprocessor.cleaned_event(event, clean_type="facttools")
+        np.testing.assert_array_equal(cleaned.photon_stream.raw, core_raw)
+
+
+class TestNormalization(unittest.TestCase):
+    def setUp(self):
+        self.images = np.random.RandomState(1337).rand(20, 3, 4, 4)
+
+    def test_normalize_batch(self):
+        images = self.images * 10
+        normalized = normalize_batch(images, axis=(2, 3))
+        self.assertIs(normalized, images)
+        np.testing.assert_allclose(normalized.mean(axis=(2, 3)), 0.0, atol=1e-12)
+        np.testing.assert_allclose(normalized.std(axis=(2, 3)), 1.0)
+
+    def test_image_statistics(self):
+        statistics = ImageStatistics(axis=(0, 2, 3))
+        for batch in np.array_split(self.images, 6):
+            statistics.update(batch)
+        self.assertEqual(statistics.count, 20 * 4 * 4)
+        np.testing.assert_allclose(
+            statistics.mean.ravel(), self.images.mean(axis=(0, 2, 3))
+        )
+        np.testing.assert_allclose(
+            statistics.std.ravel(), self.images.std(axis=(0, 2, 3))
+        )
+        normalized = normalize_batch(self.images.copy(), statistics=statistics)
+        np.testing.assert_allclose(normalized.mean(axis=(0, 2, 3)), 0.0, atol=1e-12)
+
+
+class TestBasePreprocessor(unittest.TestCase):
+    def setUp(self):
+        self.configuration = {
+            "paths": [],
+            "rebin_size": 5,
+            "shape": [10, 40],
+        }
+        rng = np.random.RandomState(1337)
+        self.photon_stream = [
+            list(rng.randint(0, 60, size=rng.randint(0, 6))) for _ in range(1440)
+        ]
+
+    def test_rebinning_matrix(self):
+        preprocessor = BasePreprocessor(config=self.configuration)
+        chid_to_pixel, pixel_index_to_grid = preprocessor.rebinning
+        input_matrix = np.zeros([5, 5, 30])
+        for index in range(1440):
+            for element in chid_to_pixel[index]:
+                if element[0] not in pixel_index_to_grid:
+                    continue
+                coords = pixel_index_to_grid[element[0]]
+                for value in self.photon_stream[index]:
+                    if 40 > value >= 10:
+                        input_matrix[coords[0]][coords[1]][value - 10] += element[1]
+
+        self.assertEqual(preprocessor.rebinning_matrix.shape, (25, 1440))
+        image = preprocessor.rasterize(
+            preprocessor.photon_histogram(self.photon_stream, 10, 30)
+        )
+        np.testing.assert_allclose(image, np.fliplr(np.rot90(input_matrix, 3)))
+
+    def test_generate_rebinning(self):
+        preprocessor = BasePreprocessor(config=self.configuration)
+        chid_to_pixel, pixel_index_to_grid = preprocessor.generate_rebinning(5)
+        self.assertEqual(pixel_index_to_grid, preprocessor.rebinning[1])
+        for chid in range(1440):
+            expected = preprocessor.rebinning[0][chid]
+            self.assertEqual(
+                [pixel for pixel, _ in chid_to_pixel[chid]],
+                [pixel for pixel, _ in expected],
+            )
+            np.testing.assert_allclose(
+                [fraction for _, fraction in chid_to_pixel[chid]],
+                [fraction for _, fraction in expected],
+                rtol=1e-6,
+            )
+
+    def test_pickle_rebinning(self):
+        preprocessor = BasePreprocessor(config=self.configuration)
+        state = preprocessor.__getstate__()
+        self.assertNotIn("rebinning_matrix", state)
+        self.assertNotIn("rebinning_arrays", state)
+
+        unpickled = pickle.loads(pickle.dumps(preprocessor))
+        # Both come from the same registry entry, so the tables are not copied
+        self.assertIs(unpickled.rebinning_matrix, preprocessor.rebinning_matrix)
+        self.assertEqual(unpickled.start, 10)
+        self.assertEqual(unpickled.shape, preprocessor.shape)
+
+    def test_share_arrays(self):
+        name = "factnn_test_{}".format(os.getpid())
+        arrays = [np.arange(10), np.linspace(0.0, 1.0, 7, dtype=np.float32)]
+        try:
+            shared = share_arrays(name, arrays)
+            for array, expected in zip(shared, arrays):
+                np.testing.assert_array_equal(array, expected)
+                self.assertEqual(array.dtype, expected.dtype)
+            path = rebinning._shared_path(name)
+            self.assertTrue(os.path.isfile(path))
+            self.assertIn(str(os.getuid()), os.path.dirname(path))
+            # Only the shared file is left, not the one it was written to first
+            self.assertEqual(
+                [file for file in os.listdir(os.path.dirname(path)) if name in file],
+                [os.path.basename(path)],
+            )
+            self.assertEqual(len(attach_arrays(name)), 2)
+        finally:
+            if os.path.exists(rebinning._shared_path(name)):
+                os.remove(rebinning._shared_path(name))
+        self.assertIsNone(attach_arrays(name))
+
+    def test_collapse_image_time(self):
+        preprocessor = BasePreprocessor(config=self.configuration)
+        image = np.random.RandomState(0).rand(1, 11, 5, 5)
+        collapsed = preprocessor.collapse_image_time(image, 3)
+        self.assertEqual(collapsed.shape, (1, 3, 5, 5))
+        np.testing.assert_allclose(collapsed[0, 1], image[0, 3:6].sum(axis=0))
+        np.testing.assert_allclose(collapsed[0, 2], image[0, 6:].sum(axis=0))
+        collapsed = preprocessor.collapse_image_time(image, 3, as_channels=True)
+        self.assertEqual(collapsed.shape, (1, 5, 5, 3))
+        np.testing.assert_allclose(collapsed[0, ..., 0], image[0, :3].sum(axis=0))
+
+    def test_rasterize_batch(self):
+        preprocessor = BasePreprocessor(config=self.configuration)
+        photon_streams = [
+            self.photon_stream,
+            self.photon_stream[::-1],
+            self.photon_stream,
+        ]
+        starts = np.array([10, 5, 20])
+        arrivals, offsets = preprocessor.flatten_photon_streams(photon_streams)
+        self.assertEqual(len(offsets), 3 * 1440 + 1)
+
+        images = preprocessor.rasterize_batch(
+            arrivals, offsets, starts, 30, end=starts + 25, overflow=True
+        )
+        self.assertEqual(images.shape, (3, 5, 5, 30))
+        self.assertEqual(images.dtype, np.float32)
+        for index, photon_stream in enumerate(photon_streams):
+            image = preprocessor.rasterize(
+                preprocessor.photon_histogram(
+                    photon_stream,
+                    starts[index],
+                    30,
+                    end=starts[index] + 25,
+                    overflow=True,
+                )
+            )
+            np.testing.assert_allclose(images[index], image, rtol=1e-6)
+
+        out = np.zeros((4, 5, 5, 30), dtype=np.float32)
+        written = preprocessor.rasterize_batch(
+            arrivals, offsets, starts, 30, end=starts + 25, overflow=True, out=out[1:]
+        )
+        self.assertIs(written.base, out)
+        np.testing.assert_array_equal(out[1:], images)
+        for wrong in [
+            np.zeros((3, 5, 5, 30), dtype=np.float64),
+            np.zeros((3, 5, 5, 31), dtype=np.float32),
+            np.zeros((3, 5, 5, 60), dtype=np.float32)[..., ::2],
+        ]:
+            with self.assertRaises(ValueError):
+                preprocessor.rasterize_batch(arrivals, offsets, starts, 30, out=wrong)
+
+    def test_chunked_batches(self):
+        configuration = dict(self.configuration, paths=["first", "second"])
+        preprocessor = BasePreprocessor(config=configuration)
+        rows = {
+            "first": [[self.photon_stream, 1.0, 2.0], [self.photon_stream[::-1], 3, 4]],
+            "second": [[self.photon_stream[::2] * 2, 5.0, 6.0]],
+        }
+        files = list(preprocessor.batches(rows.get))
+        self.assertEqual([len(data) for data in files], [2, 1])
+
+        chunks = [
+            tuple(np.copy(values) for values in chunk)
+            for chunk in preprocessor.batches(rows.get, chunk_size=2)
+        ]
+        self.assertEqual([len(chunk[0]) for chunk in chunks], [2, 1])
+        self.assertEqual(chunks[0][0].dtype, np.float32)
+        images = preprocessor.reformat(
+            np.array([row[0] for data in files for row in data])
+        )
+        np.testing.assert_allclose(
+            np.concatenate([chunk[0] for chunk in chunks]), images, rtol=1e-6
+        )
+        np.testing.assert_array_equal(
+            np.concatenate([chunk[2] for chunk in chunks]), [2.0, 4.0, 6.0]
+        )
+
+
+class TestEventFilePipeline(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = np.random.RandomState(1337)
+        self.paths = []
+        for index in range(4):
+            photon_stream = [
+                list(rng.randint(5, 60, size=rng.randint(0, 6))) for _ in range(1440)
+            ]
+            path = os.path.join(self.directory, "{}.p".format(index))
+            with open(path, "wb") as event_file:
+                pickle.dump(
+                    ([photon_stream, index], {"Image": 0}, {"extraction": 1}, None),
+                    event_file,
+                )
+            self.paths.append(path)
+        self.configuration = {
+            "paths": [],
+            "rebin_size": 5,
+            "shape": [10, 40],
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_as_on_files_processor(self):
+        for options in [
+            {},
+            {"normalize": True, "return_collapsed": True},
+            {"dynamic_resize": True, "truncate": True},
+            {"dynamic_resize": True, "equal_slices": True},
+            {"densest_window": True},
+        ]:
+            for as_channels in (False, True):
+                self.configuration["as_channels"] = as_channels
+                preprocessor = EventFilePreprocessor(config=self.configuration)
+                pipeline = EventFilePipeline(
+                    preprocessor, final_slices=3, as_channels=as_channels, **options
+                )
+                images, collapsed, _, data, _ = pipeline.process(self.paths)
+                expected = preprocessor.on_files_processor(
+                    self.paths, final_slices=3, **options
+                )
+                self.assertEqual(len(data), len(expected))
+                np.testing.assert_allclose(
+                    images,
+                    np.concatenate([event[0][0] for event in expected]),
+                    rtol=1e-4,
+                    atol=1e-5,
+                )
+                if collapsed is not None:
+                    np.testing.assert_allclose(
+                        collapsed.ravel(),
+                        np.concatenate([event[2].ravel() for event in expected]),
+                        rtol=1e-4,
+                        atol=1e-5,
+                    )
+
+    def test_no_events_kept(self):
+        preprocessor = EventFilePreprocessor(config=self.configuration)
+        pipeline = EventFilePipeline(
+            preprocessor, final_slices=3, return_features=True, return_collapsed=True
+        )
+        # Every feature extraction failed
+        images, collapsed, features, data, _ = pipeline.process(self.paths)
+        self.assertEqual(images.shape, (0, 3, 5, 5))
+        self.assertEqual(collapsed.shape, (0, 5, 5, 1))
+        self.assertEqual(features.shape, (0, preprocessor.num_features))
+        self.assertEqual(data, [])
+
+    def test_photon_window(self):
+        preprocessor = PointCloudPreprocessor(config=self.configuration)
+        photon_stream = [[] for _ in range(1440)]
+        # Photons on both sides of the window from 10 to 40, but none in it
+        photon_stream[3] = [5, 6]
+        photon_stream[7] = [80]
+        arrivals, offsets = photons.flatten_photon_streams([photon_stream])
+        window = preprocessor.photon_window(arrivals, offsets, move=True)
+        self.assertEqual(
+            photons.to_list_of_lists(*window)[0][3:8], [[5, 6], [], [], [], []]
+        )
+        path = os.path.join(self.directory, "outside.p")
+        with open(path, "wb") as event_file:
+            pickle.dump(
+                ([[[] for _ in range(1440)], 0], {"Image": 0}, {"extraction": 1}, None),
+                event_file,
+            )
+        self.assertEqual(list(preprocessor.event_file_processor(path)), [])
+
+
+class TestEventStore(unittest.TestCase):
+    # Same Eventfiles as for the pipeline
+    setUp = TestEventFilePipeline.setUp
+    tearDown = TestEventFilePipeline.tearDown
+
+    def test_import_event_files(self):
+        store_directory = os.path.join(self.directory, "store")
+        references = import_event_files(self.paths, store_directory, shard_size=3)
+        store = open_store(store_directory)
+        self.assertEqual(len(store), 4)
+        self.assertEqual(len(store.shard_names), 2)
+        for path, reference in zip(self.paths, references):
+            self.assertEqual(load_event(reference), load_event(path))
+        self.assertEqual(store.event_id(os.path.basename(self.paths[2])), 2)
+        np.testing.assert_array_equal(store.column("data/1"), [0, 1, 2, 3])
+
+        arrivals, offsets = store.batch([3, 0, 3])
+        expected = photons.flatten_photon_streams(
+            [load_event(self.paths[index])[0][0] for index in (3, 0, 3)]
+        )
+        np.testing.assert_array_equal(arrivals, expected[0])
+        np.testing.assert_array_equal(offsets, expected[1])
+
+        preprocessor = EventFilePreprocessor(config=self.configuration)
+        pipeline = EventFilePipeline(preprocessor, final_slices=3)
+        np.testing.assert_array_equal(
+            pipeline.process(references)[0], pipeline.process(self.paths)[0]
+        )
+
+    def test_append(self):
+        store_directory = os.path.join(self.directory, "store")
+        import_event_files(self.paths[:2], store_directory)
+        with EventStoreWriter(store_directory) as writer:
+            event_id = writer.add_event(*load_event(self.paths[2])[:3])
+        self.assertEqual(event_id, 2)
+        self.assertEqual(len(open_store(store_directory)), 3)
+
+
+class TestEventRecord(unittest.TestCase):
+    setUp = TestEventFilePipeline.setUp
+    tearDown = TestEventFilePipeline.tearDown
+
+    def test_round_trip(self):
+        data, data_format, features, _ = load_event(self.paths[1])
+        data += [datetime.datetime(2014, 10, 2, 1, 2, 3, 456), 2.5]
+        data_format.update({"Time": 2, "Energy": 3})
+        features = {"extraction": 0, "size": 1.5}
+        labels = np.arange(np.sum([len(pixel) for pixel in data[0]])) % 3 - 1
+        record = event_record_bytes(data, data_format, features, labels)
+        self.assertEqual(len(record) % 8, 0)
+
+        read = read_event_record(record)
+        self.assertEqual(read[:3], (data, data_format, features))
+        np.testing.assert_array_equal(read[3], labels)
+        arrivals, offsets = read_event_record(record, flat=True)[0][0]
+        expected = photons.flatten_photon_streams([data[0]])
+        np.testing.assert_array_equal(arrivals, expected[0])
+        np.testing.assert_array_equal(offsets, expected[1])
+
+    def test_many_clusters(self):
+        data, data_format, _, _ = load_event(self.paths[1])
+        num_photons = np.sum([len(pixel) for pixel in data[0]])
+        self.assertGreater(num_photons, 300)
+        # As with min_samples=1, where every lone photon is its own cluster
+        labels = np.arange(num_photons) - 1
+        record = event_record_bytes(data, data_format, cluster=labels)
+        self.assertEqual(HEADER.unpack_from(record)[6], 2)
+        read_labels = read_event_record(record)[3]
+        self.assertEqual(read_labels.dtype, np.int16)
+        np.testing.assert_array_equal(read_labels, labels)
+
+        # Records before version 3 have int8 labels and no label size
+        labels = np.arange(num_photons) % 5 - 1
+        old_record = bytearray(event_record_bytes(data, data_format, cluster=labels))
+        self.assertEqual(HEADER.unpack_from(old_record)[6], 1)
+        old_record[4:6] = (2).to_bytes(2, "little")
+        old_record[14] = 0
+        np.testing.assert_array_equal(read_event_record(bytes(old_record))[3], labels)
+
+    def test_exact_values(self):
+        data, data_format, _, _ = load_event(self.paths[1])
+        data += [2**53 + 1, datetime.datetime(2014, 10, 2, 1, 2, 3, 456), 0.1]
+        data_format.update({"Event": 2, "Time": 3, "Energy": 4})
+        record = event_record_bytes(data, data_format)
+        read = read_event_record(record)[0]
+        self.assertEqual(read[2:], data[2:])
+        self.assertIsInstance(read[2], int)
+
+        # Version 1 records stored every value as float64
+        old_record = bytearray(record)
+        old_record[4:6] = (1).to_bytes(2, "little")
+        names_length = HEADER.unpack_from(record)[-1]
+        position = (HEADER.size + 7) // 8 * 8 + (names_length + 7) // 8 * 8
+        values = np.ndarray(len(data), "<f8", buffer=old_record, offset=position)
+        values[2] = 1e6
+        values[3] = (data[3] - datetime.datetime(1970, 1, 1)) / datetime.timedelta(
+            microseconds=1
+        )
+        read = read_event_record(bytes(old_record))[0]
+        self.assertEqual(read[2], 1000000)
+        self.assertEqual(read[3], data[3])
+        self.assertEqual(read[4], 0.1)
+
+    def test_cleaning(self):
+        data, data_format, _, _ = load_event(self.paths[2])
+        num_photons = np.sum([len(pixel) for pixel in data[0]])
+        masks = {
+            "clump5": np.arange(num_photons) % 2 == 0,
+            "core5": np.arange(num_photons) % 4 == 0,
+            "core20": np.zeros(num_photons, dtype=bool),
+        }
+        path = os.path.join(self.directory, "cleaned" + RECORD_SUFFIX)
+        write_event_record(
+            path,
+            data,
+            data_format,
+            {"size": 1.0},
+            cleaning=masks,
+            cleaning_features={"core5": {"size": 0.5}},
+        )
+        loaded_masks = load_cleaning_masks(path)
+        self.assertEqual(list(loaded_masks), list(masks))
+        for name, mask in masks.items():
+            np.testing.assert_array_equal(loaded_masks[name], mask)
+
+        cleaned = load_event(path, flat=True, cleaning="core5")
+        expected = photons.select_photons(
+            *photons.flatten_photon_streams([data[0]]), masks["core5"]
+        )
+        np.testing.assert_array_equal(cleaned[0][0][0], expected[0])
+        np.testing.assert_array_equal(cleaned[0][0][1], expected[1])
+        self.assertEqual(cleaned[2], {"size": 0.5})
+        self.assertEqual(load_event(path)[2], {"size": 1.0})
+        self.assertIsNone(load_event(path, cleaning="clump5")[2])
+        # No photons kept, the same as no cleaned Eventfile
+        self.assertIsNone(load_event(path, cleaning="core20"))
+
+    def test_convert_event_files(self):
+        record_paths = convert_event_files(self.paths)
+        for path, record_path in zip(self.paths, record_paths):
+            self.assertEqual(load_event(record_path)[:3], load_event(path)[:3])
+        preprocessor = EventFilePreprocessor(config=self.configuration)
+        pipeline = EventFilePipeline(preprocessor, final_slices=3)
+        np.testing.assert_array_equal(
+            pipeline.process(record_paths)[0], pipeline.process(self.paths)[0]
+        )
+
+
+class TestEventCatalog(unittest.TestCase):
+    setUp = TestEventFilePipeline.setUp
+    tearDown = TestEventFilePipeline.tearDown
+
+    def test_update(self):
+        catalog = EventCatalog(os.path.join(self.directory, "catalog.sqlite"))
+        self.assertEqual(catalog.update(self.paths, particle="gamma", processes=1), 4)
+        self.assertEqual(catalog.update(self.paths, particle="gamma", processes=1), 0)
+        with open(self.paths[0], "ab") as event_file:
+            event_file.write(b"\0")
+        self.assertEqual(catalog.update(self.paths, particle="gamma", processes=1), 1)
+        self.assertEqual(len(catalog), 4)
+
+        preprocessor = EventFilePreprocessor(config=self.configuration)
+        windows = catalog.time_windows(self.paths)
+        for path in self.paths:
+            np.testing.assert_allclose(
+                windows[path], preprocessor.dynamic_size(load_event(path)[0][0])
+            )
+        self.assertEqual(
+            sorted(
+                catalog.names(split="train")
+                + catalog.names(split="val")
+                + catalog.names(split="test")
+            ),
+            sorted(catalog.names(split="all")),
+        )
+        self.assertEqual(catalog.names(particle="proton"), [])
+        self.assertEqual(catalog.paths(cleaning="core20"), [])
+        self.assertEqual(catalog.names(extracted=True), [])
+        self.assertEqual(len(catalog.names(fraction=0.5, seed=1)), 2)
+
+    def test_directory(self):
+        # _ and % are not wildcards, and the case matters
+        paths = []
+        for index, name in enumerate(["run_1", "runX1", "RUN_1", "run%1"]):
+            os.makedirs(os.path.join(self.directory, name))
+            paths.append(os.path.join(self.directory, name, "event"))
+            shutil.copy(self.paths[index], paths[-1])
+        catalog = EventCatalog(os.path.join(self.directory, "catalog.sqlite"))
+        catalog.update(paths, particle="gamma", processes=1)
+        for path in paths:
+            self.assertEqual(
+                catalog.paths(directory=os.path.dirname(path)), [os.path.abspath(path)]
+            )
+        self.assertEqual(len(catalog.paths(directory=self.directory)), 4)
+        self.assertEqual(catalog.paths(cleaning="no_clea_"), [])
+        self.assertEqual(len(catalog.paths(cleaning="no_clean")), 4)
+
+
+class TestDL2Index(unittest.TestCase):
+    def test_same_as_isclose(self):
+        rng = np.random.RandomState(0)
+        table = {
+            "run_id": rng.randint(0, 20, 1000),
+            "energy": rng.uniform(100.0, 1000.0, 1000),
+            "cog_x": rng.normal(size=1000),
+        }
+        # A second row within the tolerance of the same run, after the first one
+        table["run_id"][10] = table["run_id"][5]
+        table["energy"][10] = table["energy"][5] * (1 + 1e-6)
+        index = DL2Index.from_table(table, ["cog_x"], ["run_id"], close="energy")
+        runs = np.append(table["run_id"][:100], 50)
+        energies = np.append(table["energy"][:100] * (1 + 2e-6), 200.0)
+        energies[:50] += 1.0
+        positions = index.lookup(runs, energies)
+        for event, position in enumerate(positions):
+            matches = np.flatnonzero(
+                np.isclose(table["energy"], energies[event])
+                & (table["run_id"] == runs[event])
+            )
+            if len(matches) == 0:
+                self.assertEqual(position, -1)
+            else:
+                self.assertEqual(index["cog_x"][position], table["cog_x"][matches[0]])
+        self.assertEqual(
+            index.find(table["run_id"][10], table["energy"][10])["cog_x"],
+            table["cog_x"][5],
+        )
+
+
+class TestEventCache(unittest.TestCase):
+    setUp = TestEventFilePipeline.setUp
+    tearDown = TestEventFilePipeline.tearDown
+
+    def test_cache_events(self):
+        path = os.path.join(self.directory, "sim.phs.jsonl.gz")
+        for source in (path, os.path.join(self.directory, "sim.ch.gz")):
+            open(source, "wb").close()
+        cache_directory = os.path.join(self.directory, "cache")
+        cache = simulation_cache_path(
+            path, os.path.join(self.directory, "sim.ch.gz"), cache_directory
+        )
+        rng = np.random.RandomState(0)
+        events = []
+        for index in range(3):
+            arrivals, offsets = photons.flatten_photon_streams(
+                [[list(rng.randint(0, 100, rng.poisson(0.5))) for _ in range(1440)]]
+            )
+            events.append(
+                CachedEvent(
+                    CachedPhotonStream(arrivals, offsets),
+                    10.0 * index,
+                    5.0,
+                    SimulationTruth(1, index, 0, AirShowerTruth(100.0, 0.1, 0.2)),
+                )
+            )
+        # Stopping early does not keep a partial cache
+        next(cache_events(iter(events), cache))
+        self.assertFalse(os.path.exists(cache))
+        self.assertEqual(len(list(cache_events(iter(events), cache))), 3)
+
+        self.assertEqual(count_simulation_events(path, None, cache_directory), 3)
+        for event, cached in zip(
+            events, simulation_events(path, None, cache_directory)
+        ):
+            np.testing.assert_array_equal(
+                event.photon_stream.raw, cached.photon_stream.raw
+            )
+            self.assertEqual(
+                event.photon_stream.list_of_lists, cached.photon_stream.list_of_lists
+            )
+            self.assertEqual(event.zd, cached.zd)
+            self.assertEqual(event.simulation_truth, cached.simulation_truth)
+
+        # Another process caching the same file finished first
+        self.assertEqual(len(list(cache_events(iter(events), cache))), 3)
+        self.assertEqual(os.listdir(os.path.dirname(cache)), [os.path.basename(cache)])
+
+        # Cleaning sets the raw photons of the event
+        photon_stream = cached.photon_stream
+        kept = photons.select_photons(
+            photon_stream.arrivals,
+            photon_stream.offsets,
+            np.arange(photon_stream.number_photons) % 2 == 0,
+        )
+        photon_stream.raw = photons.to_raw(*kept)
+        self.assertEqual(
+            photon_stream.list_of_lists, photons.to_list_of_lists(*kept)[0]
+        )
+
+
+class TestGzipIndex(unittest.TestCase):
+    setUp = TestEventFilePipeline.setUp
+    tearDown = TestEventFilePipeline.tearDown
+
+    def test_random_access(self):
+        path = os.path.join(self.directory, "events.phs.jsonl.gz")
+        events = [{"Event": index, "Photons": [index] * index} for index in range(50)]
+        with gzip.open(path, "wb") as event_file:
+            for event in events:
+                event_file.write((json.dumps(event) + "\n").encode())
+        reader = IndexedGzipReader(path)
+        self.assertEqual(len(reader), 50)
+        self.assertEqual(reader.event(42), events[42])
+        self.assertTrue(os.path.isfile(path + ".idx.npz"))
+        self.assertEqual(len(load_gzip_index(path)), 50)
+        reader.close()
+        # The whole plain file is one member
+        self.assertRaises(ValueError, IndexedGzipReader, path, max_member_size=1000)
+
+        block_path = os.path.join(self.directory, "block.phs.jsonl.gz")
+        index = recompress_block_gzip(path, block_path, lines_per_member=4)
+        self.assertEqual(len(index.member_offsets), 14)
+        with gzip.open(block_path, "rb") as block_file, gzip.open(path) as event_file:
+            self.assertEqual(block_file.read(), event_file.read())
+        np.testing.assert_array_equal(
+            build_gzip_index(block_path).member_offsets, index.member_offsets
+        )
+        reader = IndexedGzipReader(block_path)
+        self.assertEqual(reader.index.members(42), (10, 11))
+        lines = reader.lines([30, 3, 49])
+        self.assertEqual(
+            [json.loads(line) for line in lines], [events[30], events[3], events[49]]
+        )
+        reader.close()
+
+
+class TestPhotonStreamFiles(unittest.TestCase):
+    setUp = TestEventFilePipeline.setUp
+    tearDown = TestEventFilePipeline.tearDown
+
+    def test_find_photon_stream_files(self):
+        for name in [
+            "a.phs.jsonl.gz",
+            "a.phs.gz",
+            "b.phs.jsonl.gz",
+            "b.ch.gz",
+            "c.phs.gz",
+        ]:
+            open(os.path.join(self.directory, name), "wb").close()
+
+        def names(paths):
+            return sorted(os.path.basename(path) for path in paths)
+
+        self.assertEqual(
+            names(find_photon_stream_files([self.directory])),
+            ["a.phs.gz", "b.phs.jsonl.gz", "c.phs.gz"],
+        )
+        self.assertEqual(
+            names(find_photon_stream_files([self.directory], binary=False)),
+            ["a.phs.jsonl.gz", "b.phs.jsonl.gz"],
+        )
+        self.assertEqual(
+            binary_path(os.path.join(self.directory, "b.phs.jsonl.gz"), "out"),
+            os.path.join("out", "b.phs.gz"),
+        )
+
+
+class RowsPreprocessor(BasePreprocessor):
+    data_format = {"Image": 0, "Energy": 1}
+
+    def batch_processor(self, chunk_size=None, failing=None):
+        return self.batches(partial(self.file_rows, failing=failing), chunk_size)
+
+    def file_rows(self, file, failing=None):
+        rng = np.random.RandomState(int(file))
+        for event in range(int(file)):
+            if file == failing and event == 3:
+                raise IOError("Stopped")
+            photon_stream = [list(rng.randint(0, 60, size=3)) for _ in range(1440)]
+            yield [photon_stream, int(file) * 100 + event]
+
+
+class TestCreateDataset(unittest.TestCase):
+    setUp = TestEventFilePipeline.setUp
+    tearDown = TestEventFilePipeline.tearDown
+
+    def test_resume(self):
+        output_file = os.path.join(self.directory, "output.hdf5")
+        preprocessor = RowsPreprocessor(
+            config={"paths": ["5", "7"], "rebin_size": 5, "shape": [10, 40]}
+        )
+        with self.assertRaises(IOError):
+            create_dataset(
+                preprocessor, output_file, chunk_size=2, processes=1, failing="7"
+            )
+        # Only the events of the first file are kept, and the second is converted again
+        self.assertEqual(
+            create_dataset(preprocessor, output_file, chunk_size=2, processes=1), 12
+        )
+        with h5py.File(output_file, "r") as hdf:
+            self.assertEqual(number_of_rows(hdf), 12)
+            self.assertEqual(hdf["Image"].shape, (12, 30, 5, 5))
+            self.assertEqual(hdf["Image"].chunks, (1, 30, 5, 5))
+            np.testing.assert_array_equal(
+                hdf["Energy"][:], [500, 501, 502, 503, 504] + list(range(700, 707))
+            )
+            images = hdf["Image"][5:7]
+        rows = list(preprocessor.file_rows("7"))[:2]
+
+        def file_rows(file):
+            return rows
+
+        chunk = next(preprocessor.batches(file_rows, chunk_size=2))
+        np.testing.assert_allclose(images, chunk[0], rtol=1e-6)
+
+    def assertSameRows(self, output_file, expected_file):
+        """
+        Checks that output_file has the rows of expected_file, in any order
+        """
+        with h5py.File(output_file, "r") as hdf, h5py.File(
+            expected_file, "r"
+        ) as expected:
+            self.assertEqual(number_of_rows(hdf), number_of_rows(expected))
+            self.assertEqual(hdf["Energy"].shape, expected["Energy"].shape)
+            order = np.argsort(hdf["Energy"][:])
+            expected_order = np.argsort(expected["Energy"][:])
+            np.testing.assert_array_equal(
+                hdf["Energy"][:][order], expected["Energy"][:][expected_order]
+            )
+            np.testing.assert_array_equal(
+                hdf["Image"][:][order], expected["Image"][:][expected_order]
+            )
+
+    def test_processes(self):
+        expected_file = os.path.join(self.directory, "expected.hdf5")
+        output_file = os.path.join(self.directory, "output.hdf5")
+        preprocessor = RowsPreprocessor(
+            config={"paths": ["5", "7", "3"], "rebin_size": 5, "shape": [10, 40]}
+        )
+        self.assertEqual(
+            create_dataset(preprocessor, expected_file, chunk_size=2, processes=1), 15
+        )
+        self.assertEqual(
+            create_dataset(preprocessor, output_file, chunk_size=2, processes=2), 15
+        )
+        self.assertSameRows(output_file, expected_file)
+
+        # A failed file stops the conversion, and only it is converted again
+        output_file = os.path.join(self.directory, "failed.hdf5")
+        with self.assertRaises(IOError):
+            create_dataset(
+                preprocessor, output_file, chunk_size=2, processes=2, failing="7"
+            )
+        self.assertEqual(
+            create_dataset(preprocessor, output_file, chunk_size=2, processes=2), 15
+        )
+        self.assertSameRows(output_file, expected_file)
+
+    def test_resume_partial(self):
+        expected_file = os.path.join(self.directory, "expected.hdf5")
+        output_file = os.path.join(self.directory, "output.hdf5")
+        preprocessor = RowsPreprocessor(
+            config={"paths": ["5", "7", "3"], "rebin_size": 5, "shape": [10, 40]}
+        )
+        create_dataset(preprocessor, expected_file, chunk_size=2, processes=1)
+        create_dataset(preprocessor, output_file, chunk_size=2, processes=1)
+        # As if the conversion stopped before the second file was marked complete, after the third was written
+        with h5py.File(output_file, "a", libver="latest") as hdf:
+            hdf["sources/complete"][1] = False
+        with h5py.File(output_file, "r") as hdf:
+            self.assertEqual(number_of_rows(hdf), 15)
+
+        self.assertEqual(
+            create_dataset(preprocessor, output_file, chunk_size=2, processes=1), 15
+        )
+        with h5py.File(output_file, "r") as hdf:
+            # The rows of the third file are moved down, and the second is appended again
+            np.testing.assert_array_equal(
+                hdf["Energy"][:],
+                list(range(500, 505)) + list(range(300, 303)) + list(range(700, 707)),
+            )
+            self.assertTrue(hdf["sources/complete"][:].all())
+        self.assertSameRows(output_file, expected_file)
+
+    def test_batch_reader(self):
+        output_file = os.path.join(self.directory, "output.hdf5")
+        preprocessor = RowsPreprocessor(
+            config={"paths": ["9", "8"], "rebin_size": 5, "shape": [10, 40]}
+        )
+        create_dataset(preprocessor, output_file, chunk_size=4, processes=1)
+        with h5py.File(output_file, "r") as hdf:
+            images = hdf["Image"][:, 2:7]
+        indices = np.random.RandomState(0).permutation(17)[:13]
+        reader = HDF5BatchReader(
+            output_file, indices, 4, 2, 5, block_size=4, buffer_blocks=2
+        )
+        self.assertEqual(len(reader), 3)
+        for epoch in range(2):
+            rows = []
+            for step in range(len(reader)):
+                batch, batch_rows = next(reader)
+                np.testing.assert_array_equal(batch, images[batch_rows])
+                rows.extend(batch_rows)
+            # Each epoch only has whole batches, without repeating any event
+            self.assertEqual(len(set(rows)), 12)
+            self.assertTrue(set(rows) <= set(indices))
+
+        reader = HDF5BatchReader(output_file, indices, 4, 2, 5, shuffle=False)
+        first_epoch = [next(reader)[1] for step in range(len(reader))]
+        np.testing.assert_array_equal(
+            np.concatenate(first_epoch), np.sort(indices)[:12]
+        )
+        np.testing.assert_array_equal(next(reader)[1], first_epoch[0])
+        reader.close()
 
 
 class TestProtonPreprocessor(unittest.TestCase):
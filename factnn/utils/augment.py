@@ -605,6 +605,41 @@ def get_chunk_from_list(
             )
 
 
+def get_batch_from_readers(
+    reader,
+    proton_reader=None,
+    labels=None,
+    augment=True,
+    swap=True,
+    shape=None,
+):
+    """
+    Gets the next batch from HDF5BatchReaders, which keep the files open and read them block by block, in place of
+    opening the files for every batch as the other functions do
+
+    :param reader: HDF5BatchReader of the gamma file
+    :param proton_reader: HDF5BatchReader of the proton file, if any
+    :param labels: Labels of the rows of the gamma file, if there is no proton file
+    :param augment: Whether to randomly flip and rotate the images
+    :param swap: Whether to shuffle the events of the batch
+    :param shape: Shape to reshape the images to
+    :return:
+    """
+    batch_images, positions = next(reader)
+    proton_images = None
+    if proton_reader is not None:
+        proton_images, _ = next(proton_reader)
+    return common_step(
+        batch_images,
+        positions,
+        labels=labels,
+        proton_images=proton_images,
+        augment=augment,
+        swap=swap,
+        shape=shape,
+    )
+
+
 def euclidean_distance(x1, y1, x2, y2):
     return np.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
 
@@ -667,45 +702,8 @@ def get_random_from_paths(
             processed_data, data_format = next(preprocessor)
         training_data.append(processed_data)
     # Use the type of data to determine what to keep
-    if type_training == "Separation":
-        training_data = [item[data_format["Image"]] for item in training_data]
-    elif type_training == "Energy":
-        labels = [item[data_format["Energy"]] for item in training_data]
-        labels = np.array(labels)
-        training_data = [item[data_format["Image"]] for item in training_data]
-    elif type_training == "Disp":
-        labels = [
-            euclidean_distance(
-                item[data_format["Source_X"]],
-                item[data_format["Source_Y"]],
-                item[data_format["COG_X"]],
-                item[data_format["COG_Y"]],
-            )
-            for item in training_data
-        ]
-        labels = np.array(labels)
-        training_data = [item[data_format["Image"]] for item in training_data]
-    elif type_training == "Sign":
-        labels = [
-            true_sign(
-                item[data_format["Source_X"]],
-                item[data_format["Source_Y"]],
-                item[data_format["COG_X"]],
-                item[data_format["COG_Y"]],
-                item[data_format["Delta"]],
-            )
-            for item in training_data
-        ]
-        labels = np.array(labels)
-        # Create own categorical one since only two sides anyway
-        new_labels = np.zeros((labels.shape[0], 2))
-        for index, element in enumerate(labels):
-            if element < 0:
-                new_labels[index][0] = 1.0
-            else:
-                new_labels[index][1] = 1.0
-        labels = new_labels
-        training_data = [item[data_format["Image"]] for item in training_data]
+    labels = get_training_labels(training_data, data_format, type_training)
+    training_data = [item[data_format["Image"]] for item in training_data]
 
     training_data = np.array(training_data)
     training_data = training_data.reshape(
@@ -1023,6 +1021,49 @@ def augment_pointcloud_batch(
         )
 
 
+def get_training_labels(training_data, data_format, type_training):
+    """
+    Gets the labels of a batch of events for the type of training
+    :param training_data: List of the data of each event, indexed with data_format
+    :param data_format: Dict of the name to the index in the data of each event
+    :param type_training: One of 'Separation', 'Energy', 'Disp', or 'Sign'
+    :return: Array of labels, or None for 'Separation', where the labels depend on the type of the events instead
+    """
+    if type_training == "Energy":
+        return np.array([item[data_format["Energy"]] for item in training_data])
+    elif type_training == "Disp":
+        return np.array(
+            [
+                euclidean_distance(
+                    item[data_format["Source_X"]],
+                    item[data_format["Source_Y"]],
+                    item[data_format["COG_X"]],
+                    item[data_format["COG_Y"]],
+                )
+                for item in training_data
+            ]
+        )
+    elif type_training == "Sign":
+        labels = np.array(
+            [
+                true_sign(
+                    item[data_format["Source_X"]],
+                    item[data_format["Source_Y"]],
+                    item[data_format["COG_X"]],
+                    item[data_format["COG_Y"]],
+                    item[data_format["Delta"]],
+                )
+                for item in training_data
+            ]
+        )
+        # Create own categorical one since only two sides anyway
+        new_labels = np.zeros((labels.shape[0], 2))
+        new_labels[labels < 0, 0] = 1.0
+        new_labels[labels >= 0, 1] = 1.0
+        return new_labels
+    return None
+
+
 def augment_image_batch(
     images,
     proton_images=None,
@@ -1063,7 +1104,6 @@ def augment_image_batch(
         feature_index = -99
         collapsed_index = -99
 
-    labels = None
     data_format = images[0][1]
     training_data = [item[0] for item in images]
     if return_features:
@@ -1072,46 +1112,8 @@ def augment_image_batch(
         collapsed_list = [item[collapsed_index] for item in images]
 
     # Use the type of data to determine what to keep
-    if type_training == "Separation":
-        training_data = [item[data_format["Image"]] for item in training_data]
-    elif type_training == "Energy":
-        labels = [item[data_format["Energy"]] for item in training_data]
-        labels = np.array(labels)
-        training_data = [item[data_format["Image"]] for item in training_data]
-    elif type_training == "Disp":
-        labels = [
-            euclidean_distance(
-                item[data_format["Source_X"]],
-                item[data_format["Source_Y"]],
-                item[data_format["COG_X"]],
-                item[data_format["COG_Y"]],
-            )
-            for item in training_data
-        ]
-        labels = np.array(labels)
-        training_data = [item[data_format["Image"]] for item in training_data]
-    elif type_training == "Sign":
-        labels = [
-            true_sign(
-                item[data_format["Source_X"]],
-                item[data_format["Source_Y"]],
-                item[data_format["COG_X"]],
-                item[data_format["COG_Y"]],
-                item[data_format["Delta"]],
-            )
-            for item in training_data
-        ]
-        training_data = [item[data_format["Image"]] for item in training_data]
-        labels = np.array(labels)
-        # Create own categorical one since only two sides anyway
-        new_labels = np.zeros((labels.shape[0], 2))
-        for index, element in enumerate(labels):
-            if element < 0:
-                new_labels[index][0] = 1.0
-            else:
-                new_labels[index][1] = 1.0
-        labels = new_labels
-        training_data = [item[data_format["Image"]] for item in training_data]
+    labels = get_training_labels(training_data, data_format, type_training)
+    training_data = [item[data_format["Image"]] for item in training_data]
 
     training_data = np.array(training_data)
     training_data = training_data.reshape(
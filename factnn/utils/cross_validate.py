@@ -48,6 +48,26 @@ def split_data(indicies, kfolds, seed=None):
     return list_of_training, list_of_validate, list_of_testing
 
 
+def collect_paths(directories, catalog=None):
+    """
+    Paths of all the Eventfiles in the directories
+
+    :param directories: Directories to take the Eventfiles from
+    :param catalog: Optional EventCatalog of the directories, if given the paths are taken from it instead of walking
+    the directories, leaving out empty and unreadable Eventfiles
+    :return: List of paths
+    """
+    paths = []
+    for source_dir in directories:
+        if catalog is not None:
+            paths += catalog.paths(directory=source_dir)
+            continue
+        for root, dirs, files in os.walk(source_dir):
+            for file in files:
+                paths.append(os.path.join(root, file))
+    return paths
+
+
 def data(
     start_slice,
     end_slice,
@@ -267,6 +287,7 @@ def get_data_generators(
     return_collapsed=False,
     return_features=False,
     kfolds=5,
+    catalog=None,
 ):
     """
     This is to obtain just the generators, for when cross-validation not needed
@@ -285,25 +306,18 @@ def get_data_generators(
     :param max_elements:
     :param return_collapsed:
     :param return_features:
+    :param catalog: Optional EventCatalog of the directories to take the paths from, instead of walking them
     :return: Returns images and labels, to be split with the Keras validation split
     """
 
-    paths = []
-    for source_dir in directory:
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                paths.append(os.path.join(root, file))
+    paths = collect_paths(directory, catalog)
     if max_elements is not None:
         paths = shuffle(paths)
         paths = paths[0:max_elements]
     gamma_paths = split_data(paths, kfolds=kfolds, seed=seed)
 
     if model_type == "Separation":
-        proton_paths = []
-        for source_dir in proton_directory:
-            for root, dirs, files in os.walk(source_dir):
-                for file in files:
-                    proton_paths.append(os.path.join(root, file))
+        proton_paths = collect_paths(proton_directory, catalog)
         if max_elements is not None:
             proton_paths = shuffle(proton_paths)
             proton_paths = proton_paths[0:max_elements]
@@ -364,6 +378,7 @@ def get_chunk_of_data(
     max_elements=None,
     return_collapsed=False,
     return_features=False,
+    catalog=None,
 ):
     """
     This is to obtain a single chunk of data, for situations where generators should not be used, only need a single block of data
@@ -383,25 +398,18 @@ def get_chunk_of_data(
     :param max_elements:
     :param return_collapsed:
     :param return_features:
+    :param catalog: Optional EventCatalog of the directories to take the paths from, instead of walking them
     :return: Returns images and labels, to be split with the Keras validation split
     """
 
-    paths = []
-    for source_dir in directory:
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                paths.append(os.path.join(root, file))
+    paths = collect_paths(directory, catalog)
     if max_elements is not None:
         paths = shuffle(paths)
         paths = paths[0:max_elements]
     gamma_paths = split_data(paths, kfolds=2, seed=seed)
 
     if model_type == "Separation":
-        proton_paths = []
-        for source_dir in proton_directory:
-            for root, dirs, files in os.walk(source_dir):
-                for file in files:
-                    proton_paths.append(os.path.join(root, file))
+        proton_paths = collect_paths(proton_directory, catalog)
         if max_elements is not None:
             proton_paths = shuffle(proton_paths)
             proton_paths = proton_paths[0:max_elements]
@@ -473,6 +481,7 @@ def cross_validate(
     return_collapsed=False,
     return_features=False,
     plot=False,
+    catalog=None,
 ):
     """
 
@@ -489,25 +498,18 @@ def cross_validate(
     :param workers: Number of worker threads for the fitting and evaluation
     :param verbose: How verbose the fitting and evaluation should be
     :param plot: Whether to plot the output or not
+    :param catalog: Optional EventCatalog of the directories to take the paths from, instead of walking them
     :return:
     """
 
-    paths = []
-    for source_dir in directory:
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                paths.append(os.path.join(root, file))
+    paths = collect_paths(directory, catalog)
     if max_elements is not None:
         paths = shuffle(paths)
         paths = paths[0:max_elements]
     gamma_paths = split_data(paths, kfolds=kfolds, seed=seed)
 
     if model_type == "Separation":
-        proton_paths = []
-        for source_dir in proton_directory:
-            for root, dirs, files in os.walk(source_dir):
-                for file in files:
-                    proton_paths.append(os.path.join(root, file))
+        proton_paths = collect_paths(proton_directory, catalog)
         if max_elements is not None:
             proton_paths = shuffle(proton_paths)
             proton_paths = proton_paths[0:max_elements]
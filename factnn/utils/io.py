@@ -1,4 +1,5 @@
 from factnn import ProtonPreprocessor, GammaPreprocessor, GammaDiffusePreprocessor
+from factnn.data.dataset.photon_stream_files import find_photon_stream_files
 import os
 from multiprocessing import Pool
 from functools import partial
@@ -14,12 +15,7 @@ def convert_to_eventfiles(
     threads=4,
 ):
     # Get paths from the directories
-    source_paths = []
-    for source_dir in directory:
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                if file.endswith("phs.jsonl.gz"):
-                    source_paths.append(os.path.join(root, file))
+    source_paths = find_photon_stream_files(directory)
 
     def f(clump_size, path):
         print("Gamma")
@@ -10,7 +10,8 @@ setup(
     download_url="https://github.com/jacobbieker/factnn/archive/v0.5.0.tar.gz",
     keywords=["IACT Astronomy", "FACT", "Machine Learning", "Tensorflow"],
     packages=find_packages(),
-    install_requires=["astropy", "numpy"],
+    package_data={"factnn.data.resources": ["rebinning.npz"]},
+    install_requires=["astropy", "numpy", "shapely>=2"],
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Developers",